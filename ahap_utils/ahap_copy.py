@@ -10,7 +10,6 @@ import argparse
 import copy
 import platform
 import os
-import shutil
 import sys
 
 import geopandas as gpd
@@ -20,6 +19,8 @@ import geopandas as gpd
 from selection_utils.query_danco import query_footprint
 from misc_utils.id_parse_utils import read_ids
 from misc_utils.logging_utils import create_logger
+from misc_utils.transfer import transfer_files, DirListing, COPY, LINK, \
+    JOURNAL_NAME
 
 
 ### Inputs
@@ -135,7 +136,7 @@ def main(selection, destination, source_loc, high_res, med_res, tm,
                 
     
     def find_server_location(row):
-        if os.path.exists(row[SERVER_PATH]):
+        if listing.exists(row[SERVER_PATH]):
             filepath = row[SERVER_PATH]
         else:
             filepath = NOT_MOUNTED
@@ -251,7 +252,9 @@ def main(selection, destination, source_loc, high_res, med_res, tm,
     # Create full destination path
     aia[DST_PATH] = aia.apply(lambda x: os.path.join(destination, x[RELATIVE_PATH]), axis=1)
     # Check if destination exists
-    aia[DST_EXISTS] = aia[DST_PATH].apply(lambda x: os.path.exists(x))
+    # Each directory is listed once rather than checking each file
+    listing = DirListing()
+    aia[DST_EXISTS] = aia[DST_PATH].apply(listing.exists)
     
 
     if source_loc == FROM_DRIVE:
@@ -326,29 +329,17 @@ def main(selection, destination, source_loc, high_res, med_res, tm,
         wc = open(write_copied, wc_open_mode)
     
     ## Copy loop
-    # progress bar setup
-    # manager = enlighten.get_manager()
-    # pbar = manager.counter(total=len(aia_mounted[SRC_PATH]), desc='Copying:', unit='files')
     logger.info('Copying files from {} to {}...'.format(source_loc, destination))
-    for src, dst in zip(aia_mounted[SRC_PATH], aia_mounted[DST_PATH]):
-        # Make directory tree if necessary
-        dst_dir = os.path.dirname(dst)
-        if not os.path.exists(dst_dir):
-            logger.debug('Making directories: \n{}'.format(dst_dir))
-            os.makedirs(dst_dir)
-        if not os.path.exists(dst):
-            logger.debug('Copying \n{} -> \n{}\n'.format(src, dst))
-            if not dryrun:
-                if tm == tm_copy:
-                    shutil.copyfile(src, dst)
-                elif tm == tm_link:
-                    os.link(src, dst)
-                if write_copied:
-                    wc.write(os.path.basename(src).split('.')[0])
-                    wc.write('\n')
-        else:
-            logger.debug('Destination file already exists, skipping: \n{}\n{}'.format(src, dst))
-        # pbar.update()
+    # Journal of completed transfers in the destination, so an interrupted
+    # copy resumes without re-checking every file
+    journal = None if dryrun else os.path.join(destination, JOURNAL_NAME)
+    results = transfer_files(zip(aia_mounted[SRC_PATH], aia_mounted[DST_PATH]),
+                             method=LINK if tm == tm_link else COPY,
+                             journal=journal, dryrun=dryrun)
+    if write_copied and not dryrun:
+        for src, dst in results['transferred']:
+            wc.write(os.path.basename(src).split('.')[0])
+            wc.write('\n')
     if write_copied:
         wc.close()
 
@@ -13,17 +13,16 @@ import logging
 import posixpath
 import os
 import sys
-import shutil
 import subprocess
 
 import numpy as np
 import pandas as pd
 import geopandas as gpd
-from tqdm import tqdm
 #from tqdm.auto import tqdm
 
 from query_danco import query_footprint
 from logging_utils import create_logger
+from transfer import transfer_files, DirListing, JOURNAL_NAME
 
 
 # # # INPUTS
@@ -223,7 +222,8 @@ def ahap_upload(server_loc, prj_dir, drives=None, skip_log=False, drive_loc=None
     logger.debug('Server paths found: {}'.format(len(master_df[master_df['server_path']==''])))
     
     #### Check for existence on server
-    ## TODO: speed this up - bottleneck - checking log first is an attempt to speed up the server check
+    # Each server directory is listed once rather than checking each file
+    listing = DirListing()
     logger.info('Checking for existence of drive imagery on server...')
     if skip_log:
         master_df['online'] = False
@@ -231,7 +231,7 @@ def ahap_upload(server_loc, prj_dir, drives=None, skip_log=False, drive_loc=None
         # Check if filenames are in log of what has been uploaded
         master_df['online'] = np.where(master_df['filename'].isin(uploaded), True, False)
     # Check the rest of the filenames against what is actually on server
-    master_df['online'] = master_df[master_df['online']==False]['server_path'].apply(lambda x: os.path.exists(x))
+    master_df['online'] = master_df[master_df['online']==False]['server_path'].apply(listing.exists)
     
     ## Select files that are not online by either test (upload log and existence on server)
     offline = master_df[master_df['online']==False]
@@ -244,6 +244,9 @@ def ahap_upload(server_loc, prj_dir, drives=None, skip_log=False, drive_loc=None
     #### Copy missing paths to server
     # Open list of uploaded files
     logger.info('Beginning upload to {}'.format(server_loc))
+    # Journal of completed transfers on the server, so an interrupted upload
+    # resumes without re-checking every file
+    journal = None if dryrun else os.path.join(server_loc, JOURNAL_NAME)
     with open(upload_log, 'a') as ul:
         for letter_drive in offline['drive'].unique():
             # Count of total offline files for progress bar
@@ -254,27 +257,16 @@ def ahap_upload(server_loc, prj_dir, drives=None, skip_log=False, drive_loc=None
                                                                       offline_count))
             logger.info('Transfering from drive: {} ({})'.format(letter_drive[:2], usgs_drive))
             # Do the actual copying to the server
-            for src, dst in tqdm(zip(offline[offline['drive']==letter_drive]['src'], 
-                                     offline[offline['drive']==letter_drive]['server_path']),
-                                 total=offline_count):
-                # Make directory tree if necessary
-                dst_dir = os.path.dirname(dst)
-                if not os.path.exists(dst_dir):
-                    logger.debug('Making directories: {}'.format(dst_dir))
-                    if not dryrun:
-                        os.makedirs(dst_dir)
-                logger.debug('Copying {} \n to {}'.format(src, dst))
+            drive_offline = offline[offline['drive']==letter_drive]
+            results = transfer_files(zip(drive_offline['src'],
+                                         drive_offline['server_path']),
+                                     journal=journal, dryrun=dryrun)
+            for src, dst in results['transferred']:
                 if not dryrun:
-                    try:
-                        shutil.copyfile(src, dst)
-                    except PermissionError:
-                        logger.debug('Permission error on {}'.format(os.path.basename(dst)))
-                    if os.path.exists(dst):
-                        logger.debug('{} uploaded successfully'.format(dst))
-                        ul.write(src)
-                        ul.write('\n')
-    
-                # TODO os.stat to confirm transfer?
+                    ul.write(src)
+                    ul.write('\n')
+            for src, dst, e in results['failed']:
+                logger.debug('Failed to upload {}: {}'.format(os.path.basename(dst), e))
             logger.info('Completed transferring: {}'.format(letter_drive[:2]))
 
 
@@ -308,8 +300,9 @@ def ahap_upload_status(server_loc):
                           aia.apply(lambda x: det_server_path(x), axis=1))
     
     # Check for existence
+    listing = DirListing()
     aia['online'] = False
-    aia['online'] = aia[aia['online']==False]['server_path'].apply(lambda x: os.path.exists(x))
+    aia['online'] = aia[aia['online']==False]['server_path'].apply(listing.exists)
     
     return aia
 
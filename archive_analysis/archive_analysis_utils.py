@@ -17,6 +17,7 @@ from shapely.geometry import Point, Polygon, box
 import geopandas as gpd
 import pandas as pd
 
+from archive_analysis.grid_count import grid_points, grid_cells, footprint_counts
 from selection_utils.query_danco import query_footprint
 # from misc_utils.get_bounding_box import get_bounding_box
 # from range_creation import range_tuples
@@ -62,38 +63,14 @@ def grid_aoi(aoi_path, n_pts_x=None, n_pts_y=None,
         y_space = y_range / n_pts_y
     logger.debug('Grid spacing\nx: {}\ny: {}'.format(round(x_space, 2), round(y_space, 2)))
 
-    # Create x,y Point geometries
-    x_pts = np.arange(minx, maxx, step=x_space)
-    y_pts = np.arange(miny, maxy, step=y_space)
-    mesh = np.array(np.meshgrid(x_pts, y_pts))
-    xys = mesh.T.reshape(-1, 2)
-    grid_points = [Point(x, y) for (x, y) in xys]
-
-    # Make geodataframe of Point geometries
-    grid = gpd.GeoDataFrame(geometry=grid_points, crs=aoi.crs)
-
-    # Remove any grid points that do not fall in actual feature aoi_all
-    grid['in'] = [pt.within(aoi.geometry.iloc[0]) for pt in grid.geometry]
-
-    grid = grid[grid['in'] == True].drop(columns=['in'])
+    # Create x,y Point geometries, keeping those in the feature
+    grid = grid_points(aoi.geometry.iloc[0], x_space, y_space, crs=aoi.crs)
 
     if poly:
         logger.debug('Creating polygon grid...')
-        x_pts = sorted(set(grid.geometry.values.x))
-        y_pts = sorted(set(grid.geometry.values.y))
-
-        all_cells = []
-        for i, x in tqdm(enumerate(x_pts), total=len(x_pts)):
-            if i == len(x_pts) - 1:
-                break
-            next_x = x_pts[i + 1]
-            for j, y in enumerate(y_pts):
-                if j == len(y_pts) - 1:
-                    break
-                next_y = y_pts[j + 1]
-                cell = box(x, y, next_x, next_y)
-                all_cells.append(cell)
-        grid = gpd.GeoDataFrame(geometry=all_cells, crs=grid.crs)
+        x_pts = np.unique(grid.geometry.x.values)
+        y_pts = np.unique(grid.geometry.y.values)
+        grid = grid_cells(x_pts, y_pts, crs=grid.crs)
 
     return grid
 
@@ -163,10 +140,8 @@ def grid_aoi(aoi_path, n_pts_x=None, n_pts_y=None,
 def get_count(geocells, fps, date_col=None):
     '''
     Gets the count of features in fps that intersect with each feature in geocells
-    This method is essentially a many to many spatial join, so if two footprints
-    overlaps a grid cell, there will be two of that grid cell in the resulting
-    dataframe. These repeated cells are then counted and saved to the returned
-    dataframe
+    Footprints are matched to features with a bulk spatial index query, see
+    grid_count.footprint_counts.
     
     geocells: geodataframe of features to count within
     fps: geodataframe of polygons
@@ -177,24 +152,16 @@ def get_count(geocells, fps, date_col=None):
         logger.info('Converting crs of grid to match footprint...')
         geocells = geocells.to_crs(fps.crs)
 
-    # TODO: Speed the subsequent spatial join by first intersecting
-    logger.info('Performing spatial join...')
-    ## Get a column from fps to use to test if sjoin found matches
-    fp_col = fps.columns[0]
-    sj = gpd.sjoin(geocells, fps, how='left', op='intersects')
-    sj.index.names = ['count']
-    sj.reset_index(inplace=True)
-    
     logger.info('Getting count...')
-    ## Remove no matches, group the rest, counting the index, and
-    ## get minimum and maximum dates if requested
-    agg = {'count':'count'}
+    counts = footprint_counts(geocells, fps, date_col=date_col)
+    # Cells without footprints are left as NaN
+    counts['count'] = counts['count'].where(counts['count'] > 0)
     if date_col:
-        agg[date_col] = ['min', 'max']
-        
-    gb = sj[~sj[fp_col].isna()].groupby('count').agg(agg)
+        counts.columns = pd.MultiIndex.from_tuples([('count', 'count'),
+                                                    (date_col, 'min'),
+                                                    (date_col, 'max')])
     ## Join geocells to dataframe with counts
-    out = geocells.join(gb)
+    out = geocells.join(counts)
 
     out = gpd.GeoDataFrame(out, geometry=out.geometry, crs=geocells.crs)
 
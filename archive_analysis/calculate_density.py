@@ -13,13 +13,20 @@ import geopandas as gpd
 # from osgeo import gdal
 
 from archive_analysis.archive_analysis_utils import get_count
+from archive_analysis.grid_count import raster_count
 from misc_utils.logging_utils import create_logger
 from selection_utils.query_danco import list_danco_db, query_footprint
 
 
 logger = create_logger(__name__, 'sh', 'INFO')
 
-def calculate_density(grid_p, footprint_p, out_path=None, date_col=None, rasterize=False):
+def calculate_density(grid_p, footprint_p, out_path=None, date_col=None, rasterize=False,
+                      res=None):
+    """
+    Count footprints over each cell of a grid. If rasterize, the footprints
+    are instead burned into a count raster with cells of size res over the
+    bounds of the grid, written to out_path.
+    """
     if not isinstance(grid_p, gpd.GeoDataFrame):
         logger.info('Loading grid...')
         if 'gdb' in grid_p:
@@ -46,23 +53,25 @@ def calculate_density(grid_p, footprint_p, out_path=None, date_col=None, rasteri
         else:
             footprint = gpd.read_file(footprint_p)
 
+    if rasterize:
+        if footprint.crs != grid.crs:
+            footprint = footprint.to_crs(grid.crs)
+        if res is None:
+            # Size of first grid cell
+            minx, miny, maxx, maxy = grid.geometry.iloc[0].bounds
+            res = maxx - minx
+        logger.info('Rasterizing density...')
+        density = raster_count(footprint, res, bounds=grid.total_bounds,
+                               out_path=out_path)
+        return density
+
     logger.info('Calculating density...')
     density = get_count(grid, footprint, date_col=date_col)
     # Convert any tuple columns to strings (occurs with agg-ing same column multiple ways)
     density.columns = [str(x) if type(x) == tuple else x for x in density.columns]
-    if rasterize:
-        logger.info('Rasterizing...')
-        vec_out = '/vsimem/density_temp.shp'
-        density.to_file(vec_out)
-        # TODO: Finish this
-        # rasterize_options = gdal.RasterizeOptions(xRes=, yRes=, )
-        if out_path:
-            1 == 1
-            # Rasterize to out_path
-    else:
-        if out_path:
-            logger.info('Writing density...')
-            density.to_file(out_path)
+    if out_path:
+        logger.info('Writing density...')
+        density.to_file(out_path)
         
     return density
 
@@ -78,6 +87,9 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--rasterize', action='store_true',
                         help="""Use this flag to rasterize the output. out_path must have a GDAL
                                 writable extension.""")
+    parser.add_argument('--res', type=float,
+                        help="""Cell size of the rasterized output, defaults to the
+                                width of the first grid cell.""")
 
     args = parser.parse_args()
 
@@ -86,9 +98,11 @@ if __name__ == '__main__':
     out_path = args.out_path
     date_col = args.date_col
     rasterize = args.rasterize
+    res = args.res
     
     calculate_density(grid_p=grid_p,
                       footprint_p=footprint_p,
                       out_path=out_path,
                       date_col=date_col,
-                      rasterize=rasterize)
+                      rasterize=rasterize,
+                      res=res)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Grids over AOIs and counts of footprints over grid cells. Grid coordinates
+are generated with numpy, points are filtered to the AOI and footprints
+are matched to cells with bulk queries of a spatial index (STRtree), and
+counts and date ranges are aggregated from the resulting index pairs
+rather than from a many-to-many spatial join. Counts can also be burned
+directly into a raster grid.
+"""
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely.geometry import box
+from osgeo import gdal, ogr, osr
+
+from misc_utils.gpd_utils import sindex_pairs
+from misc_utils.logging_utils import create_logger
+
+gdal.UseExceptions()
+ogr.UseExceptions()
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+COUNT = 'count'
+
+
+def boxes(minx, miny, maxx, maxy):
+    """
+    Box polygons from arrays of bounds, vectorised when shapely 2 is
+    available.
+    """
+    if hasattr(shapely, 'box'):
+        return shapely.box(minx, miny, maxx, maxy)
+    return [box(*b) for b in zip(minx, miny, maxx, maxy)]
+
+
+def grid_points(aoi_geom, x_space, y_space, crs=None):
+    """
+    Points spaced x_space, y_space from the lower left of the bounds of
+    aoi_geom, keeping only those within aoi_geom.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+    """
+    minx, miny, maxx, maxy = aoi_geom.bounds
+    x_pts = np.arange(minx, maxx, step=x_space)
+    y_pts = np.arange(miny, maxy, step=y_space)
+    # Ordered x-major, as np.meshgrid(x, y).T
+    xs = np.repeat(x_pts, len(y_pts))
+    ys = np.tile(y_pts, len(x_pts))
+    pts = gpd.GeoDataFrame(geometry=gpd.points_from_xy(xs, ys), crs=crs)
+
+    aoi = gpd.GeoDataFrame(geometry=[aoi_geom], crs=crs)
+    within, _ = sindex_pairs(pts, aoi, predicate='within')
+    pts = pts.iloc[np.unique(within)].reset_index(drop=True)
+
+    return pts
+
+
+def grid_cells(x_pts, y_pts, crs=None):
+    """
+    Polygon cells between consecutive x and y coordinates.
+
+    Parameters
+    ----------
+    x_pts, y_pts : np.array
+        Sorted cell edge coordinates.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+    """
+    x_pts, y_pts = np.asarray(x_pts), np.asarray(y_pts)
+    n_y = max(len(y_pts) - 1, 0)
+    n_x = max(len(x_pts) - 1, 0)
+    # Ordered x-major
+    minx = np.repeat(x_pts[:-1], n_y)
+    maxx = np.repeat(x_pts[1:], n_y)
+    miny = np.tile(y_pts[:-1], n_x)
+    maxy = np.tile(y_pts[1:], n_x)
+
+    return gpd.GeoDataFrame(geometry=boxes(minx, miny, maxx, maxy), crs=crs)
+
+
+def footprint_counts(geocells, fps, date_col=None, centroid=False,
+                     count_field=COUNT):
+    """
+    Count the footprints intersecting each feature in geocells, and the
+    minimum and maximum dates of those footprints.
+
+    Parameters
+    ----------
+    geocells : gpd.GeoDataFrame
+        Features to count within, in the crs of fps.
+    fps : gpd.GeoDataFrame
+        Footprints to count.
+    date_col : str
+        Column in fps with dates to get the minimum and maximum of.
+    centroid : bool
+        Count footprints only where their centroids intersect geocells.
+    count_field : str
+        Name of count column.
+
+    Returns
+    -------
+    pd.DataFrame : indexed as geocells, with count_field and, if date_col,
+    'min' and 'max' columns (NaN where no footprints)
+    """
+    if centroid:
+        fps = fps.set_geometry(fps.centroid)
+    cells, matches = sindex_pairs(geocells, fps, predicate='intersects')
+    logger.debug('Cell-footprint pairs: {:,}'.format(len(cells)))
+
+    counts = pd.DataFrame({count_field: np.bincount(cells,
+                                                    minlength=len(geocells))})
+    if date_col:
+        dates = pd.Series(fps[date_col].values[matches], index=cells)
+        date_range = dates.groupby(level=0).agg(['min', 'max'])
+        counts = counts.join(date_range)
+    counts.index = geocells.index
+
+    return counts
+
+
+def raster_count(fps, res, bounds=None, out_path=None, centroid=False,
+                 dtype=gdal.GDT_UInt16):
+    """
+    Count footprints over a raster grid by burning each footprint into it,
+    adding 1 to every cell whose center it covers.
+
+    Parameters
+    ----------
+    fps : gpd.GeoDataFrame
+        Footprints to count.
+    res : float
+        Cell size, in units of the crs of fps.
+    bounds : tuple
+        (minx, miny, maxx, maxy) of the grid, defaults to the bounds of fps.
+    out_path : str
+        Path to write GeoTiff of counts to, if not provided the counts are
+        returned.
+    centroid : bool
+        Count only the centroids of footprints.
+    dtype : int
+        GDAL data type of counts.
+
+    Returns
+    -------
+    str or np.array : out_path if provided, otherwise array of counts
+    """
+    if bounds is None:
+        bounds = fps.total_bounds
+    minx, miny, maxx, maxy = bounds
+    x_sz = int(np.ceil((maxx - minx) / res))
+    y_sz = int(np.ceil((maxy - miny) / res))
+    geoms = fps.centroid if centroid else fps.geometry
+    srs = osr.SpatialReference()
+    if fps.crs is not None:
+        srs.ImportFromWkt(fps.crs.to_wkt())
+
+    mem_ds = ogr.GetDriverByName('Memory').CreateDataSource('footprints')
+    lyr = mem_ds.CreateLayer('footprints', srs, ogr.wkbUnknown)
+    for g in geoms:
+        if g is None or g.is_empty:
+            continue
+        feat = ogr.Feature(lyr.GetLayerDefn())
+        feat.SetGeometry(ogr.CreateGeometryFromWkb(g.wkb))
+        lyr.CreateFeature(feat)
+        feat = None
+
+    if out_path:
+        driver = gdal.GetDriverByName('GTiff')
+        dst_ds = driver.Create(str(out_path), x_sz, y_sz, 1, dtype,
+                               options=['TILED=YES', 'COMPRESS=LZW'])
+    else:
+        dst_ds = gdal.GetDriverByName('MEM').Create('', x_sz, y_sz, 1, dtype)
+    dst_ds.SetGeoTransform((minx, res, 0, maxy, 0, -res))
+    dst_ds.SetProjection(srs.ExportToWkt())
+    logger.info('Burning {:,} footprints into {:,} x {:,} count '
+                'grid...'.format(lyr.GetFeatureCount(), x_sz, y_sz))
+    gdal.RasterizeLayer(dst_ds, [1], lyr, burn_values=[1],
+                        options=['MERGE_ALG=ADD'])
+    if out_path:
+        dst_ds = None
+        return out_path
+
+    counts = dst_ds.GetRasterBand(1).ReadAsArray()
+    dst_ds = None
+
+    return counts
@@ -4,9 +4,9 @@ Created on Sat Apr 27 22:00:43 2019
 
 @author: disbr007
 
-Calculates TPI at specified window size. Rather than moving a window across the
-DEM, this method moves a copy of the entire DEM in the shape of the 'window', 
-adding the value at each overlap. It counts the number of movements 
+Calculates TPI at specified window size. Window means are computed from
+integral images of the DEM (see dem_utils.topo_position), rather than by
+moving a copy of the entire DEM in the shape of the 'window'.
 
 MODIFIED FROM:
 Topographic position index for elevation models, 
@@ -16,13 +16,10 @@ Zoran Čučković
 
 import argparse
 import logging.config
-import numpy as np
 import os
 
-from osgeo import gdal
-from tqdm import tqdm
-
 from misc_utils.logging_utils import create_logger, LOGGING_CONFIG
+from dem_utils.topo_position import topo_position, TPI
 
 
 handler_level = 'INFO'
@@ -32,103 +29,37 @@ logger = logging.getLogger(__name__)
 
 def calc_TPI(win_size, elevation_model, output_model=None, count_model=None):
     """
-    TODO:
-    Write docstring.
+    Calculate TPI (elevation - mean elevation of the surrounding cells in
+    the window, excluding the central cell and NoData cells) and write to
+    output_model, with a NoData value of 0. The DEM is processed in tiles,
+    see dem_utils.topo_position.
+
+    Parameters
+    ----------
+    win_size : int
+        Size of one side of the moving window, in pixels.
+    elevation_model : str
+        Path to DEM.
+    output_model : str
+        Path to write TPI to, defaults to elevation_model + '_TPI#.tif'.
+    count_model : str
+        Unused, kept for compatibility.
+
+    Returns
+    -------
+    str : output_model
     """
     if output_model is None:
         output_model = os.path.join(os.path.split(elevation_model)[0],
                                     '{}_TPI{}.tif'.format(os.path.basename(elevation_model), win_size))
         logger.info('No output model path provided, using: {}'.format(output_model))
 
-    # ----------  create the moving window  ------------
-    win = np.ones((win_size, win_size), np.int32)
-
-    # window radius is needed for the function,
-    # deduce from window size (can be different for height and width…)
-    r_y, r_x = win.shape[0] // 2, win.shape[1] // 2
-    win[r_y, r_x] = 0  # let's remove the central cell
-
-    def view(offset_y, offset_x, shape, step=1):
-        """
-        Function returning two matching numpy views for moving window routines.
-        - 'offset_y' and 'offset_x' refer to the shift in relation to the analysed (central) cell
-        - 'shape' are 2 dimensions of the data matrix (not of the window!)
-        - 'view_in' is the shifted view and 'view_out' is the position of central cells
-        (see on LandscapeArchaeology.org/2018/numpy-loops/)
-        """
-        size_y, size_x = shape
-        x, y = abs(offset_x), abs(offset_y)
-
-        x_in = slice(x, size_x, step)
-        x_out = slice(0, size_x - x, step)
-
-        y_in = slice(y, size_y, step)
-        y_out = slice(0, size_y - y, step)
-        # the swapping trick
-        if offset_x < 0:
-            x_in, x_out = x_out, x_in
-        if offset_y < 0:
-            y_in, y_out = y_out, y_in
-
-        # return window view (in) and main view (out)
-        return np.s_[y_in, x_in], np.s_[y_out, x_out]
-
-    # ----  main routine  -------
     logger.info('Opening input elevation model: {}'.format(elevation_model))
-    dem = gdal.Open(elevation_model)
-    dem_band = dem.GetRasterBand(1)
-    src_nodata = dem_band.GetNoDataValue()
-    mx_z = dem.ReadAsArray()
-    # Convert DEM NoData to 0.0
-    mx_z = np.where(mx_z == src_nodata, 0.0, mx_z)
-    # CURRENTLY ONLY WORKS IF NO DATA == 0, add line to change array's NoData to 0...? Real 0's vs NoData zeros...
-    nodata = 0.0
-
-    # matrices for temporary data
-    mx_temp = np.zeros(mx_z.shape)
-    mx_count = np.zeros(mx_z.shape)
-
-    # loop through window and accumulate values
-    for (y, x), weight in tqdm(np.ndenumerate(win), total=win.shape[0]*win.shape[1]):
-
-        if weight == 0: continue  #skip zero values !
-        # determine views to extract data
-        view_in, view_out = view(y - r_y, x - r_x, mx_z.shape)
-        # using window weights (eg. for a Gaussian function)
-        mx_temp[view_out] += mx_z[view_in] * weight
-        # ADD substract np.where(mx_z[view_in]==0, subtract -> mx_z[view_in] * weight, else do nothing)
-        # track the number of neighbours
-        # (this is used for weighted mean : Σ weights*val / Σ weights)
-        mx_count[view_out] += weight
-        # Subtract number of times nodata value was included in the count
-        # Where there is a zero in the moving window, substract 1 from the count, else do nothing (+0)
-        mx_count[view_out] = np.where(mx_z[view_in] == 0, mx_count[view_out] - 1, mx_count[view_out] + 0)
-
-    # Calculate TPI: (spot height – average neighbourhood height)
-    # Mask any NoData in the DEM from the 'temp' summed matrix
-    # mx_temp = np.where(mx_z == nodata, 0.0, mx_z)
-    # np.seterr(divide='ignore', invalid='ignore')
-    with np.errstate(divide='ignore',invalid='ignore'):
-        out = mx_z - mx_temp / mx_count
-    out = np.where(mx_z == 0.0, 0.0, out)
-
-    # Writing output TPI
-    driver = gdal.GetDriverByName('GTiff')
-    ds = driver.Create(output_model, mx_z.shape[1], mx_z.shape[0], 1, gdal.GDT_Float32)
-    ds.SetProjection(dem.GetProjection())
-    ds.SetGeoTransform(dem.GetGeoTransform())
-    ds.GetRasterBand(1).SetNoDataValue(0.0)
-    ds.GetRasterBand(1).WriteArray(out)
-    ds = None
-
-    # Write Count matrix for debugging
-    # driver = gdal.GetDriverByName('GTiff')
-    # ds = driver.Create(count_model, mx_count.shape[1], mx_count.shape[0], 1, gdal.GDT_Float32)
-    # ds.SetProjection(dem.GetProjection())
-    # ds.SetGeoTransform(dem.GetGeoTransform())
-    # ds.GetRasterBand(1).WriteArray(mx_count)
-    # ds.GetRasterBand(1).SetNoDataValue(src_nodata)
-    # ds = None
+    topo_position(elevation_model, output_model, win_size, stat=TPI,
+                  exclude_center=True, out_nodata=0.0)
+
+    return output_model
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -8,7 +8,6 @@ import argparse
 import os
 import ntpath
 import platform
-import shutil
 
 import pandas as pd
 import geopandas as gpd
@@ -16,6 +15,8 @@ from tqdm import tqdm
 
 from misc_utils.logging_utils import create_logger
 from misc_utils.gpd_utils import read_vec
+from misc_utils.transfer import (transfer_files, DirListing, COPY, SYMLINK,
+                                 JOURNAL_NAME)
 # from dem_utils import get_filepath_field, get_dem_path
 from dem_utils import get_filepath_field, get_dem_path
 
@@ -35,7 +36,7 @@ def mnt2v(filepath):
 def get_footprint_dems(footprint_path, filepath=get_filepath_field(),
                        dem_name='DEM_NAME', dem_path_fld='dem_path',
                        dem_exist_fld='dem_exist', location=None,
-                       use_terrranova=False):
+                       use_terranova=False, listing=None):
     """Load Footprint - Check for existence of DEMs"""
     logger.debug('Footprint type: {}'.format(type(footprint_path)))
     if isinstance(footprint_path, list):
@@ -70,7 +71,10 @@ def get_footprint_dems(footprint_path, filepath=get_filepath_field(),
     logger.info('Records found: {:,}'.format(num_fps))
 
     logger.info('Verifying DEMs existence at location indicated...')
-    fp[dem_exist_fld] = fp.apply(lambda x: os.path.exists(x[dem_path_fld]), axis=1)
+    # Each DEM directory is listed once
+    if listing is None:
+        listing = DirListing()
+    fp[dem_exist_fld] = fp[dem_path_fld].apply(listing.exists)
 
     dem_paths = list(fp[fp[dem_exist_fld] == True][dem_path_fld])
     num_exist_fps = len(fp)
@@ -80,9 +84,16 @@ def get_footprint_dems(footprint_path, filepath=get_filepath_field(),
     return dem_paths
 
 
-def create_copy_list(dem_paths, dest_parent_dir, meta_file_sfx, flat=False):
-    """Create list of files to copy, DEMs and meta files"""
+def create_copy_list(dem_paths, dest_parent_dir, meta_file_sfx, flat=False,
+                     listing=None):
+    """
+    Create list of (source, destination file) to copy, DEMs and meta files.
+    Destinations that are already up to date are skipped when copying, see
+    transfer.transfer_files.
+    """
     logger.info('Checking for existence of DEM and meta data files...')
+    if listing is None:
+        listing = DirListing()
     copy_list = []
     for dem in tqdm(dem_paths):
         dem_dirname = os.path.basename(os.path.dirname(dem))
@@ -93,14 +104,12 @@ def create_copy_list(dem_paths, dest_parent_dir, meta_file_sfx, flat=False):
         meta_files = []
         for sfx in meta_file_sfx:
             mf = dem.replace('dem.tif', sfx)
-            if os.path.exists(mf):
+            if listing.exists(mf):
                 meta_files.append(mf)
             else:
                 logger.debug('Missing metadata file: {}'.format(mf))
-        if not os.path.exists(os.path.join(dst_dir, os.path.basename(dem))):
-            copy_list.append((dem, dst_dir))
-        copy_list.extend([(mf, dst_dir) for mf in meta_files
-                          if not os.path.exists(os.path.join(dst_dir, os.path.basename(mf)))])
+        copy_list.extend([(f, os.path.join(dst_dir, os.path.basename(f)))
+                          for f in [dem] + meta_files])
 
     return copy_list
 
@@ -132,50 +141,36 @@ def copy_dems(footprint_path, output_directory, location=None,
             logger.debug('Skipping ortho files.')
             meta_file_sfx.remove('ortho.tif')
 
-    dem_paths = get_footprint_dems(footprint_path, location=location)
-    copy_list = create_copy_list(dem_paths, output_directory, meta_file_sfx, flat=flat)
-
-    dem_src_list = [pair[0] for pair in copy_list if pair[0].endswith('dem.tif')]
-    # print(len(dem_src_list))
-    dem_dst_list = [os.path.join(pair[1], os.path.basename(pair[0])) for pair in copy_list if pair[0].endswith('dem.tif')]
-
-    logger.info('Located DEMs to copy: {:,}'.format(len(dem_src_list)))
-
-    total_src_dems = len(dem_src_list)
-    remaining_dems = total_src_dems
-    pbar = tqdm(copy_list, desc='Remaining DEMs: {:,}'.format(remaining_dems))
-    for src, dst in pbar:
-        try:
-            if not dryrun:
-                pbar.write('Copying: {}'.format(os.path.basename(src)))
-                if not os.path.exists(dst):
-                    os.makedirs(dst)
-                dst_file = os.path.join(dst, os.path.basename(src))
-                if not os.path.exists(dst_file):
-                    if platform.system() == 'Windows' or not use_symlinks:
-                        shutil.copy2(src, dst)
-                    elif platform.system() == 'Linux' and use_symlinks:
-                        os.symlink(src, dst)
-                else:
-                    pbar.write('Skipping (exists): {}'.format(dst_file))
-                pbar.set_description('Remaining DEMs: {:,}'.format(remaining_dems))
-            # else:
-            #     pbar.write('[DRYRUN] Copying: {}'.format(src))
-        except Exception as e:
-            logger.warning('Failed to copy: {}'.format(src))
-            logger.error(e)
-        finally:
-            if src.endswith('dem.tif'):
-                remaining_dems -= 1
-                pbar.set_description('Remaining DEMs: {:,}'.format(remaining_dems))
-
-    copied_dems = [d for d in dem_dst_list if os.path.exists(d)]
+    listing = DirListing()
+    dem_paths = get_footprint_dems(footprint_path, location=location,
+                                   use_terranova=use_terranova,
+                                   listing=listing)
+    copy_list = create_copy_list(dem_paths, output_directory, meta_file_sfx,
+                                 flat=flat, listing=listing)
+
+    dem_dst_list = [dst for src, dst in copy_list if src.endswith('dem.tif')]
+    total_src_dems = len(dem_dst_list)
+    logger.info('Located DEMs to copy: {:,}'.format(total_src_dems))
+
+    if platform.system() == 'Linux' and use_symlinks:
+        method = SYMLINK
+    else:
+        method = COPY
+    journal = None if dryrun else os.path.join(output_directory, JOURNAL_NAME)
+    results = transfer_files(copy_list, method=method, journal=journal,
+                             dryrun=dryrun)
+    for src, dst, e in results['failed']:
+        logger.warning('Failed to copy: {}'.format(src))
+        logger.error(e)
+
+    done = set([dst for src, dst in results['transferred'] + results['skipped']])
+    copied_dems = [d for d in dem_dst_list if d in done]
     num_copied_dems = len(copied_dems)
     logger.info('Successfully copied DEMs: {:,}'.format(num_copied_dems))
 
     if (total_src_dems != num_copied_dems) and not dryrun:
         logger.warning('Missing DEMs in destination: {}'.format(total_src_dems - num_copied_dems))
-        missing_dems = [d for d in dem_dst_list if d not in copied_dems]
+        missing_dems = [d for d in dem_dst_list if d not in done]
         logger.debug('Missing DEMs:\n{}'.format('\n'.join(missing_dems)))
 
 
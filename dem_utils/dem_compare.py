@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+Windowed comparison of two DEMs. Both DEMs are aligned on the fly to a
+common grid through warped VRTs (no intermediate clipped files), then read
+block by block, so peak memory is a few blocks regardless of DEM size. The
+differences (dem1 - dem2) are optionally written to a raster, and summary
+statistics are accumulated as blocks are read: count, mean, RMSE, min, max
+and a fine histogram from which the median, percentiles and NMAD are
+estimated.
+"""
+import argparse
+import math
+import os
+import uuid
+
+import numpy as np
+from osgeo import gdal
+
+from misc_utils.gdal_tools import block_windows, minimum_bounding_box
+from misc_utils.logging_utils import create_logger
+
+gdal.UseExceptions()
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+OUT_NODATA = -9999
+# Approximate size of blocks read at once, in pixels
+BLOCK_SIZE = 1024
+# Differences histogram covers +/- HIST_RANGE in bins of HIST_BIN_WIDTH,
+# values outside it are counted at the edges
+HIST_RANGE = 100
+HIST_BIN_WIDTH = 0.01
+# Scale factor relating the median absolute deviation to the standard
+# deviation of a normal distribution
+NMAD_SCALE = 1.4826
+
+
+class DiffStats:
+    """
+    Streaming accumulator of difference statistics. Call update with each
+    block of valid differences, the statistics are available at any time.
+    Median, percentiles and NMAD are estimated from a histogram, so are
+    accurate to HIST_BIN_WIDTH for differences within +/- HIST_RANGE.
+    """
+    def __init__(self, hist_range=HIST_RANGE, bin_width=HIST_BIN_WIDTH):
+        self.hist_range = hist_range
+        self.bin_width = bin_width
+        n_bins = int(round(2 * hist_range / bin_width))
+        self.edges = np.linspace(-hist_range, hist_range, n_bins + 1)
+        self.hist = np.zeros(n_bins, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.min = np.nan
+        self.max = np.nan
+
+    def update(self, diffs):
+        """Add an array of valid differences."""
+        diffs = np.asarray(diffs, dtype=np.float64).ravel()
+        if diffs.size == 0:
+            return
+        self.count += diffs.size
+        self.total += diffs.sum()
+        self.total_sq += (diffs ** 2).sum()
+        self.min = np.nanmin([self.min, diffs.min()])
+        self.max = np.nanmax([self.max, diffs.max()])
+        clipped = np.clip(diffs, self.edges[0], self.edges[-1])
+        self.hist += np.histogram(clipped, bins=self.edges)[0]
+
+    @property
+    def centers(self):
+        return (self.edges[:-1] + self.edges[1:]) / 2
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else np.nan
+
+    @property
+    def rmse(self):
+        return math.sqrt(self.total_sq / self.count) if self.count else np.nan
+
+    @property
+    def std(self):
+        if not self.count:
+            return np.nan
+        return math.sqrt(max(self.total_sq / self.count - self.mean ** 2, 0))
+
+    def percentile(self, q):
+        """Estimate the q-th percentile (0-100) of the differences."""
+        return _weighted_percentile(self.centers, self.hist, q)
+
+    @property
+    def median(self):
+        return self.percentile(50)
+
+    @property
+    def nmad(self):
+        """Normalized median absolute deviation from the median."""
+        if not self.count:
+            return np.nan
+        abs_dev = np.abs(self.centers - self.median)
+        return NMAD_SCALE * _weighted_percentile(abs_dev, self.hist, 50)
+
+    def histogram(self, bins=10):
+        """
+        Rebin the accumulated histogram into bins bins between the minimum
+        and maximum difference (or +/- hist_range). With no differences,
+        all counts are zero and the bins span +/- hist_range.
+
+        Returns
+        -------
+        tuple : (counts, edges)
+        """
+        if not self.count:
+            return np.histogram([], bins=bins,
+                                range=(self.edges[0], self.edges[-1]))
+        lo = max(self.min, self.edges[0])
+        hi = min(self.max, self.edges[-1])
+        # Centers of the bins holding the minimum and maximum can fall
+        # outside them
+        centers = np.clip(self.centers, lo, hi)
+        return np.histogram(centers, bins=bins, range=(lo, hi),
+                            weights=self.hist)
+
+    def summary(self):
+        """Dict of all statistics."""
+        return {'count': self.count,
+                'mean': self.mean,
+                'rmse': self.rmse,
+                'std': self.std,
+                'min': self.min,
+                'max': self.max,
+                'median': self.median,
+                'nmad': self.nmad,
+                'p05': self.percentile(5),
+                'p95': self.percentile(95)}
+
+
+def _weighted_percentile(values, weights, q):
+    order = np.argsort(values)
+    values, weights = values[order], weights[order]
+    cum = np.cumsum(weights)
+    if cum[-1] == 0:
+        return np.nan
+    idx = np.searchsorted(cum, q / 100 * cum[-1])
+
+    return values[min(idx, len(values) - 1)]
+
+
+def common_grid(dem1, dem2, bounds=None):
+    """
+    Determine the grid both DEMs are compared on: the pixel size and
+    projection of dem1 over the overlap of the two DEMs (or bounds),
+    snapped to the pixels of dem1.
+
+    Returns
+    -------
+    dict : outputBounds, xRes, yRes, dstSRS for gdal.Warp
+    """
+    if bounds is None:
+        ulx, uly, lrx, lry = minimum_bounding_box([dem1, dem2])
+    else:
+        ulx, uly, lrx, lry = bounds
+    ds = gdal.Open(dem1)
+    gt = ds.GetGeoTransform()
+    srs = ds.GetProjection()
+    ds = None
+    x_res, y_res = gt[1], abs(gt[5])
+    # Snap inwards to the pixels of dem1
+    xmin = gt[0] + math.ceil(round((ulx - gt[0]) / x_res, 6)) * x_res
+    xmax = gt[0] + math.floor(round((lrx - gt[0]) / x_res, 6)) * x_res
+    ymax = gt[3] - math.ceil(round((gt[3] - uly) / y_res, 6)) * y_res
+    ymin = gt[3] - math.floor(round((gt[3] - lry) / y_res, 6)) * y_res
+    if xmin >= xmax or ymin >= ymax:
+        logger.error('DEMs do not overlap: {}, {}'.format(dem1, dem2))
+        raise ValueError('DEMs do not overlap.')
+
+    return {'outputBounds': (xmin, ymin, xmax, ymax),
+            'xRes': x_res,
+            'yRes': y_res,
+            'dstSRS': srs}
+
+
+def aligned_vrt(dem, grid, resampleAlg='near'):
+    """
+    Create an in memory warped VRT of dem on grid. Pixels are only
+    resampled when they are read.
+
+    Returns
+    -------
+    str : path to VRT
+    """
+    vrt = '/vsimem/{}_{}.vrt'.format(
+        os.path.splitext(os.path.basename(dem))[0], uuid.uuid4().hex)
+    ds = gdal.Warp(vrt, dem, format='VRT', resampleAlg=resampleAlg, **grid)
+    ds = None
+
+    return vrt
+
+
+def compare_dems(dem1, dem2, out_diff=None, max_diff=None, bounds=None,
+                 resampleAlg='near', block_size=BLOCK_SIZE,
+                 hist_range=HIST_RANGE, bin_width=HIST_BIN_WIDTH):
+    """
+    Difference two DEMs (dem1 - dem2) block by block on a common grid,
+    accumulating statistics of the differences.
+
+    Parameters
+    ----------
+    dem1 : str
+        Path to first DEM, whose grid is used.
+    dem2 : str
+        Path to second DEM, resampled to the grid of dem1 as needed.
+    out_diff : str
+        Path to write Float32 difference raster to.
+    max_diff : float
+        Differences with an absolute value of max_diff or greater are
+        excluded from the statistics (but still written to out_diff).
+    bounds : list
+        [ulx, uly, lrx, lry] extent to compare within, defaults to the
+        overlap of the DEMs.
+    resampleAlg : str
+        Resampling algorithm used to align dem2.
+    block_size : int
+        Approximate size of blocks read at once, in pixels.
+    hist_range, bin_width : float
+        Range and bin width of the differences histogram.
+
+    Returns
+    -------
+    DiffStats : statistics of the differences
+    """
+    dem1, dem2 = str(dem1), str(dem2)
+    grid = common_grid(dem1, dem2, bounds=bounds)
+    logger.debug('Comparison grid: {}'.format(grid))
+    vrt1 = aligned_vrt(dem1, grid)
+    vrt2 = aligned_vrt(dem2, grid, resampleAlg=resampleAlg)
+    ds1, ds2 = gdal.Open(vrt1), gdal.Open(vrt2)
+    b1, b2 = ds1.GetRasterBand(1), ds2.GetRasterBand(1)
+    nd1, nd2 = b1.GetNoDataValue(), b2.GetNoDataValue()
+    x_sz, y_sz = ds1.RasterXSize, ds1.RasterYSize
+
+    dst_ds = None
+    if out_diff:
+        driver = gdal.GetDriverByName('GTiff')
+        dst_ds = driver.Create(str(out_diff), x_sz, y_sz, 1,
+                               gdal.GDT_Float32,
+                               options=['TILED=YES', 'COMPRESS=LZW',
+                                        'BIGTIFF=IF_SAFER'])
+        dst_ds.SetGeoTransform(ds1.GetGeoTransform())
+        dst_ds.SetProjection(ds1.GetProjection())
+        dst_ds.GetRasterBand(1).SetNoDataValue(OUT_NODATA)
+
+    stats = DiffStats(hist_range=hist_range, bin_width=bin_width)
+    logger.info('Differencing DEMs ({:,} x {:,} pixels):\nDEM1: {}\n'
+                'DEM2: {}'.format(x_sz, y_sz, dem1, dem2))
+    for window in block_windows(b1, target_size=block_size):
+        arr1 = b1.ReadAsArray(*window).astype(np.float64)
+        arr2 = b2.ReadAsArray(*window).astype(np.float64)
+        valid = np.isfinite(arr1) & np.isfinite(arr2)
+        if nd1 is not None:
+            valid &= arr1 != nd1
+        if nd2 is not None:
+            valid &= arr2 != nd2
+        diffs = arr1 - arr2
+        if dst_ds is not None:
+            dst_ds.GetRasterBand(1).WriteArray(
+                np.where(valid, diffs, OUT_NODATA).astype(np.float32),
+                window[0], window[1])
+        diffs = diffs[valid]
+        if max_diff:
+            diffs = diffs[np.abs(diffs) < max_diff]
+        stats.update(diffs)
+
+    dst_ds = None
+    ds1, ds2 = None, None
+    gdal.Unlink(vrt1)
+    gdal.Unlink(vrt2)
+    logger.debug('Pixels considered: {:,}'.format(stats.count))
+
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Difference two DEMs and '
+                                                 'report statistics of the '
+                                                 'differences.')
+    parser.add_argument('dem1', type=os.path.abspath,
+                        help='Path to the first DEM.')
+    parser.add_argument('dem2', type=os.path.abspath,
+                        help='Path to the second DEM.')
+    parser.add_argument('--out_diff', type=os.path.abspath,
+                        help='Path to write difference raster to.')
+    parser.add_argument('--max_diff', type=float,
+                        help='Exclude differences this large or larger from '
+                             'the statistics.')
+    parser.add_argument('--resampleAlg', default='near',
+                        help='Resampling algorithm used to align dem2.')
+    parser.add_argument('--block_size', type=int, default=BLOCK_SIZE,
+                        help='Approximate size of blocks to read at once.')
+
+    args = parser.parse_args()
+
+    stats = compare_dems(args.dem1, args.dem2, out_diff=args.out_diff,
+                         max_diff=args.max_diff,
+                         resampleAlg=args.resampleAlg,
+                         block_size=args.block_size)
+    for k, v in stats.summary().items():
+        logger.info('{}: {}'.format(k, v))
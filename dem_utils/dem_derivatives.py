@@ -15,12 +15,13 @@ import numpy as np
 ## Third Party Libs
 import cv2
 from osgeo import gdal
-from scipy.ndimage.filters import generic_filter
 
 ## Local libs
 from misc_utils.RasterWrapper import Raster
 from misc_utils.logging_utils import create_logger
 from misc_utils.array_utils import interpolate_nodata
+from dem_utils.topo_position import topo_position, topo_position_array, \
+    TPI, TPI_DEV
 
 
 gdal.UseExceptions()
@@ -59,7 +60,8 @@ def gdal_dem_derivative(input_dem, output_path, derivative, return_array=False,
 
 def calc_tpi(dem, size):
     """
-    OpenCV implemntation of TPI, updated to ignore NaN values.
+    TPI (value - mean of valid values in window), ignoring NoData values.
+    Windows extending beyond the array include only the pixels within it.
     
     Parameters
     ----------
@@ -72,44 +74,10 @@ def calc_tpi(dem, size):
     np.ndarray (masked) : TPI
     """
     logger.info('Computing TPI with kernel size {}...'.format(size))
-    # Set up 'kernel'
-    window = (size, size)
-    window_count = size * size
-
-    # Get original mask
-    # mask = copy.deepcopy(dem.mask)
-
-    # # Change fill value to -9999 to ensure NaN corrections are applied correctly
-    # nodata_val = -9999
-    # dem.fill_value = nodata_val
-    nodata_val = dem.fill_value
-
-    # Count the number of non-NaN values in the window for each pixel
-    logger.debug('Counting number of valid pixels per window...')
-    num_valid_window = cv2.boxFilter(np.logical_not(dem.mask).astype(int), -1, window, normalize=False,
-                                     borderType=cv2.BORDER_REPLICATE)
-
-    # Change masked values to fill value
-    dem = dem.data
-
-    # Get raw sum within window for each pixel
-    logger.debug('Getting raw sum including NoData values...')
-    sum_window = cv2.boxFilter(dem, -1, window, normalize=False, borderType=cv2.BORDER_REPLICATE)
-
-    # Correct these sums by removing (fill value*number of times it was include in the sum) for each pixel
-    logger.debug('Correcting for inclusion of NoData values...')
-    sum_window = np.where(num_valid_window != window_count,  # if not all pixels in window were valid
-                          # remove NoData val from sum for each time it was included
-                          sum_window + (-nodata_val * (window_count - num_valid_window)),
-                          sum_window)
-
-    # Compute TPI (value - mean of value in window)
-    logger.debug('Calculating TPI...')
-    with np.errstate(divide='ignore', invalid='ignore'):
-        tpi = dem - (sum_window / num_valid_window)
+    valid = ~np.ma.getmaskarray(dem)
+    tpi = topo_position_array(dem.data, valid, size, stat=TPI)
     # Remask any originally masked pixels
-    tpi = np.ma.masked_where(dem.data == nodata_val, tpi)
-    # tpi = np.ma.masked_where(mask, tpi)
+    tpi = np.ma.masked_invalid(tpi)
 
     return tpi
 
@@ -146,15 +114,15 @@ def calc_tpi_dev(dem, size):
     """
     Based on (De Reu 2013)
     Calculates the tpi/standard deviation of the kernel to account for surface roughness.
-    dem: array
+    dem: array (masked)
     size: int, kernel size in x and y directions (square kernel)
     """
-    tpi = calc_tpi(dem, size)
-    
-    # Calculate the standard deviation of each cell, mode='nearest' == cv2.BORDER_REPLICATE
-    std_array = generic_filter(dem, np.std, size=size, mode='nearest')
-
-    tpi_dev = tpi / std_array
+    logger.info('Computing TPI deviation with kernel size '
+                '{}...'.format(size))
+    valid = ~np.ma.getmaskarray(dem)
+    tpi_dev = topo_position_array(np.ma.getdata(dem), valid, size,
+                                  stat=TPI_DEV)
+    tpi_dev = np.ma.masked_invalid(tpi_dev)
 
     return tpi_dev
 
@@ -189,31 +157,16 @@ def dem_derivative(dem, derivative, output_path, size, **args):
         op = derivative.split('_')[1]
         gdal_dem_derivative(dem, output_path, op, **args)
     elif derivative == 'tpi_ocv' or derivative == 'tpi_std':
+        # Stream the DEM in tiles rather than loading it into memory
         dem_raster = Raster(dem)
-        arr = dem_raster.MaskedArray.copy()
-        arr.fill = dem_raster.nodata_val
-
-        logger.info('shape of arr: {}'.format(arr.shape))
-        if derivative == 'tpi_ocv':
-            tpi = calc_tpi(arr, size=size)
-
-        elif derivative == 'tpi_std':
-            tpi = calc_tpi_dev(dem, size=size)
-
-        logger.info('Writing derivative to: {}'.format(output_path))
-        # Mask any originally masked pixels, this supposed to be done in calc_tpi
-        # but is not working. 
-        # tpi = np.ma.masked_where(arr.mask == True, tpi)
-        tpi = np.where(arr.mask==True, dem_raster.nodata_val, tpi)
-        dem_raster.WriteArray(tpi, output_path)
-        # dem_raster.WriteArray(dem_raster.Array, '{}_arr.tif'.format(output_path[:-4]))
-        # masked_int = arr.mask.astype(int)
-        # print(masked_int.shape)
-        # dem_raster.WriteArray(masked_int, '{}_arr_mask.tif'.format(output_path[:-4]))
-
-        tpi = None
-        arr = None
+        nodata_val = dem_raster.nodata_val
+        if nodata_val is None:
+            nodata_val = -9999
         dem_raster = None
+        stat = TPI if derivative == 'tpi_ocv' else TPI_DEV
+        logger.info('Writing derivative to: {}'.format(output_path))
+        topo_position(dem, output_path, size, stat=stat,
+                      out_nodata=nodata_val)
     else:
         logger.error('Unknown derivative argument: {}'.format(derivative))
 
@@ -6,89 +6,37 @@ Created on Tue Jan 28 22:18:52 2020
 """
 
 import argparse
-import logging.config
-import numpy as np
 import os
-import random
 import matplotlib.pyplot as plt
 
-from osgeo import gdal, osr
-import geopandas as gpd
-from shapely.geometry import Point
-
-
-from misc_utils.RasterWrapper import Raster
-from misc_utils.logging_utils import create_logger, LOGGING_CONFIG
-from misc_utils.gdal_tools import clip_minbb
+from misc_utils.logging_utils import create_logger
+from dem_utils.dem_compare import compare_dems
 
 
 logger = create_logger(__name__, 'sh', 'DEBUG')
 
 
-# TODO: Add shape1 == shape2 checking and 
-# TODO: if not clip to minimum bounding box (in memory)
-
-# TODO: Add support for saving image/tif of raw differences
-
 def dem_rmse(dem1_path, dem2_path, max_diff=None, outfile=None, out_diff=None, plot=False,
              show_plot=False, save_plot=None, bins=10, log_scale=True):
-    # Load DEMs as arrays
-    logger.info('Loading DEMs...')
-    dem1 = Raster(dem1_path)
-    dem2 = Raster(dem2_path)
-
-    if dem1.geotransform != dem2.geotransform:
-        logger.warning('''DEM geotransforms do not match. 
-                          Clipping to minimum bounding box in memory....''')
-        dem1 = None
-        dem2 = None
-        clipped = clip_minbb(rasters=[dem1_path, dem2_path],
-                             in_mem=True,
-                             out_format='vrt')
-        logger.debug('Clipping complete. Reloading DEMs...')
-        dem1 = Raster(clipped[0])
-        arr1 = dem1.MaskedArray
-        dem1 = None
-        logger.debug('DEM1 loaded and array extracted...')
-        dem2 = Raster(clipped[1])
-        arr2 = dem2.MaskedArray
-        dem2 = None
-        logger.debug('DEM2 loaded and array extracted...')
-    else:
-        arr1 = dem1.MaskedArray
-        dem1 = None
-        arr2 = dem2.MaskedArray
-        dem2 = None
-
-
-    # Compute RMSE
+    """
+    Compute the RMSE between two DEMs over their overlap. The DEMs are
+    differenced block by block on the grid of dem1, see
+    dem_compare.compare_dems, so they are never fully loaded.
+    """
     logger.info('Computing RMSE...')
-    diffs = arr1 - arr2
-    
-    # Remove any differences bigger than max_diff
-    if max_diff:
-        logger.debug('Checking for large differences, max_diff: {}'.format(max_diff))
-        size_uncleaned = diffs.size
-        diffs = diffs[abs(diffs) < max_diff]
-        size_cleaned = diffs.size
-        if size_uncleaned != size_cleaned:
-            logger.debug('Removed differences over max_diff ({}) from RMSE calculation...'.format(max_diff))
-            logger.debug('Size before: {:,}'.format(size_uncleaned))
-            logger.debug('Size after:  {:,}'.format(size_cleaned))
-            logger.debug('Pixels removed: {:.2f}% of overlap area'.format(((size_uncleaned-size_cleaned)/size_uncleaned)*100))
-    
-    sq_diff = diffs**2
-    mean_sq = sq_diff.sum() / sq_diff.count()
-    logger.debug('Mean square error: {}'.format(mean_sq))
-    rmse = np.sqrt(mean_sq)
+    stats = compare_dems(dem1_path, dem2_path, out_diff=out_diff,
+                         max_diff=max_diff)
+    rmse = stats.rmse
+    logger.debug('Mean square error: {}'.format(rmse**2))
 
     # Report differences
-    diffs_valid_count = diffs.count()
-    min_diff = diffs.min()
-    max_diff = diffs.max()
+    diffs_valid_count = stats.count
+    min_diff = stats.min
+    max_diff = stats.max
     logger.debug('Minimum difference: {:.2f}'.format(min_diff))
     logger.debug('Maximum difference: {:.2f}'.format(max_diff))
     logger.debug('Pixels considered: {:,}'.format(diffs_valid_count))
+    logger.debug('NMAD: {:.2f}'.format(stats.nmad))
     logger.info('RMSE: {:.2f}'.format(rmse))
 
     # Write text file of results
@@ -100,31 +48,28 @@ def dem_rmse(dem1_path, dem2_path, max_diff=None, outfile=None, out_diff=None, p
             of.write('Pixels considered: {:,}\n'.format(diffs_valid_count))
             of.write('Minimum difference: {:.2f}\n'.format(min_diff))
             of.write('Maximum difference: {:.2f}\n'.format(max_diff))
-    
-    # Write raster file of results
-    if out_diff:
-        logger.info('Out diff not supported, skipping writing.')
-        # dem1.WriteArray(diffs, out_diff)
-        
+            of.write('Mean difference: {:.2f}\n'.format(stats.mean))
+            of.write('Median difference: {:.2f}\n'.format(stats.median))
+            of.write('NMAD: {:.2f}\n'.format(stats.nmad))
+
     # Plot results
     # TODO: Add legend
-    # TODO: Incorporate min/max differences based on max_diff argument
     if plot:
         plt.style.use('ggplot')
         fig, ax = plt.subplots(1, 1)
-        ax.hist(diffs.compressed().flatten(), log=log_scale, bins=bins, edgecolor='white', 
-                alpha=0.875)
+        counts, edges = stats.histogram(bins=bins)
+        ax.hist(edges[:-1], bins=edges, weights=counts, log=log_scale,
+                edgecolor='white', alpha=0.875)
         ax.annotate('RMSE: {:.3f}'.format(rmse),
-                    xy=(76, 0.75),
+                    xy=(0.76, 0.75),
                     xycoords='axes fraction')
-        plt.legend(loc="upper left")
         plt.tight_layout()
-        
+
         if save_plot:
             plt.savefig(save_plot)
         if show_plot:
             plt.show()
-        
+
     return rmse
 
 
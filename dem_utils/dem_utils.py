@@ -16,10 +16,11 @@ import geopandas as gpd
 import shapely
 
 # from dem_utils.dem_selector import dem_selector
-from misc_utils.gdal_tools import clip_minbb
+from misc_utils.gpd_utils import sindex_pairs
 from misc_utils.logging_utils import create_logger
 from misc_utils.raster_clip import clip_rasters
-from misc_utils.RasterWrapper import Raster
+from dem_utils.dem_compare import compare_dems
+from dem_utils.valid_stats import valid_density
 
 
 logger = create_logger(__name__, 'sh', 'INFO')
@@ -43,7 +44,7 @@ def intersect_pair(geom1, geom2):
 
 
 def calc_sqkm(geom):
-    return geom.area / 10e6
+    return geom.area / 1e6
 
 
 def calc_ovlp_perc(geom1, geom2, ovlp_geom):
@@ -59,6 +60,9 @@ def dems2dems_ovlp(dems,
                    sqkm=True, drop_orig_geom=True):
     """
     Compute overlap between all DEM footprints that intersect in dems geodataframe.
+    Candidate pairs are found with a single bulk query of the spatial index,
+    and the intersections and areas of all pairs are computed in bulk,
+    rather than overlaying each pair.
 
     Parameters
     ----------
@@ -70,148 +74,136 @@ def dems2dems_ovlp(dems,
         Name of column to create to hold the area in units of projection.
     ovlp_perc_name : str
         Name of column to create to hold the percentage of overlap between each pair
+    drop_orig_geom : bool
+        False to keep the footprint of each DEM in the pair, as columns
+        new_geom_col_[lsuffix] and new_geom_col_[rsuffix].
     Returns
     -------
-    gpd.GeoDataFrame : where the geometry is all of the intersections with
-                       area and percent overlap computed.
+    gpd.GeoDataFrame : one row per overlapping pair, indexed by pair name,
+                       with the attributes of both DEMs (suffixed), where
+                       the geometry is the intersection, with area and
+                       percent overlap computed.
     """
     new_geom_col = 'new_geom_col'
-    # lsuffix = 'd1'
-    # rsuffix = 'd2'
-    name_left = '{}_{}'.format(name, lsuffix)
-    name_right = '{}_{}'.format(name, rsuffix)
-    geom_left = '{}_{}'.format(new_geom_col, lsuffix)
-    geom_right = '{}_{}'.format(new_geom_col, rsuffix)
-    # intersect_geom = 'inters_geom'
     ovlp_area_sqkm = '{}_sqkm'.format(ovlp_area_name)
-    # ovlp_perc_dems = 'ovlp_perc_dems'
-
-    # Save each features geometry to colum to allow accessing both left and right geom
-    dems[new_geom_col] = dems.geometry
-
-    # Join with self, one record per intersection in resulting df
-    sj = gpd.sjoin(dems, dems, lsuffix=lsuffix, rsuffix=rsuffix)
-
-    # Drop self joins
-    sj = sj[sj['{}_{}'.format(name, lsuffix)] != sj['{}_{}'.format(name, rsuffix)]]
+    geom_name = dems.geometry.name
+
+    # Each pair of intersecting footprints once, excluding self pairs
+    left, right = sindex_pairs(dems, predicate='intersects')
+    keep = left < right
+    left, right = left[keep], right[keep]
+
+    dems = dems.reset_index()
+    geoms = dems.geometry
+    geoms_left = geoms.iloc[left].reset_index(drop=True)
+    geoms_right = geoms.iloc[right].reset_index(drop=True)
+    attrs = dems.drop(columns=[geom_name])
+    pairs = pd.concat([
+        attrs.iloc[left].reset_index(drop=True).add_suffix('_{}'.format(lsuffix)),
+        attrs.iloc[right].reset_index(drop=True).add_suffix('_{}'.format(rsuffix))],
+        axis=1)
 
     # Create ID column for each pair
-    sj[combo_name] = sj.apply(lambda x: dem_pair(x[name_left], x[name_right]), axis=1)
-
-    # Set index as combined name
-    sj.set_index(combo_name, inplace=True)
-
-    # Drop duplicates where dem1 -> dem2 == dem2 -> dem1 (reciprocal matches)
-    sj = sj[~sj.index.duplicated(keep='first')]
-    # sj = sj.drop_duplicates(subset=combo_name, keep='first')
+    names_left = pairs['{}_{}'.format(name, lsuffix)].astype(str)
+    names_right = pairs['{}_{}'.format(name, rsuffix)].astype(str)
+    pairs[combo_name] = np.where(names_left <= names_right,
+                                 names_left + '-' + names_right,
+                                 names_right + '-' + names_left)
+    # Drop pairs of the same DEM and duplicate pairs
+    keep = (names_left != names_right).values & \
+        ~pairs[combo_name].duplicated(keep='first').values
+    pairs = pairs[keep]
+    geoms_left = geoms_left[keep]
+    geoms_right = geoms_right[keep]
 
     # Get intersection area, calculate sqkm, % overlap
-    sj[intersect_geom] = sj.apply(lambda x: intersect_pair(x[geom_left], x[geom_right]), axis=1)
-    sj = sj.set_geometry(intersect_geom)
-    sj[ovlp_area_name] = sj.geometry.area
+    inters = geoms_left.intersection(geoms_right)
+    pairs[intersect_geom] = inters.values
+    pairs = gpd.GeoDataFrame(pairs, geometry=intersect_geom, crs=dems.crs)
+    if not drop_orig_geom:
+        pairs['{}_{}'.format(new_geom_col, lsuffix)] = geoms_left.values
+        pairs['{}_{}'.format(new_geom_col, rsuffix)] = geoms_right.values
+    pairs[ovlp_area_name] = pairs.geometry.area
+    # Drop pairs that only touch
+    pairs = pairs[pairs[ovlp_area_name] > 0]
     if sqkm:
-        sj[ovlp_area_sqkm] = sj.apply(lambda x: calc_sqkm(x[intersect_geom]), axis=1)
-    sj[ovlp_perc_name] = sj.apply(lambda x: calc_ovlp_perc(x[geom_left], x[geom_right], x[intersect_geom]), axis=1)
-
-    if drop_orig_geom:
-        sj = sj.drop(columns=[geom_left, geom_right])
+        pairs[ovlp_area_sqkm] = pairs[ovlp_area_name] / 1e6
+    pairs[ovlp_perc_name] = np.round(
+        pairs[ovlp_area_name] / (geoms_left[pairs.index].area.values +
+                                 geoms_right[pairs.index].area.values), 2)
+    pairs = pairs.set_index(combo_name)
 
-    return sj
+    return pairs
 
 
 def dems2aoi_ovlp(dems, aoi, aoi_ovlp_area_col='aoi_ovlp_area', aoi_ovlp_perc_col='aoi_ovlp_perc'):
-    """Compute overlap between dem footprints and an aoi"""
-    dems_idx_name = dems.index.name
-    if dems_idx_name is None:
-        dems_idx_name = 'index'
-
-    aoi_ovlp = gpd.overlay(dems.reset_index(), aoi, how='intersection')
-    aoi_ovlp.set_index(dems_idx_name, inplace=True)
-    aoi_ovlp[aoi_ovlp_area_col] = aoi_ovlp.geometry.area.apply(
-                                    lambda x: round(x, 5))
-    dems = pd.merge(dems, aoi_ovlp[aoi_ovlp_area_col],
-                    left_index=True, right_index=True)
-    dems[aoi_ovlp_perc_col] = dems[aoi_ovlp_area_col].apply(
-                                lambda x: x / aoi.geometry.area.values[0])
-    # dems[aoi_ovlp_area_col] = [round(a, 2) for a in list(aoi_ovlp.geometry.area)]
-    # dems[aoi_ovlp_perc_col] = [round(p, 2) for p in list(aoi_ovlp.geometry.area / aoi.geometry.area.values[0])]
+    """
+    Compute overlap between dem footprints and an aoi, keeping only
+    footprints that overlap the aoi. The footprints are intersected with
+    the aoi in bulk, only for those whose bounds intersect it.
+    """
+    aoi_geom = aoi.geometry.unary_union
+    aoi_area = aoi_geom.area
+
+    candidates = np.zeros(len(dems), dtype=bool)
+    if hasattr(dems.sindex, 'query'):
+        candidates[dems.sindex.query(aoi_geom)] = True
+    else:
+        candidates[list(dems.sindex.intersection(aoi_geom.bounds))] = True
+    dems = dems[candidates]
+
+    ovlp_area = dems.geometry.intersection(aoi_geom).area.round(5)
+    dems = dems[ovlp_area > 0].copy()
+    dems[aoi_ovlp_area_col] = ovlp_area[ovlp_area > 0]
+    dems[aoi_ovlp_perc_col] = dems[aoi_ovlp_area_col] / aoi_area
 
     return dems
 
 
-def compute_density(mt_p, aoi_p):
+def compute_density(mt_p, aoi_p, overview=None):
+    """
+    Density of a matchtag over an AOI: area of valid matchtag pixels within
+    the AOI / area of the AOI. The matchtag is read block by block, only
+    within the AOI's extent, so it does not need to be clipped first.
+    """
     logger.debug('Computing density...')
-    aoi = gpd.read_file(aoi_p)
-    if len(aoi) == 1:
-        geom_area = aoi.geometry.area
-    else:
-        logger.warning('Multiple features found in AOI provided. Using first for density calculation.')
-        geom_area = aoi.geometry.area[0]
-
-    ds = gdal.Open(mt_p)
-    b = ds.GetRasterBand(1)
-    gtf = ds.GetGeoTransform()
-    matchtag_res_x = gtf[1]
-    matchtag_res_y = gtf[5]
-    matchtag_ndv = b.GetNoDataValue()
-    data = b.ReadAsArray()
-
-    err = gdal.GetLastErrorNo()
-    if err != 0:
-        raise RuntimeError("Matchtag dataset read error: {}, {}".format(gdal.GetLastErrorMsg(), mt_p))
-    else:
-        data_pixel_count = np.count_nonzero(data != matchtag_ndv)
-        data_area = abs(data_pixel_count * matchtag_res_x * matchtag_res_y)
-        density = data_area / geom_area
-        data = None
-        ds = None
+    density = valid_density(mt_p, aoi_p, overview=overview)
 
     return round(density, 2)
 
 
-def combined_density(mt1, mt2, aoi, in_mem_epsg=None, clip=False, out_path=None):
-    """Get density for two matchtags over AOI"""
-    # Ensure both matchtags exist
-    # if not os.path.exists(mt1) or not os.path.exists(mt2):
-    #     for mt in [mt1, mt2]:
-    #         if not os.path.exists(mt):
-    #             logger.error('Matchtag file not found: {}'.format(mt))
-    #     return -9999
-    
-    # Determine type of aoi
-    # If shapely geometry, save to in-memory file
-    if isinstance(aoi, (shapely.geometry.polygon.Polygon, shapely.geometry.MultiPolygon)):
-        gdf = gpd.GeoDataFrame(geometry=[aoi], crs='epsg:{}'.format(in_mem_epsg))
-        aoi = r'/vsimem/combined_density_temp.shp'
-        gdf.to_file(aoi)
-    
-    if clip:
-        logger.debug('Clipping matchtags before comparing...')
-        mt1, mt2 = clip_rasters(aoi, [mt1, mt2], in_mem=True)
-    
-    if not out_path:
-        # compute combined matchtag in memory only
-        out_path = r'/vsimem/temp_comb_mt.tif'
-        
-    # Read matchtag arrays
-    m1 = Raster(mt1)
-    arr1 = m1.Array
-    m2 = Raster(mt2)
-    arr2 = m2.Array
-    if arr1.shape != arr2.shape:
-        logger.warning("""Matchtag arrays do not match. 
-                       Must be clipped before computing combined density.""")
-
-    # Create new array, 1 if both matchtags were 1, otherwise 0.
-    combo_mt = np.where(arr1 + arr2 == 2, 1, 0)
+def combined_density(mt1, mt2, aoi, in_mem_epsg=None, clip=False, out_path=None,
+                     overview=None):
+    """
+    Get density for two matchtags over AOI: area of pixels that are 1 in
+    both matchtags within the AOI / area of the AOI. The matchtags are read
+    block by block, only within the AOI's extent, so clipping is not
+    needed and clip is ignored.
 
-    # Write new combined matchtag array
-    m1.WriteArray(combo_mt, out_path)
+    Parameters
+    ----------
+    mt1, mt2 : str
+        Paths to matchtags.
+    aoi : str, shapely.geometry
+        Path to AOI or AOI geometry (in in_mem_epsg).
+    in_mem_epsg : int
+        EPSG code of aoi if a geometry.
+    clip : bool
+        Unused, kept for compatibility.
+    out_path : str
+        Path to write combined matchtag to.
+    overview : int
+        Overview level to estimate density from.
 
-    # Compute density
-    combo_dens = compute_density(out_path, aoi)
+    Returns
+    -------
+    float : density
+    """
+    combo_dens = valid_density([mt1, mt2], aoi, aoi_crs=in_mem_epsg,
+                               valid_value=1, out_path=out_path,
+                               overview=overview)
 
-    return round(combo_dens.values[0], 2)
+    return round(combo_dens, 2)
 
 
 def get_filepath_field():
@@ -284,15 +276,16 @@ def get_dem_image1_id(meta_path):
 
 
 def difference_dems(dem1, dem2, out_dem=None, in_mem=False):
+    """
+    Difference two DEMs (dem1 - dem2) over their overlap, block by block,
+    see dem_compare.compare_dems.
+    """
     logger.debug('Difference DEMs:\nDEM1: {}\nDEM2:{}'.format(dem1, dem2))
-    clipped = clip_minbb([dem1, dem2], in_mem=True)
-    dem1_clipped = Raster(clipped[0])
-    dem2_clipped = Raster(clipped[1])
-
-    diff = dem1_clipped.MaskedArray - dem2_clipped.MaskedArray
-
+    if not out_dem and in_mem:
+        out_dem = r'/vsimem/{}_diff.tif'.format(
+            os.path.splitext(os.path.basename(dem1))[0])
     if out_dem:
         logger.debug('Writing difference to: {}'.format(out_dem))
-        dem1_clipped.WriteArray(diff, out_path=out_dem)
+    compare_dems(dem1, dem2, out_diff=out_dem)
 
     return out_dem
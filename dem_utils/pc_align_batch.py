@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""
+Batch alignment of DEMs with ASP pc_align. Reads a manifest of
+reference / source DEM pairs and aligns each pair (pc_align, then
+point2dem or apply_trans to create the aligned DEM), running a bounded
+number of jobs concurrently, each with a limited number of threads. Each
+pair is keyed on its parameters and the contents of its DEMs, and skipped
+if its outputs already exist from a run with the same key. The
+translation and error statistics from each pc_align log are gathered into
+one results table.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import os
+from pathlib import Path
+import re
+import subprocess
+import time
+
+import pandas as pd
+from osgeo import gdal
+
+from misc_utils.logging_utils import create_logger
+from misc_utils.pipeline import StepCache, Step
+from dem_utils.dem_compare import compare_dems
+from dem_utils.pc_align import apply_trans, combo_name
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+# Executables, overridable for testing or non-standard installs
+PC_ALIGN = 'pc_align'
+POINT2DEM = 'point2dem'
+
+# Manifest columns
+REF = 'reference'
+SRC = 'source'
+NAME = 'name'
+
+# Methods of creating the aligned DEM
+POINT2DEM_METHOD = 'point2dem'
+APPLY_TRANS_METHOD = 'apply_trans'
+METHODS = [POINT2DEM_METHOD, APPLY_TRANS_METHOD]
+
+CACHE_NAME = 'pc_align_batch.json'
+RESULTS_NAME = 'pc_align_results.csv'
+
+# pc_align log patterns
+FLOAT_RE = r'([-+]?[\d.]+(?:[eE][-+]?\d+)?)'
+TRANS_NED_RE = re.compile(r'Translation vector \(North-East-Down, meters\): '
+                          r'Vector3\(' + ','.join([FLOAT_RE]*3) + r'\)')
+TRANS_MAG_RE = re.compile(r'Translation vector magnitude \(meters\): ' +
+                          FLOAT_RE)
+ERR_PERC_RE = re.compile(r'(Input|Output): error percentile of smallest '
+                         r'errors \(meters\): 16%: ' + FLOAT_RE +
+                         r', 50%: ' + FLOAT_RE + r', 84%: ' + FLOAT_RE)
+
+
+def read_manifest(manifest):
+    """
+    Read a manifest of DEM pairs to align: a CSV with columns 'reference'
+    and 'source' (paths to DEMs) and optionally 'name' (used to name
+    outputs). Names are created from the DEM names if not provided.
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    pairs = pd.read_csv(manifest)
+    missing = [c for c in [REF, SRC] if c not in pairs.columns]
+    if missing:
+        logger.error('Manifest missing columns: {}'.format(missing))
+        raise ValueError(missing)
+    if NAME not in pairs.columns:
+        pairs[NAME] = None
+    no_name = pairs[NAME].isnull()
+    short = [combo_name(r, s) for r, s in zip(pairs[REF], pairs[SRC])]
+    # Use full DEM names if short names collide
+    long_name = len(set(short)) != len(short)
+    pairs.loc[no_name, NAME] = [
+        combo_name(r, s, long_name=long_name)
+        for r, s in zip(pairs.loc[no_name, REF], pairs.loc[no_name, SRC])]
+    if pairs[NAME].duplicated().any():
+        logger.error('Duplicate names in manifest: {}'.format(
+            list(pairs[pairs[NAME].duplicated()][NAME])))
+        raise ValueError('Duplicate names in manifest.')
+
+    return pairs
+
+
+def parse_pc_align_log(log_file):
+    """
+    Parse the translation vector and error percentiles from a pc_align log
+    file.
+
+    Returns
+    -------
+    dict : trans_north, trans_east, trans_down, trans_magnitude, and
+    [input|output]_err_[16|50|84]
+    """
+    results = {}
+    with open(log_file, 'r') as lf:
+        for line in lf:
+            match = TRANS_NED_RE.search(line)
+            if match:
+                for k, v in zip(['trans_north', 'trans_east', 'trans_down'],
+                                match.groups()):
+                    results[k] = float(v)
+                continue
+            match = TRANS_MAG_RE.search(line)
+            if match:
+                results['trans_magnitude'] = float(match.group(1))
+                continue
+            match = ERR_PERC_RE.search(line)
+            if match:
+                which = match.group(1).lower()
+                for p, v in zip([16, 50, 84], match.groups()[1:]):
+                    results['{}_err_{}'.format(which, p)] = float(v)
+    if 'trans_north' not in results:
+        logger.warning('No translation vector found in pc_align log: '
+                       '{}'.format(log_file))
+
+    return results
+
+
+def find_pc_align_log(prefix):
+    """Most recent pc_align log file written with output prefix."""
+    prefix = Path(prefix)
+    logs = sorted(prefix.parent.glob('{}-log-pc_align*.txt'.format(
+        prefix.name)), key=os.path.getmtime)
+    if not logs:
+        logger.error('No pc_align log file found for: {}'.format(prefix))
+        raise FileNotFoundError(prefix)
+
+    return logs[-1]
+
+
+def dem_res_nodata(dem):
+    """Mean pixel size and NoData value of a DEM."""
+    ds = gdal.Open(str(dem))
+    gt = ds.GetGeoTransform()
+    nodata = ds.GetRasterBand(1).GetNoDataValue()
+    ds = None
+
+    return (abs(gt[1]) + abs(gt[5])) / 2, nodata
+
+
+def run_command(command, log_file, threads):
+    """
+    Run command (list of args), appending its output to log_file. Threads
+    used by OpenMP within the command are limited to threads.
+    """
+    env = dict(os.environ)
+    env['OMP_NUM_THREADS'] = str(threads)
+    logger.debug('Running: {}'.format(' '.join(command)))
+    with open(log_file, 'a') as log:
+        log.write('$ {}\n'.format(' '.join(command)))
+        log.flush()
+        subprocess.run(command, stdout=log, stderr=subprocess.STDOUT,
+                       env=env, check=True)
+
+
+def align_pair(ref, src, out_dir, name, max_diff=10, threads=4,
+               allow_rotation=False, ref_pts=None, src_pts=None,
+               method=POINT2DEM_METHOD):
+    """
+    Align src to ref with pc_align, then create the aligned DEM.
+
+    Parameters
+    ----------
+    ref : str
+        Path to reference DEM.
+    src : str
+        Path to source DEM, to be aligned.
+    out_dir : str
+        Directory to write outputs to.
+    name : str
+        Prefix of outputs.
+    max_diff : float
+        pc_align --max-displacement.
+    threads : int
+        Number of threads the job may use.
+    allow_rotation : bool
+        False to compute translation only.
+    ref_pts, src_pts : int
+        Maximum number of reference and source points to use.
+    method : str
+        'point2dem' to grid the transformed source points, 'apply_trans' to
+        shift the source DEM by the translation vector.
+
+    Returns
+    -------
+    dict : results parsed from the pc_align log, and out_dem
+    """
+    prefix = os.path.join(out_dir, name)
+    job_log = '{}_batch.log'.format(prefix)
+    command = [PC_ALIGN,
+               '--max-displacement', str(max_diff),
+               '--threads', str(threads),
+               '-o', prefix]
+    if method == POINT2DEM_METHOD:
+        command.append('--save-transformed-source-points')
+    if not allow_rotation:
+        command.append('--compute-translation-only')
+    if ref_pts:
+        command.extend(['--max-num-reference-points', str(ref_pts)])
+    if src_pts:
+        command.extend(['--max-num-source-points', str(src_pts)])
+    command.extend([str(ref), str(src)])
+    run_command(command, job_log, threads)
+
+    results = parse_pc_align_log(find_pc_align_log(prefix))
+
+    if method == POINT2DEM_METHOD:
+        res, nodata = dem_res_nodata(ref)
+        command = [POINT2DEM,
+                   '--threads', str(threads),
+                   '-s', str(res),
+                   '-o', '{}_pca'.format(prefix)]
+        if nodata is not None:
+            command.extend(['--nodata-value', str(nodata)])
+        command.append('{}-trans_source.tif'.format(prefix))
+        run_command(command, job_log, threads)
+        out_dem = '{}_pca-DEM.tif'.format(prefix)
+    else:
+        out_dem = '{}-pcaDEM.tif'.format(prefix)
+        # pc_align reports (north, east, down), apply_trans takes
+        # (dx, dy, dz) with dz subtracted from elevations
+        apply_trans(src, [results['trans_east'], results['trans_north'],
+                          results['trans_down']], out_dem)
+    results['out_dem'] = out_dem
+
+    return results
+
+
+def pair_outputs(out_dir, name, method=POINT2DEM_METHOD):
+    """Paths to the aligned DEM and results of a pair."""
+    prefix = os.path.join(out_dir, name)
+    if method == POINT2DEM_METHOD:
+        out_dem = '{}_pca-DEM.tif'.format(prefix)
+    else:
+        out_dem = '{}-pcaDEM.tif'.format(prefix)
+
+    return out_dem, '{}_results.json'.format(prefix)
+
+
+def align_batch(pairs, out_dir, jobs=4, threads=4, max_diff=10,
+                allow_rotation=False, ref_pts=None, src_pts=None,
+                method=POINT2DEM_METHOD, rmse=False, max_diff_rmse=None,
+                force=False, results_path=None, dryrun=False):
+    """
+    Align a batch of DEM pairs concurrently.
+
+    Parameters
+    ----------
+    pairs : pd.DataFrame or str
+        DEM pairs or path to manifest, see read_manifest.
+    out_dir : str
+        Directory to write outputs to.
+    jobs : int
+        Maximum number of pairs aligned at once.
+    threads : int
+        Number of threads each job may use.
+    max_diff, allow_rotation, ref_pts, src_pts, method :
+        See align_pair.
+    rmse : bool
+        True to compute RMSE of each pair before and after alignment.
+    max_diff_rmse : float
+        Differences this large or larger are excluded from the RMSEs.
+    force : bool
+        True to align pairs even if up to date.
+    results_path : str
+        Path to write results table (CSV) to, defaults to
+        out_dir/pc_align_results.csv.
+    dryrun : bool
+        True to only report which pairs would be aligned.
+
+    Returns
+    -------
+    pd.DataFrame : one row per pair, with status 'ran', 'cached' or
+    'failed' and the results of the alignment.
+    """
+    if method not in METHODS:
+        logger.error('Unsupported method: {}, must be one of: '
+                     '{}'.format(method, METHODS))
+        raise ValueError(method)
+    if not isinstance(pairs, pd.DataFrame):
+        pairs = read_manifest(pairs)
+    if not dryrun and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    if results_path is None:
+        results_path = os.path.join(out_dir, RESULTS_NAME)
+
+    cache = StepCache(os.path.join(out_dir, CACHE_NAME))
+    params = {'max_diff': max_diff, 'allow_rotation': allow_rotation,
+              'ref_pts': ref_pts, 'src_pts': src_pts, 'method': method,
+              'rmse': rmse, 'max_diff_rmse': max_diff_rmse}
+
+    def run_job(row):
+        out_dem, out_results = pair_outputs(out_dir, row[NAME], method=method)
+        step = Step(row[NAME], None, inputs=[row[REF], row[SRC]],
+                    outputs=[out_dem, out_results], params=params)
+        key = cache.key(step)
+        if not force and cache.is_current(step, key):
+            logger.info('Up to date, skipping: {}'.format(row[NAME]))
+            with open(out_results) as src:
+                results = json.load(src)
+            results['status'] = 'cached'
+            return results
+        if dryrun:
+            logger.info('Would align: {}'.format(row[NAME]))
+            return {'status': 'pending'}
+
+        logger.info('Aligning: {}'.format(row[NAME]))
+        start = time.time()
+        results = align_pair(row[REF], row[SRC], out_dir, row[NAME],
+                             max_diff=max_diff, threads=threads,
+                             allow_rotation=allow_rotation, ref_pts=ref_pts,
+                             src_pts=src_pts, method=method)
+        if rmse:
+            results['pre_rmse'] = compare_dems(
+                row[REF], row[SRC], max_diff=max_diff_rmse).rmse
+            results['post_rmse'] = compare_dems(
+                row[REF], results['out_dem'], max_diff=max_diff_rmse).rmse
+        results['runtime'] = round(time.time() - start, 1)
+        with open(out_results, 'w') as dst:
+            json.dump(results, dst, indent=1)
+        cache.record(step, key, runtime=results['runtime'])
+        logger.info('Aligned: {} ({:.1f}s)'.format(row[NAME],
+                                                   results['runtime']))
+        results['status'] = 'ran'
+
+        return results
+
+    records = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(run_job, row): row[NAME]
+                   for _, row in pairs.iterrows()}
+        for f in as_completed(futures):
+            name = futures[f]
+            try:
+                records[name] = f.result()
+            except Exception as e:
+                logger.error('Alignment failed: {}\n{}'.format(name, e))
+                records[name] = {'status': 'failed', 'error': str(e)}
+
+    results = pd.DataFrame([records[n] for n in pairs[NAME]],
+                           index=pairs.index)
+    results = pd.concat([pairs[[NAME, REF, SRC]], results], axis=1)
+    if not dryrun:
+        results.to_csv(results_path, index=False)
+        logger.info('Results written to: {}'.format(results_path))
+    n_failed = (results['status'] == 'failed').sum()
+    if n_failed:
+        logger.warning('Failed to align {} of {} pairs.'.format(
+            n_failed, len(results)))
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Align a batch of DEM pairs '
+                                                 'with pc_align.')
+    parser.add_argument('manifest', type=os.path.abspath,
+                        help='CSV with columns "reference" and "source" '
+                             '(paths to DEMs), and optionally "name".')
+    parser.add_argument('out_dir', type=os.path.abspath,
+                        help='Directory to write outputs to.')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='Number of pairs to align at once.')
+    parser.add_argument('-t', '--threads', type=int, default=4,
+                        help='Number of threads per pair.')
+    parser.add_argument('--max_diff', type=float, default=10,
+                        help='Maximum displacement used by pc_align.')
+    parser.add_argument('--allow_rotation', action='store_true',
+                        help='Allow rotation when aligning DEMs.')
+    parser.add_argument('--ref_pts', type=int,
+                        help='Number of reference points to consider.')
+    parser.add_argument('--src_pts', type=int,
+                        help='Number of source points to consider.')
+    parser.add_argument('--method', choices=METHODS, default=POINT2DEM_METHOD,
+                        help='Method of creating the aligned DEM.')
+    parser.add_argument('--rmse', action='store_true',
+                        help='Compute RMSE before and after alignment.')
+    parser.add_argument('--max_diff_rmse', type=float,
+                        help='Maximum difference to use in RMSE.')
+    parser.add_argument('--force', action='store_true',
+                        help='Align pairs even if up to date.')
+    parser.add_argument('--results', type=os.path.abspath,
+                        help='Path to write results table to.')
+    parser.add_argument('--dryrun', action='store_true',
+                        help='Report pairs to align without aligning.')
+
+    args = parser.parse_args()
+
+    align_batch(args.manifest, args.out_dir, jobs=args.jobs,
+                threads=args.threads, max_diff=args.max_diff,
+                allow_rotation=args.allow_rotation, ref_pts=args.ref_pts,
+                src_pts=args.src_pts, method=args.method, rmse=args.rmse,
+                max_diff_rmse=args.max_diff_rmse, force=args.force,
+                results_path=args.results, dryrun=args.dryrun)
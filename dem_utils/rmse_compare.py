@@ -1,108 +1,33 @@
 import argparse
-import numpy as np
 import os
 import matplotlib.pyplot as plt
 
-# from osgeo import gdal, osr
-# import geopandas as gpd
-# from shapely.geometry import Point
-
-from misc_utils.RasterWrapper import Raster
 from misc_utils.logging_utils import create_logger
-from misc_utils.gdal_tools import clip_minbb, match_pixel_size
+from misc_utils.gdal_tools import minimum_bounding_box
+from dem_utils.dem_compare import compare_dems
 
 logger = create_logger(__name__, 'sh', 'INFO')
 
 
 def rmse_compare(dem1_path, dem2_path, dem2pca_path, max_diff=None, outfile=None, plot=False,
                  save_plot=None, show_plot=False, bins=20, log_scale=True):
-    # Load DEMs as arrays
-    logger.info('Loading DEMs...')
-    dem1 = Raster(dem1_path)
-    dem2 = Raster(dem2_path)
-    dem2pca = Raster(dem2pca_path)
-
-    if dem1.geotransform != dem2.geotransform or dem1.geotransform != dem2pca.geotransform:
-        logger.warning('DEM geotransforms do not match.')
-        # Check for pixel size match
-        if (((dem1.geotransform[1] != dem2.geotransform[1]) or (dem1.geotransform[1] != dem2pca.geotransform[1]) or
-                (dem1.geotransform[5] != dem2.geotransform[5]) or (dem2.geotransform[5] != dem2pca.geotransform[5]))):
-            logger.info('DEM pixel sizes do not match, translating to match.')
-            p1 = dem1.src_path
-            p2 = dem2.src_path
-            dem1 = None
-            dem2 = None
-            # max = match_pixel_size([p1, p2], r'/vsimem/matching_px.tif', resampleAlg='cubic', in_mem=True)
-            dem1 = Raster(p1)
-            dem2 = Raster(p2)
-            logger.info('DEM1 sz: {} {}'.format(dem1.x_sz, dem1.y_sz))
-            logger.info('DEM2 sz: {} {}'.format(dem2.x_sz, dem2.y_sz))
-
-        # Check for size match
-        if ((dem1.x_sz != dem2.x_sz) or (dem1.x_sz != dem2pca.x_sz) or
-                (dem1.y_sz != dem2.y_sz) or (dem1.y_sz != dem2pca.y_sz)):
-            logger.info('DEM sizes do not match. Clipping to minimum bounding box in memory....')
-            dem1 = None
-            dem2 = None
-            clipped = clip_minbb(rasters=[dem1_path, dem2_path, dem2pca_path],
-                                 in_mem=True,
-                                 out_format='vrt')
-            logger.debug('Clipping complete. Reloading DEMs...')
-            dem1 = Raster(clipped[0])
-            logger.debug('DEM1 loaded and array extracted...')
-            dem2 = Raster(clipped[1])
-            logger.debug('DEM2 loaded and array extracted...')
-            dem2pca = Raster(clipped[2])
-
-            logger.debug('DEM1 sz: {} {}'.format(dem1.x_sz, dem1.y_sz))
-            logger.debug('DEM2 sz: {} {}'.format(dem2.x_sz, dem2.y_sz))
-
-        arr1 = dem1.MaskedArray
-        dem1 = None
-        arr2 = dem2.MaskedArray
-        dem2 = None
-        arr2pca = dem2pca.MaskedArray
-
-    else:
-        arr1 = dem1.MaskedArray
-        dem1 = None
-        arr2 = dem2.MaskedArray
-        dem2 = None
-        arr2pca = dem2pca.MaskedArray
-        dem2pca = None
-
+    """
+    Compare the RMSE of dem2 and dem2pca (dem2 after alignment) against
+    dem1, over the overlap of all three DEMs. Differences are computed
+    block by block, see dem_compare.compare_dems.
+    """
+    bounds = minimum_bounding_box([dem1_path, dem2_path, dem2pca_path])
 
     #### PRE-ALIGNMENT ####
-    # Compute RMSE 
     logger.info('Computing RMSE pre-alignment...')
-    diffs = arr1 - arr2
-    # Remove any differences bigger than max_diff
-    if max_diff:
-        logger.debug('Checking for large differences, max_diff: '
-                     '{}'.format(max_diff))
-        size_uncleaned = diffs.size
-        diffs = diffs[abs(diffs) < max_diff]
-
-        size_cleaned = diffs.size
-        if size_uncleaned != size_cleaned:
-            logger.debug('Removed differences over max_diff ({}) from RMSE '
-                         'calculation...'.format(max_diff))
-            logger.debug('Size before: {:,}'.format(size_uncleaned))
-            logger.debug('Size after:  {:,}'.format(size_cleaned))
-            logger.debug('Pixels removed: {:.2f}% of overlap area'.format(
-                ((size_uncleaned-size_cleaned)/size_uncleaned)*100))
-
-    sq_diff = diffs**2
-    mean_sq = sq_diff.sum() / sq_diff.count()
-    rmse = np.sqrt(mean_sq)
+    stats = compare_dems(dem1_path, dem2_path, max_diff=max_diff,
+                         bounds=bounds)
+    rmse = stats.rmse
 
     # Report differences
-    diffs_valid_count = diffs.count()
-    min_diff = diffs.min()
-    max_diff = diffs.max()
-    logger.debug('Minimum difference: {:.2f}'.format(min_diff))
-    logger.debug('Maximum difference: {:.2f}'.format(max_diff))
-    logger.debug('Pixels considered: {:,}'.format(diffs_valid_count))
+    logger.debug('Minimum difference: {:.2f}'.format(stats.min))
+    logger.debug('Maximum difference: {:.2f}'.format(stats.max))
+    logger.debug('Pixels considered: {:,}'.format(stats.count))
     logger.info('RMSE: {:.2f}'.format(rmse))
 
     # Write text file of results
@@ -110,57 +35,22 @@ def rmse_compare(dem1_path, dem2_path, dem2pca_path, max_diff=None, outfile=None
         with open(outfile, 'w') as of:
             of.write("DEM1: {}\n".format(dem1_path))
             of.write("DEM2: {}\n".format(dem2_path))
-            of.write('Pixels considered: {:,}\n'.format(diffs_valid_count))
-            of.write('Minimum difference: {:.2f}\n'.format(min_diff))
-            of.write('Maximum difference: {:.2f}\n\n'.format(max_diff))
+            of.write('Pixels considered: {:,}\n'.format(stats.count))
+            of.write('Minimum difference: {:.2f}\n'.format(stats.min))
+            of.write('Maximum difference: {:.2f}\n'.format(stats.max))
+            of.write('NMAD: {:.2f}\n\n'.format(stats.nmad))
             of.write('RMSE: {:.2f}\n'.format(rmse))
 
     #### POST ALIGNMENT ####
-    # Compute RMSE
     logger.info('Computing RMSE post-alignment...')
-    diffs_pca = arr1 - arr2pca
-
-    # Remove any differences bigger than max_diff
-    if max_diff:
-        size_uncleaned = diffs.size
-        diffs_pca = diffs_pca[abs(diffs_pca) < max_diff]
-        size_cleaned = diffs.size
-        if size_uncleaned != size_cleaned:
-            logger.debug('Removed differences over max_diff ({}) from RMSE '
-                         'calculation...'.format(max_diff))
-            logger.debug('Size before: {:,}'.format(size_uncleaned))
-            logger.debug('Size after:  {:,}'.format(size_cleaned))
-            logger.debug('Pixels removed: {:.2f}% of overlap area'.format(
-                ((size_uncleaned-size_cleaned)/size_uncleaned)*100))
-
-    # Remove any differences bigger than max_diff
-    if max_diff:
-        logger.debug('Checking for large differences, max_diff: '
-                     '{}'.format(max_diff))
-        size_uncleaned = diffs.size
-        diffs = diffs[abs(diffs) < max_diff]
-
-        size_cleaned = diffs.size
-        if size_uncleaned != size_cleaned:
-            logger.debug('Removed differences over max_diff ({}) from RMSE '
-                         'calculation...'.format(max_diff))
-            logger.debug('Size before: {:,}'.format(size_uncleaned))
-            logger.debug('Size after:  {:,}'.format(size_cleaned))
-            logger.debug('Pixels removed: {:.2f}% of overlap area'.format(
-                ((size_uncleaned-size_cleaned)/size_uncleaned)*100))
-
-
-    sq_diff_pca = diffs_pca**2
-    mean_sq_pca = sq_diff_pca.sum() / sq_diff_pca.count()
-    rmse_pca = np.sqrt(mean_sq_pca)
+    stats_pca = compare_dems(dem1_path, dem2pca_path, max_diff=max_diff,
+                             bounds=bounds)
+    rmse_pca = stats_pca.rmse
 
     # Report differences
-    diffs_pca_valid_count = diffs_pca.count()
-    min_diff_pca = diffs_pca.min()
-    max_diff_pca = diffs_pca.max()
-    logger.debug('Minimum difference: {:.2f}'.format(min_diff_pca))
-    logger.debug('Maximum difference: {:.2f}'.format(max_diff_pca))
-    logger.debug('Pixels considered: {:,}'.format(diffs_pca_valid_count))
+    logger.debug('Minimum difference: {:.2f}'.format(stats_pca.min))
+    logger.debug('Maximum difference: {:.2f}'.format(stats_pca.max))
+    logger.debug('Pixels considered: {:,}'.format(stats_pca.count))
     logger.info('RMSE: {:.2f}'.format(rmse_pca))
 
     # Add to text file of results
@@ -168,34 +58,27 @@ def rmse_compare(dem1_path, dem2_path, dem2pca_path, max_diff=None, outfile=None
         with open(outfile, 'a') as of:
             of.write("DEM1: {}\n".format(dem1_path))
             of.write("DEM2pca: {}\n".format(dem2pca_path))
-            of.write('Pixels considered pca: {:,}\n'.format(diffs_pca_valid_count))
-            of.write('Minimum difference pca: {:.2f}\n'.format(min_diff_pca))
-            of.write('Maximum difference pca: {:.2f}\n\n'.format(max_diff_pca))
+            of.write('Pixels considered pca: {:,}\n'.format(stats_pca.count))
+            of.write('Minimum difference pca: {:.2f}\n'.format(stats_pca.min))
+            of.write('Maximum difference pca: {:.2f}\n'.format(stats_pca.max))
+            of.write('NMAD pca: {:.2f}\n\n'.format(stats_pca.nmad))
             of.write('RMSEpca: {:.2f}\n'.format(rmse_pca))
 
     # Plot results
     # TODO: Add legend and RMSE annotations
-    # TODO: Incorporate min/max differences based on max_diff argument
     if plot:
         plt.style.use('ggplot')
         fig, ax = plt.subplots(2, 1)
+        hist_range = (min([stats.min, stats_pca.min]),
+                      max([stats.max, stats_pca.max]))
 
-        # Plot unaligned differences with line at 0
-        ax[0].hist(diffs.compressed().flatten(), log=log_scale, bins=bins,
-                   edgecolor='white', alpha=0.75,
-                   range=[min([diffs.min(), diffs_pca.min()]),
-                          max([diffs.min(), diffs_pca.max()])
-                          ])
-        ax[0].axvline(x=0, linewidth=2, color='black')
-        
-        # Plot aligned differences with line at 0
-        ax[1].hist(diffs_pca.compressed().flatten(), log=log_scale, bins=bins,
-                   edgecolor='white', color='b', alpha=0.75,
-                   range=[min([diffs.min(), diffs_pca.min()]),
-                          max([diffs.min(), diffs_pca.max()])])
-        ax[1].axvline(x=0, linewidth=2, color='black')
+        # Plot unaligned and aligned differences with line at 0
+        for a, s, color in [(ax[0], stats, None), (ax[1], stats_pca, 'b')]:
+            a.hist(s.centers, bins=bins, range=hist_range, weights=s.hist,
+                   log=log_scale, edgecolor='white', color=color, alpha=0.75)
+            a.axvline(x=0, linewidth=2, color='black')
 
-        # Annotation and titles        
+        # Annotation and titles
         ax[0].set_title('Pre-Alignment')
         ax[0].annotate('RMSE: {:.2f}'.format(rmse), xy=(0.05, 0.95),
                        xycoords='axes fraction')
@@ -203,15 +86,15 @@ def rmse_compare(dem1_path, dem2_path, dem2pca_path, max_diff=None, outfile=None
         ax[1].annotate('RMSE: {:.2f}'.format(rmse_pca), xy=(0.05, 0.95),
                        xycoords='axes fraction')
 
-        plt.legend()
-
         plt.tight_layout()
-        
+
         if save_plot:
             plt.savefig(save_plot)
         if show_plot:
             plt.show()
 
+    return rmse, rmse_pca
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
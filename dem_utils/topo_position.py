@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Topographic position: focal mean, standard deviation, TPI (elevation -
+focal mean) and TPI deviation (TPI / focal standard deviation, De Reu
+2013) for any window size. Window sums are computed with separable
+cumulative sums (integral images), so the cost per pixel does not depend on
+the window size, and NoData pixels are excluded from every window. Rasters
+are processed in tiles padded with a halo of half the window size, so
+rasters larger than memory are streamed.
+"""
+import argparse
+import os
+
+import numpy as np
+from osgeo import gdal
+
+from misc_utils.gdal_tools import block_windows, pad_window
+from misc_utils.logging_utils import create_logger
+
+gdal.UseExceptions()
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+MEAN = 'mean'
+STD = 'std'
+TPI = 'tpi'
+TPI_DEV = 'tpi_dev'
+STATS = [MEAN, STD, TPI, TPI_DEV]
+# Approximate size of tiles processed at once, in pixels
+TILE_SIZE = 2048
+OUT_NODATA = -9999
+
+
+def box_sum(arr, size):
+    """
+    Sum of arr over the size x size window around each pixel, with pixels
+    outside arr contributing nothing. For even sizes the window extends one
+    pixel further before the pixel than after it (as cv2.boxFilter).
+
+    Parameters
+    ----------
+    arr : np.ndarray
+        2D array.
+    size : int
+        Size of window along each axis.
+
+    Returns
+    -------
+    np.ndarray : float64 array of window sums, the shape of arr
+    """
+    before = size // 2
+    after = size - 1 - before
+    out = arr
+    for axis in (0, 1):
+        n = out.shape[axis]
+        # Cumulative sum with a leading 0, so csum[k] is the sum of the
+        # first k values
+        csum = np.cumsum(out, axis=axis, dtype=np.float64)
+        pad = [(0, 0), (0, 0)]
+        pad[axis] = (1, 0)
+        csum = np.pad(csum, pad, mode='constant')
+        idx = np.arange(n)
+        hi = np.minimum(idx + after + 1, n)
+        lo = np.maximum(idx - before, 0)
+        out = np.take(csum, hi, axis=axis) - np.take(csum, lo, axis=axis)
+
+    return out
+
+
+def window_stats(arr, valid, size, exclude_center=False):
+    """
+    Focal count, mean and standard deviation of the valid pixels of arr in
+    the size x size window around each pixel.
+
+    Parameters
+    ----------
+    arr : np.ndarray
+        2D array of values.
+    valid : np.ndarray
+        2D bool array, False where arr is NoData.
+    size : int
+        Size of window along each axis.
+    exclude_center : bool
+        True to exclude each pixel from its own window.
+
+    Returns
+    -------
+    tuple : (count, mean, std) arrays, mean and std are NaN where no valid
+    pixels are in the window
+    """
+    # Values relative to the mean of the array, to limit loss of precision
+    # in the sums of squares
+    offset = arr[valid].mean() if valid.any() else 0.0
+    values = np.where(valid, arr - offset, 0.0).astype(np.float64)
+
+    count = box_sum(valid.astype(np.float64), size)
+    total = box_sum(values, size)
+    total_sq = box_sum(values ** 2, size)
+    if exclude_center:
+        count -= valid
+        total -= values
+        total_sq -= values ** 2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / count
+        var = total_sq / count - mean ** 2
+    std = np.sqrt(np.clip(var, 0, None))
+    mean += offset
+
+    return count, mean, std
+
+
+def topo_position_array(arr, valid, size, stat=TPI, exclude_center=False):
+    """
+    Compute a topographic position statistic for an in memory array.
+
+    Parameters
+    ----------
+    arr : np.ndarray
+        2D array of elevations.
+    valid : np.ndarray
+        2D bool array, False where arr is NoData.
+    size : int
+        Size of window along each axis.
+    stat : str
+        One of STATS.
+    exclude_center : bool
+        True to exclude each pixel from its own window.
+
+    Returns
+    -------
+    np.ndarray : float64, NaN where not valid or undefined
+    """
+    if stat not in STATS:
+        logger.error('Unsupported stat: {}, must be one of: '
+                     '{}'.format(stat, STATS))
+        raise ValueError(stat)
+    count, mean, std = window_stats(arr, valid, size,
+                                    exclude_center=exclude_center)
+    if stat == MEAN:
+        result = mean
+    elif stat == STD:
+        result = std
+    else:
+        result = arr - mean
+        if stat == TPI_DEV:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result = result / std
+    result = np.where(valid & np.isfinite(result), result, np.nan)
+
+    return result
+
+
+def topo_position(dem, out_path, sizes, stat=TPI, exclude_center=False,
+                  tile_size=TILE_SIZE, out_nodata=OUT_NODATA):
+    """
+    Compute a topographic position statistic for a DEM at one or more
+    window sizes, streaming the DEM in tiles. Each tile is read once with a
+    halo for the largest window size.
+
+    Parameters
+    ----------
+    dem : str
+        Path to DEM.
+    out_path : str
+        Path to write Float32 GeoTiff to, with one band per window size.
+    sizes : int or list
+        Window size(s), in pixels along each axis.
+    stat : str
+        One of STATS.
+    exclude_center : bool
+        True to exclude each pixel from its own window.
+    tile_size : int
+        Approximate size of tiles, in pixels, not including the halo.
+    out_nodata : float
+        NoData value of output.
+
+    Returns
+    -------
+    str : out_path
+    """
+    if isinstance(sizes, int):
+        sizes = [sizes]
+    if stat not in STATS:
+        logger.error('Unsupported stat: {}, must be one of: '
+                     '{}'.format(stat, STATS))
+        raise ValueError(stat)
+    halo = max(sizes) // 2
+
+    src_ds = gdal.Open(str(dem))
+    band = src_ds.GetRasterBand(1)
+    x_sz, y_sz = src_ds.RasterXSize, src_ds.RasterYSize
+    src_nodata = band.GetNoDataValue()
+
+    driver = gdal.GetDriverByName('GTiff')
+    dst_ds = driver.Create(str(out_path), x_sz, y_sz, len(sizes),
+                           gdal.GDT_Float32,
+                           options=['TILED=YES', 'COMPRESS=LZW',
+                                    'BIGTIFF=IF_SAFER'])
+    dst_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    dst_ds.SetProjection(src_ds.GetProjection())
+    for i in range(len(sizes)):
+        dst_ds.GetRasterBand(i + 1).SetNoDataValue(out_nodata)
+
+    logger.info('Computing {} for window size(s) {}: {}'.format(
+        stat, ', '.join([str(s) for s in sizes]), dem))
+    for window in block_windows(band, target_size=tile_size):
+        padded, inner = pad_window(window, halo, x_sz, y_sz)
+        arr = band.ReadAsArray(*padded).astype(np.float64)
+        valid = np.isfinite(arr)
+        if src_nodata is not None:
+            valid &= arr != src_nodata
+        for i, size in enumerate(sizes):
+            if valid[inner].any():
+                result = topo_position_array(arr, valid, size, stat=stat,
+                                             exclude_center=exclude_center)
+                result = result[inner]
+                result = np.where(np.isnan(result), out_nodata, result)
+            else:
+                result = np.full(valid[inner].shape, out_nodata)
+            dst_ds.GetRasterBand(i + 1).WriteArray(
+                result.astype(np.float32), window[0], window[1])
+
+    dst_ds = None
+    src_ds = None
+
+    return out_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute topographic '
+                                                 'position statistics.')
+    parser.add_argument('dem', type=os.path.abspath,
+                        help='Path to DEM.')
+    parser.add_argument('out_path', type=os.path.abspath,
+                        help='Path to write output to, one band per window '
+                             'size.')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', required=True,
+                        help='Window size(s) in pixels.')
+    parser.add_argument('--stat', choices=STATS, default=TPI,
+                        help='Statistic to compute.')
+    parser.add_argument('--exclude_center', action='store_true',
+                        help='Exclude each pixel from its own window.')
+    parser.add_argument('--tile_size', type=int, default=TILE_SIZE,
+                        help='Approximate size of tiles to process at once.')
+
+    args = parser.parse_args()
+
+    topo_position(args.dem, args.out_path, args.sizes, stat=args.stat,
+                  exclude_center=args.exclude_center,
+                  tile_size=args.tile_size)
@@ -14,6 +14,7 @@ from osgeo import gdal, ogr, osr
 from misc_utils.raster_clip import clip_rasters
 from misc_utils.gdal_tools import auto_detect_ogr_driver, remove_shp
 from misc_utils.logging_utils import create_logger
+from dem_utils.valid_stats import valid_counts
 
 
 #### Logging setup
@@ -35,59 +36,37 @@ def valid_data(gdal_ds, band_number=1, valid_value=None, write_valid=False, out_
     Returns
     Tuple:  Count of valid pixels, count of total pixels
     """
-    # TODO: Only check within acutal bounds of image, not edges
     # Check if gdal_ds is a file or already opened datasource
-    if isinstance(gdal_ds, gdal.Dataset):
-        pass
-    # elif os.path.exists(gdal_ds):
-        # gdal_ds = gdal.Open(gdal_ds)
-    else:
+    if not isinstance(gdal_ds, gdal.Dataset):
         try:
             gdal_ds = gdal.Open(gdal_ds)
         except Exception as e:
             logger.error('Cannot open {}'.format(gdal_ds))
             logger.error(e)
             raise e
-        # logger.warning('{} is neither path to GDAL datasource or open datasource'.format(gdal_ds))
-    # Get raster band
-    rb = gdal_ds.GetRasterBand(band_number)
-    no_data_val = rb.GetNoDataValue()
-    arr = rb.ReadAsArray()
-    # Create mask showing only valid data as 1's
-    if valid_value is not None:
-        mask = np.where(arr == valid_value, 1, 0)
-    else:
-        mask = np.where(arr != no_data_val, 1, 0)
-    # Count number of valid
-    valid_pixels = len(mask[mask == 1])
-    total_pixels = mask.size
-    
-    # Write mask if desired
-    if write_valid is True:
-        if len(mask.shape) == 2:
-            rows, cols = mask.shape
-            depth = 1
-        else:
-            rows, cols, depth = mask.shape
-        driver = gdal.GetDriverByName('GTiff')
-        
-        dst_ds = driver.Create(out_path, gdal_ds.RasterXSize, gdal_ds.RasterYSize, 1, rb.DataType)
-        dst_ds.SetGeoTransform(gdal_ds.GetGeoTransform())
-        out_prj = osr.SpatialReference()
-        out_prj.ImportFromWkt(gdal_ds.GetProjectionRef())
-        dst_ds.SetProjection(out_prj.ExportToWkt())
-        for i in range(depth):
-            b = i+1
-            dst_ds.GetRasterBand(b).WriteArray(mask)
-            dst_ds.GetRasterBand(b).SetNoDataValue(no_data_val)
-        dst_ds = None
+    # Count valid pixels block by block
+    if not write_valid:
+        out_path = None
+    counts = valid_counts(gdal_ds, band_num=band_number,
+                          valid_value=valid_value, out_path=out_path)
+    valid_pixels, total_pixels = counts.valid, counts.total
 
     return valid_pixels, total_pixels
 
 
-def valid_percent(gdal_ds, band_number=1, valid_value=None, write_valid=False, out_path=None):
-    valid, total = valid_data(gdal_ds=gdal_ds, band_number=band_number, valid_value=valid_value,
-                              write_valid=write_valid, out_path=out_path)
+def valid_percent(gdal_ds, band_number=1, valid_value=None, write_valid=False, out_path=None,
+                  overview=None):
+    """
+    Percent of valid pixels in gdal_ds, see valid_data. Optionally estimated
+    from overview level overview.
+    """
+    if overview is not None and not write_valid:
+        counts = valid_counts(gdal_ds, band_num=band_number,
+                              valid_value=valid_value, overview=overview)
+        valid, total = counts.valid, counts.total
+    else:
+        valid, total = valid_data(gdal_ds=gdal_ds, band_number=band_number, valid_value=valid_value,
+                                  write_valid=write_valid, out_path=out_path)
     vp = valid / total
     vp = round(vp*100, 2)
 
@@ -168,48 +147,36 @@ def rasterize_shp2raster_extent(ogr_ds, gdal_ds, write_rasterized=False,
     return out_path
 
 
-def valid_data_aoi(aoi, raster, out_dir=None, in_mem=True, write_rasterized=False):
+def valid_data_aoi(aoi, raster, out_dir=None, in_mem=True, write_rasterized=False,
+                   overview=None):
     """
-    Compute percentage of valid pixels given an AOI. The raster MUST ALREADY BE CLIPPED
-    to the AOI to return valid results.
+    Compute percentage of valid pixels given an AOI, out of the pixels of
+    raster within the AOI. The raster does not need to be clipped to the
+    AOI.
     
-    out_dir : os.path.abspath
-        Path to write rasterized AOI to.
+    out_dir, in_mem, write_rasterized : unused, kept for compatibility.
+    overview : int
+        Overview level to estimate the percentage from.
     """
     logger.debug('Finding percent of {} valid pixels in {}'.format(raster, aoi))
-    
-    # Create in memory out_dir if needed
-    if in_mem or not out_dir:
-        out_dir = r'/vsimem'
-
-    # Convert aoi to raster and count the number of pixels
     if isinstance(aoi, ogr.DataSource):
-        out_path = os.path.join(out_dir, '{}.tif'.format(aoi.GetName()))
-    else:
-        out_path = os.path.join(out_dir, '{}.tif'.format(os.path.basename(aoi).split('.')[0]))
-    
-    aoi_gdal_ds = rasterize_shp2raster_extent(aoi, raster, write_rasterized=write_rasterized)
-    aoi_valid_pixels, aoi_total_pixels = valid_data(aoi_gdal_ds)
-    # Pixels outside bounding box of AOI
-    boundary_pixels = aoi_total_pixels - aoi_valid_pixels
-    
-    # Get the number of valid pixels in the raster
-    valid_pixels, total_pixels = valid_data(raster)
-    # Get total number of pixels within the footprint
-    possible_valid_pixels = total_pixels - boundary_pixels
-    valid_perc = valid_pixels / possible_valid_pixels
+        aoi = aoi.GetDescription()
+    counts = valid_counts(raster, aoi=aoi, overview=overview)
+    if counts.total == 0:
+        logger.warning('No pixels of {} in {}'.format(raster, aoi))
+        return 0.0
+    valid_perc = counts.valid / counts.total
     valid_perc = valid_perc*100
     valid_perc = round(valid_perc, 2)
     
-    aoi_gdal_ds = None
-    raster = None
-    
     return valid_perc
 
 
-def valid_percent_clip(aoi, raster, out_dir=None):
+def valid_percent_clip(aoi, raster, out_dir=None, overview=None):
     """
-    Clip a raster to the aoi, and get the percent of non-NoData pixels in the AOI.
+    Get the percent of non-NoData pixels of raster in the AOI. Only the
+    blocks of the raster within the AOI are read, so the raster is not
+    clipped first.
     Useful with pandas.apply function applied to a row with a raster filename.
 
     Parameters
@@ -219,24 +186,16 @@ def valid_percent_clip(aoi, raster, out_dir=None):
     raster : os.path.abspath
         Path to raster to check number of valid pixels.
     out_dir : os.path.abspath
-        Path to place clipped DEMs if in-memory is not desired.
-    threshold: INT
-        Threshold above which to write out clipped raster.
-    thresh_dir: STR
-        Directory to write clipped rasters to. Will be written with original filename.
+        Unused, kept for compatibility.
+    overview : int
+        Overview level to estimate the percentage from.
 
     Returns
     -------
     FLOAT : percentage of valid pixels
 
     """
-    if out_dir is None:
-        in_mem = True
-        out_dir = r'/vsimem'
-        
-    clipped_path = clip_rasters(aoi, rasters=raster, in_mem=in_mem, out_dir=out_dir)[0]
-    clipped_raster = gdal.Open(clipped_path)
-    valid_perc = valid_data_aoi(aoi=aoi, raster=clipped_raster, out_dir=out_dir)
+    valid_perc = valid_data_aoi(aoi=aoi, raster=raster, overview=overview)
     valid_perc = round(valid_perc, 2)
     
     return valid_perc
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+"""
+Valid data statistics (valid pixel counts, percentages and densities) for
+one or more rasters, optionally within an AOI, computed by streaming the
+rasters block by block rather than reading whole bands. Rasters do not need
+to be clipped to the AOI first: only blocks within the AOI's extent are read
+and the AOI is rasterized per block. Counts can be estimated from an
+overview level, and results are cached on the raster paths and modification
+times and a hash of the AOI.
+"""
+from collections import namedtuple
+import hashlib
+import json
+import os
+from pathlib import Path
+import threading
+import uuid
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from osgeo import gdal, ogr, osr
+
+from misc_utils.gdal_tools import block_windows, bounds2pixel_window, \
+    rasterize_window
+from misc_utils.logging_utils import create_logger
+
+gdal.UseExceptions()
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+BLOCK_SIZE = 2048
+
+ValidCounts = namedtuple('ValidCounts', ['valid', 'total', 'pixel_area'])
+ValidCounts.__doc__ = """Number of valid pixels, number of pixels
+considered (within the AOI, if provided) and area of a pixel."""
+
+_cache = {}
+_cache_path = None
+_lock = threading.Lock()
+
+
+def set_cache_path(cache_path):
+    """
+    Persist cached results to a JSON file at cache_path, loading any
+    results already in it. None to only cache in memory.
+    """
+    global _cache_path
+    with _lock:
+        _cache_path = Path(cache_path) if cache_path else None
+        if _cache_path and _cache_path.exists():
+            with open(_cache_path) as src:
+                _cache.update(json.load(src))
+
+
+def clear_cache():
+    with _lock:
+        _cache.clear()
+
+
+def _cache_get(key):
+    with _lock:
+        result = _cache.get(key)
+    return ValidCounts(*result) if result is not None else None
+
+
+def _cache_put(key, counts):
+    with _lock:
+        _cache[key] = list(counts)
+        if _cache_path:
+            tmp = _cache_path.with_suffix('.tmp')
+            with open(tmp, 'w') as dst:
+                json.dump(_cache, dst)
+            os.replace(tmp, _cache_path)
+
+
+def _file_key(path):
+    """Path and modification time of path, or None if not a file."""
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_mtime_ns, stat.st_size]
+
+
+def aoi_geometry(aoi, srs=None, aoi_crs=None):
+    """
+    Single geometry (the union of all features) of aoi, in srs.
+
+    Parameters
+    ----------
+    aoi : str, gpd.GeoDataFrame, shapely.geometry
+        Path to vector file, GeoDataFrame or geometry.
+    srs : str
+        WKT of spatial reference to return geometry in, if None the
+        geometry is not reprojected.
+    aoi_crs : object
+        CRS of aoi if it is a shapely geometry, e.g. an EPSG code.
+
+    Returns
+    -------
+    shapely.geometry
+    """
+    if isinstance(aoi, shapely.geometry.base.BaseGeometry):
+        if aoi_crs is not None and not isinstance(aoi_crs, str):
+            aoi_crs = 'epsg:{}'.format(aoi_crs)
+        aoi = gpd.GeoDataFrame(geometry=[aoi], crs=aoi_crs)
+    elif not isinstance(aoi, gpd.GeoDataFrame):
+        aoi = gpd.read_file(aoi)
+    if srs is not None and aoi.crs is not None:
+        aoi = aoi.to_crs(srs)
+
+    return aoi.geometry.unary_union
+
+
+def _aoi_layer(geom, srs):
+    """In memory OGR layer containing geom."""
+    mem_ds = ogr.GetDriverByName('Memory').CreateDataSource(
+        'aoi{}'.format(uuid.uuid4().hex))
+    sr = osr.SpatialReference()
+    sr.ImportFromWkt(srs)
+    lyr = mem_ds.CreateLayer('aoi', sr, ogr.wkbUnknown)
+    feat = ogr.Feature(lyr.GetLayerDefn())
+    feat.SetGeometry(ogr.CreateGeometryFromWkb(geom.wkb))
+    lyr.CreateFeature(feat)
+    feat = None
+
+    return mem_ds, lyr
+
+
+def _band(ds, band_num, overview):
+    """Band of ds, or its overview at level overview if it exists."""
+    band = ds.GetRasterBand(band_num)
+    if overview is not None:
+        if overview < band.GetOverviewCount():
+            band = band.GetOverview(overview)
+        else:
+            logger.warning('Overview level {} not found, using full '
+                           'resolution: {}'.format(overview,
+                                                   ds.GetDescription()))
+    return band
+
+
+def _band_geotransform(ds, band):
+    """Geotransform of band, which may be an overview of ds."""
+    gt = list(ds.GetGeoTransform())
+    x_scale = ds.RasterXSize / band.XSize
+    y_scale = ds.RasterYSize / band.YSize
+    gt[1] *= x_scale
+    gt[2] *= x_scale
+    gt[4] *= y_scale
+    gt[5] *= y_scale
+
+    return tuple(gt)
+
+
+def _same_srs(ref_srs, srs):
+    """
+    True if the WKT spatial references ref_srs and srs are the same, or if
+    either is missing, in which case the rasters cannot be reprojected.
+    """
+    if not ref_srs or not srs:
+        return True
+    ref_sr = osr.SpatialReference()
+    ref_sr.ImportFromWkt(ref_srs)
+    sr = osr.SpatialReference()
+    sr.ImportFromWkt(srs)
+
+    return bool(ref_sr.IsSame(sr))
+
+
+def _pixel_offset(ref_gt, gt):
+    """
+    Offset in pixels of a raster with geotransform gt from the reference
+    grid, or None if the grids are not aligned.
+    """
+    if not np.allclose([ref_gt[1], ref_gt[5]], [gt[1], gt[5]]):
+        return None
+    dx = (gt[0] - ref_gt[0]) / ref_gt[1]
+    dy = (gt[3] - ref_gt[3]) / ref_gt[5]
+    if not np.allclose([dx, dy], np.round([dx, dy]), atol=1e-3):
+        return None
+
+    return int(round(dx)), int(round(dy))
+
+
+def _read_window(band, xoff, yoff, xsize, ysize):
+    """
+    Read a window which may extend beyond the band.
+
+    Returns
+    -------
+    tuple : (array, bool array of pixels within the band)
+    """
+    arr = np.zeros((ysize, xsize), dtype=np.float64)
+    inside = np.zeros((ysize, xsize), dtype=bool)
+    x0, y0 = max(0, xoff), max(0, yoff)
+    x1, y1 = min(band.XSize, xoff + xsize), min(band.YSize, yoff + ysize)
+    if x0 < x1 and y0 < y1:
+        sl = np.s_[y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff]
+        arr[sl] = band.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+        inside[sl] = True
+
+    return arr, inside
+
+
+def _valid(arr, inside, nodata, valid_value):
+    if valid_value is not None:
+        return inside & (arr == valid_value)
+    valid = inside & ~np.isnan(arr)
+    if nodata is not None:
+        valid &= arr != nodata
+
+    return valid
+
+
+def valid_counts(rasters, band_num=1, valid_value=None, aoi=None,
+                 aoi_crs=None, overview=None, out_path=None,
+                 block_size=BLOCK_SIZE, use_cache=True):
+    """
+    Count the pixels that are valid in all of rasters, within aoi if
+    provided, reading the rasters block by block on the grid of the first
+    raster. Rasters on other grids are resampled to it on the fly.
+
+    Parameters
+    ----------
+    rasters : str, list
+        Raster path(s), or open gdal.Dataset(s).
+    band_num : int
+        Band to check in each raster.
+    valid_value : float
+        Value of valid pixels, e.g. 1 for matchtags. If None, pixels that
+        are not NoData (or NaN) are valid.
+    aoi : str, gpd.GeoDataFrame, shapely.geometry
+        Only count pixels within aoi, see aoi_geometry.
+    aoi_crs : object
+        CRS of aoi if it is a shapely geometry.
+    overview : int
+        Overview level to estimate counts from, if None full resolution.
+    out_path : str
+        Path to write valid pixel mask (1 = valid in all rasters) to, on
+        the grid of the first raster.
+    block_size : int
+        Approximate size of blocks to read, in pixels.
+    use_cache : bool
+        False to always compute counts.
+
+    Returns
+    -------
+    ValidCounts
+    """
+    if isinstance(rasters, (str, Path, gdal.Dataset)):
+        rasters = [rasters]
+    datasets = [r if isinstance(r, gdal.Dataset) else gdal.Open(str(r))
+                for r in rasters]
+    ref_ds = datasets[0]
+    ref_srs = ref_ds.GetProjection()
+    geom = aoi_geometry(aoi, srs=ref_srs, aoi_crs=aoi_crs) \
+        if aoi is not None else None
+
+    # Cache key, only when all rasters are files
+    key = None
+    file_keys = [_file_key(ds.GetDescription()) for ds in datasets]
+    if use_cache and out_path is None and all(file_keys):
+        aoi_hash = hashlib.sha1(geom.wkb).hexdigest() \
+            if geom is not None else None
+        key = hashlib.sha1(json.dumps(
+            [file_keys, band_num, valid_value, aoi_hash,
+             overview]).encode()).hexdigest()
+        cached = _cache_get(key)
+        if cached is not None:
+            logger.debug('Using cached valid counts: '
+                         '{}'.format(ref_ds.GetDescription()))
+            return cached
+
+    ref_band = _band(ref_ds, band_num, overview)
+    ref_gt = _band_geotransform(ref_ds, ref_band)
+    pixel_area = abs(ref_gt[1] * ref_gt[5])
+
+    # Bands of each raster with their offset from the reference grid
+    sources = []
+    temp_vrts = []
+    for ds in datasets:
+        band = _band(ds, band_num, overview)
+        offset = None
+        if _same_srs(ref_srs, ds.GetProjection()):
+            offset = _pixel_offset(ref_gt, _band_geotransform(ds, band))
+        if offset is None:
+            logger.debug('Resampling to reference grid: '
+                         '{}'.format(ds.GetDescription()))
+            vrt = '/vsimem/valid_stats_{}.vrt'.format(uuid.uuid4().hex)
+            ds = gdal.Warp(vrt, ds, format='VRT', dstSRS=ref_srs,
+                           outputBounds=(ref_gt[0],
+                                         ref_gt[3] + ref_band.YSize * ref_gt[5],
+                                         ref_gt[0] + ref_band.XSize * ref_gt[1],
+                                         ref_gt[3]),
+                           width=ref_band.XSize, height=ref_band.YSize,
+                           resampleAlg='near')
+            temp_vrts.append((vrt, ds))
+            band = ds.GetRasterBand(band_num)
+            offset = (0, 0)
+        sources.append((band, band.GetNoDataValue(), offset))
+
+    aoi_lyr = None
+    pixel_window = None
+    if geom is not None:
+        aoi_ds, aoi_lyr = _aoi_layer(geom, ref_srs)
+        pixel_window = bounds2pixel_window(geom.bounds, ref_gt)
+
+    dst_band = None
+    if out_path:
+        dst_ds = gdal.GetDriverByName('GTiff').Create(
+            str(out_path), ref_band.XSize, ref_band.YSize, 1, gdal.GDT_Byte,
+            options=['TILED=YES', 'COMPRESS=LZW'])
+        dst_ds.SetGeoTransform(ref_gt)
+        dst_ds.SetProjection(ref_srs)
+        dst_band = dst_ds.GetRasterBand(1)
+
+    valid_total = 0
+    total = 0
+    for xoff, yoff, xsize, ysize in block_windows(ref_band,
+                                                  target_size=block_size,
+                                                  pixel_window=pixel_window):
+        if aoi_lyr is not None:
+            considered = rasterize_window(aoi_lyr, ref_gt, ref_srs,
+                                          xoff, yoff, xsize, ysize,
+                                          dtype=gdal.GDT_Byte) > 0
+        else:
+            considered = np.ones((ysize, xsize), dtype=bool)
+        valid = considered.copy()
+        for band, nodata, (dx, dy) in sources:
+            if not valid.any():
+                break
+            arr, inside = _read_window(band, xoff - dx, yoff - dy,
+                                       xsize, ysize)
+            valid &= _valid(arr, inside, nodata, valid_value)
+        total += int(considered.sum())
+        valid_total += int(valid.sum())
+        if dst_band is not None:
+            dst_band.WriteArray(valid.astype(np.uint8), xoff, yoff)
+
+    dst_band = None
+    dst_ds = None
+    aoi_lyr = None
+    aoi_ds = None
+    # Release all references to the VRTs before unlinking them
+    sources = None
+    band = None
+    ds = None
+    vrt_paths = [vrt for vrt, _vrt_ds in temp_vrts]
+    temp_vrts = None
+    for vrt in vrt_paths:
+        gdal.Unlink(vrt)
+
+    counts = ValidCounts(valid_total, total, pixel_area)
+    if key is not None:
+        _cache_put(key, counts)
+
+    return counts
+
+
+def valid_percent(rasters, **kwargs):
+    """Percent of pixels (within aoi, if provided) that are valid in all of
+    rasters, see valid_counts."""
+    counts = valid_counts(rasters, **kwargs)
+    if counts.total == 0:
+        return 0.0
+
+    return round(counts.valid / counts.total * 100, 2)
+
+
+def valid_density(rasters, aoi, aoi_crs=None, **kwargs):
+    """Area of pixels valid in all of rasters within aoi, divided by the
+    area of aoi, see valid_counts."""
+    ref = rasters[0] if isinstance(rasters, (list, tuple)) else rasters
+    ref_ds = ref if isinstance(ref, gdal.Dataset) else gdal.Open(str(ref))
+    geom = aoi_geometry(aoi, srs=ref_ds.GetProjection(), aoi_crs=aoi_crs)
+    ref_ds = None
+    if geom.area == 0:
+        return 0.0
+    counts = valid_counts(rasters, aoi=geom, **kwargs)
+
+    return counts.valid * counts.pixel_area / geom.area
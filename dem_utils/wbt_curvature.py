@@ -1,37 +1,22 @@
 import argparse
 import os
 from pathlib import Path
-import subprocess
-from subprocess import PIPE
 
 from misc_utils.logging_utils import create_logger
+from dem_utils.wbt_runner import run_tool
 
 
 logger = create_logger(__name__, 'sh', 'INFO')
 
 # Params
-wbt = 'whitebox_tools.exe'
 curv_prof = 'ProfileCurvature'
 curv_plan = 'PlanCurvature'
 curv_tang = 'TangentialCurvature'
 curv_tot = 'TotalCurvature'
 
 
-def run_subprocess(command):
-    proc = subprocess.Popen(command, stdout=PIPE, stderr=PIPE, shell=True)
-    for line in iter(proc.stdout.readline, b''):
-        logger.info('(subprocess) {}'.format(line.decode()))
-    proc_err = ""
-    for line in iter(proc.stderr.readline, b''):
-        proc_err += line.decode()
-    if proc_err:
-        logger.info('(subprocess) {}'.format(proc_err))
-    output, error = proc.communicate()
-    logger.debug('Output: {}'.format(output.decode()))
-    logger.debug('Err: {}'.format(error.decode()))
-
-
-def wbt_curvature(in_dem, out_curv=None, out_dir=None, curv_type=curv_prof, dryrun=False):
+def wbt_curvature(in_dem, out_curv=None, out_dir=None, curv_type=curv_prof, dryrun=False,
+                  threads=None):
     in_dem = Path(in_dem)
     if not out_curv:
         if not out_dir:
@@ -43,14 +28,11 @@ def wbt_curvature(in_dem, out_curv=None, out_dir=None, curv_type=curv_prof, dryr
     logger.info('Input DEM: {}'.format(in_dem))
     logger.info('Output:    {}'.format(out_curv))
     logger.info('Type:      {}'.format(curv_type))
-    cmd = '{} -r={} --dem={} --output={}'.format(wbt, curv_type, in_dem, out_curv)
-    logger.debug('Cmd: {}'.format(cmd))
-    
+    args = {'dem': in_dem, 'output': out_curv}
+
     if not dryrun:
         logger.info('Running WBT Curvature - {}...'.format(curv_type))
-        run_subprocess(cmd)
-    else:
-        logger.info(cmd)
+    run_tool(curv_type, args, threads=threads, dryrun=dryrun)
 
     logger.info('Done.')
 
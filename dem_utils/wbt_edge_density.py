@@ -1,34 +1,19 @@
 import argparse
 import os
 from pathlib import Path
-import subprocess
-from subprocess import PIPE
 
 from misc_utils.logging_utils import create_logger
+from dem_utils.wbt_runner import run_tool
 
 
 logger = create_logger(__name__, 'sh', 'INFO')
 
 # Params
-wbt = 'whitebox_tools.exe'
 edge_density = 'EdgeDensity'
 
 
-def run_subprocess(command):
-    proc = subprocess.Popen(command, stdout=PIPE, stderr=PIPE, shell=True)
-    for line in iter(proc.stdout.readline, b''):
-        logger.info('(subprocess) {}'.format(line.decode()))
-    proc_err = ""
-    for line in iter(proc.stderr.readline, b''):
-        proc_err += line.decode()
-    if proc_err:
-        logger.info('(subprocess) {}'.format(proc_err))
-    output, error = proc.communicate()
-    logger.debug('Output: {}'.format(output.decode()))
-    logger.debug('Err: {}'.format(error.decode()))
-
-
-def wbt_edge_density(in_dem, out_path=None, filter_size=11, norm_diff=2, out_dir=None, dryrun=False):
+def wbt_edge_density(in_dem, out_path=None, filter_size=11, norm_diff=2, out_dir=None, dryrun=False,
+                     threads=None):
     in_dem = Path(in_dem)
     if not out_path:
         out_path = Path(out_dir) / '{}_ED_f{}nd{}{}'.format(in_dem.stem, filter_size,
@@ -37,15 +22,12 @@ def wbt_edge_density(in_dem, out_path=None, filter_size=11, norm_diff=2, out_dir
 
     logger.info('Input DEM: {}'.format(in_dem))
     logger.info('Output:    {}'.format(out_path))
-    cmd = '{} -r={} --dem={} --output={} --filter={} --norm_diff={}'.format(wbt, edge_density, in_dem, out_path,
-                                                                            filter_size, norm_diff)
-    logger.debug('Cmd: {}'.format(cmd))
-    
+    args = {'dem': in_dem, 'output': out_path, 'filter': filter_size,
+            'norm_diff': norm_diff}
+
     if not dryrun:
         logger.info('Running WBT EdgeDensity')
-        run_subprocess(cmd)
-    else:
-        logger.info('Dryrun -- command: {}'.format(cmd))
+    run_tool(edge_density, args, threads=threads, dryrun=dryrun)
     logger.info('Done.')
 
 
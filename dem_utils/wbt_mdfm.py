@@ -1,28 +1,19 @@
 import argparse
 import os
 from pathlib import Path
-import subprocess
-from subprocess import PIPE
 
 from misc_utils.logging_utils import create_logger
+from dem_utils.wbt_runner import run_tool
 
+logger = create_logger(__name__, 'sh', 'INFO')
 
 # Params
-wbt = 'whitebox_tools.exe'
 mdfm = 'MaxDifferenceFromMean'
 
 
-def run_subprocess(command):
-    proc = subprocess.Popen(command, stdout=PIPE, stderr=PIPE, shell=True)
-    # proc.wait()
-    output, error = proc.communicate()
-    logger.debug('Output: {}'.format(output.decode()))
-    logger.debug('Err: {}'.format(error.decode()))
-
-
 def wbt_mdfm(dem, out_dir=None, out_mag=None, out_scale=None,
              min_scale=1, max_scale=50, step=5, vw=False,
-             dryrun=False):
+             dryrun=False, threads=None):
     logger.info('Setting up whitebox_tool.exe MaximumDifferenceFromMean')
     if not out_mag:
         out_mag = out_dir / '{}_mdfm_mag_{}-{}-{}{}'.format(dem.stem, min_scale,
@@ -40,17 +31,12 @@ def wbt_mdfm(dem, out_dir=None, out_mag=None, out_scale=None,
     Step: {}
     """.format(dem, out_mag, out_scale, min_scale, max_scale, step))
 
-    # Create command string
-    cmd = "{} -r={} --dem={} --out_mag={} --out_scale={} " \
-          "--min_scale={} --max_scale={} --step={}""".format(wbt, mdfm, dem, out_mag, out_scale,
-                                                             min_scale, max_scale, step)
-    if vw:
-        cmd += ' -v'
+    args = {'dem': dem, 'out_mag': out_mag, 'out_scale': out_scale,
+            'min_scale': min_scale, 'max_scale': max_scale, 'step': step}
 
     if not dryrun:
         logger.info('Running MaximumDifferenceFromMean...')
-        logger.debug(cmd)
-        run_subprocess(cmd)
+        run_tool(mdfm, args, threads=threads, verbose=vw)
 
     logger.info('Done')
 
@@ -1,30 +1,20 @@
 import argparse
 import os
 from pathlib import Path, PurePath
-import subprocess
-from subprocess import PIPE
 
 from misc_utils.logging_utils import create_logger
+from dem_utils.wbt_runner import run_tool
 
 
 logger = create_logger(__name__, 'sh', 'INFO')
 
 # Params
-wbt = 'whitebox_tools.exe'
 med = 'MaxElevationDeviation'
 
 
-def run_subprocess(command):
-    proc = subprocess.Popen(command, stdout=PIPE, stderr=PIPE, shell=True)
-    # proc.wait()
-    output, error = proc.communicate()
-    logger.debug('Output: {}'.format(output.decode()))
-    logger.debug('Err: {}'.format(error.decode()))
-
-
 def wbt_med(dem, out_dir=None, out_mag=None, out_scale=None,
             min_scale=1, max_scale=50, step=5, vw=False,
-            dryrun=False):
+            dryrun=False, threads=None):
     logger.info('Setting up whitebox_tool.exe MaxElevationDeviation')
     if not isinstance(dem, PurePath):
         dem = Path(dem)
@@ -46,17 +36,12 @@ def wbt_med(dem, out_dir=None, out_mag=None, out_scale=None,
     Step: {}
     """.format(dem, out_mag, out_scale, min_scale, max_scale, step))
 
-    # Create command string
-    cmd = "{} -r={} --dem={} --out_mag={} --out_scale={} " \
-          "--min_scale={} --max_scale={} --step={}""".format(wbt, med, dem, out_mag, out_scale,
-                                                             min_scale, max_scale, step)
-    if vw:
-        cmd += ' -v'
+    args = {'dem': dem, 'out_mag': out_mag, 'out_scale': out_scale,
+            'min_scale': min_scale, 'max_scale': max_scale, 'step': step}
 
     if not dryrun:
         logger.info('Running MaxElevationDeviation...')
-        logger.debug(cmd)
-        run_subprocess(cmd)
+        run_tool(med, args, threads=threads, verbose=vw)
 
     logger.info('Done')
 
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Shared runner for WhiteboxTools. Tools are run directly (not through a
+shell) with their output logged, and limited to a number of threads.
+run_derivatives runs several tools on one DEM concurrently, dividing a
+total thread budget between them, and keys each tool's outputs on the
+contents of the DEM and the tool's parameters, so rerunning with the same
+DEM and parameters does not run the tools again. The runtime of each tool
+is reported and recorded as a telemetry stage (see misc_utils.profiler).
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+from pathlib import Path
+import platform
+import subprocess
+import time
+
+import pandas as pd
+
+from misc_utils.logging_utils import create_logger
+from misc_utils.pipeline import StepCache, Step
+from misc_utils.profiler import stage, in_current_stage
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+# Executable, overridable for testing or non-standard installs
+WBT = 'whitebox_tools.exe' if platform.system() == 'Windows' \
+    else 'whitebox_tools'
+# Arguments of tools that are output paths
+OUTPUT_ARGS = ['output', 'out_mag', 'out_scale']
+CACHE_NAME = 'wbt_derivatives.json'
+
+
+def wbt_command(tool, args, threads=None, verbose=False):
+    """
+    Command (list of args) running tool with args, a dict of
+    {argument name: value}, e.g. {'dem': 'dem.tif', 'output': 'out.tif'}.
+    """
+    command = [WBT, '-r={}'.format(tool)]
+    command.extend(['--{}={}'.format(k, v) for k, v in args.items()])
+    if threads:
+        command.append('--max_procs={}'.format(threads))
+    if verbose:
+        command.append('-v')
+
+    return command
+
+
+def run_tool(tool, args, threads=None, verbose=False, dryrun=False):
+    """
+    Run a WhiteboxTools tool, raising subprocess.CalledProcessError if it
+    fails.
+
+    Parameters
+    ----------
+    tool : str
+        Name of tool, e.g. 'SurfaceAreaRatio'.
+    args : dict
+        {argument name: value} passed to the tool.
+    threads : int
+        Maximum number of threads the tool may use.
+    verbose : bool
+        Run the tool with its verbose flag.
+    dryrun : bool
+        Only log the command.
+
+    Returns
+    -------
+    float : runtime in seconds
+    """
+    command = wbt_command(tool, args, threads=threads, verbose=verbose)
+    if dryrun:
+        logger.info('Dryrun -- command: {}'.format(' '.join(command)))
+        return 0.0
+    logger.debug('Running: {}'.format(' '.join(command)))
+    start = time.time()
+    with stage('wbt_{}'.format(tool), threads=threads):
+        proc = subprocess.run(command, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+    runtime = time.time() - start
+    output = proc.stdout.decode(errors='replace')
+    for line in output.splitlines():
+        logger.debug('(subprocess) {}'.format(line))
+    if proc.returncode != 0:
+        logger.error('{} failed:\n{}'.format(tool, output))
+        raise subprocess.CalledProcessError(proc.returncode, command,
+                                            output=output)
+
+    return runtime
+
+
+class Derivative:
+    """
+    A WhiteboxTools tool to run on a DEM.
+
+    Parameters
+    ----------
+    name : str
+        Unique name of the derivative.
+    tool : str
+        Name of tool.
+    args : dict
+        {argument name: value} passed to the tool, other than the DEM.
+        Outputs are the values of the arguments in OUTPUT_ARGS.
+    """
+    def __init__(self, name, tool, args):
+        self.name = name
+        self.tool = tool
+        self.args = dict(args)
+
+    @property
+    def outputs(self):
+        return [str(self.args[a]) for a in OUTPUT_ARGS if a in self.args]
+
+    @property
+    def params(self):
+        """Arguments other than outputs, that change the outputs."""
+        params = {k: v for k, v in self.args.items() if k not in OUTPUT_ARGS}
+        params['tool'] = self.tool
+
+        return params
+
+    def __repr__(self):
+        return 'Derivative({}, {})'.format(self.name, self.tool)
+
+
+def run_derivatives(dem, derivatives, threads=None, cache_path=None,
+                    force=False, dryrun=False):
+    """
+    Run WhiteboxTools derivatives of a DEM concurrently.
+
+    Parameters
+    ----------
+    dem : str
+        Path to DEM.
+    derivatives : list
+        Derivatives to create.
+    threads : int
+        Total threads to divide between the tools run at once, default the
+        number of CPUs.
+    cache_path : str
+        JSON file recording the keys outputs were created with, defaults
+        to a file in the directory of the first output.
+    force : bool
+        True to run tools even if their outputs are up to date.
+    dryrun : bool
+        True to only report which tools would be run.
+
+    Returns
+    -------
+    pd.DataFrame : one row per derivative, with status 'ran', 'cached' or
+    'failed', runtime (s) and threads.
+    """
+    if not derivatives:
+        raise ValueError('No derivatives to run.')
+    no_outputs = [d.name for d in derivatives if not d.outputs]
+    if no_outputs:
+        logger.error('Derivatives without outputs ({}): '
+                     '{}'.format(OUTPUT_ARGS, no_outputs))
+        raise ValueError('Derivatives without outputs: '
+                         '{}'.format(no_outputs))
+    names = [d.name for d in derivatives]
+    if len(set(names)) != len(names):
+        logger.error('Duplicate derivative names: {}'.format(names))
+        raise ValueError(names)
+    if threads is None:
+        threads = os.cpu_count() or 1
+    if cache_path is None:
+        cache_path = Path(derivatives[0].outputs[0]).parent / CACHE_NAME
+    cache = StepCache(cache_path)
+
+    # Check which are up to date before dividing the threads
+    records = {}
+    to_run = []
+    for d in derivatives:
+        step = Step(d.name, None, inputs=[dem], outputs=d.outputs,
+                    params=d.params)
+        key = cache.key(step)
+        if not force and cache.is_current(step, key):
+            logger.info('Up to date, skipping: {}'.format(d.name))
+            records[d.name] = {'status': 'cached', 'runtime': None,
+                               'threads': None}
+        else:
+            to_run.append((d, step, key))
+    if not to_run:
+        return _report(derivatives, records)
+    jobs = min(len(to_run), threads)
+    job_threads = max(1, threads // jobs)
+
+    def run_job(d, step, key):
+        if not dryrun:
+            for o in d.outputs:
+                os.makedirs(os.path.dirname(os.path.abspath(o)),
+                            exist_ok=True)
+        logger.info('Running {} ({}) with {} threads...'.format(
+            d.name, d.tool, job_threads))
+        args = dict(d.args)
+        args['dem'] = str(dem)
+        runtime = run_tool(d.tool, args, threads=job_threads, dryrun=dryrun)
+        if dryrun:
+            return {'status': 'pending', 'runtime': None,
+                    'threads': job_threads}
+        missing = [o for o in d.outputs if not os.path.exists(o)]
+        if missing:
+            raise FileNotFoundError('{} did not create: {}'.format(d.tool,
+                                                                   missing))
+        cache.record(step, key, runtime=runtime)
+        logger.info('Finished {} ({:.1f}s)'.format(d.name, runtime))
+
+        return {'status': 'ran', 'runtime': round(runtime, 1),
+                'threads': job_threads}
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(in_current_stage(run_job), *job):
+                   job[0].name
+                   for job in to_run}
+        for f in as_completed(futures):
+            name = futures[f]
+            try:
+                records[name] = f.result()
+            except Exception as e:
+                logger.error('Derivative failed: {}\n{}'.format(name, e))
+                records[name] = {'status': 'failed', 'runtime': None,
+                                 'threads': job_threads, 'error': str(e)}
+
+    return _report(derivatives, records)
+
+
+def _report(derivatives, records):
+    report = pd.DataFrame([dict(name=d.name, tool=d.tool, **records[d.name])
+                           for d in derivatives])
+    logger.info('WhiteboxTools derivatives:\n{}'.format(
+        report[['name', 'tool', 'status', 'runtime', 'threads']].to_string(
+            index=False)))
+    n_failed = (report['status'] == 'failed').sum()
+    if n_failed:
+        logger.warning('Failed derivatives: {} of {}'.format(
+            n_failed, len(report)))
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a WhiteboxTools tool '
+                                                 'on DEMs, skipping DEMs '
+                                                 'already processed with '
+                                                 'the same parameters.')
+    parser.add_argument('tool', type=str,
+                        help='Name of tool, e.g. SurfaceAreaRatio.')
+    parser.add_argument('dems', nargs='+', type=os.path.abspath,
+                        help='DEMs to process.')
+    parser.add_argument('-od', '--out_dir', type=os.path.abspath,
+                        help='Directory to write outputs to, named '
+                             '[dem name]_[tool].tif, default the directory '
+                             'of each DEM.')
+    parser.add_argument('-a', '--args', nargs='*', default=[],
+                        help='Tool arguments as name=value, e.g. filter=11.')
+    parser.add_argument('-t', '--threads', type=int,
+                        help='Total threads to use.')
+    parser.add_argument('--force', action='store_true',
+                        help='Run even if outputs are up to date.')
+    parser.add_argument('--dryrun', action='store_true',
+                        help='Print commands without running them.')
+
+    args = parser.parse_args()
+
+    tool_args = dict([a.split('=', 1) for a in args.args])
+    for dem in args.dems:
+        dem = Path(dem)
+        out_dir = Path(args.out_dir) if args.out_dir else dem.parent
+        output = out_dir / '{}_{}{}'.format(dem.stem, args.tool, dem.suffix)
+        run_derivatives(dem, [Derivative(args.tool, args.tool,
+                                         dict(tool_args, output=output))],
+                        threads=args.threads, force=args.force,
+                        dryrun=args.dryrun)
@@ -1,34 +1,18 @@
 import argparse
 import os
 from pathlib import Path
-import subprocess
-from subprocess import PIPE
 
 from misc_utils.logging_utils import create_logger
+from dem_utils.wbt_runner import run_tool
 
 
 logger = create_logger(__name__, 'sh', 'INFO')
 
 # Params
-wbt = 'whitebox_tools.exe'
 sar = 'SurfaceAreaRatio'
 
 
-def run_subprocess(command):
-    proc = subprocess.Popen(command, stdout=PIPE, stderr=PIPE, shell=True)
-    for line in iter(proc.stdout.readline, b''):
-        logger.info('(subprocess) {}'.format(line.decode()))
-    proc_err = ""
-    for line in iter(proc.stderr.readline, b''):
-        proc_err += line.decode()
-    if proc_err:
-        logger.info('(subprocess) {}'.format(proc_err))
-    output, error = proc.communicate()
-    logger.debug('Output: {}'.format(output.decode()))
-    logger.debug('Err: {}'.format(error.decode()))
-
-
-def wbt_sar(in_dem, out_sar=None, out_dir=None, dryrun=False):
+def wbt_sar(in_dem, out_sar=None, out_dir=None, dryrun=False, threads=None):
     in_dem = Path(in_dem)
     if not out_sar:
         if not out_dir:
@@ -39,14 +23,11 @@ def wbt_sar(in_dem, out_sar=None, out_dir=None, dryrun=False):
 
     logger.info('Input DEM: {}'.format(in_dem))
     logger.info('Output:    {}'.format(out_sar))
-    cmd = '{} -r={} --dem={} --output={}'.format(wbt, sar, in_dem, out_sar)
-    logger.debug('Cmd: {}'.format(cmd))
-    
+    args = {'dem': in_dem, 'output': out_sar}
+
     if not dryrun:
         logger.info('Running WBT SurfaceAreaRatio...')
-        run_subprocess(cmd)
-    else:
-        logger.info(cmd)
+    run_tool(sar, args, threads=threads, dryrun=dryrun)
 
     logger.info('Done.')
 
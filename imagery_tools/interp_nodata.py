@@ -3,7 +3,7 @@ import os
 import sys
 
 sys.path.insert(1, r'C:\code\pgc-code-all')
-from misc_utils.rio_utils import fill_internal_nodata
+from misc_utils.nodata_fill import fill_voids, METHODS, IDW, HALO
 from misc_utils.logging_utils import create_logger
 
 logger = create_logger(__name__, 'sh', 'INFO')
@@ -14,9 +14,14 @@ if __name__ == '__main__':
     parser.add_argument('-i', '--image', type=os.path.abspath)
     parser.add_argument('-o', '--out', type=os.path.abspath)
     parser.add_argument('-a', '--aoi', type=os.path.abspath)
+    parser.add_argument('-m', '--method', choices=METHODS, default=IDW)
+    parser.add_argument('--halo', type=int, default=HALO,
+                        help='Maximum distance to fill from, in pixels.')
+    parser.add_argument('--max_workers', type=int)
 
     args = parser.parse_args()
 
     logger.info('Filling internal NoData...')
-    fill_internal_nodata(img=args.image, out=args.out, aoi=args.aoi)
+    fill_voids(args.image, args.out, aoi=args.aoi, method=args.method,
+               halo=args.halo, max_workers=args.max_workers)
     logger.info('Done.')
@@ -10,7 +10,7 @@ import geopandas as gpd
 import os, datetime, sys, argparse, re
 import pprint
 
-from misc_utils.id_parse_utils import date_words, mfp_ids
+from misc_utils.id_parse_utils import date_words, isin_mfp
 from misc_utils.logging_utils import create_logger
 
 logger = create_logger(__name__, 'sh', 'INFO')
@@ -131,7 +131,7 @@ def clean_dataframe(dataframe, keep_swir, out_path=None, drop_mfp=False,
         if drop_online_only:
             logger.info('(Online only)')
         len_b4 = len(dataframe)
-        dataframe = dataframe[~dataframe['catalogid'].isin(mfp_ids(online=drop_online_only))]
+        dataframe = dataframe[~isin_mfp(dataframe['catalogid'], online=drop_online_only)]
         len_after = len(dataframe)
         if len_b4 != len_after:
             logger.info('IDs found in MFP and removed: {}'.format(len_b4-len_after))
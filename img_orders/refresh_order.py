@@ -12,7 +12,7 @@ import os
 import geopandas as gpd
 
 from selection_utils.query_danco import query_footprint, mono_noh, stereo_noh, generate_rough_aoi_where
-from misc_utils.id_parse_utils import date_words, remove_onhand, onhand_ids
+from misc_utils.id_parse_utils import date_words, remove_onhand, isin_onhand
 from misc_utils.logging_utils import create_logger
 from misc_utils.gpd_utils import select_in_aoi
 
@@ -245,9 +245,7 @@ if __name__ == '__main__':
                         drop_onhand=drop_onhand)
     
     if drop_onhand:
-        oh_ids = onhand_ids()
-        # not_onhand_ids = remove_onhand(selection['catalogid'])
-        selection = selection[~selection['catalogid'].isin(oh_ids)]
+        selection = selection[~isin_onhand(selection['catalogid'])]
 
     # Stats for printing to command line
     logger.info('IDs found: {:,}'.format(len(selection)))
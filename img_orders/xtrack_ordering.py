@@ -21,9 +21,10 @@ import geopandas as gpd
 
 from misc_utils.utm_area_calc import area_calc
 from misc_utils.logging_utils import create_logger
-from misc_utils.id_parse_utils import write_ids, get_platform_code, onhand_ids
+from misc_utils.id_parse_utils import write_ids, get_platform_code, \
+    isin_onhand, refresh_mfp, refresh_ordered
 from misc_utils.gpd_utils import select_in_aoi
-from selection_utils.query_danco import query_footprint, count_table
+from selection_utils.query_danco import query_footprint_chunks, count_table
 from selection_utils.danco_utils import create_cid_noh_where
 
 
@@ -153,12 +154,10 @@ def main(args):
     logger.info('Total table size with query: {:,}'.format(table_total))
 
     if remove_oh:
-        # Get all onhand and ordered ids
-        logger.info('Loading all onhand and ordered IDs...')
-        oh_ids = set(onhand_ids(update=update_ordered))
-        logger.info('Onhand and ordered IDs loaded: {:,}'.format(len(oh_ids)))
-    else:
-        oh_ids = set()
+        # Update index of onhand and ordered ids
+        logger.info('Updating index of onhand and ordered IDs...')
+        refresh_mfp()
+        refresh_ordered(update=update_ordered)
 
     # Load land shapefile if necessary
     if use_land:
@@ -170,20 +169,22 @@ def main(args):
     master = gpd.GeoDataFrame()
     limit = chunk_size
     offset = 0
-    while offset < table_total:
-        # Load chunk
-        logger.info('Loading chunk: {:,} - {:,}'.format(offset, offset+limit))
-        chunk = query_footprint(xtrack_tbl, columns=columns,
-                                # orderby=orderby, orderby_asc=False,
-                                where=where, limit=limit, offset=offset,
-                                dryrun=False)
+    # Chunks are streamed from a single query
+    chunks = query_footprint_chunks(xtrack_tbl, chunksize=chunk_size,
+                                    columns=columns,
+                                    # orderby=orderby, orderby_asc=False,
+                                    where=where)
+    for chunk in chunks:
+        logger.info('Loaded chunk: {:,} - {:,}'.format(offset, offset+limit))
+        # Increase offset
+        offset += limit
 
         remaining_records = len(chunk)
 
         # Remove records where both IDs are onhand
         if remove_oh:
             logger.info('Dropping records where both IDs are on onhand...')
-            chunk = chunk[~((chunk['catalogid1'].isin(oh_ids)) & (chunk['catalogid2'].isin(oh_ids)))]
+            chunk = chunk[~(isin_onhand(chunk['catalogid1']) & isin_onhand(chunk['catalogid2']))]
             remaining_records = len(chunk)
             logger.info('Remaining records: {:,}'.format(remaining_records))
             if remaining_records == 0:
@@ -214,13 +215,14 @@ def main(args):
         logger.info('Combining chunk with master...')
         master = pd.concat([master, chunk])
 
-        # Increase offset
-        offset += limit
-
     # Select n records with highest area
     master = master.sort_values(by=area_col)
-    master[cid1_oh_fld] = master[catid1_fld].isin(oh_ids)
-    master[cid2_oh_fld] = master[catid2_fld].isin(oh_ids)
+    if remove_oh:
+        master[cid1_oh_fld] = isin_onhand(master[catid1_fld])
+        master[cid2_oh_fld] = isin_onhand(master[catid2_fld])
+    else:
+        master[cid1_oh_fld] = False
+        master[cid2_oh_fld] = False
 
     if remove_oh:
         noh_str = ' not_on_hand'
@@ -17,7 +17,8 @@ from shapely.geometry import box
 import geopandas as gpd
 
 from misc_utils.logging_utils import create_logger
-from misc_utils.gdal_tools import clip_minbb, gdal_polygonize
+from misc_utils.gdal_tools import clip_minbb, gdal_polygonize, block_windows
+from misc_utils.polygonize import polygonize_blocks
 
 logger = create_logger(__name__, 'sh', 'DEBUG')
 
@@ -136,7 +137,17 @@ class Raster:
         -sample raster with window around point
     """
 
-    def __init__(self, raster_path):
+    def __init__(self, raster_path, lazy=True):
+        """
+        Parameters
+        ----------
+        raster_path : str
+            Path to raster.
+        lazy : bool
+            True to only read metadata on creation, with the pixel values
+            (Array, Mask, MaskedArray) read on first access. False to read
+            them immediately.
+        """
         self.src_path = raster_path
         self.data_src = gdal.Open(raster_path)
         self.geotransform = self.data_src.GetGeoTransform()
@@ -168,16 +179,105 @@ class Raster:
         #  otherwise default. This will allow setting nodata_val explicity.
         self.nodata_val = self.data_src.GetRasterBand(1).GetNoDataValue()
         self.dtype = self.data_src.GetRasterBand(1).DataType
+        self.block_size = self.data_src.GetRasterBand(1).GetBlockSize()
+
+        # Pixel values, read on first access of Array, Mask or MaskedArray.
+        # Defaults to all bands -- use GetBandAsArray() to return a single
+        # band
+        self._array = None
+        self._mask = None
+        self._masked_array = None
+        if not lazy:
+            self.load()
+
+    @property
+    def loaded(self):
+        """True if the pixel values have been read."""
+        return self._array is not None
+
+    def load(self):
+        """Read the pixel values of the raster."""
+        if self._array is None:
+            logger.debug('Reading array: {}'.format(self.src_path))
+            self._array = self.data_src.ReadAsArray()
+
+        return self._array
+
+    @property
+    def Array(self):
+        return self.load()
+
+    @Array.setter
+    def Array(self, array):
+        self._array = array
+        self._mask = None
+        self._masked_array = None
+
+    @property
+    def Mask(self):
+        if self._mask is None:
+            self._mask = self.Array == self.nodata_val
+        return self._mask
+
+    @Mask.setter
+    def Mask(self, mask):
+        self._mask = mask
+        self._masked_array = None
+
+    @property
+    def MaskedArray(self):
+        if self._masked_array is None:
+            self._masked_array = ma.masked_array(self.Array, mask=self.Mask)
+            np.ma.set_fill_value(self._masked_array, self.nodata_val)
+        return self._masked_array
+
+    @MaskedArray.setter
+    def MaskedArray(self, masked_array):
+        self._masked_array = masked_array
+
+    def ReadWindowArray(self, xoff, yoff, xsize, ysize, band_num=1):
+        """
+        Read a window of a single band, in pixel coordinates, without reading
+        the whole raster. If the raster has already been read, the window is
+        sliced from Array.
 
-        # Get the raster as an array
-        # Defaults to band 1 -- use ReadArray() to return stack
-        # of multiple bands
-        # TODO: Init these here, but then call as method to avoid loading all on Raster() call
-        # @property for lazy evaluation?
-        self.Array = self.data_src.ReadAsArray()
-        self.Mask = self.Array == self.nodata_val
-        self.MaskedArray = ma.masked_array(self.Array, mask=self.Mask)
-        np.ma.set_fill_value(self.MaskedArray, self.nodata_val)
+        Returns
+        -------
+        np.ndarray
+        """
+        if self.loaded and self.depth == 1:
+            return self._array[yoff:yoff + ysize, xoff:xoff + xsize]
+        band = self.data_src.GetRasterBand(band_num)
+
+        return band.ReadAsArray(xoff, yoff, xsize, ysize)
+
+    def iter_blocks(self, target_size=None, band_num=1, pixel_window=None):
+        """
+        Iterate over the raster in windows aligned to the native block size
+        of the raster, reading only one window at a time.
+
+        Parameters
+        ----------
+        target_size : int
+            Approximate size of windows in pixels, rounded to a whole number
+            of blocks. Default is a single block.
+        band_num : int
+            Band to read windows from.
+        pixel_window : tuple
+            (xmin, ymin, xmax, ymax) pixel extent to restrict windows to.
+
+        Yields
+        -------
+        RasterWindow
+        """
+        band = self.data_src.GetRasterBand(band_num)
+        if target_size is None:
+            target_size = 1
+        for xoff, yoff, xsize, ysize in block_windows(band,
+                                                      target_size=target_size,
+                                                      pixel_window=pixel_window):
+            yield RasterWindow.from_pixel_window(self, xoff, yoff, xsize, ysize,
+                                                 band_num=band_num)
 
     # def Masked_Array(self):
     #     masked_array = ma.masked_array(self.Array, mask=self.Mask)
@@ -443,7 +543,9 @@ class Raster:
         if out_mask_img is None:
             out_mask_img = r'/vsimem/mask.tif'
         self.WriteMask(out_path=out_mask_img)
-        gdal_polygonize(img=out_mask_img, out_vec=out_vec, **kwargs)
+        # Polygons for both masked and unmasked areas
+        kwargs.setdefault('mask_nodata', False)
+        polygonize_blocks(out_mask_img, out_vec=out_vec, **kwargs)
 
     def NDVI(self, out_path, red_num, nir_num):
         ndvi_arr = self.ndvi_array(red_num, nir_num)
@@ -586,14 +688,36 @@ class Raster:
 
 
 class RasterWindow:
-    def __init__(self, raster, window_size, center):
+    def __init__(self, raster, window_size, center, band_num=1):
         self.raster = raster
         self.window_size = window_size  # x, y
         self.center = center
+        self.band_num = band_num
         self.py, self.px = raster.geo2pixel(center)
         self.x_origin = center[1] - (window_size[1]/2)*self.raster.pixel_width
         self.y_origin = center[0] - (window_size[0]/2)*self.raster.pixel_height
         self._window = None
+        self._bounds = None
+
+    @classmethod
+    def from_pixel_window(cls, raster, xoff, yoff, xsize, ysize, band_num=1):
+        """
+        Create a window from an offset and size in pixel coordinates, as
+        generated by Raster.iter_blocks.
+        """
+        center = raster.pixel2geo((yoff + ysize // 2, xoff + xsize // 2))
+        rw = cls(raster, (ysize, xsize), center, band_num=band_num)
+        rw.py, rw.px = yoff + ysize // 2, xoff + xsize // 2
+        rw.x_origin = raster.x_origin + xoff * raster.pixel_width
+        rw.y_origin = raster.y_origin + yoff * raster.pixel_height
+        rw._bounds = (yoff, yoff + ysize, xoff, xoff + xsize)
+        return rw
+
+    @property
+    def pixel_window(self):
+        """Window as (xoff, yoff, xsize, ysize) in pixel coordinates."""
+        ymin, ymax, xmin, xmax = self.window_bounds()
+        return xmin, ymin, xmax - xmin, ymax - ymin
 
     @property
     def window(self):
@@ -608,6 +732,8 @@ class RasterWindow:
         py: int 125
         px: int 100
         """
+        if self._bounds is not None:
+            return self._bounds
         # Get window around center point
         # Get size in y, x directions
         y_sz = self.window_size[0]
@@ -657,12 +783,16 @@ class RasterWindow:
     def get_window(self, masked=True) -> np.ma.masked_array:
         ymin, ymax, xmin, xmax = self.window_bounds()
         if ymin < 0 or xmin < 0 or \
-                ymax > self.raster.Array.shape[0] or \
-                xmax > self.raster.Array.shape[1]:
+                ymax > self.raster.y_sz or \
+                xmax > self.raster.x_sz:
             # create array with nans
             window = self.create_exceed_window(ymin, ymax, xmin, xmax)
         else:
-            window = self.raster.Array[ymin:ymax, xmin:xmax].astype(np.float32)
+            # Read only the window, unless the raster is already in memory
+            window = self.raster.ReadWindowArray(xmin, ymin,
+                                                 xmax - xmin, ymax - ymin,
+                                                 band_num=self.band_num)
+            window = window.astype(np.float32)
         if masked:
             window = np.ma.masked_where(window == self.raster.nodata_val,
                                         window)
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Run many raster clips (gdal.Warp to a cutline or gdal.Translate to a
+projWin) concurrently in a bounded pool of worker processes, each with
+limits on GDAL threads, block cache and warp memory so the workers share
+the machine rather than oversubscribe it. Results are returned in the same
+order as the clips were submitted.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+
+from osgeo import gdal
+
+from misc_utils.logging_utils import create_logger
+
+gdal.UseExceptions()
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+VSIMEM = '/vsimem'
+# Per worker limits
+WARP_MEMORY = 512  # MB
+CACHE_MAX = 256  # MB
+WARP = 'warp'
+TRANSLATE = 'translate'
+
+
+def warp_task(src, dst, cutline_ds, cutline_layer=None, **warp_kwargs):
+    """
+    Clip src to a cutline with gdal.Warp, cropping to the cutline and keeping
+    the source resolution.
+
+    Parameters
+    ----------
+    src : str
+        Raster to clip.
+    dst : str
+        Path to write clipped raster to.
+    cutline_ds : str
+        Path to cutline datasource.
+    cutline_layer : str
+        Layer within cutline_ds, for multi-layer formats.
+    warp_kwargs : dict
+        Additional gdal.WarpOptions arguments.
+
+    Returns
+    -------
+    dict : task to pass to run_clips
+    """
+    return {'mode': WARP, 'src': str(src), 'dst': str(dst),
+            'cutline_ds': str(cutline_ds), 'cutline_layer': cutline_layer,
+            'kwargs': warp_kwargs}
+
+
+def translate_task(src, dst, projWin, **translate_kwargs):
+    """Clip src to projWin with gdal.Translate. See warp_task."""
+    return {'mode': TRANSLATE, 'src': str(src), 'dst': str(dst),
+            'projWin': projWin, 'kwargs': translate_kwargs}
+
+
+def _init_worker(num_threads, cache_max):
+    gdal.SetConfigOption('GDAL_NUM_THREADS', str(num_threads))
+    gdal.SetCacheMax(cache_max * 1024 * 1024)
+
+
+def _clip(task, num_threads=1, warp_memory=WARP_MEMORY):
+    """Perform a single clip task, returning the output path or None if
+    GDAL did not create the output."""
+    src, dst = task['src'], task['dst']
+    logger.debug('Clipping: {} -> {}'.format(src, dst))
+    src_ds = gdal.Open(src, gdal.GA_ReadOnly)
+    if task['mode'] == WARP:
+        gt = src_ds.GetGeoTransform()
+        warp_options = gdal.WarpOptions(
+            cutlineDSName=task['cutline_ds'],
+            cutlineLayer=task['cutline_layer'],
+            cropToCutline=True,
+            targetAlignedPixels=True,
+            xRes=gt[1],
+            yRes=gt[5],
+            multithread=num_threads > 1,
+            warpMemoryLimit=warp_memory,
+            warpOptions=['NUM_THREADS={}'.format(num_threads)],
+            **task['kwargs'])
+        output = gdal.Warp(dst, src_ds, options=warp_options)
+    else:
+        output = gdal.Translate(dst, src_ds, projWin=task['projWin'],
+                                **task['kwargs'])
+    src_ds = None
+    if output is None:
+        logger.warning('Unable to clip raster: {}'.format(src))
+        return None
+    # Close to flush to disk
+    output = None
+
+    return dst
+
+
+def _run_clip(args):
+    return _clip(*args)
+
+
+def run_clips(tasks, max_workers=None, num_threads=None,
+              warp_memory=WARP_MEMORY, cache_max=CACHE_MAX):
+    """
+    Run clip tasks concurrently.
+
+    Clips writing to (or reading a cutline from) /vsimem are run in threads
+    of this process, as /vsimem is not shared with worker processes; GDAL
+    releases the GIL while warping, so these still run concurrently.
+
+    Parameters
+    ----------
+    tasks : list
+        Tasks created with warp_task or translate_task.
+    max_workers : int
+        Maximum number of concurrent clips. Default is the number of CPUs,
+        up to the number of tasks.
+    num_threads : int
+        GDAL_NUM_THREADS for each worker. Default is the number of CPUs
+        divided between the workers.
+    warp_memory : int
+        Warp memory limit for each worker, in MB.
+    cache_max : int
+        GDAL block cache limit for each worker process, in MB.
+
+    Returns
+    -------
+    list : output path of each task (None where the output was not
+    created), in the order of tasks. GDAL errors are raised.
+    """
+    if not tasks:
+        return []
+    cpus = os.cpu_count() or 1
+    if max_workers is None:
+        max_workers = cpus
+    max_workers = max(1, min(max_workers, len(tasks)))
+    if num_threads is None:
+        num_threads = max(1, cpus // max_workers)
+
+    args = [(t, num_threads, warp_memory) for t in tasks]
+    in_mem = any([str(v).startswith(VSIMEM)
+                  for t in tasks for v in (t['src'], t['dst'],
+                                           t.get('cutline_ds'))])
+    logger.info('Clipping {} raster(s) with {} worker(s)...'.format(
+        len(tasks), max_workers))
+    if max_workers == 1:
+        results = [_run_clip(a) for a in args]
+    elif in_mem:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_run_clip, args))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 initializer=_init_worker,
+                                 initargs=(num_threads, cache_max)) as executor:
+            results = list(executor.map(_run_clip, args))
+
+    return results
@@ -6,7 +6,9 @@ Created on Tue May 21 13:11:35 2019
 Transfer any files in src and not in dest to dest
 """
 
-import os, shutil, tqdm, argparse
+import os, argparse
+
+from misc_utils.transfer import transfer_files, JOURNAL_NAME
 
 
 def find_missing_files(src_path, dst_path, rel_path_src, rel_path_dst, use_exts=None):
@@ -33,6 +35,7 @@ def find_missing_files(src_path, dst_path, rel_path_src, rel_path_dst, use_exts=
             rel_dst_files.append(rel_f)
 
 
+    rel_dst_files = set(rel_dst_files)
     rel_missing_files = [x for x in rel_src_files if x not in rel_dst_files]
     abs_missing = [x for x in src_files if x.endswith(tuple(rel_missing_files))]
 
@@ -50,9 +53,16 @@ def find_missing_files(src_path, dst_path, rel_path_src, rel_path_dst, use_exts=
 
 
 def copy_missing_files(missing_files, dst_path):
+    '''
+    Copy files into dst_path concurrently, see transfer.transfer_files.
+    Completed copies are recorded in a journal in dst_path, so an
+    interrupted copy can be resumed.
+    '''
 #    missing_files = find_missing_files(src_path, dst_path)
-    for f in tqdm.tqdm(missing_files):
-        shutil.copy2(f, dst_path)
+    pairs = [(f, os.path.join(dst_path, os.path.basename(f)))
+             for f in missing_files]
+    return transfer_files(pairs,
+                          journal=os.path.join(dst_path, JOURNAL_NAME))
 
 
 if __name__ == '__main__':
@@ -13,10 +13,12 @@ import subprocess
 from subprocess import PIPE
 import typing
 
+import numpy as np
 from osgeo import gdal, ogr, osr
 
 from misc_utils.get_creds import get_creds
 from misc_utils.logging_utils import create_logger
+from misc_utils.clip_engine import translate_task, run_clips
 
 
 logger = create_logger(__name__, 'sh',
@@ -446,9 +448,10 @@ def minimum_bounding_box(rasters):
 
 
 def clip_minbb(rasters, in_mem=False, out_dir=None, out_suffix='_clip',
-               out_format='tif'):
+               out_format='tif', max_workers=None):
     '''
     Takes a list of rasters and translates (clips) them to the minimum bounding box.
+    Rasters are clipped concurrently, see clip_engine.run_clips.
 
     Returns
     --------
@@ -458,7 +461,7 @@ def clip_minbb(rasters, in_mem=False, out_dir=None, out_suffix='_clip',
     logger.debug('Minimum bounding box: {}'.format(projWin))
 
     #  Clip to minimum bounding box
-    translated = []
+    tasks = []
     for raster_p in rasters:
         if not out_dir and in_mem == False:
             out_dir = os.path.dirname(raster_p)
@@ -476,13 +479,10 @@ def clip_minbb(rasters, in_mem=False, out_dir=None, out_suffix='_clip',
                                            out_format)
 
         raster_op = os.path.join(out_dir, raster_out_name)
+        tasks.append(translate_task(raster_p, raster_op, projWin=projWin))
 
-        raster_ds = gdal.Open(raster_p)
-        output = gdal.Translate(raster_op, raster_ds, projWin=projWin)
-        if output is not None:
-            translated.append(raster_op)
-        else:
-            logger.warning('Unable to translate raster: {}'.format(raster_p))
+    translated = [t for t in run_clips(tasks, max_workers=max_workers)
+                  if t is not None]
 
     return translated
 
@@ -763,3 +763,180 @@ def rasterize_shp2raster_extent(ogr_ds, gdal_ds,
     out_ds = None
 
     return out_path
+
+
+def block_windows(band, target_size=1024, pixel_window=None):
+    """
+    Generate read windows aligned to the native block size of a raster
+    band, with each window made up of whole blocks and roughly target_size
+    pixels on a side.
+
+    Parameters
+    ----------
+    band : gdal.Band
+        Band to determine block size and raster size from.
+    target_size : int
+        Approximate size of windows, in pixels. Windows are always a whole
+        number of blocks.
+    pixel_window : tuple
+        (xmin, ymin, xmax, ymax) pixel extent to restrict windows to, only
+        windows intersecting this extent are generated.
+
+    Yields
+    -------
+    tuple : (xoff, yoff, xsize, ysize)
+    """
+    x_sz, y_sz = band.XSize, band.YSize
+    block_x, block_y = band.GetBlockSize()
+    win_x = block_x * max(1, target_size // block_x)
+    win_y = block_y * max(1, target_size // block_y)
+
+    if pixel_window is None:
+        pixel_window = (0, 0, x_sz, y_sz)
+    px_min, py_min, px_max, py_max = pixel_window
+    px_min, py_min = max(0, int(px_min)), max(0, int(py_min))
+    px_max, py_max = min(x_sz, int(px_max)), min(y_sz, int(py_max))
+    if px_min >= px_max or py_min >= py_max:
+        return
+
+    # Snap start of restricted extent to window grid
+    x_start = (px_min // win_x) * win_x
+    y_start = (py_min // win_y) * win_y
+    for yoff in range(y_start, py_max, win_y):
+        ysize = min(win_y, y_sz - yoff)
+        for xoff in range(x_start, px_max, win_x):
+            xsize = min(win_x, x_sz - xoff)
+            yield xoff, yoff, xsize, ysize
+
+
+def pad_window(window, halo, x_sz, y_sz):
+    """
+    Expand a (xoff, yoff, xsize, ysize) window by halo pixels on each side,
+    clipped to the raster extent, for neighbourhood operations on tiles.
+
+    Returns
+    -------
+    tuple : (padded window, (row slice, column slice) of the original
+    window within the padded window)
+    """
+    xoff, yoff, xsize, ysize = window
+    pxoff, pyoff = max(0, xoff - halo), max(0, yoff - halo)
+    pxmax = min(x_sz, xoff + xsize + halo)
+    pymax = min(y_sz, yoff + ysize + halo)
+    inner = np.s_[yoff - pyoff:yoff - pyoff + ysize,
+                  xoff - pxoff:xoff - pxoff + xsize]
+
+    return (pxoff, pyoff, pxmax - pxoff, pymax - pyoff), inner
+
+
+def window_geotransform(geotransform, xoff, yoff):
+    """Geotransform of a window of a raster starting at (xoff, yoff)."""
+    gt = list(geotransform)
+    gt[0] = geotransform[0] + xoff * geotransform[1] + yoff * geotransform[2]
+    gt[3] = geotransform[3] + xoff * geotransform[4] + yoff * geotransform[5]
+    return tuple(gt)
+
+
+def bounds2pixel_window(bounds, geotransform):
+    """
+    Convert (minx, miny, maxx, maxy) in georeferenced units to a
+    (xmin, ymin, xmax, ymax) pixel extent, for a north-up geotransform.
+    """
+    minx, miny, maxx, maxy = bounds
+    px_min = int((minx - geotransform[0]) // geotransform[1])
+    px_max = int(-((geotransform[0] - maxx) // geotransform[1]))
+    py_min = int((maxy - geotransform[3]) // geotransform[5])
+    py_max = int(-((geotransform[3] - miny) // geotransform[5]))
+    return px_min, py_min, px_max, py_max
+
+
+def rasterize_window(ogr_lyr, geotransform, projection, xoff, yoff,
+                     xsize, ysize, attribute=None, burn_value=1,
+                     dtype=gdal.GDT_Int32, all_touched=False):
+    """
+    Rasterize an OGR layer into an in-memory array covering a window of a
+    raster grid, only burning features intersecting the window.
+
+    Returns
+    -------
+    np.array : (ysize, xsize), 0 where no features
+    """
+    win_gt = window_geotransform(geotransform, xoff, yoff)
+    mem_ds = gdal.GetDriverByName('MEM').Create('', xsize, ysize, 1, dtype)
+    mem_ds.SetGeoTransform(win_gt)
+    mem_ds.SetProjection(projection)
+    minx, maxy = win_gt[0], win_gt[3]
+    maxx = minx + xsize * win_gt[1]
+    miny = maxy + ysize * win_gt[5]
+    ogr_lyr.SetSpatialFilterRect(minx, miny, maxx, maxy)
+    options = []
+    if attribute:
+        options.append('ATTRIBUTE={}'.format(attribute))
+    if all_touched:
+        options.append('ALL_TOUCHED=TRUE')
+    if attribute:
+        gdal.RasterizeLayer(mem_ds, [1], ogr_lyr, options=options)
+    else:
+        gdal.RasterizeLayer(mem_ds, [1], ogr_lyr, burn_values=[burn_value],
+                            options=options)
+    ogr_lyr.SetSpatialFilter(None)
+    arr = mem_ds.GetRasterBand(1).ReadAsArray()
+    mem_ds = None
+
+    return arr
+
+
+def sample_raster(raster, xs, ys, band=1, block_size=1024):
+    """
+    Sample a raster band at points, reading only the blocks of the raster
+    that contain points.
+
+    Parameters
+    ----------
+    raster : str
+        Path to raster, in the same CRS as the points.
+    xs, ys : np.array
+        Coordinates of points.
+    band : int
+        Band number to sample.
+    block_size : int
+        Approximate size in pixels of the blocks read at once.
+
+    Returns
+    -------
+    tuple : (values, valid) arrays. valid is False where points are
+    outside the raster or on NoData (or NaN) pixels.
+    """
+    xs, ys = np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+    ds = gdal.Open(str(raster))
+    gt = ds.GetGeoTransform()
+    b = ds.GetRasterBand(band)
+    nodata = b.GetNoDataValue()
+    cols = np.floor((xs - gt[0]) / gt[1]).astype(np.int64)
+    rows = np.floor((ys - gt[3]) / gt[5]).astype(np.int64)
+    inside = ((cols >= 0) & (cols < ds.RasterXSize) &
+              (rows >= 0) & (rows < ds.RasterYSize))
+
+    values = np.full(len(xs), np.nan)
+    valid = np.zeros(len(xs), dtype=bool)
+    if inside.any():
+        pixel_window = (cols[inside].min(), rows[inside].min(),
+                        cols[inside].max() + 1, rows[inside].max() + 1)
+        for xoff, yoff, xsize, ysize in block_windows(b, target_size=block_size,
+                                                      pixel_window=pixel_window):
+            in_win = (inside & (cols >= xoff) & (cols < xoff + xsize) &
+                      (rows >= yoff) & (rows < yoff + ysize))
+            if not in_win.any():
+                continue
+            arr = b.ReadAsArray(xoff, yoff, xsize, ysize)
+            vals = arr[rows[in_win] - yoff, cols[in_win] - xoff]
+            ok = np.ones(len(vals), dtype=bool)
+            if np.issubdtype(vals.dtype, np.floating):
+                ok &= ~np.isnan(vals)
+            if nodata is not None:
+                ok &= vals != nodata
+            values[in_win] = vals
+            valid[in_win] = ok
+    ds = None
+
+    return values, valid
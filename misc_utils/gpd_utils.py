@@ -16,6 +16,7 @@ import geopandas as gpd
 import pandas as pd
 from shapely.geometry import Point, LineString, Polygon
 from shapely.ops import split
+from scipy import sparse
 from scipy.sparse.csgraph import connected_components
 from tqdm import tqdm
 
@@ -418,13 +419,130 @@ def write_gdf(src_gdf, out_footprint, to_str_cols=None,
         logger.error('Unsupported driver: {}'.format(driver))
 
 
+def sindex_pairs(gdf, other=None, predicate=None):
+    """
+    Find all pairs of geometries in gdf and other that satisfy predicate
+    using a bulk query against the spatial index (STRtree) of other,
+    rather than testing every geometry against every other geometry.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame or gpd.GeoSeries
+        Input geometries.
+    other : gpd.GeoDataFrame or gpd.GeoSeries
+        Geometries to build the spatial index on. If None, gdf is queried
+        against itself (self-pairs are included).
+    predicate : str
+        Binary predicate to test candidate pairs with, e.g. 'intersects',
+        'touches'. If None, pairs with intersecting bounding boxes are
+        returned.
+
+    Returns
+    -------
+    tuple : (np.array, np.array) of integer positions into gdf and other
+    """
+    if other is None:
+        other = gdf
+    geoms = gdf.geometry.reset_index(drop=True)
+    other_geoms = other.geometry.reset_index(drop=True)
+    tree = other_geoms.sindex
+    if hasattr(tree, 'query_bulk'):
+        left, right = tree.query_bulk(geoms.values, predicate=predicate)
+    elif hasattr(tree, 'query'):
+        left, right = tree.query(geoms.values, predicate=predicate)
+    else:
+        # rtree backed spatial index (older geopandas), bounding box
+        # candidates only, predicate applied below
+        pairs = [(i, j) for i, g in enumerate(geoms)
+                 for j in tree.intersection(g.bounds)]
+        left = np.array([p[0] for p in pairs], dtype=np.int64)
+        right = np.array([p[1] for p in pairs], dtype=np.int64)
+        if predicate is not None and len(left) > 0:
+            keep = getattr(geoms.iloc[left].reset_index(drop=True),
+                           predicate)(other_geoms.iloc[right]
+                                      .reset_index(drop=True))
+            left, right = left[keep.values], right[keep.values]
+
+    return np.asarray(left, dtype=np.int64), np.asarray(right, dtype=np.int64)
+
+
+def group_labels(n, left, right):
+    """
+    Resolve pairs of integer positions that should be merged into a single
+    group label per position (union-find over the pairs), such that chains
+    of pairs (a-b, b-c) end up in the same group.
+
+    Parameters
+    ----------
+    n : int
+        Number of positions.
+    left, right : np.array
+        Integer positions of each pair.
+
+    Returns
+    -------
+    np.array : group label for each of the n positions
+    """
+    pairs = sparse.coo_matrix((np.ones(len(left), dtype=np.int8),
+                               (left, right)), shape=(n, n))
+    _n_groups, labels = connected_components(pairs, directed=False)
+
+    return labels
+
+
+def merge_groups(left_ids, right_ids):
+    """
+    Resolve pairs of IDs to merge into a group label per ID.
+
+    Parameters
+    ----------
+    left_ids, right_ids : list-like
+        IDs of each pair to merge.
+
+    Returns
+    -------
+    pd.Series : group label, indexed by ID
+    """
+    ids = pd.Index(pd.unique(np.concatenate([np.asarray(left_ids),
+                                             np.asarray(right_ids)])))
+    labels = group_labels(len(ids),
+                          ids.get_indexer(left_ids),
+                          ids.get_indexer(right_ids))
+
+    return pd.Series(labels, index=ids)
+
+
+def dissolve_groups(gdf, groups, aggfunc='first'):
+    """
+    Dissolve gdf on group labels with a single (vectorised) dissolve.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        Features to dissolve.
+    groups : list-like
+        Group label for each row of gdf.
+    aggfunc : str, dict
+        Aggregation passed to gpd.GeoDataFrame.dissolve.
+
+    Returns
+    -------
+    gpd.GeoDataFrame : one row per group label, indexed by group label
+    """
+    dg = 'dissolve_group'
+    gdf = gdf.copy()
+    gdf[dg] = np.asarray(groups)
+
+    return gdf.dissolve(by=dg, aggfunc=aggfunc)
+
+
 def dissolve_touching(gdf: gpd.GeoDataFrame):
     dg = 'dissolve_group'
 
-    overlap_matrix = gdf.geometry.apply(
-        lambda x: gdf.geometry.touches(x)).values.astype(int)
-    n, ids = connected_components(overlap_matrix)
-    gdf[dg] = ids
+    # Touching pairs from the spatial index rather than a dense
+    # every-feature-against-every-feature touches matrix
+    left, right = sindex_pairs(gdf, predicate='touches')
+    gdf[dg] = group_labels(len(gdf), left, right)
 
     dissolved = gdf.dissolve(by=dg)
 
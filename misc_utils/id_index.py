@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent index of sets of IDs (e.g. master footprint, ordered, stereo
+catalogids) in a local SQLite database. Each set is built from sources:
+files, refreshed incrementally when their size or modification time
+changes, or queries (e.g. danco tables), refreshed when older than a
+maximum age. Membership of a whole Series of IDs is checked with a single
+join, rather than by rebuilding Python sets of millions of IDs.
+"""
+from contextlib import closing
+from datetime import datetime
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+from misc_utils.logging_utils import create_logger
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    id_set TEXT NOT NULL,
+    source TEXT NOT NULL,
+    stamp TEXT,
+    built REAL NOT NULL,
+    PRIMARY KEY (id_set, source)
+);
+CREATE TABLE IF NOT EXISTS ids (
+    id_set TEXT NOT NULL,
+    id TEXT NOT NULL,
+    source TEXT NOT NULL,
+    date TEXT,
+    PRIMARY KEY (id_set, id, source)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ids_source ON ids (id_set, source);
+"""
+# Number of IDs inserted per statement
+INSERT_CHUNK = 100_000
+
+
+def file_stamp(path):
+    """Size and modification time of path, used to detect changes."""
+    stat = os.stat(path)
+    return '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+def _clean_ids(ids):
+    """Unique, non-empty IDs as stripped strings."""
+    ids = pd.Series(list(ids), dtype=object).dropna().astype(str).str.strip()
+    return ids[ids != ''].unique()
+
+
+class IDIndex:
+    """
+    Persistent index of sets of IDs.
+
+    Parameters
+    ----------
+    db_path : str
+        Path to the SQLite database, created if it does not exist.
+    """
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self._lock = threading.Lock()
+        with closing(self._connect()) as con, con:
+            con.executescript(SCHEMA)
+
+    def _connect(self):
+        con = sqlite3.connect(str(self.db_path), timeout=60)
+        con.execute('PRAGMA journal_mode=WAL')
+        con.execute('PRAGMA synchronous=NORMAL')
+        return con
+
+    def _sources(self, con, id_set):
+        return dict(con.execute('SELECT source, stamp FROM sources '
+                                'WHERE id_set = ?', (id_set,)).fetchall())
+
+    @staticmethod
+    def _replace(con, id_set, source, ids, stamp=None, date=None):
+        """Replace the IDs from source in id_set."""
+        con.execute('DELETE FROM ids WHERE id_set = ? AND source = ?',
+                    (id_set, source))
+        ids = _clean_ids(ids)
+        for i in range(0, len(ids), INSERT_CHUNK):
+            con.executemany('INSERT OR IGNORE INTO ids VALUES (?, ?, ?, ?)',
+                            [(id_set, x, source, date)
+                             for x in ids[i:i + INSERT_CHUNK]])
+        con.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)',
+                    (id_set, source, stamp, time.time()))
+
+        return len(ids)
+
+    @staticmethod
+    def _remove(con, id_set, source):
+        con.execute('DELETE FROM ids WHERE id_set = ? AND source = ?',
+                    (id_set, source))
+        con.execute('DELETE FROM sources WHERE id_set = ? AND source = ?',
+                    (id_set, source))
+
+    def refresh_files(self, id_set, paths, reader, remove_missing=True):
+        """
+        Update id_set from files, reading only files that are new or have
+        changed since they were last read.
+
+        Parameters
+        ----------
+        id_set : str
+            Name of the set of IDs.
+        paths : list
+            Files containing IDs.
+        reader : callable
+            Called with a path, returns the IDs in it.
+        remove_missing : bool
+            True to remove IDs from sources of id_set that are not in paths
+            (e.g. deleted files).
+
+        Returns
+        -------
+        int : number of files read
+        """
+        paths = [str(p) for p in paths]
+        with self._lock, closing(self._connect()) as con, con:
+            known = self._sources(con, id_set)
+            if remove_missing:
+                for source in set(known) - set(paths):
+                    logger.debug('Removing source from {}: '
+                                 '{}'.format(id_set, source))
+                    self._remove(con, id_set, source)
+            updated = 0
+            for p in paths:
+                stamp = file_stamp(p)
+                if known.get(p) == stamp:
+                    continue
+                logger.debug('Reading IDs into {}: {}'.format(id_set, p))
+                try:
+                    ids = reader(p)
+                except Exception as e:
+                    logger.error('Failed to read IDs from: {}'.format(p))
+                    logger.error(e)
+                    continue
+                date = datetime.fromtimestamp(
+                    os.path.getmtime(p)).strftime('%Y-%m-%d')
+                self._replace(con, id_set, p, ids, stamp=stamp, date=date)
+                updated += 1
+        if updated:
+            logger.info('Updated {} from {:,} file(s).'.format(id_set,
+                                                               updated))
+
+        return updated
+
+    def refresh_query(self, id_set, source, fetch, max_age=None):
+        """
+        Update id_set with the IDs returned by fetch, if they are older than
+        max_age.
+
+        Parameters
+        ----------
+        id_set : str
+            Name of the set of IDs.
+        source : str
+            Name of the source, e.g. a table name.
+        fetch : callable
+            Called with no arguments, returns the IDs.
+        max_age : float
+            Maximum age in seconds of the IDs before fetching again. None to
+            only fetch if the source has never been fetched.
+
+        Returns
+        -------
+        bool : True if fetched
+        """
+        with self._lock, closing(self._connect()) as con, con:
+            row = con.execute('SELECT built FROM sources WHERE id_set = ? '
+                              'AND source = ?', (id_set, source)).fetchone()
+            if row is not None and (max_age is None or
+                                    time.time() - row[0] < max_age):
+                return False
+            logger.info('Fetching IDs for {} from: {}'.format(id_set, source))
+            count = self._replace(con, id_set, source, fetch())
+        logger.debug('{} IDs: {:,}'.format(id_set, count))
+
+        return True
+
+    def clear(self, id_set):
+        """Remove all IDs and sources of id_set."""
+        with self._lock, closing(self._connect()) as con, con:
+            con.execute('DELETE FROM ids WHERE id_set = ?', (id_set,))
+            con.execute('DELETE FROM sources WHERE id_set = ?', (id_set,))
+
+    def has_sources(self, id_set):
+        with closing(self._connect()) as con:
+            return bool(self._sources(con, id_set))
+
+    def built(self, id_set):
+        """Time id_set was last updated, None if never built."""
+        with closing(self._connect()) as con:
+            built = con.execute('SELECT MAX(built) FROM sources '
+                                'WHERE id_set = ?', (id_set,)).fetchone()[0]
+        if built is None:
+            return None
+
+        return datetime.fromtimestamp(built)
+
+    def ids(self, id_set):
+        """All IDs in id_set."""
+        with closing(self._connect()) as con:
+            return set([r[0] for r in con.execute(
+                'SELECT DISTINCT id FROM ids WHERE id_set = ?', (id_set,))])
+
+    def records(self, id_set):
+        """DataFrame of id, source and date for each ID and source in
+        id_set."""
+        with closing(self._connect()) as con:
+            return pd.read_sql_query('SELECT id, source, date FROM ids '
+                                     'WHERE id_set = ?', con,
+                                     params=(id_set,))
+
+    def isin(self, values, id_sets):
+        """
+        Membership of each of values in any of id_sets.
+
+        Parameters
+        ----------
+        values : pd.Series, list
+            IDs to look up.
+        id_sets : str, list
+            Name(s) of sets of IDs.
+
+        Returns
+        -------
+        pd.Series : bool, with the index of values if a Series
+        """
+        if isinstance(id_sets, str):
+            id_sets = [id_sets]
+        if not isinstance(values, pd.Series):
+            values = pd.Series(list(values), dtype=object)
+        query = _clean_ids(values)
+        if len(query) == 0:
+            return pd.Series(False, index=values.index)
+
+        with closing(self._connect()) as con:
+            con.execute('CREATE TEMP TABLE query (id TEXT PRIMARY KEY)')
+            con.executemany('INSERT INTO query VALUES (?)',
+                            [(x,) for x in query])
+            found = [r[0] for r in con.execute(
+                'SELECT DISTINCT q.id FROM query q JOIN ids i '
+                'ON i.id = q.id WHERE i.id_set IN ({})'.format(
+                    ', '.join(['?'] * len(id_sets))), id_sets)]
+
+        return values.astype(str).str.strip().isin(found) & values.notna()
@@ -18,6 +18,7 @@ import pandas as pd
 
 from selection_utils.query_danco import query_footprint
 from misc_utils.dataframe_utils import determine_id_col, determine_stereopair_col
+from misc_utils.id_index import IDIndex
 #from ids_order_sources import get_ordered_ids
 from misc_utils.logging_utils import create_logger
 
@@ -32,6 +33,19 @@ ORDERED_PKL = r'C:\code\pgc-code-all\config\ordered_locs.pkl'
 ordered_directory = r'E:\disbr007\imagery_orders'
 # Offline IDs path
 offline_ids_path = r'E:\pgc_index\pgcImageryIndexV6_2020nov23_offline_ids.txt'
+# Persistent index of IDs
+ID_INDEX_PATH = r'C:\code\pgc-code-all\config\id_index.db'
+# Sets of IDs in the index
+MFP = 'mfp'
+OFFLINE = 'offline'
+ORDERED = 'ordered'
+STEREO = 'stereo'
+DEMS = 'dems'
+# Age in seconds after which IDs from danco tables are fetched again
+DANCO_MAX_AGE = 24 * 60 * 60
+ORDER_SHEET_EXTS = ['.txt', '.csv', '.xls', '.xlsx']
+
+_id_index = None
 
 
 def type_parser(filepath):
@@ -440,8 +454,46 @@ def locate_ids(df, cat_id_field):
     # df['location'] = df[cat_id_field].apply(lambda x: locate_id(x, pgc_ids, nasa_ids, ordered_ids))
 
 
+def id_index():
+    """
+    The persistent index of IDs, see misc_utils.id_index.
+    """
+    global _id_index
+    if _id_index is None:
+        _id_index = IDIndex(ID_INDEX_PATH)
+
+    return _id_index
+
+
+def refresh_mfp(online=False):
+    """
+    Update the index of master footprint IDs (and offline IDs if online)
+    if the IDs files have changed.
+    """
+    id_index().refresh_files(MFP, [pgc_index_path(ids=True)], read_ids)
+    if online:
+        id_index().refresh_files(OFFLINE, [offline_ids_path], read_ids)
+
+
+def refresh_ordered(update=False):
+    """
+    Update the index of ordered IDs from order sheets if update. The
+    ordered IDs text file is always checked, and only re-read if it has
+    changed since it was last read, so edits to it are picked up. IDs read
+    from order sheets are kept alongside it.
+    """
+    if update:
+        update_ordered()
+    if os.path.exists(ORDERED_PATH):
+        id_index().refresh_files(ORDERED, [ORDERED_PATH], read_ids,
+                                 remove_missing=False)
+    elif not id_index().has_sources(ORDERED):
+        logger.warning('Ordered IDs file not found: {}'.format(ORDERED_PATH))
+
+
 def get_offline_ids():
-    offline_ids = set(read_ids(offline_ids_path))
+    id_index().refresh_files(OFFLINE, [offline_ids_path], read_ids)
+    offline_ids = id_index().ids(OFFLINE)
     return offline_ids
 
 
@@ -449,11 +501,10 @@ def mfp_ids(online=False):
     """
     Returns all catalogids in the current masterfootprint.
     """
-    ids_path = pgc_index_path(ids=True)
-    ids = set(read_ids(ids_path))
+    refresh_mfp(online=online)
+    ids = id_index().ids(MFP)
     if online is True:
-        offline_ids = get_offline_ids()
-        ids = ids.difference(offline_ids)
+        ids = ids.difference(id_index().ids(OFFLINE))
 
     return ids
 
@@ -462,11 +513,8 @@ def ordered_ids(update=False):
     """
     Returns all catalogids that are in order sheets.
     """
-    if update:
-        # Read all IDs in order sheets and rewrite txt file
-        update_ordered()
-    ordered = list(set(read_ids(ORDERED_PATH)))
-    ordered = set([o for o in ordered if o != ''])
+    refresh_ordered(update=update)
+    ordered = id_index().ids(ORDERED)
 
     return ordered
 
@@ -483,6 +531,42 @@ def onhand_ids(update=False):
     return onhand
 
 
+def isin_mfp(ids, online=False):
+    """
+    Returns a boolean Series, True where each of ids is in the master
+    footprint (and online, if online).
+    ids : pd.Series / list
+    """
+    refresh_mfp(online=online)
+    in_mfp = id_index().isin(ids, MFP)
+    if online:
+        in_mfp &= ~id_index().isin(ids, OFFLINE)
+
+    return in_mfp
+
+
+def isin_ordered(ids, update=False):
+    """
+    Returns a boolean Series, True where each of ids is in order sheets.
+    ids : pd.Series / list
+    """
+    refresh_ordered(update=update)
+
+    return id_index().isin(ids, ORDERED)
+
+
+def isin_onhand(ids, update=False):
+    """
+    Returns a boolean Series, True where each of ids is in the master
+    footprint or order sheets.
+    ids : pd.Series / list
+    """
+    refresh_mfp()
+    refresh_ordered(update=update)
+
+    return id_index().isin(ids, [MFP, ORDERED])
+
+
 def remove_mfp(src):
     """
     Takes an input src of ids and removes all
@@ -490,12 +574,8 @@ def remove_mfp(src):
     src: list of ids
     """
     logger.debug('Removing IDs that are in master footprint...')
-    src_ids = set(src)
-    # logger.debug('src_ids: {}'.format(list(src_ids)[:10]))
-    onhand_ids = set(mfp_ids())
-    # logger.debug('onhand ids: {}'.format(list(onhand_ids)[:10]))
-    not_mfp = list(src_ids - onhand_ids)
-    # logger.debug('not mfp ids: {}'.format(list(not_mfp)[:10]))
+    src_ids = pd.Series(list(set(src)), dtype=object)
+    not_mfp = list(src_ids[~isin_mfp(src_ids)])
     logger.debug('IDs removed: {}'.format((len(src_ids) - len(not_mfp))))
 
     return not_mfp
@@ -508,11 +588,8 @@ def remove_ordered(src):
     src: list of ids
     """
     logger.debug('Removing IDs in order sheets...')
-    logger.debug('Removing ordered...')
-    src_ids = set(src)
-    ordered = set(ordered_ids())
-
-    not_ordered = list(src_ids - ordered)
+    src_ids = pd.Series(list(set(src)), dtype=object)
+    not_ordered = list(src_ids[~isin_ordered(src_ids)])
     logger.debug('IDs removed: {}'.format((len(src_ids) - len(not_ordered))))
 
     return not_ordered
@@ -628,11 +705,13 @@ def is_stereo(dataframe, catalogid_field, out_field='is_stereo'):
     Takes a dataframe and determines if each catalogd in catalogid_field
     is a stereo image.
     """
-    stereo_ids = query_footprint('pgc_imagery_catalogids_stereo', 
-                                 table=True, 
-                                 columns=['CATALOG_ID'])
-    stereo_ids = list(stereo_ids)
-    dataframe[out_field] = dataframe[catalogid_field].apply(lambda x: x in stereo_ids)
+    stereo_tbl = 'pgc_imagery_catalogids_stereo'
+    id_index().refresh_query(
+        STEREO, stereo_tbl,
+        lambda: query_footprint(stereo_tbl, table=True,
+                                columns=['CATALOG_ID'])['CATALOG_ID'],
+        max_age=DANCO_MAX_AGE)
+    dataframe[out_field] = id_index().isin(dataframe[catalogid_field], STEREO)
 
 
 def dem_exists(dataframe, catalogid_field, out_field='dem_exists'):
@@ -654,9 +733,15 @@ def dem_exists(dataframe, catalogid_field, out_field='dem_exists'):
     None.
 
     """
-    dems = query_footprint('pgc_dem_setsm_strips', table=True, columns=['catalogid1', 'catalogid2'])
-    dem_ids = list(dems['catalogid1']) + list(dems['catalogid2'])
-    dataframe[out_field] = dataframe[catalogid_field].apply(lambda x: x in dem_ids)
+    def _dem_ids():
+        dems = query_footprint(dems_tbl, table=True,
+                               columns=['catalogid1', 'catalogid2'])
+        return list(dems['catalogid1']) + list(dems['catalogid2'])
+
+    dems_tbl = 'pgc_dem_setsm_strips'
+    id_index().refresh_query(DEMS, dems_tbl, _dem_ids,
+                             max_age=DANCO_MAX_AGE)
+    dataframe[out_field] = id_index().isin(dataframe[catalogid_field], DEMS)
 
 
 def create_s_filepath(scene_id, strip_id, acqdate, prod_code):
@@ -685,86 +770,46 @@ def create_s_filepath(scene_id, strip_id, acqdate, prod_code):
 
 
 #%% Update ordered
-def update_ordered(ordered_dir=None, ordered_loc=None, exclude=('NASA'),
+def update_ordered(ordered_dir=None, ordered_loc=None, exclude=('NASA',),
                    new_only=True):
-    # TODO: Add a config file that is a list of filepaths that have already been processed,
-    # TODO: then only read files not in that list
-    """Update the text file of ordered IDs by reading from order sheets"""
-    from tqdm import tqdm
+    """
+    Update the index of ordered IDs from order sheets, reading only sheets
+    that are new or changed since the last update, and rewrite the text
+    file of ordered IDs and the pickle of (catalog_id, loc, date).
 
+    new_only : bool
+        False to re-read all order sheets.
+    """
     # Determine location of ordered IDs
     if not ordered_loc:
-        # global ordered_p
         ordered_loc = ORDERED_PATH
     if not ordered_dir:
-        # global ordered_directory
         ordered_dir = ordered_directory
+    if isinstance(exclude, str):
+        exclude = [exclude]
 
-    # List for all IDs
-    if Path(ordered_loc).exists():
-        # Get last modified time for ordered list
-        last_update = os.path.getmtime(ordered_loc)
-        logger.info('Reading existing list of ordered ids...')
-        ordered = read_ids(ordered_loc)
-        logger.info('Ordered IDs found: {:,}'.format(len(ordered)))
-    else:
-        ordered = list()
-        last_update = 0
+    if not new_only:
+        id_index().clear(ORDERED)
 
-    # Load PKL
-    if Path(ORDERED_PKL).exists() and not new_only:
-        df = pd.read_pickle(ORDERED_PKL)
-    else:
-        df = pd.DataFrame()
-
-    ordered_locations = []
-
-    # Progress bar set up
-    total_len = sum([len(files) for r, d, files in os.walk(ordered_dir)])
-    pbar = tqdm(total=total_len, desc='Iterating imagery order sheets...')
-
-    logger.debug('Reading sheets from: {}'.format(ordered_dir))
+    logger.debug('Finding sheets in: {}'.format(ordered_dir))
+    sheets = []
     for root, dirs, files in os.walk(ordered_dir):
-        dirs = [d for d in dirs if not any(ex in d for ex in exclude)]
-        last_dir = None
-        for f in files:
-            f_path = os.path.join(root, f)
-            if new_only:
-                # Check if file newer than last update
-                if not os.path.getmtime(f_path) > last_update:
-                    # print('skipping already read file.')
-                    continue
-            cur_dir = os.path.basename(os.path.dirname(os.path.join(root, f)))
-            if exclude and not any(ex in cur_dir for ex in exclude):
-                if cur_dir != last_dir:
-                    pbar.write('Reading from: {}'.format(cur_dir))
-                ext = os.path.splitext(f)[1]
-                if ext in ['.txt', '.csv', '.xls', '.xlsx']:
-                    try:
-                        # logger.info('Reading; {}'.format(f))
-                        sheet_ids = read_ids(f_path)
-                        ordered.extend(sheet_ids)
-                        # Add (id, filename, date)
-                        date = datetime.fromtimestamp(os.path.getmtime(f_path)).strftime('%Y-%m-%d')
-                        ordered_locations.extend([(i, f, date) for i in sheet_ids])
-                    except Exception as e:
-                        print('failed to read: {}'.format(f))
-                        logger.error(e)
-
-                pbar.update(1)
-                last_dir = cur_dir
-
-    ordered = list(set(ordered))
-    logger.info('Writing {:,} ordered IDs to: {}'.format(len(ordered), ordered_loc))
-    write_ids(ordered, ordered_loc)
-
-    new_df = pd.DataFrame.from_records(ordered_locations,
-                                       columns=['catalog_id', 'loc', 'date'])
-
-    df = pd.concat([df, new_df])
+        cur_dir = os.path.basename(root)
+        if exclude and any(ex in cur_dir for ex in exclude):
+            continue
+        sheets.extend([os.path.join(root, f) for f in files
+                       if os.path.splitext(f)[1] in ORDER_SHEET_EXTS])
+    logger.info('Order sheets found: {:,}'.format(len(sheets)))
+    id_index().refresh_files(ORDERED, sheets, read_ids)
+
+    df = id_index().records(ORDERED)
+    df = df.rename(columns={'id': 'catalog_id', 'source': 'loc'})
+    df['loc'] = df['loc'].apply(os.path.basename)
     df.sort_values(by='date', inplace=True)
-    df.drop_duplicates(subset='catalog_id', keep='first')
+    df.drop_duplicates(subset='catalog_id', keep='first', inplace=True)
+
+    logger.info('Writing {:,} ordered IDs to: {}'.format(len(df), ordered_loc))
+    write_ids(df['catalog_id'], ordered_loc)
     df.to_pickle(ORDERED_PKL)
 
     return df
-
@@ -13,7 +13,8 @@ import os
 import geopandas as gpd
 from tqdm import tqdm
 
-from raster_clip import clip_rasters
+from raster_clip import prepare_cutline
+from clip_engine import warp_task, run_clips
 from logging_utils import create_logger
 
 
@@ -25,10 +26,12 @@ logger = create_logger('multi_clip2shp',
 
 def multi_clip2shp(aoi_master, raster_parent_dir, subfolder_field,
                    clipped_dir=None, return_rasters=False,
-                   dryrun=False):
+                   max_workers=None, dryrun=False):
     """
     Take an aoi master OGR file with polygons for multiple AOIs and clips rasters in
     subdirectories in raster_parent_dir to the aoi corresponding to the subdirectory name.
+    The rasters in all subdirectories are clipped concurrently in a single pool
+    of workers, see clip_engine.run_clips.
     
     Parameters
     -------
@@ -39,8 +42,9 @@ def multi_clip2shp(aoi_master, raster_parent_dir, subfolder_field,
     clipped_dir : STR
         Path to output clipped rasters (in subdirectories), existing or new
     return_rasters : BOOLEAN
-        Set to True to return dictionary of clipped raster path and GDAL datasource
-        (WARNING: MEMORY INTENSIVE)
+        Set to True to return list of clipped raster paths
+    max_workers : INT
+        Maximum number of rasters to clip at once.
         
     Returns
     -------
@@ -62,12 +66,8 @@ def multi_clip2shp(aoi_master, raster_parent_dir, subfolder_field,
     subdirs = [sd for sd in os.listdir(raster_parent_dir) 
                if os.path.isdir(os.path.join(raster_parent_dir, sd))]
     logger.debug('Subdirectories found: {}'.format(subdirs))    
-    # Loop over imagery subdirectories and clip to appropriate AOI
-    if return_rasters is True:
-        # Create master dictionary of clipped raster paths and GDAL objects
-        clipped = {}
-    else:
-        clipped = None
+    # Loop over imagery subdirectories and create clip tasks to appropriate AOI
+    tasks = []
     pbar = tqdm(subdirs)
     for sd in pbar:
         logger.info('Working on subdirectory: {}'.format(sd))
@@ -77,35 +77,45 @@ def multi_clip2shp(aoi_master, raster_parent_dir, subfolder_field,
         if not os.path.exists(os.path.dirname(aoi_outpath)):
             os.makedirs(os.path.dirname(aoi_outpath))
         aoi.to_file(aoi_outpath)
-        
+        # Dissolve once for all rasters in subdirectory
+        cutline_ds, cutline_layer = prepare_cutline(aoi_outpath, in_mem=False)
+
         # Create out subdirectory for clipped imagery
         out_subdir = os.path.join(clipped_dir, '{}_clip'.format(sd))
         if not os.path.exists(out_subdir):
             os.makedirs(out_subdir)
-        # Loop over each image in subdirectory and clip to AOI
+        # Clip each image in subdirectory to AOI, if not already clipped
+        rasters = []
         for root, dirs, files in os.walk(os.path.join(raster_parent_dir, sd)):
-            rasters = [os.path.join(root, f)
-                       for f in files 
-                       if f.endswith('.tif') or f.endswith('.ntf')]
-            for r in rasters:
-                clipped_path = '{}_clip.tif'.format(r[:-4])
-                if os.path.exists(clipped_path):
-                    rasters.remove(r)
-        
-        logger.debug('Number of rasters: {}'.format(len(rasters)))
+            rasters.extend([os.path.join(root, f)
+                            for f in files
+                            if f.endswith('.tif') or f.endswith('.ntf')])
+        sd_tasks = []
+        for r in rasters:
+            clipped_path = os.path.join(out_subdir, '{}_clip.tif'.format(
+                os.path.basename(r).split('.')[0]))
+            if not os.path.exists(clipped_path):
+                sd_tasks.append(warp_task(r, clipped_path,
+                                          cutline_ds=cutline_ds,
+                                          cutline_layer=cutline_layer))
+
+        logger.debug('Number of rasters: {}'.format(len(sd_tasks)))
         logger.debug('Using {} as clip boundary...'.format(os.path.basename(aoi_outpath)))
-        
-        # Perform clipping for current subdirectory
-        pbar.set_description('Clipping {} rasters to {}'.format(len(rasters), os.path.basename(aoi_outpath)))
-        if not dryrun:
-            clipped_subdir_rasters = clip_rasters(aoi_outpath, rasters=rasters, out_dir=out_subdir)
-        else:
-            logger.info('Clipping to aoi: {}'.format(aoi_outpath))
-            logger.info('Clipping {} rasters'.format(len(rasters)))
-        # Add dictionary of clipped paths and GDAL datasources to master dict
-        if return_rasters is True:
-            clipped.extend(clipped_subdir_rasters)
-    
+        pbar.set_description('Clipping {} rasters to {}'.format(len(sd_tasks), os.path.basename(aoi_outpath)))
+        tasks.extend(sd_tasks)
+
+    # Perform clipping for all subdirectories
+    if not dryrun:
+        clipped_rasters = run_clips(tasks, max_workers=max_workers)
+    else:
+        logger.info('Clipping {} rasters'.format(len(tasks)))
+        clipped_rasters = []
+
+    if return_rasters is True:
+        clipped = [c for c in clipped_rasters if c is not None]
+    else:
+        clipped = None
+
     return clipped
 
 
@@ -122,6 +132,8 @@ if __name__ == '__main__':
     parser.add_argument('--clipped_dir', type=os.path.abspath,
                         help='''Path to directory to create clipped rasters in 
                                 subdirectories''')
+    parser.add_argument('--max_workers', type=int,
+                        help='Maximum number of rasters to clip at once.')
     parser.add_argument('--dryrun', action='store_true',
                         help='Prints actions only.')
     parser.add_argument('--debug', action='store_true',
@@ -135,5 +147,6 @@ if __name__ == '__main__':
     
     multi_clip2shp(args.aoi_path, args.raster_directory, args.subfolder_field,
                    clipped_dir=args.clipped_dir,
+                   max_workers=args.max_workers,
                    dryrun=args.dryrun)
     
\ No newline at end of file
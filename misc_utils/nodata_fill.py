@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+Tiled filling of NoData voids in rasters. The raster is read in windows
+aligned to its blocks. Windows without voids are copied through; windows
+with voids are read with a halo of surrounding pixels and filled in a pool
+of processes, so only the small fraction of the raster containing voids
+is interpolated and memory use is bounded by the window size. Voids are
+filled only from valid pixels within the halo distance (which every window
+includes), and sources tied in distance are all used and summed in a fixed
+order, so the result does not depend on the tiling. Two methods are
+available:
+    idw    : GDAL's inverse distance fill (as rasterio's fillnodata).
+    kdtree : inverse distance weighting of the k nearest valid pixels on
+             the edges of voids, found with a KD-tree.
+If an AOI is given only voids within it are filled and pixels outside it
+are set to NoData.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+
+import numpy as np
+from osgeo import gdal, ogr
+from scipy.ndimage import binary_dilation
+from scipy.spatial import cKDTree
+
+from misc_utils.gdal_tools import block_windows, pad_window, rasterize_window
+from misc_utils.gpd_utils import read_vec
+from misc_utils.logging_utils import create_logger
+
+gdal.UseExceptions()
+ogr.UseExceptions()
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+IDW = 'idw'
+KDTREE = 'kdtree'
+METHODS = [IDW, KDTREE]
+# Pixels read around each window, the maximum distance filled from (the
+# default search distance of rasterio's fillnodata)
+HALO = 100
+TILE_SIZE = 1024
+# Neighbours and distance power for kdtree fill
+K = 12
+POWER = 2
+
+
+def fill_array(arr, targets, valid, method=IDW, max_distance=HALO, k=K,
+               power=POWER):
+    """
+    Fill the target pixels of an array from valid pixels within
+    max_distance.
+
+    Parameters
+    ----------
+    arr : np.array
+        2D array to fill.
+    targets : np.array
+        Boolean array, True for pixels to fill.
+    valid : np.array
+        Boolean array, True for pixels to fill from.
+    method : str
+        One of METHODS.
+    max_distance : int
+        Maximum distance in pixels to fill from.
+    k : int
+        Number of neighbours used by kdtree.
+    power : float
+        Power of distance weights used by kdtree.
+
+    Returns
+    -------
+    tuple : (filled array (float64), filled) filled True for targets that
+    were filled, targets without valid pixels within max_distance are not.
+    """
+    out = arr.astype(np.float64)
+    filled = np.zeros(arr.shape, dtype=bool)
+    if not targets.any() or not valid.any():
+        return out, filled
+
+    if method == IDW:
+        mem = gdal.GetDriverByName('MEM')
+        ds = mem.Create('', arr.shape[1], arr.shape[0], 1, gdal.GDT_Float64)
+        ds.GetRasterBand(1).WriteArray(out)
+        mask_ds = mem.Create('', arr.shape[1], arr.shape[0], 1,
+                             gdal.GDT_Byte)
+        mask_ds.GetRasterBand(1).WriteArray(valid.astype(np.uint8))
+        gdal.FillNodata(ds.GetRasterBand(1), mask_ds.GetRasterBand(1),
+                        max_distance, 0)
+        result = ds.GetRasterBand(1).ReadAsArray()
+        # Pixels FillNodata reached are those that changed value
+        filled = targets & (result != out)
+        out[filled] = result[filled]
+        ds = None
+        mask_ds = None
+    elif method == KDTREE:
+        # Only valid pixels on the edges of voids are needed
+        sources = valid & binary_dilation(~valid)
+        src_rows, src_cols = np.nonzero(sources)
+        tree = cKDTree(np.column_stack([src_rows, src_cols]))
+        tgt_rows, tgt_cols = np.nonzero(targets)
+        # Query extra neighbours so that sources tied with the kth nearest
+        # are all used, otherwise which of the tied sources are used
+        # depends on the tree and so on the tiling
+        n = min(4 * k, len(src_rows))
+        dist, idx = tree.query(np.column_stack([tgt_rows, tgt_cols]), k=n,
+                               distance_upper_bound=max_distance)
+        if n == 1:
+            dist, idx = dist[:, np.newaxis], idx[:, np.newaxis]
+        kth = dist[:, min(k, n) - 1]
+        # Where even the last source queried is tied with the kth, there
+        # may be more tied sources, so those targets use all sources within
+        # the kth distance
+        more = (n < len(src_rows)) & np.isfinite(kth) & (dist[:, -1] <= kth)
+        use = np.isfinite(dist) & (dist <= kth[:, np.newaxis])
+        # Missing neighbours have idx == number of sources
+        idx = np.minimum(idx, len(src_rows) - 1)
+        total, sums = _idw(out, src_rows[idx], src_cols[idx], use,
+                           tgt_rows, tgt_cols, power)
+        for i in np.nonzero(more)[0]:
+            nebs = np.array(tree.query_ball_point(
+                [tgt_rows[i], tgt_cols[i]], r=kth[i]), dtype=np.int64)
+            tied_total, tied_sums = _idw(out, src_rows[nebs][np.newaxis],
+                                         src_cols[nebs][np.newaxis],
+                                         np.ones((1, len(nebs)), dtype=bool),
+                                         tgt_rows[i:i + 1],
+                                         tgt_cols[i:i + 1], power)
+            total[i], sums[i] = tied_total[0], tied_sums[0]
+        ok = total > 0
+        out[tgt_rows[ok], tgt_cols[ok]] = sums[ok] / total[ok]
+        filled[tgt_rows[ok], tgt_cols[ok]] = True
+    else:
+        logger.error('Unsupported fill method: {}, must be one of: '
+                     '{}'.format(method, METHODS))
+        raise ValueError(method)
+
+    return out, filled
+
+
+def _idw(arr, rows, cols, use, tgt_rows, tgt_cols, power):
+    """
+    Sums of inverse distance weights, and of weighted values, of the source
+    pixels of arr at rows, cols (one row of sources per target) where use,
+    from each target pixel at tgt_rows, tgt_cols. Sources are summed in
+    order of distance then relative position, so the sums do not depend on
+    the order the sources were found in or the window they are in.
+
+    Returns
+    -------
+    tuple : (sum of weights, sum of weighted values), per target
+    """
+    dr = rows - tgt_rows[:, np.newaxis]
+    dc = cols - tgt_cols[:, np.newaxis]
+    dist = np.where(use, np.sqrt(dr * dr + dc * dc), np.inf)
+    order = np.lexsort((dc, dr, dist), axis=-1)
+    dist = np.take_along_axis(dist, order, axis=-1)
+    values = np.take_along_axis(arr[rows, cols], order, axis=-1)
+    with np.errstate(divide='ignore'):
+        weights = np.where(np.isfinite(dist), 1 / np.power(dist, power), 0)
+    if weights.shape[1] == 0:
+        return np.zeros(len(weights)), np.zeros(len(weights))
+    # Summed sequentially, unused sources (zero weight) sort last
+    return (np.cumsum(weights, axis=1)[:, -1],
+            np.cumsum(weights * np.where(weights > 0, values, 0),
+                      axis=1)[:, -1])
+
+
+def _aoi_layer(aoi_wkbs):
+    """In memory OGR layer of AOI geometries, for rasterizing."""
+    ds = ogr.GetDriverByName('Memory').CreateDataSource('')
+    lyr = ds.CreateLayer('aoi', geom_type=ogr.wkbUnknown)
+    for g in aoi_wkbs:
+        feat = ogr.Feature(lyr.GetLayerDefn())
+        feat.SetGeometry(ogr.CreateGeometryFromWkb(g))
+        lyr.CreateFeature(feat)
+        feat = None
+
+    # The data source must be kept alive with the layer
+    return ds, lyr
+
+
+def _invalid(arr, nodata):
+    invalid = ~np.isfinite(arr) if np.issubdtype(arr.dtype, np.floating) \
+        else np.zeros(arr.shape, dtype=bool)
+    if nodata is not None:
+        invalid |= arr == nodata
+
+    return invalid
+
+
+def _fill_window(img, window, halo, aoi_wkbs, method, k, power):
+    """
+    Fill the voids in a window of img, reading a halo around it.
+
+    Returns
+    -------
+    tuple : (window, [filled array for each band], number of pixels filled)
+    """
+    ds = gdal.Open(str(img))
+    x_sz, y_sz = ds.RasterXSize, ds.RasterYSize
+    padded, inner = pad_window(window, halo, x_sz, y_sz)
+    in_aoi = None
+    if aoi_wkbs is not None:
+        _aoi_ds, aoi_lyr = _aoi_layer(aoi_wkbs)
+        in_aoi = rasterize_window(aoi_lyr, ds.GetGeoTransform(),
+                                  ds.GetProjection(), *padded,
+                                  dtype=gdal.GDT_Byte).astype(bool)
+        _aoi_ds = None
+    results = []
+    num_filled = 0
+    for b in range(1, ds.RasterCount + 1):
+        band = ds.GetRasterBand(b)
+        nodata = band.GetNoDataValue()
+        arr = band.ReadAsArray(*padded)
+        invalid = _invalid(arr, nodata)
+        targets = invalid.copy()
+        if in_aoi is not None:
+            targets &= in_aoi
+        # Only pixels in the window itself need filling
+        core = np.zeros(arr.shape, dtype=bool)
+        core[inner] = True
+        filled_arr, filled = fill_array(arr, targets & core, ~invalid,
+                                        method=method, max_distance=halo,
+                                        k=k, power=power)
+        num_filled += filled.sum()
+        out = np.where(filled, filled_arr, arr)[inner]
+        if in_aoi is not None and nodata is not None:
+            out = np.where(in_aoi[inner], out, nodata)
+        if np.issubdtype(arr.dtype, np.integer):
+            out = np.rint(out)
+        results.append(out.astype(arr.dtype))
+    ds = None
+
+    return window, results, int(num_filled)
+
+
+def fill_voids(img, out_path, aoi=None, method=IDW, halo=HALO,
+               tile_size=TILE_SIZE, k=K, power=POWER, max_workers=None):
+    """
+    Fill NoData voids in a raster, in tiles, in parallel.
+
+    Parameters
+    ----------
+    img : str
+        Path to raster with NoData set.
+    out_path : str
+        Path to write filled GeoTiff to.
+    aoi : str
+        Path to vector of polygons to fill voids within, outside of which
+        pixels are set to NoData.
+    method : str
+        One of METHODS.
+    halo : int
+        Pixels read around each tile, voids are filled from valid pixels
+        up to this distance away.
+    tile_size : int
+        Approximate size of tiles, in pixels, rounded to the native blocks
+        of img.
+    k : int
+        Number of neighbours used by kdtree.
+    power : float
+        Power of distance weights used by kdtree.
+    max_workers : int
+        Number of processes, default the number of CPUs.
+
+    Returns
+    -------
+    str : out_path
+    """
+    if method not in METHODS:
+        logger.error('Unsupported fill method: {}, must be one of: '
+                     '{}'.format(method, METHODS))
+        raise ValueError(method)
+    src_ds = gdal.Open(str(img))
+    x_sz, y_sz = src_ds.RasterXSize, src_ds.RasterYSize
+    num_bands = src_ds.RasterCount
+    gt, prj = src_ds.GetGeoTransform(), src_ds.GetProjection()
+    bands = [src_ds.GetRasterBand(b) for b in range(1, num_bands + 1)]
+    nodatas = [b.GetNoDataValue() for b in bands]
+    if all([n is None for n in nodatas]) and \
+            bands[0].DataType not in (gdal.GDT_Float32, gdal.GDT_Float64):
+        logger.warning('No NoData value set, nothing to fill: '
+                       '{}'.format(img))
+
+    aoi_wkbs = None
+    aoi_lyr = None
+    if aoi is not None:
+        gdf = read_vec(str(aoi))
+        if prj and gdf.crs is not None and gdf.crs.to_wkt() != prj:
+            logger.debug('Reprojecting AOI to raster CRS.')
+            gdf = gdf.to_crs(prj)
+        aoi_wkbs = [g.wkb for g in gdf.geometry if g is not None]
+        _aoi_ds, aoi_lyr = _aoi_layer(aoi_wkbs)
+
+    driver = gdal.GetDriverByName('GTiff')
+    dst_ds = driver.Create(str(out_path), x_sz, y_sz, num_bands,
+                           bands[0].DataType,
+                           options=['TILED=YES', 'COMPRESS=LZW',
+                                    'BIGTIFF=IF_SAFER'])
+    dst_ds.SetGeoTransform(gt)
+    dst_ds.SetProjection(prj)
+    for i, nodata in enumerate(nodatas):
+        if nodata is not None:
+            dst_ds.GetRasterBand(i + 1).SetNoDataValue(nodata)
+
+    # Copy windows without voids, queue those with voids
+    void_windows = []
+    windows = list(block_windows(bands[0], target_size=tile_size))
+    for window in windows:
+        in_aoi = None
+        if aoi_lyr is not None:
+            in_aoi = rasterize_window(aoi_lyr, gt, prj, *window,
+                                      dtype=gdal.GDT_Byte).astype(bool)
+        arrs = [b.ReadAsArray(*window) for b in bands]
+        has_voids = False
+        for arr, nodata in zip(arrs, nodatas):
+            invalid = _invalid(arr, nodata)
+            if in_aoi is not None:
+                invalid &= in_aoi
+            if invalid.any():
+                has_voids = True
+                break
+        if has_voids:
+            void_windows.append(window)
+            continue
+        for i, (arr, nodata) in enumerate(zip(arrs, nodatas)):
+            if in_aoi is not None and nodata is not None:
+                arr = np.where(in_aoi, arr, nodata).astype(arr.dtype)
+            dst_ds.GetRasterBand(i + 1).WriteArray(arr, window[0], window[1])
+    bands = None
+    src_ds = None
+    aoi_lyr = None
+    _aoi_ds = None
+    logger.info('Filling voids ({}) in {:,} of {:,} tiles: {}'.format(
+        method, len(void_windows), len(windows), img))
+
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    max_workers = max(1, min(max_workers, len(void_windows)))
+    num_filled = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_fill_window, str(img), w, halo,
+                                   aoi_wkbs, method, k, power)
+                   for w in void_windows]
+        for f in as_completed(futures):
+            window, arrs, n = f.result()
+            num_filled += n
+            for i, arr in enumerate(arrs):
+                dst_ds.GetRasterBand(i + 1).WriteArray(arr, window[0],
+                                                       window[1])
+    dst_ds = None
+    logger.info('Pixels filled: {:,}'.format(num_filled))
+
+    return out_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fill NoData voids in a '
+                                                 'raster, in tiles.')
+    parser.add_argument('img', type=os.path.abspath,
+                        help='Raster to fill.')
+    parser.add_argument('out_path', type=os.path.abspath,
+                        help='Path to write filled raster to.')
+    parser.add_argument('-a', '--aoi', type=os.path.abspath,
+                        help='Only fill voids within these polygons, '
+                             'setting pixels outside them to NoData.')
+    parser.add_argument('-m', '--method', choices=METHODS, default=IDW,
+                        help='Fill method.')
+    parser.add_argument('--halo', type=int, default=HALO,
+                        help='Maximum distance to fill from, in pixels.')
+    parser.add_argument('--tile_size', type=int, default=TILE_SIZE,
+                        help='Approximate size of tiles, in pixels.')
+    parser.add_argument('-k', type=int, default=K,
+                        help='Neighbours used by the kdtree method.')
+    parser.add_argument('--power', type=float, default=POWER,
+                        help='Power of distance weights used by the kdtree '
+                             'method.')
+    parser.add_argument('--max_workers', type=int,
+                        help='Number of processes, default the number of '
+                             'CPUs.')
+
+    args = parser.parse_args()
+
+    fill_voids(args.img, args.out_path, aoi=args.aoi, method=args.method,
+               halo=args.halo, tile_size=args.tile_size, k=args.k,
+               power=args.power, max_workers=args.max_workers)
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+Steps of a processing pipeline declared with their input and output paths
+and parameters, run as a dependency graph. Each step is keyed on hashes of
+the contents of its inputs and its parameters, and skipped when the key
+matches the key recorded the last time the step ran (and its outputs are
+unchanged). Steps that do not depend on each other are run concurrently.
+"""
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import hashlib
+import json
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+from misc_utils.logging_utils import create_logger
+from misc_utils.profiler import stage, in_current_stage
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+# Files that make up a shapefile
+SHP_PARTS = ['.shp', '.shx', '.dbf', '.prj']
+HASH_CHUNK = 2**20
+
+
+def _norm(path):
+    return os.path.normpath(os.path.abspath(str(path)))
+
+
+def file_sha1(path):
+    """Hash of the contents of the file at path."""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as src:
+        for chunk in iter(lambda: src.read(HASH_CHUNK), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def gpkg_layer_state(gpkg, layer):
+    """
+    State of a layer within a geopackage, from the last change timestamp and
+    row count of the layer's table. Used rather than hashing the whole
+    geopackage, as other layers in the same geopackage may be written by
+    other steps.
+    """
+    con = sqlite3.connect('file:{}?mode=ro'.format(Path(gpkg).as_posix()),
+                          uri=True)
+    try:
+        row = con.execute('SELECT last_change FROM gpkg_contents '
+                          'WHERE table_name = ?', (layer,)).fetchone()
+        if row is None:
+            return None
+        count = con.execute('SELECT COUNT(*) FROM "{}"'.format(
+            layer.replace('"', '""'))).fetchone()[0]
+    finally:
+        con.close()
+
+    return '{}:{}'.format(row[0], count)
+
+
+class StepCache:
+    """
+    Record of the key each step was last run with and the fingerprints of
+    its outputs, stored as JSON. File content hashes are memoized on size and
+    modification time, so unchanged files are only hashed once.
+
+    Parameters
+    ----------
+    cache_path : str
+        JSON file to store the cache in.
+    """
+    def __init__(self, cache_path):
+        self.cache_path = Path(cache_path)
+        self._lock = threading.Lock()
+        if self.cache_path.exists():
+            with open(self.cache_path) as src:
+                cache = json.load(src)
+        else:
+            cache = {}
+        self.steps = cache.get('steps', {})
+        self.files = cache.get('files', {})
+
+    def save(self):
+        with self._lock:
+            cache = {'steps': self.steps, 'files': self.files}
+            tmp = self.cache_path.with_suffix('.tmp')
+            with open(tmp, 'w') as dst:
+                json.dump(cache, dst, indent=1)
+            os.replace(tmp, self.cache_path)
+
+    def _file_hash(self, path):
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        with self._lock:
+            memo = self.files.get(path)
+        if memo and memo['stamp'] == stamp:
+            return memo['sha1']
+        logger.debug('Hashing: {}'.format(path))
+        sha = file_sha1(path)
+        with self._lock:
+            self.files[path] = {'stamp': stamp, 'sha1': sha}
+
+        return sha
+
+    def fingerprint(self, path):
+        """
+        Fingerprint of the contents of path: a file, a shapefile, a directory
+        or a layer within a geopackage ('/path/to/db.gpkg/layer'). None if
+        path does not exist.
+        """
+        path = _norm(path)
+        p = Path(path)
+        if p.is_file():
+            if p.suffix.lower() == '.shp':
+                parts = [p.with_suffix(s) for s in SHP_PARTS]
+                return '|'.join([self._file_hash(str(sp)) for sp in parts
+                                 if sp.exists()])
+            return self._file_hash(path)
+        elif p.is_dir():
+            return '|'.join(['{}:{}'.format(c.name, self.fingerprint(c))
+                             for c in sorted(p.iterdir())])
+        elif p.parent.suffix.lower() == '.gpkg' and p.parent.is_file():
+            return gpkg_layer_state(p.parent, p.name)
+
+        return None
+
+    def key(self, step):
+        """Hash of the step's parameters and the contents of its inputs."""
+        inputs = {_norm(i): self.fingerprint(i) for i in step.inputs}
+        missing = [i for i, fp in inputs.items() if fp is None]
+        if missing:
+            logger.warning('{}: inputs do not exist: '
+                           '{}'.format(step.name, missing))
+        key_src = json.dumps({'params': step.params, 'inputs': inputs},
+                             sort_keys=True, default=str)
+
+        return hashlib.sha1(key_src.encode()).hexdigest()
+
+    def is_current(self, step, key):
+        """True if step was last run with key and its outputs are
+        unchanged since."""
+        with self._lock:
+            record = self.steps.get(step.name)
+        if record is None or record['key'] != key:
+            return False
+        outputs = {_norm(o): self.fingerprint(o) for o in step.outputs}
+        if any([fp is None for fp in outputs.values()]):
+            return False
+
+        return outputs == record['outputs']
+
+    def record(self, step, key, runtime=None):
+        outputs = {_norm(o): self.fingerprint(o) for o in step.outputs}
+        with self._lock:
+            self.steps[step.name] = {'key': key,
+                                     'outputs': outputs,
+                                     'runtime': runtime}
+        self.save()
+
+
+class Step:
+    """
+    A step in a pipeline.
+
+    Parameters
+    ----------
+    name : str
+        Unique name of the step.
+    func : callable
+        Called with no arguments to run the step.
+    inputs : list
+        Paths read by the step.
+    outputs : list
+        Paths written by the step.
+    params : dict
+        JSON serializable parameters that change the outputs of the step.
+    after : list
+        Names of steps that must run before this step, in addition to those
+        that write its inputs.
+    """
+    def __init__(self, name, func, inputs=None, outputs=None, params=None,
+                 after=None):
+        self.name = name
+        self.func = func
+        self.inputs = [str(i) for i in inputs] if inputs else []
+        self.outputs = [str(o) for o in outputs] if outputs else []
+        self.params = params if params is not None else {}
+        self.after = list(after) if after else []
+
+    def __repr__(self):
+        return 'Step({})'.format(self.name)
+
+
+class Pipeline:
+    """
+    Dependency graph of Steps, run with a step cache.
+
+    Parameters
+    ----------
+    cache_path : str
+        JSON file to store the step cache in.
+    max_workers : int
+        Maximum number of steps to run concurrently.
+    groups : dict
+        {group_name: [step names]}, allows group names to be used when
+        skipping or forcing steps.
+    """
+    def __init__(self, cache_path, max_workers=4, groups=None):
+        self.cache = StepCache(cache_path)
+        self.max_workers = max_workers
+        self.groups = groups if groups else {}
+        self.steps = {}
+
+    def add(self, name, func, inputs=None, outputs=None, params=None,
+            after=None, group=None):
+        if name in self.steps:
+            logger.error('Duplicate step name: {}'.format(name))
+            raise ValueError(name)
+        step = Step(name, func, inputs=inputs, outputs=outputs,
+                    params=params, after=after)
+        self.steps[name] = step
+        if group is not None:
+            self.groups.setdefault(group, []).append(name)
+
+        return step
+
+    def _expand(self, names):
+        expanded = set()
+        for n in names if names else []:
+            expanded.update(self.groups.get(n, [n]))
+
+        return expanded
+
+    def dependencies(self):
+        """{step name: set of names of steps it depends on}"""
+        producers = {}
+        for s in self.steps.values():
+            for o in s.outputs:
+                producers[_norm(o)] = s.name
+        deps = {}
+        for s in self.steps.values():
+            d = {producers[_norm(i)] for i in s.inputs
+                 if _norm(i) in producers}
+            d.update([a for a in s.after if a in self.steps])
+            d.discard(s.name)
+            deps[s.name] = d
+
+        return deps
+
+    def order(self):
+        """Step names in a valid run order."""
+        deps = self.dependencies()
+        done = []
+        remaining = dict(deps)
+        while remaining:
+            ready = [n for n, d in remaining.items() if d.issubset(done)]
+            if not ready:
+                logger.error('Cycle in pipeline steps: '
+                             '{}'.format(list(remaining)))
+                raise ValueError(list(remaining))
+            for n in ready:
+                done.append(n)
+                del remaining[n]
+
+        return done
+
+    def _run_step(self, name, skip, force):
+        step = self.steps[name]
+        if name in skip:
+            logger.info('Skipping step: {}'.format(name))
+            return 'skipped'
+        key = self.cache.key(step)
+        if name not in force and self.cache.is_current(step, key):
+            logger.info('Up to date, skipping step: {}'.format(name))
+            return 'cached'
+        logger.info('Running step: {}'.format(name))
+        start = time.time()
+        with stage(name):
+            step.func()
+        runtime = time.time() - start
+        logger.info('Finished step: {} ({:.1f}s)'.format(name, runtime))
+        # Key on the inputs as they were when the step ran
+        self.cache.record(step, key, runtime=runtime)
+
+        return 'ran'
+
+    def run(self, skip=None, force=None, dryrun=False):
+        """
+        Run all steps, in dependency order, concurrently where possible.
+
+        Parameters
+        ----------
+        skip : list
+            Step or group names to skip without checking the cache, their
+            outputs must already exist.
+        force : list
+            Step or group names to run even if up to date.
+        dryrun : bool
+            True to only log the order steps would be run in.
+
+        Returns
+        -------
+        dict : {step name: 'ran', 'cached' or 'skipped'}
+        """
+        skip = self._expand(skip)
+        force = self._expand(force)
+        deps = self.dependencies()
+        order = self.order()
+        if dryrun:
+            logger.info('Steps: {}'.format(', '.join(order)))
+            return {}
+
+        status = {}
+        pending = list(order)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                # Submit steps whose dependencies have finished
+                for name in list(pending):
+                    if deps[name].issubset(status):
+                        pending.remove(name)
+                        # Steps are recorded as stages within the stage
+                        # the pipeline is run in
+                        running[executor.submit(
+                            in_current_stage(self._run_step), name, skip,
+                            force)] = name
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    name = running.pop(f)
+                    try:
+                        status[name] = f.result()
+                    except Exception as e:
+                        logger.error('Step failed: {}'.format(name))
+                        for other in running:
+                            other.cancel()
+                        raise e
+
+        return {n: status[n] for n in order}
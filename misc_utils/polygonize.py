@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+Block-wise polygonization of label rasters. The raster is split into
+windows aligned to its blocks and each window is polygonized (GDAL
+Polygonize, 4-connected) in a pool of processes. Polygons of labels that
+do not touch an interior window edge are complete and are written as they
+arrive, in batches. Only the pieces of labels touching window edges are
+kept, and are dissolved by label once all windows are done. Polygons are
+written with OGR (e.g. GPKG, shapefile) in transactions, or to GeoParquet
+if pyarrow is available.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from osgeo import gdal, ogr, osr
+from shapely import wkb
+from shapely.geometry import MultiPolygon
+from shapely.ops import unary_union
+
+from misc_utils.gdal_tools import block_windows, window_geotransform
+from misc_utils.logging_utils import create_logger
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+gdal.UseExceptions()
+ogr.UseExceptions()
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+BLOCK_SIZE = 2048
+BATCH_SIZE = 50000
+PARQUET = '.parquet'
+
+
+def _block_polygons(img, band, window, mask_nodata=True, min_area=None):
+    """
+    Polygonize a window of a label raster.
+
+    Returns
+    -------
+    tuple : (labels, WKB geometries, on_edge), on_edge True for polygons
+    of labels touching an edge of the window that is not the edge of the
+    raster, which may continue in the neighbouring window. Complete
+    polygons smaller than min_area are dropped.
+    """
+    xoff, yoff, xsize, ysize = window
+    ds = gdal.Open(str(img))
+    b = ds.GetRasterBand(band)
+    arr = b.ReadAsArray(xoff, yoff, xsize, ysize)
+    nodata = b.GetNoDataValue() if mask_nodata else None
+    gt = window_geotransform(ds.GetGeoTransform(), xoff, yoff)
+    x_sz, y_sz = ds.RasterXSize, ds.RasterYSize
+    dtype = b.DataType
+    ds = None
+
+    mem = gdal.GetDriverByName('MEM')
+    src_ds = mem.Create('', xsize, ysize, 1, dtype)
+    src_ds.SetGeoTransform(gt)
+    src_ds.GetRasterBand(1).WriteArray(arr)
+    mask_ds = None
+    mask_band = None
+    if nodata is not None:
+        mask_ds = mem.Create('', xsize, ysize, 1, gdal.GDT_Byte)
+        mask_ds.GetRasterBand(1).WriteArray((arr != nodata).astype(np.uint8))
+        mask_band = mask_ds.GetRasterBand(1)
+
+    vec_ds = ogr.GetDriverByName('Memory').CreateDataSource('')
+    lyr = vec_ds.CreateLayer('polygons', geom_type=ogr.wkbPolygon)
+    lyr.CreateField(ogr.FieldDefn('label', ogr.OFTInteger))
+    gdal.Polygonize(src_ds.GetRasterBand(1), mask_band, lyr, 0, [])
+
+    # Labels on window edges shared with another window
+    edges = []
+    if yoff > 0:
+        edges.append(arr[0, :])
+    if yoff + ysize < y_sz:
+        edges.append(arr[-1, :])
+    if xoff > 0:
+        edges.append(arr[:, 0])
+    if xoff + xsize < x_sz:
+        edges.append(arr[:, -1])
+    edge_labels = set(np.unique(np.concatenate(edges)).tolist()) \
+        if edges else set()
+
+    labels = []
+    geoms = []
+    on_edge = []
+    for feat in lyr:
+        label = feat.GetField(0)
+        geom = feat.GetGeometryRef()
+        edge = label in edge_labels
+        if not edge and min_area is not None and geom.GetArea() < min_area:
+            continue
+        labels.append(label)
+        geoms.append(bytes(geom.ExportToWkb()))
+        on_edge.append(edge)
+    lyr = None
+    vec_ds = None
+    src_ds = None
+    mask_ds = None
+
+    return (np.array(labels, dtype=np.int64), geoms,
+            np.array(on_edge, dtype=bool))
+
+
+def _dissolve_edge_pieces(labels, geoms, min_area=None):
+    """
+    Dissolve polygons pieces by label, splitting the result into its
+    connected parts.
+
+    Returns
+    -------
+    tuple : (labels, WKB geometries)
+    """
+    pieces = pd.DataFrame({'label': labels, 'geom': geoms})
+    out_labels = []
+    out_geoms = []
+    for label, group in pieces.groupby('label', sort=False):
+        if len(group) == 1:
+            parts = [wkb.loads(group['geom'].iloc[0])]
+        else:
+            merged = unary_union([wkb.loads(g) for g in group['geom']])
+            if isinstance(merged, MultiPolygon):
+                parts = list(merged.geoms)
+            else:
+                parts = [merged]
+        for p in parts:
+            if min_area is not None and p.area < min_area:
+                continue
+            out_labels.append(label)
+            out_geoms.append(p.wkb)
+
+    return out_labels, out_geoms
+
+
+class _OGRWriter:
+    """Writes batches of polygons to an OGR data source."""
+    def __init__(self, out_vec, srs, fieldname, overwrite=True):
+        out_vec = str(out_vec)
+        if out_vec.endswith('.gpkg'):
+            # Layer named for the file
+            db, lyr_name = out_vec, Path(out_vec).stem
+        elif '.gpkg' in out_vec:
+            # path/to/db.gpkg/layer
+            db, lyr_name = str(Path(out_vec).parent), Path(out_vec).name
+        else:
+            db, lyr_name = out_vec, Path(out_vec).stem
+        driver = {'.gpkg': 'GPKG', '.geojson': 'GeoJSON'}.get(
+            Path(db).suffix, 'ESRI Shapefile')
+        driver = ogr.GetDriverByName(driver)
+        if os.path.exists(db) and driver.GetName() == 'GPKG':
+            self.ds = ogr.Open(db, update=True)
+            existing = [self.ds.GetLayer(i).GetName()
+                        for i in range(self.ds.GetLayerCount())]
+            if lyr_name in existing:
+                if not overwrite:
+                    raise FileExistsError('{} exists in {}'.format(lyr_name,
+                                                                   db))
+                logger.debug('Removing existing layer: {}'.format(lyr_name))
+                self.ds.DeleteLayer(lyr_name)
+        else:
+            if os.path.exists(db):
+                if not overwrite:
+                    raise FileExistsError(db)
+                driver.DeleteDataSource(db)
+            self.ds = driver.CreateDataSource(db)
+        self.lyr = self.ds.CreateLayer(lyr_name, srs=srs,
+                                       geom_type=ogr.wkbPolygon)
+        self.lyr.CreateField(ogr.FieldDefn(fieldname, ogr.OFTInteger))
+        self.defn = self.lyr.GetLayerDefn()
+
+    def write(self, labels, geoms):
+        self.lyr.StartTransaction()
+        for label, g in zip(labels, geoms):
+            feat = ogr.Feature(self.defn)
+            feat.SetField(0, int(label))
+            feat.SetGeometry(ogr.CreateGeometryFromWkb(g))
+            self.lyr.CreateFeature(feat)
+            feat = None
+        self.lyr.CommitTransaction()
+
+    def close(self):
+        self.lyr = None
+        self.ds = None
+
+
+class _ParquetWriter:
+    """Writes batches of polygons to a GeoParquet file, geometries as
+    WKB."""
+    def __init__(self, out_vec, srs, fieldname, overwrite=True):
+        if pa is None:
+            raise ImportError('pyarrow is required to write GeoParquet.')
+        if os.path.exists(out_vec) and not overwrite:
+            raise FileExistsError(out_vec)
+        geo = {'primary_column': 'geometry',
+               'columns': {'geometry': {
+                   'encoding': 'WKB',
+                   'crs': srs.ExportToWkt() if srs is not None else None,
+                   'geometry_types': ['Polygon']}},
+               'version': '0.1.0'}
+        self.fieldname = fieldname
+        self.schema = pa.schema([(fieldname, pa.int64()),
+                                 ('geometry', pa.binary())],
+                                metadata={'geo': json.dumps(geo)})
+        self.writer = pq.ParquetWriter(str(out_vec), self.schema)
+
+    def write(self, labels, geoms):
+        table = pa.Table.from_arrays([pa.array(labels, type=pa.int64()),
+                                      pa.array(geoms, type=pa.binary())],
+                                     schema=self.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+
+
+class _FrameWriter:
+    """Collects polygons into a GeoDataFrame."""
+    def __init__(self, srs, fieldname):
+        self.crs = srs.ExportToWkt() if srs is not None else None
+        self.fieldname = fieldname
+        self.labels = []
+        self.geoms = []
+
+    def write(self, labels, geoms):
+        self.labels.extend(labels)
+        self.geoms.extend(geoms)
+
+    def close(self):
+        pass
+
+    def frame(self):
+        return gpd.GeoDataFrame({self.fieldname: self.labels},
+                                geometry=[wkb.loads(g) for g in self.geoms],
+                                crs=self.crs)
+
+
+def polygonize_blocks(img, out_vec=None, band=1, fieldname='label',
+                      mask_nodata=True, min_area=None, overwrite=True,
+                      block_size=BLOCK_SIZE, batch_size=BATCH_SIZE,
+                      max_workers=None):
+    """
+    Polygonize a label raster in blocks, in parallel.
+
+    Parameters
+    ----------
+    img : str
+        Path to raster to polygonize.
+    out_vec : str
+        Path to write polygons to: .parquet for GeoParquet, otherwise an
+        OGR format (.gpkg, path/to/db.gpkg/layer, .shp, .geojson). None
+        to return a GeoDataFrame.
+    band : int
+        Band to polygonize.
+    fieldname : str
+        Field to write raster values to.
+    mask_nodata : bool
+        True to not create polygons for NoData pixels.
+    min_area : float
+        Drop polygons with a smaller area than this, in raster units.
+    overwrite : bool
+        True to overwrite out_vec if it exists.
+    block_size : int
+        Approximate size in pixels of the blocks polygonized by each worker,
+        rounded to the raster's native blocks.
+    batch_size : int
+        Number of polygons written at once.
+    max_workers : int
+        Number of processes, default the number of CPUs. 0 to polygonize in
+        this process, which is always the case for /vsimem/ rasters.
+
+    Returns
+    -------
+    gpd.GeoDataFrame if out_vec is None, else out_vec
+    """
+    img = str(img)
+    logger.info('Polygonizing: {}'.format(img))
+    ds = gdal.Open(img)
+    b = ds.GetRasterBand(band)
+    windows = list(block_windows(b, target_size=block_size))
+    wkt = ds.GetProjection()
+    srs = None
+    if wkt:
+        srs = osr.SpatialReference()
+        srs.ImportFromWkt(wkt)
+    b = None
+    ds = None
+
+    if out_vec is None:
+        writer = _FrameWriter(srs, fieldname)
+    elif str(out_vec).endswith(PARQUET):
+        writer = _ParquetWriter(out_vec, srs, fieldname, overwrite=overwrite)
+    else:
+        writer = _OGRWriter(out_vec, srs, fieldname, overwrite=overwrite)
+
+    if img.startswith('/vsimem/'):
+        # In memory rasters are not visible to other processes
+        max_workers = 0
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    max_workers = min(max_workers, len(windows))
+    logger.debug('Windows: {:,}  Processes: {}'.format(len(windows),
+                                                       max_workers))
+
+    args = ([img] * len(windows), [band] * len(windows), windows,
+            [mask_nodata] * len(windows), [min_area] * len(windows))
+    batch_labels, batch_geoms = [], []
+    edge_labels, edge_geoms = [], []
+    num_polys = 0
+    executor = ProcessPoolExecutor(max_workers=max_workers) \
+        if max_workers > 1 else None
+    try:
+        results = executor.map(_block_polygons, *args) if executor \
+            else map(_block_polygons, *args)
+        for labels, geoms, on_edge in results:
+            for i in np.flatnonzero(on_edge):
+                edge_labels.append(labels[i])
+                edge_geoms.append(geoms[i])
+            for i in np.flatnonzero(~on_edge):
+                batch_labels.append(labels[i])
+                batch_geoms.append(geoms[i])
+            if len(batch_labels) >= batch_size:
+                writer.write(batch_labels, batch_geoms)
+                num_polys += len(batch_labels)
+                batch_labels, batch_geoms = [], []
+
+        logger.debug('Dissolving {:,} polygons on block '
+                     'edges...'.format(len(edge_labels)))
+        labels, geoms = _dissolve_edge_pieces(edge_labels, edge_geoms,
+                                              min_area=min_area)
+        batch_labels.extend(labels)
+        batch_geoms.extend(geoms)
+        for i in range(0, len(batch_labels), batch_size):
+            writer.write(batch_labels[i:i + batch_size],
+                         batch_geoms[i:i + batch_size])
+        num_polys += len(batch_labels)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        writer.close()
+    logger.info('Polygons created: {:,}'.format(num_polys))
+
+    if out_vec is None:
+        return writer.frame()
+    logger.info('Polygons written to: {}'.format(out_vec))
+
+    return out_vec
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Polygonize a label raster '
+                                                 'in blocks, in parallel.')
+    parser.add_argument('img', type=os.path.abspath,
+                        help='Raster to polygonize.')
+    parser.add_argument('out_vec', type=os.path.abspath,
+                        help='Vector file to write, .parquet for '
+                             'GeoParquet.')
+    parser.add_argument('-b', '--band', type=int, default=1,
+                        help='Band to polygonize.')
+    parser.add_argument('-f', '--fieldname', default='label',
+                        help='Field to write raster values to.')
+    parser.add_argument('--min_area', type=float,
+                        help='Drop polygons smaller than this area.')
+    parser.add_argument('--block_size', type=int, default=BLOCK_SIZE,
+                        help='Approximate size of blocks, in pixels.')
+    parser.add_argument('--max_workers', type=int,
+                        help='Number of processes, default the number of '
+                             'CPUs.')
+
+    args = parser.parse_args()
+
+    polygonize_blocks(args.img, out_vec=args.out_vec, band=args.band,
+                      fieldname=args.fieldname, min_area=args.min_area,
+                      block_size=args.block_size,
+                      max_workers=args.max_workers)
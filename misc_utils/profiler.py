@@ -3,43 +3,373 @@
 Created on Fri Jan 31 09:10:22 2020
 
 @author: disbr007
-"""
 
-import os
+Resource telemetry for named stages of processing. Each stage records its
+wall time, CPU time (of the process, of the calling thread and of child
+processes, e.g. OTB and WhiteboxTools), resident memory (at the end and
+the peak sampled during the stage), bytes read and written and GDAL block
+cache usage, and appends them as a JSON line to the telemetry file, so a
+slow run can be diagnosed from its outputs without rerunning it under a
+profiler. Stages can optionally also be run under cProfile.
+
+Use as a context manager:
+    with stage('zonal_stats', n_objects=len(objs)):
+        ...
+or a decorator:
+    @profile_stage()
+    def cleanup_objects(...):
+Stages opened within a stage record it as their parent. The stack of open
+stages is per thread, so functions submitted to an executor from within a
+stage should be wrapped with in_current_stage to keep their stages nested:
+    executor.submit(in_current_stage(func), *args)
+Records are written to the path set with set_telemetry_path (or the
+TELEMETRY_PATH environment variable), if neither is set records are only
+logged.
+"""
+import argparse
 from cProfile import Profile
+import datetime
+import functools
+import json
+import os
+from pathlib import Path
 from pstats import Stats
+import platform
+import runpy
+import sys
+import threading
+import time
+
+import pandas as pd
+
+from misc_utils.logging_utils import create_logger
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+TELEMETRY_ENV = 'TELEMETRY_PATH'
+TELEMETRY_NAME = 'telemetry.jsonl'
+# Seconds between samples of memory use during a stage
+SAMPLE_INTERVAL = 0.1
+MB = 2**20
+
+_telemetry_path = None
+_write_lock = threading.Lock()
+_local = threading.local()
+
+
+def set_telemetry_path(path):
+    """
+    Set the file stage records are appended to, also exported to the
+    environment so that Python subprocesses append to the same file. Pass
+    None to stop writing records.
+    """
+    global _telemetry_path
+    _telemetry_path = str(path) if path is not None else None
+    if _telemetry_path:
+        os.environ[TELEMETRY_ENV] = _telemetry_path
+    else:
+        os.environ.pop(TELEMETRY_ENV, None)
+
+
+def get_telemetry_path():
+    return _telemetry_path or os.environ.get(TELEMETRY_ENV)
+
+
+def _rss():
+    if psutil is None:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+def _max_rss(who):
+    """Peak resident memory of this process or its (waited for) children,
+    in bytes, from getrusage."""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss if platform.system() == 'Darwin' else maxrss * 1024
+
+
+def _io_bytes():
+    if psutil is None:
+        return None
+    try:
+        io = psutil.Process().io_counters()
+    except (AttributeError, psutil.Error):
+        # Not available on macOS
+        return None
+    return io.read_bytes, io.write_bytes
+
+
+def _gdal_cache():
+    """(used, max) bytes of GDAL's block cache, if GDAL has been imported."""
+    gdal = sys.modules.get('osgeo.gdal')
+    if gdal is None:
+        return None
+    return gdal.GetCacheUsed(), gdal.GetCacheMax()
+
+
+def _mb(b):
+    return round(b / MB, 1) if b is not None else None
+
+
+class _PeakSampler(threading.Thread):
+    """Samples the resident memory of the process until stopped."""
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = _rss()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, _rss())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, _rss())
+
+
+def current_stage():
+    """Name of the innermost open stage of this thread, or None."""
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        return stack[-1]
+    return getattr(_local, 'base', None)
+
+
+def in_current_stage(func):
+    """
+    Wrap func, to be run in another thread, so that stages it opens record
+    the stage open in this thread (when wrapped) as their parent.
+    """
+    parent = current_stage()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        prior = getattr(_local, 'base', None)
+        _local.base = parent
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.base = prior
+
+    return wrapper
+
+
+def write_record(record, path=None):
+    """Append record as a JSON line to path (default the telemetry path)."""
+    path = path or get_telemetry_path()
+    if not path:
+        return
+    line = json.dumps(record, default=str)
+    with _write_lock:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'a') as dst:
+            dst.write(line + '\n')
+
+
+class stage:
+    """
+    Context manager recording the resources used by a named stage.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage.
+    path : str
+        File to append the record to, default the telemetry path.
+    cprofile : bool
+        True to also run the stage under cProfile, writing the stats to
+        <name>.prof next to the telemetry file.
+    **meta :
+        Additional values to include in the record, e.g. input sizes.
+    """
+    def __init__(self, name, path=None, cprofile=False, **meta):
+        self.name = name
+        self.path = path
+        self.cprofile = cprofile
+        self.meta = meta
+        self.record = None
+
+    def __enter__(self):
+        self.parent = current_stage()
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self.name)
+
+        self._sampler = None
+        if psutil is not None:
+            self._sampler = _PeakSampler()
+            self._sampler.start()
+        self._io = _io_bytes()
+        self._times = os.times()
+        self._thread_cpu = time.thread_time()
+        self._start = datetime.datetime.now()
+        self._wall = time.perf_counter()
+        self._profile = None
+        if self.cprofile:
+            self._profile = Profile()
+            self._profile.enable()
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        wall = time.perf_counter() - self._wall
+        if self._profile is not None:
+            self._profile.disable()
+        times = os.times()
+        thread_cpu = time.thread_time() - self._thread_cpu
+        io = _io_bytes()
+        peak = None
+        if self._sampler is not None:
+            self._sampler.stop()
+            peak = self._sampler.peak
+        cache = _gdal_cache()
+        _local.stack.pop()
+
+        record = {
+            'stage': self.name,
+            'parent': self.parent,
+            'start': self._start.isoformat(),
+            'status': 'error' if exc_type is not None else 'ok',
+            'wall_s': round(wall, 3),
+            'cpu_s': round((times.user - self._times.user) +
+                           (times.system - self._times.system), 3),
+            'thread_cpu_s': round(thread_cpu, 3),
+            'child_cpu_s': round(
+                (times.children_user - self._times.children_user) +
+                (times.children_system - self._times.children_system), 3),
+            'rss_mb': _mb(_rss()),
+            'peak_rss_mb': _mb(peak),
+            'max_rss_mb': _mb(_max_rss(resource.RUSAGE_SELF)
+                              if resource else None),
+            'child_max_rss_mb': _mb(_max_rss(resource.RUSAGE_CHILDREN)
+                                    if resource else None),
+            'read_mb': _mb(io[0] - self._io[0]) if io and self._io else None,
+            'write_mb': _mb(io[1] - self._io[1]) if io and self._io else None,
+            'gdal_cache_mb': _mb(cache[0]) if cache else None,
+            'gdal_cache_max_mb': _mb(cache[1]) if cache else None,
+            'pid': os.getpid(),
+            'host': platform.node(),
+        }
+        if exc_type is not None:
+            record['error'] = '{}: {}'.format(exc_type.__name__, exc_val)
+        record.update(self.meta)
+        self.record = record
+
+        logger.debug('Stage {}: {:.1f}s wall, {:.1f}s cpu, peak rss '
+                     '{} MB'.format(self.name, record['wall_s'],
+                                    record['cpu_s'], record['peak_rss_mb']))
+        try:
+            write_record(record, path=self.path)
+        except OSError as e:
+            logger.warning('Unable to write telemetry for stage {}: '
+                           '{}'.format(self.name, e))
+
+        if self._profile is not None:
+            out_dir = os.path.dirname(os.path.abspath(
+                self.path or get_telemetry_path() or TELEMETRY_NAME))
+            prof_path = os.path.join(out_dir, '{}.prof'.format(self.name))
+            self._profile.dump_stats(prof_path)
+            logger.info('Profile stats for {} written to: '
+                        '{}'.format(self.name, prof_path))
+
+        # Do not suppress exceptions
+        return False
+
+
+def profile_stage(name=None, cprofile=False, **meta):
+    """
+    Decorator recording the resources used by each call of the decorated
+    function as a stage, named for the function if name is not provided.
+    See stage.
+    """
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name, cprofile=cprofile, **meta):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def read_telemetry(path):
+    """Read records from a telemetry file into a DataFrame."""
+    with open(path) as src:
+        records = [json.loads(line) for line in src if line.strip()]
+
+    return pd.DataFrame(records)
+
+
+def summarize(path):
+    """
+    Summarize a telemetry file by stage: number of runs and total and
+    maximum wall time, CPU time and memory, slowest stages first.
+    """
+    df = read_telemetry(path)
+    summary = df.groupby('stage').agg(
+        runs=('wall_s', 'count'),
+        wall_s=('wall_s', 'sum'),
+        max_wall_s=('wall_s', 'max'),
+        cpu_s=('cpu_s', 'sum'),
+        child_cpu_s=('child_cpu_s', 'sum'),
+        peak_rss_mb=('peak_rss_mb', 'max'),
+        read_mb=('read_mb', 'sum'),
+        write_mb=('write_mb', 'sum'))
+
+    return summary.sort_values('wall_s', ascending=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a Python script as a '
+                                                 'profiled stage, or '
+                                                 'summarize a telemetry file.')
+    parser.add_argument('script', type=os.path.abspath,
+                        help='Script to run, or telemetry file to summarize '
+                             'with --summarize.')
+    parser.add_argument('script_args', nargs=argparse.REMAINDER,
+                        help='Arguments to pass to script.')
+    parser.add_argument('-o', '--out_dir', type=os.path.abspath,
+                        default=os.getcwd(),
+                        help='Directory to write telemetry and profile '
+                             'stats to.')
+    parser.add_argument('--summarize', action='store_true',
+                        help='Print a summary of the telemetry file passed.')
+
+    args = parser.parse_args()
+
+    if args.summarize:
+        with pd.option_context('display.width', 200,
+                               'display.max_columns', None):
+            print(summarize(args.script))
+    else:
+        set_telemetry_path(Path(args.out_dir) / TELEMETRY_NAME)
+        sys.argv = [args.script] + args.script_args
+        with stage(Path(args.script).stem, cprofile=True):
+            runpy.run_path(args.script, run_name='__main__')
 
-prof = Profile()
-# Don't time imports
-prof.disable()
-# Import main function to run
-from dem_utils import dem_valid_data
-# Set output directories for profile stats
-profile_dir = r'E:\disbr007\umn\ms\scratch'
-stats = os.path.join(profile_dir, '{}.stats'.format(__name__))
-profile_txt = os.path.join(profile_dir, '{}_profile.txt'.format(__name__))
-# Turn timing back on
-prof.enable()
-
-DEMS_PATH = r'E:\disbr007\umn\ms\scratch\banks_dems_multispec_test_5.shp'
-OUT_SHP = r'E:\disbr007\umn\ms\scratch\banks_dems_multispec_test_5_vp.shp'
-PRJ_DIR = r'E:\disbr007\umn\ms\scratch'
-SCRATCH_DIR= r'E:\disbr007\umn\ms\scratch'
-LOG_FILE = r'E:\disbr007\umn\ms\scratch\vp_profile_5.log'
-PROCESSED = r'E:\disbr007\umn\ms\scratch\vp_processed_5.txt'
-
-dem_valid_data.main(DEMS_PATH=DEMS_PATH,
-                    OUT_SHP=OUT_SHP,
-                    PRJ_DIR=PRJ_DIR,
-                    SCRATCH_DIR=SCRATCH_DIR,
-                    LOG_FILE=LOG_FILE,
-                    PROCESSED=PROCESSED)
-
-prof.disable()
-
-prof.dump_stats(stats)
-
-with open(profile_txt, 'wt') as output:
-    stats = Stats(stats, stream=output)
-    stats.sort_stats('cumulative', 'time')
-    stats.print_stats()
\ No newline at end of file
+        stats_path = Path(args.out_dir) / '{}.prof'.format(
+            Path(args.script).stem)
+        with open(Path(args.out_dir) / '{}_profile.txt'.format(
+                Path(args.script).stem), 'wt') as output:
+            stats = Stats(str(stats_path), stream=output)
+            stats.sort_stats('cumulative', 'time')
+            stats.print_stats()
@@ -10,6 +10,9 @@ import argparse
 import os
 from pathlib import Path
 import shutil
+import tempfile
+import threading
+from uuid import uuid4
 
 from osgeo import ogr, gdal
 import geopandas as gpd
@@ -17,6 +20,7 @@ import geopandas as gpd
 
 from misc_utils.gdal_tools import check_sr, ogr_reproject, get_raster_sr, \
     remove_shp, detect_ogr_driver
+from misc_utils.clip_engine import warp_task, run_clips, VSIMEM
 from misc_utils.gpd_utils import read_vec
 from misc_utils.id_parse_utils import read_ids
 from misc_utils.logging_utils import create_logger
@@ -27,6 +31,15 @@ ogr.UseExceptions()
 
 logger = create_logger(__name__, 'sh', 'INFO')
 
+# Prepared (dissolved) cutlines: {(shp_p, mtime, in_mem): (ds, layer)},
+# shared by clips run from several threads
+_cutlines = {}
+_cutlines_lock = threading.Lock()
+# Directory for cutlines written to disk, removed by clear_cutlines or at
+# exit
+_cutline_dir = None
+DISSOLVED_PREFIX = 'clip_shp_dissolve_'
+
 
 def move_meta_files(raster_p, out_dir, raster_ext=None):
     """Move metadata files associted with raster, skipping files with
@@ -43,16 +56,97 @@ def move_meta_files(raster_p, out_dir, raster_ext=None):
         shutil.copy(src, out_dir)
 
 
+def prepare_cutline(shp_p, in_mem=True):
+    """
+    Prepare a cutline from shp_p, dissolving to a single feature if it has
+    multiple features. Prepared cutlines are cached, so repeated clips to
+    the same AOI only read and dissolve it once.
+
+    Parameters
+    ----------
+    shp_p : str
+        Path to vector file (layer paths within geopackages supported).
+    in_mem : bool
+        True to write a dissolved cutline to /vsimem, otherwise it is
+        written to a temporary directory, so it can be read by other
+        processes.
+
+    Returns
+    -------
+    tuple : (cutline datasource, cutline layer or None)
+    """
+    shp_p = str(shp_p)
+    _shp_driver, shp_layer = detect_ogr_driver(shp_p)
+    src = Path(shp_p).parent if shp_layer is not None else Path(shp_p)
+    key = (shp_p, os.path.getmtime(src) if src.exists() else None, in_mem)
+    # Held while preparing, so threads clipping to the same AOI wait for
+    # one dissolve rather than each writing their own
+    with _cutlines_lock:
+        if key in _cutlines:
+            return _cutlines[key]
+
+        if shp_layer is not None:
+            cutline = (str(Path(shp_p).parent), shp_layer)
+        else:
+            cutline = (shp_p, None)
+        shp = read_vec(shp_p)
+        if len(shp) > 1:
+            logger.debug('Dissolving clipping shape with multiple '
+                         'features...')
+            shp['dissolve'] = 1
+            shp = shp.dissolve(by='dissolve')
+            name = '{}{}.shp'.format(DISSOLVED_PREFIX, uuid4().hex)
+            if in_mem:
+                dissolved = '{}/{}'.format(VSIMEM, name)
+            else:
+                dissolved = os.path.join(_temp_dir(), name)
+            shp.to_file(dissolved)
+            cutline = (dissolved, None)
+        _cutlines[key] = cutline
+
+    return cutline
+
+
+def _temp_dir():
+    """Directory for cutlines written to disk, created on first use."""
+    global _cutline_dir
+    if _cutline_dir is None:
+        _cutline_dir = tempfile.TemporaryDirectory(prefix='clip_cutlines_')
+    return _cutline_dir.name
+
+
+def clear_cutlines():
+    """Remove all prepared cutlines."""
+    global _cutline_dir
+    with _cutlines_lock:
+        for ds, _layer in _cutlines.values():
+            if (ds.startswith(VSIMEM) and
+                    os.path.basename(ds).startswith(DISSOLVED_PREFIX)):
+                ogr.GetDriverByName('ESRI Shapefile').DeleteDataSource(ds)
+        _cutlines.clear()
+        if _cutline_dir is not None:
+            _cutline_dir.cleanup()
+            _cutline_dir = None
+
+
 def clip_rasters(shp_p, rasters, out_path=None, out_dir=None, out_suffix='_clip',
                  out_prj_shp=None, raster_ext=None, move_meta=False, 
-                 in_mem=False, skip_srs_check=False, overwrite=False):
+                 in_mem=False, skip_srs_check=False, overwrite=False,
+                 max_workers=None, num_threads=None):
     """
     Take a list of rasters and warps (clips) them to the shapefile feature
-    bounding box.
+    bounding box. Rasters are clipped concurrently, see
+    clip_engine.run_clips.
     rasters : LIST or STR
         List of rasters to clip, or if STR, path to single raster.
     out_prj_shp : os.path.abspath
         Path to create the projected shapefile if necessary to match raster prj
+    max_workers : INT
+        Maximum number of rasters to clip at once, default is the number of
+        CPUs.
+    num_threads : INT
+        GDAL threads used by each clip, default is the number of CPUs divided
+        between the workers.
     """
     # TODO: Fix permission error if out_prj_shp not supplied -- create in-mem
     #  OGR?
@@ -83,18 +177,10 @@ def clip_rasters(shp_p, rasters, out_path=None, out_dir=None, out_suffix='_clip'
                                   to_sr=get_raster_sr(check_raster),
                                   output_shp=out_prj_shp)
 
-    # shp = gpd.read_file(shp_p)
-    _shp_driver, shp_layer = detect_ogr_driver(shp_p)
-    shp = read_vec(shp_p)
-    if len(shp) > 1:
-        logger.debug('Dissolving clipping shape with multiple features...')
-        shp['dissolve'] = 1
-        shp = shp.dissolve(by='dissolve')
-        shp_p = r'/vsimem/clip_shp_dissolve.shp'
-        shp.to_file(shp_p)
+    cutline_ds, cutline_layer = prepare_cutline(shp_p, in_mem=in_mem)
 
     # Do the 'warping' / clipping
-    warped = []
+    tasks = []
     for raster_p in rasters:
         # TODO: Handle this with platform.sys and pathlib.Path objects
         raster_p = raster_p.replace(r'\\', os.sep)
@@ -118,35 +204,22 @@ def clip_rasters(shp_p, rasters, out_path=None, out_dir=None, out_suffix='_clip'
         if os.path.exists(raster_out_path) and not overwrite:
             logger.warning('Outpath exists, skipping: '
                            '{}'.format(raster_out_path))
-            pass
         else:
-            raster_ds = gdal.Open(raster_p, gdal.GA_ReadOnly)
-            x_res = raster_ds.GetGeoTransform()[1]
-            y_res = raster_ds.GetGeoTransform()[5]
-            if shp_layer is not None:
-                warp_options = gdal.WarpOptions(cutlineDSName=Path(shp_p).parent,
-                                                cutlineLayer=shp_layer,
-                                                cropToCutline=True,
-                                                targetAlignedPixels=True,
-                                                xRes=x_res,
-                                                yRes=y_res)
-            else:
-                warp_options = gdal.WarpOptions(cutlineDSName=shp_p,
-                                                cropToCutline=True,
-                                                targetAlignedPixels=True,
-                                                xRes=x_res,
-                                                yRes=y_res)
-            gdal.Warp(raster_out_path, raster_ds, options=warp_options)
-            # Close the raster
-            raster_ds = None
-            logger.debug('Clipped raster created at {}'.format(raster_out_path))
-            # Add clipped raster path to list of clipped rasters to return
-            warped.append(raster_out_path)
+            tasks.append(warp_task(raster_p, raster_out_path,
+                                   cutline_ds=cutline_ds,
+                                   cutline_layer=cutline_layer))
         # Move meta-data files if specified
         if move_meta:
             logger.debug('Moving metadata files to clip destination...')
             move_meta_files(raster_p, out_dir, raster_ext=raster_ext)
 
+    # Add clipped raster paths to list of clipped rasters to return, in the
+    # order provided
+    warped = [w for w in run_clips(tasks, max_workers=max_workers,
+                                   num_threads=num_threads)
+              if w is not None]
+    logger.debug('Clipped rasters created: {}'.format(len(warped)))
+
     # Remove projected shp
     if in_mem is True:
         remove_shp(out_prj_shp)
@@ -1,59 +1,28 @@
 import argparse
 import os
-from pathlib import Path
-import shutil
-import time
-
-from tqdm import tqdm
 
 from misc_utils.logging_utils import create_logger
+from misc_utils.transfer import sync_dirs
 
 
 logger = create_logger(__name__, 'sh', 'INFO')
 
 
 def sync_folders(src_dir, dst_dir, mod_date=True, dryrun=False):
+    """
+    Copy files in src_dir that are missing from dst_dir, and if mod_date
+    those that are newer or differ in size, see transfer.sync_dirs.
+    """
     logger.info('Finding directory differences...')
     logger.info('Source 1:      {}'.format(src_dir))
     logger.info('Destination 2: {}'.format(dst_dir))
-    copy_list = []
-    for root, dirs, files in os.walk(src_dir):
-        r = Path(root)
-        pbar = tqdm(files)
-        prev_dir = ''
-        for f in pbar:
-            fp = r / f
-            cur_dir = fp.parent
-            if cur_dir != prev_dir:
-                pbar.write('Scanning: {}'.format(cur_dir.relative_to(src_dir)))
-            rp = fp.relative_to(src_dir)
-            dst = dst_dir / rp
-            if not dst.exists():
-                copy_list.append((fp, dst))
-            elif mod_date and (os.path.getmtime(fp) > os.path.getmtime(dst)):
-                copy_list.append((fp, dst))
-            prev_dir = cur_dir
-    logger.info('Differences found: {:,}'.format(len(copy_list)))
-    time.sleep(5)
-
-    logger.info('Syncing files...')
-    if not dryrun:
-        error_files = []
-        pbar = tqdm(copy_list)
-        for src, dst in pbar:
-            if not dst.parent.exists():
-                os.makedirs(dst.parent)
-            pbar.write('Copying to: {}'.format(dst))
-            try:
-                shutil.copy2(src, dst)
-            except Exception as e:
-                logger.error('Error copying file: {}'.format(src))
-                logger.error(e)
-                error_files = []
+    results = sync_dirs(src_dir, dst_dir, update=mod_date, dryrun=dryrun)
+    error_files = [str(f[0]) for f in results['failed']]
     if len(error_files) > 0:
         logger.warning('Errors during file copy: {}'.format(len(error_files)))
         logger.debug('Error files:\n{}'.format('\n'.join(error_files)))
 
+    return results
 
 
 if __name__ == '__main__':
@@ -79,7 +48,7 @@ if __name__ == '__main__':
 
     if args.reverse:
         sync_folders(src_dir=args.directory2, dst_dir=args.directory1,
-                     mod_date=mod_date,
+                     mod_date=args.mod_date,
                      dryrun=args.dryrun)
 
     logger.info('Done.')
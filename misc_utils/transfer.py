@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent, resumable file transfers (copy, hard link or symlink).
+Destination directories are listed once rather than checking each
+destination with os.path.exists, files are compared by size and
+modification time (optionally by checksum), and transfers run in a pool
+of threads, as copying many files is usually limited by per-file latency
+rather than bandwidth. Completed transfers are recorded in a journal, so
+an interrupted job continues where it stopped. Copies are written to a
+temporary file and renamed when complete, so partial copies are never
+mistaken for complete ones.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import os
+from pathlib import Path
+import shutil
+import threading
+
+from tqdm import tqdm
+
+from misc_utils.logging_utils import create_logger
+from misc_utils.pipeline import file_sha1
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+COPY = 'copy'
+LINK = 'link'
+SYMLINK = 'symlink'
+METHODS = [COPY, LINK, SYMLINK]
+
+JOURNAL_NAME = '.transfer_journal.jsonl'
+PART_SFX = '.part'
+MAX_WORKERS = 8
+# Seconds modification times may differ by and be considered equal, some
+# file systems store times at 2 second resolution
+MTIME_TOLERANCE = 2
+
+
+class DirListing:
+    """
+    Memoized listings of directories: {name: (size, mtime)} of the files in
+    each directory, read with a single os.scandir per directory.
+    """
+    def __init__(self):
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def listing(self, directory):
+        directory = os.path.normpath(str(directory))
+        with self._lock:
+            if directory in self._listings:
+                return self._listings[directory]
+        entries = {}
+        try:
+            with os.scandir(directory) as it:
+                for e in it:
+                    try:
+                        if e.is_file():
+                            st = e.stat()
+                            entries[e.name] = (st.st_size, st.st_mtime)
+                    except OSError:
+                        continue
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        with self._lock:
+            self._listings[directory] = entries
+
+        return entries
+
+    def stat(self, path):
+        """(size, mtime) of the file at path, None if it does not exist."""
+        path = str(path)
+        return self.listing(os.path.dirname(path)).get(os.path.basename(path))
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+
+def list_files(root, exclude=(JOURNAL_NAME,)):
+    """
+    All files under root, from a single walk of the directory tree.
+
+    Returns
+    -------
+    dict : {path relative to root: (size, mtime)}
+    """
+    files = {}
+    stack = [Path(root)]
+    while stack:
+        d = stack.pop()
+        try:
+            with os.scandir(d) as it:
+                for e in it:
+                    if e.is_dir(follow_symlinks=False):
+                        stack.append(Path(e.path))
+                    elif e.is_file() and e.name not in exclude \
+                            and not e.name.endswith(PART_SFX):
+                        st = e.stat()
+                        rel = os.path.relpath(e.path, root)
+                        files[rel] = (st.st_size, st.st_mtime)
+        except FileNotFoundError:
+            continue
+
+    return files
+
+
+class TransferJournal:
+    """
+    Append-only record (JSON lines) of completed transfers, keyed on the
+    destination path with the size and modification time of the source.
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self.done = {}
+        if os.path.exists(self.path):
+            with open(self.path) as src:
+                for line in src:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # Partially written last line of an interrupted job
+                        continue
+                    self.done[rec['dst']] = (rec['size'], rec['mtime'])
+        self._dst = None
+
+    def is_done(self, dst, src_stat):
+        rec = self.done.get(str(dst))
+        return rec is not None and rec[0] == src_stat[0] and \
+            abs(rec[1] - src_stat[1]) <= MTIME_TOLERANCE
+
+    def record(self, src, dst, src_stat):
+        line = json.dumps({'src': str(src), 'dst': str(dst),
+                           'size': src_stat[0], 'mtime': src_stat[1]})
+        with self._lock:
+            if self._dst is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                            exist_ok=True)
+                self._dst = open(self.path, 'a')
+            self._dst.write(line + '\n')
+            self._dst.flush()
+            self.done[str(dst)] = src_stat
+
+    def close(self):
+        with self._lock:
+            if self._dst is not None:
+                self._dst.close()
+                self._dst = None
+
+
+def is_current(src, dst, src_stat, dst_stat, method=COPY, checksum=False):
+    """True if dst is already an up to date transfer of src."""
+    if dst_stat is None:
+        return False
+    if method == SYMLINK:
+        return os.path.islink(dst) and \
+            os.path.realpath(dst) == os.path.realpath(src)
+    if method == LINK:
+        try:
+            return os.path.samefile(src, dst)
+        except OSError:
+            return False
+    if src_stat[0] != dst_stat[0]:
+        return False
+    if checksum:
+        return file_sha1(src) == file_sha1(dst)
+
+    return dst_stat[1] + MTIME_TOLERANCE >= src_stat[1]
+
+
+def transfer_file(src, dst, method=COPY):
+    """Transfer a single file, creating the destination directory."""
+    src, dst = str(src), str(dst)
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    if method == COPY:
+        part = dst + PART_SFX
+        shutil.copy2(src, part)
+        os.replace(part, dst)
+    else:
+        if os.path.lexists(dst):
+            os.remove(dst)
+        if method == LINK:
+            os.link(src, dst)
+        elif method == SYMLINK:
+            os.symlink(src, dst)
+
+
+def transfer_files(pairs, method=COPY, max_workers=MAX_WORKERS,
+                   journal=None, checksum=False, overwrite=False,
+                   dryrun=False, progress=True):
+    """
+    Transfer files concurrently, skipping those already transferred.
+
+    Parameters
+    ----------
+    pairs : list
+        (source path, destination file path) tuples.
+    method : str
+        'copy', 'link' (hard link) or 'symlink'.
+    max_workers : int
+        Number of files to transfer at once.
+    journal : str
+        Path to journal of completed transfers, to resume from and append
+        to. None to only compare sources and destinations.
+    checksum : bool
+        True to compare contents of sources and existing destinations of
+        the same size, rather than modification times.
+    overwrite : bool
+        True to transfer even if the destination is up to date.
+    dryrun : bool
+        True to only report which files would be transferred.
+    progress : bool
+        True to show a progress bar.
+
+    Returns
+    -------
+    dict : lists of (src, dst) 'transferred', 'skipped' and 'missing'
+    (sources that do not exist), and (src, dst, error) 'failed'
+    """
+    if method not in METHODS:
+        logger.error('Unsupported transfer method: {}, must be one of: '
+                     '{}'.format(method, METHODS))
+        raise ValueError(method)
+    pairs = [(str(s), str(d)) for s, d in pairs]
+    listing = DirListing()
+    jrnl = TransferJournal(journal) if journal else None
+    results = {'transferred': [], 'skipped': [], 'missing': [],
+               'failed': []}
+    lock = threading.Lock()
+
+    def run(src, dst):
+        try:
+            st = os.stat(src)
+        except FileNotFoundError:
+            return 'missing'
+        src_stat = (st.st_size, st.st_mtime)
+        dst_stat = listing.stat(dst)
+        if not overwrite:
+            if jrnl is not None and dst_stat is not None \
+                    and jrnl.is_done(dst, src_stat):
+                return 'skipped'
+            if is_current(src, dst, src_stat, dst_stat, method=method,
+                          checksum=checksum):
+                if jrnl is not None and not dryrun:
+                    jrnl.record(src, dst, src_stat)
+                return 'skipped'
+        if dryrun:
+            return 'transferred'
+        transfer_file(src, dst, method=method)
+        if jrnl is not None:
+            jrnl.record(src, dst, src_stat)
+
+        return 'transferred'
+
+    logger.info('{} {:,} files...'.format(
+        '[DRYRUN] Checking' if dryrun else 'Transferring ({})'.format(method),
+        len(pairs)))
+    pbar = tqdm(total=len(pairs), desc='Transferring', disable=not progress)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(run, s, d): (s, d) for s, d in pairs}
+            for f in as_completed(futures):
+                s, d = futures[f]
+                try:
+                    status = f.result()
+                    with lock:
+                        results[status].append((s, d))
+                except Exception as e:
+                    logger.error('Failed to transfer: {}\n{}'.format(s, e))
+                    results['failed'].append((s, d, str(e)))
+                pbar.update(1)
+    finally:
+        pbar.close()
+        if jrnl is not None:
+            jrnl.close()
+
+    logger.info('Transferred: {:,}  Up to date: {:,}  Missing source: {:,}  '
+                'Failed: {:,}'.format(*[len(results[k]) for k in
+                                        ['transferred', 'skipped', 'missing',
+                                         'failed']]))
+    if results['missing']:
+        logger.debug('Missing sources:\n{}'.format(
+            '\n'.join([s for s, d in results['missing']])))
+
+    return results
+
+
+def sync_dirs(src_dir, dst_dir, exts=None, update=True, **kwargs):
+    """
+    Transfer all files under src_dir that are missing or out of date in
+    dst_dir, keeping relative paths. Both trees are listed once.
+
+    Parameters
+    ----------
+    src_dir, dst_dir : str
+        Source and destination directories.
+    exts : list
+        Only transfer files with these extensions (e.g. ['tif', 'xml']).
+    update : bool
+        False to only transfer files missing from dst_dir, not those that
+        differ.
+    **kwargs :
+        Passed to transfer_files. The journal defaults to a file in
+        dst_dir.
+
+    Returns
+    -------
+    dict : see transfer_files
+    """
+    logger.info('Listing source: {}'.format(src_dir))
+    src_files = list_files(src_dir)
+    logger.info('Listing destination: {}'.format(dst_dir))
+    dst_files = list_files(dst_dir)
+    if exts:
+        exts = tuple(['.{}'.format(e.lstrip('.')) for e in exts])
+        src_files = {r: s for r, s in src_files.items() if r.endswith(exts)}
+    pairs = []
+    for rel, (size, mtime) in src_files.items():
+        d = dst_files.get(rel)
+        if d is not None and not kwargs.get('overwrite'):
+            if not update:
+                continue
+            if d[0] == size and d[1] + MTIME_TOLERANCE >= mtime and \
+                    not kwargs.get('checksum'):
+                continue
+        pairs.append((os.path.join(src_dir, rel), os.path.join(dst_dir, rel)))
+    logger.info('Differences found: {:,} of {:,} files'.format(
+        len(pairs), len(src_files)))
+    kwargs.setdefault('journal', os.path.join(dst_dir, JOURNAL_NAME))
+
+    return transfer_files(pairs, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Transfer files that are '
+                                                 'missing or out of date '
+                                                 'from one directory to '
+                                                 'another.')
+    parser.add_argument('src_dir', type=os.path.abspath,
+                        help='Directory to transfer from.')
+    parser.add_argument('dst_dir', type=os.path.abspath,
+                        help='Directory to transfer to.')
+    parser.add_argument('-m', '--method', choices=METHODS, default=COPY,
+                        help='Transfer method.')
+    parser.add_argument('-e', '--exts', nargs='+',
+                        help='Only transfer files with these extensions.')
+    parser.add_argument('-w', '--max_workers', type=int, default=MAX_WORKERS,
+                        help='Number of files to transfer at once.')
+    parser.add_argument('--checksum', action='store_true',
+                        help='Compare file contents rather than '
+                             'modification times.')
+    parser.add_argument('--dryrun', action='store_true',
+                        help='Report differences without transferring.')
+
+    args = parser.parse_args()
+
+    sync_dirs(args.src_dir, args.dst_dir, exts=args.exts, method=args.method,
+              max_workers=args.max_workers, checksum=args.checksum,
+              dryrun=args.dryrun)
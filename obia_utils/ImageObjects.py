@@ -10,7 +10,12 @@ import geopandas as gpd
 from tqdm import tqdm
 
 from misc_utils.logging_utils import create_logger
-from misc_utils.gpd_utils import read_vec, write_gdf
+from misc_utils.gpd_utils import read_vec, write_gdf, merge_groups, \
+    dissolve_groups
+from obia_utils.neighbor_graph import NeighborGraph
+from obia_utils.rule_engine import compile_rules
+from obia_utils.region_merging import RegionMerger, weighted_mean, \
+    weighted_majority, within_range, pairwise_match, z_score, abs_stds
 # from misc_utils.RasterWrapper import Raster
 
 import matplotlib.pyplot as plt
@@ -24,84 +29,6 @@ pd.options.mode.chained_assignment = None
 logger = create_logger(__name__, 'sh', 'DEBUG')
 
 #%%
-def weighted_mean(values, weights):
-    weight_proportions = [i / sum(weights) for i in weights]
-    wm = sum([v * w for v, w in zip(values, weight_proportions)])
-
-    return wm
-
-
-def weighted_majority(values, weights):
-    weighted_values = [(v, w) for v, w in zip(values, weights)]
-    wmaj = max(weighted_values, key=operator.itemgetter(1))
-    return wmaj
-
-
-# Pairwise functions
-def within_range(a, b, range):
-    return operator.le(abs(a - b), range)
-
-
-def pairwise_match(row, possible_match, pairwise_criteria : list):
-    """Tests each set of pairwise critieria against the current row
-    and a possible match.
-    Parameters
-    ---------
-    row : pd.Series
-        Must contain all fields in pairwise criteria
-    possible_match : pd.Series
-        Must contain all fields in pairwise critieria
-    pairwise_criteria : list
-        List of dicts:
-        Dict of critiria, supported types:
-            'within': {'field': "field_name", 'range': "within range"}
-            'threshold: {'field': "field_name, 'op', operator comparison fxn,
-                         'threshold': value to use in fxn}
-    Returns
-    -------
-    bool : True is all criteria are met
-    """
-    # If no pairwise criteria provided, mark as True
-    if pairwise_criteria is None:
-        return True
-
-    criteria_met = []
-    for criteria_type, params in pairwise_criteria.items():
-        if criteria_type == 'within':
-            met = within_range(row[params['field']],
-                               possible_match[params['field']],
-                               params['range'])
-            # logger.debug('{} {} {} {}: {}'.format(params['field'],
-            #                                       criteria_type,
-            #                                       params['op'],
-            #                                       params['range'],
-            #                                       met))
-            criteria_met.append(met)
-        elif criteria_type == 'threshold':
-            if params['threshold'] == 'self':
-                threshold = row[params['field']]
-            else:
-                threshold = params['threshold']
-            met = params['op'](possible_match[params['field']],
-                               threshold)
-            # logger.debug('{} {} {} {}: {}'.format(params['field'],
-            #                                       criteria_type,
-            #                                       params['op'],
-            #                                       params['threshold'],
-            #                                       met))
-            criteria_met.append(met)
-
-    return all(criteria_met)
-
-
-def z_score(value, mean, std):
-    return (value - mean) / std
-
-
-def abs_stds(value1, value2, std):
-    return abs((value1 - value2) / std)
-
-
 def rule_field_name(rule):
     fn = '{}_{}{}'.format(rule['in_field'],
                            str(rule['op'])[-3:-1],
@@ -210,6 +137,8 @@ class ImageObjects:
         # Neighbor value fields
         self.nv_fields = list()
         self.objects[self.nebs_fld] = np.NaN
+        # Sparse adjacency graph of all objects, built on first use
+        self._neighbor_graph = None
         # Rules
         self._rule_fld_name = 'in_field' # field name in rule dictionaries
 
@@ -283,63 +212,40 @@ class ImageObjects:
         value = self.objects.at[index_value, value_field]
         return value
 
+    @property
+    def neighbor_graph(self):
+        """Adjacency graph of all objects. Built once from a spatial index
+        over the object geometries and rebuilt only if the objects have
+        changed since it was built."""
+        if self._neighbor_graph is None or not self._neighbor_graph_current():
+            logger.info('Building neighbor graph...')
+            self._neighbor_graph = NeighborGraph(self.objects)
+        return self._neighbor_graph
+
+    def _neighbor_graph_current(self):
+        labels = self._neighbor_graph.labels
+        if len(labels) != len(self.objects):
+            return False
+        return (labels.equals(self.objects.index) or
+                self.objects.index.isin(labels).all())
+
     def get_neighbors(self, subset=None):
         """Creates a new column containing IDs of neighbors as list of
-        indicies."""
+        indicies. Neighbors are looked up in the neighbor graph."""
         # If no subset is provided, use the whole dataframe
         if subset is None:
-            logger.warning('No subset provided when finding neighbors, '
-                           'computation may be slow.')
-            subset = copy.deepcopy(self.objects)
-
-        # List to store neighbors
-        ns = []
-        # List to store unique_ids
-        labels = []
-        # Iterate over rows, for each row, get indicies of all features
-        # it touches
-        # logger.debug('Getting neighbors for {} '
-        #              'features...'.format(len(subset)))
-        pre = time.time()
-        for index, row in tqdm(subset.iterrows(),
-                               total=len(subset),
-                               desc='Finding neighbors'):
-            # neighbors = self.objects[self.objects.geometry
-            #                          .touches(row['geometry'])].index.tolist()
-            # ARF
-            neighbors = np.unique(self.objects[self.objects.geometry
-                                  .touches(row['geometry'])]
-                                  .index.to_numpy(dtype='i'))
-
-            # If the feature is considering itself a neighbor remove it from
-            # the list
-            if index in neighbors:
-                neighbors = np.delete(neighbors, np.where(neighbors == index))
-
-            # Save the neighbors that have been found and their IDs
-            ns.append(neighbors)
-            labels.append(index)
-        # post = time.time()
-        # logger.info('rows: {}'.format(post-pre))
-        # pre = time.time()
-        # neighbors = [self.objects[self.objects.geometry.touches(t.geometry)].index.values
-        #              for t in subset.itertuples()]
-        # post = time.time()
-        # logger.info('tuples compre: {}'.format(post-pre))
-
-        # if not any(ns):
-        #     logger.warning('No neighbors found.')
+            subset = self.objects
+
+        logger.debug('Getting neighbors for {:,} features...'.format(
+            len(subset)))
         # Create data frame of the unique ids and their neighbors
-        nebs = pd.DataFrame({self.objects.index.name: labels,
-                             self.nebs_fld: ns}).set_index(self.objects.
-                                                           index.name,
-                                                           drop=True)
+        nebs = pd.DataFrame({self.nebs_fld: self.neighbor_graph
+                            .neighbor_lists(subset.index)})
+        nebs.index.name = self.objects.index.name
 
         # Combine the neighbors dataframe back into the main dataframe
         self.objects.update(nebs)
 
-        # logger.debug('Neighbor computation complete.')
-
         return self.objects[self.objects.index.isin(subset.index)]
 
     def replace_neighbor(self, old_neb, new_neb, update_merges=False):
@@ -389,6 +295,21 @@ class ImageObjects:
             self.objects[self.mp_fld] = self.objects[self.mp_fld].apply(
                 lambda x: np.unique(np.where(x == old_neb, new_neb, x)))
 
+    def replace_neighbors(self, replace, update_merges=True):
+        """Replace neighbors in every objects list of neighbors, in a single
+        pass, using the dict replace of {old_neb: new_neb}. Optionally,
+        update merge_path field as well."""
+        def _replace(x):
+            if not isinstance(x, (list, np.ndarray)):
+                return x
+            return np.unique([replace.get(n, n) for n in x])
+
+        self.objects[self.nebs_fld] = self.objects[self.nebs_fld].apply(
+            _replace)
+        if update_merges:
+            self.objects[self.mp_fld] = self.objects[self.mp_fld].apply(
+                _replace)
+
     def replace_neighbor_value(self, neb_v_fld, old_neb, new_neb, new_value):
         """Replace old_nebs value in neb_v_fld with new_neb and new_nebs
         value, new_value."""
@@ -432,28 +353,18 @@ class ImageObjects:
         """
         out_field = self._nv_field_name(value_field)
         if subset is None:
-            subset = copy.deepcopy(self.objects)
+            subset = self.objects[[self.nebs_fld]].copy()
         if compute_neighbors:
             # If subset doesn't have neighbors computed, compute them
             if any(subset[self.nebs_fld].isnull()):
                 subset = self.get_neighbors(subset)
-        # Get all neighbors that have been found in dataframe
-        # This takes lists of neighbors and puts them into the index of an
-        # empty dataframe, and drops NaN's and drops duplicates.
-        neighbors = pd.DataFrame(subset.neighbors.explode().
-                                 dropna().
-                                 drop_duplicates()).set_index(self.nebs_fld)
-        # Get the value in value_field for each neighbor feature
-        neighbors = pd.merge(neighbors, self.objects[[value_field]],
-                             left_index=True, right_index=True,
-                             )
         # Create a dictionary in the main objects dataframe
         # which is {neighbor_id: value} for all objects that
-        # have neighbors computed
-        # TODO: change to use get_value()
+        # have neighbors computed, looking values up in a single
+        # id: value mapping
+        values = self.objects[value_field].to_dict()
         subset[out_field] = (subset[~subset[self.nebs_fld].isnull()][self.nebs_fld]
-                             .apply(lambda x: {i: neighbors.at[i, value_field]
-                                               for i in x}))
+                             .apply(lambda x: {i: values[i] for i in x}))
 
         # Merge neighbor value field back in
         if out_field in self.fields:
@@ -481,12 +392,7 @@ class ImageObjects:
         -------
         List of IDs to use as merge seeds.
         """
-        # Get a single series indicating if all conditions are True across each
-        # row
-        is_merge_seed = (pd.DataFrame([self.apply_single_rule(**kwargs)
-                                       for kwargs in rules])
-                         .transpose()
-                         .all(axis=1))
+        is_merge_seed = self.evaluate_rules(rules).all(axis=1)
         self.objects[self.m_seed_fld] = is_merge_seed
 
         return is_merge_seed.index
@@ -539,20 +445,25 @@ class ImageObjects:
         if merge_candidate_rules is not None:
             for rule in merge_candidate_rules:
                 self.apply_single_rule(**rule)
+            self.classify_objects(True, class_fld=self.mc_fld,
+                                  threshold_rules=[r for r in merge_candidate_rules
+                                                   if r['rule_type'] == 'threshold'],
+                                  adj_rules=[r for r in merge_candidate_rules
+                                             if r['rule_type'] == 'adjacent'],
+                                  overwrite_class=True)
         else:
             self.objects[self.mc_fld] = True
-        self.classify_objects(True, class_fld=self.mc_fld,
-                              threshold_rules=[r for r in merge_candidate_rules
-                                               if r['rule_type'] == 'threshold'],
-                              adj_rules=[r for r in merge_candidate_rules
-                                         if r['rule_type'] == 'adjacent'],
-                              overwrite_class=True)
 
     def pseudo_merging(self, merge_candidate_rules, pairwise_criteria,
                        grow_fields: list = None,
                        merge_seeds=False,
                        max_iter=None):
         """
+        Determine merges (merge paths) without altering geometries. Objects
+        are merged smallest first from a priority queue, and only the merged
+        objects and their neighbors are updated after each merge, see
+        region_merging.RegionMerger.
+
         mc_fields_ops_thresholds : list TODO: Update for merge_candidate_rules
             List of tuples of (field_name, operator fxn, threshold) to identify
             merge candidate objects. Only these object will be merged into. If
@@ -597,242 +508,136 @@ class ImageObjects:
         logger.debug('Merge candidates found: {:,}'.format(
             len(self.objects[self.objects[self.mc_fld] == True])))
 
-        # Sort by area
         self.objects[self.pseudo_area_fld] = self.objects.area
-        self.objects = self.objects.sort_values(by=self.pseudo_area_fld)
 
-        # Initialize empty lists to store "merge path" -> ordered list of
-        # neighbors IDs to merge into
-        self.objects[self.mp_fld] = [[] for i in range(self.num_objs)]
+        # If no grow fields provided, use all value fields
+        value_fields = self.value_fields if self.value_fields else {}
+        if grow_fields is None:
+            grow_fields = [vf for vf in value_fields if vf != self.m_seed_fld]
 
-        # Determine all mergable IDs, using the merge_seeds as starting point
-        if max_iter is None:
+        # Only rules used to classify merge candidates are re-tested during
+        # merging
+        if merge_candidate_rules is not None:
+            mc_rules = [r for r in merge_candidate_rules
+                        if r['rule_type'] in ('threshold', 'adjacent')]
+        else:
+            mc_rules = []
+
+        # Fields needed to aggregate, grow, re-test rules and test pairwise
+        # criteria
+        fields = list(value_fields) + list(grow_fields)
+        fields.extend([r[self._rule_fld_name] for r in mc_rules])
+        fields.extend([r['src_field'] for r in mc_rules if r.get('src_field')])
+        if pairwise_criteria is not None:
+            fields.extend([params['field'] for pc in pairwise_criteria
+                           for params in pc.values()])
+        fields = list(dict.fromkeys(fields))
+
+        # Determine all merges, smallest objects first, updating only merged
+        # objects and their neighbors after each merge
+        merger = RegionMerger(
+            records=self.objects[fields].to_dict('index'),
+            neighbors={i: set(n) for i, n in
+                       self.neighbor_graph.neighbor_lists(self.objects.index)
+                       .items()},
+            areas=self.objects[self.pseudo_area_fld].to_dict(),
+            value_fields=value_fields,
+            grow_fields=grow_fields,
+            merge_candidates=(self.objects[self.mc_fld] == True).to_dict(),
+            seeds=(self.objects[self.m_seed_fld] == True).to_dict(),
+            merge_candidate_rules=mc_rules,
+            pairwise_criteria=pairwise_criteria,
+            merge_counts=self.objects[self.m_ct_fld].to_dict(),
+            max_iter=max_iter)
+        merger.run()
+
+        # Write aggregated values, areas, merge paths and flags back
+        ids = list(merger.records.keys())
+        for vf in value_fields:
+            self.objects[vf] = pd.Series([merger.records[i][vf] for i in ids],
+                                         index=ids)
+        self.objects[self.pseudo_area_fld] = pd.Series(merger.areas)
+        self.objects[self.mp_fld] = pd.Series(
+            [np.array(merger.merge_paths[i]) for i in ids], index=ids,
+            dtype='object')
+        self.objects[self.nebs_fld] = pd.Series(
+            [np.array(sorted(merger.neighbors[i])) for i in ids], index=ids,
+            dtype='object')
+        self.objects[self.m_fld] = pd.Series(merger.mergeable)
+        self.objects[self.mc_fld] = pd.Series(merger.candidates)
+        self.objects[self.m_seed_fld] = pd.Series(merger.seeds)
+        if max_iter is not None:
+            self.objects[self.continue_iter] = (
+                (self.objects[self.m_ct_fld] +
+                 self.objects[self.mp_fld].map(len)) < max_iter)
+        else:
             self.objects[self.continue_iter] = False
-        self.update_mergeable_ids(max_iter=max_iter)
+        self.mergeable_ids = []
 
-        # Get neighbors for mergeable IDs
-        self.get_neighbors(subset=self.objects[
-            self.objects.index.isin(self.mergeable_ids)])
+        # Neighbor values of grow fields, using merged values and neighbors
+        for gf in grow_fields:
+            self.compute_neighbor_values(gf)
 
-        # If no grow fields provided, use all value fields
-        if grow_fields is None:
-            grow_fields = self.value_fields
-
-        # While there are rows that are mergeable and
-        # that haven't been checked look for a possible merge to a neighbor
-        # that is a merge_candidate
-        while self.mergeable_ids:
-            logger.info('Mergeable IDs: {:,}'.format(len(self.mergeable_ids)))
-            # Get the first row
-            r = self.objects.loc[self.mergeable_ids[0]]
-
-            # Get ID of row
-            i = r.name
-            logger.debug('Working on object: {}'.format(i))
-
-            # logger.debug('Current ID: {}'.format(i))
-            # Check that neighbor value fields have been computed for all
-            # merge fields, if not compute
-            for gf in grow_fields:
-                merge_nv_field = self._nv_field_name(gf)
-                # TODO: better check for computed_neighbor values
-                # TODO: could add compute_neighbors=True to compute neighbors
-                #  "on the fly" rather than upfront out of the merging loop
-                # if not all(neighbors in merge_field.keys()) (apply)
-                if merge_nv_field not in r.index:
-                    self.compute_neighbor_values(gf)  # TODO: for merge_candidates only?
-
-            # Find best match, which is closest value in terms of standard
-            # deviations summed for all merge fields, given pairwise criteria
-            # are all met.
-            # Init dict to hold all standard deviations for current ID for
-            # each neighbor:
-            # {neighbor_id1: [std of merge_field1, std of merge_field2, ...],
-            #  neighbor_id2: [...]}
-            neighbor_abs_stds = {n: [] for n in r[self.nebs_fld]
-                                 if n is not None}
-            # Compute number of std away from current row's value for each
-            # neighbor for each merge_field, in order to choose best neighbor
-            # to merge with
-            for neb_id in r[self.nebs_fld]:
-                # Skip if marked unmergeable or not a merge_candidate
-                try:
-                    if (not self.objects.at[neb_id, self.m_fld] or not self.objects.at[neb_id, self.mc_fld]):
-                        continue
-                except Exception as e:
-                    logger.error(e)
-                    logger.error('row: {}'.format(i))
-                    logger.error('neb_id: {}, type: {}'.format(neb_id, type(neb_id)))
-                    logger.error('m_fld: {}, type: {}'.format(self.m_fld, type(self.m_fld)))
-                    continue
-
-                # Get the neighbors row, containing all values
-                possible_match = self.objects.loc[neb_id, :]
-                # Check if neighbor meets pairwise criteria, if not skip
-                if pairwise_criteria is not None and \
-                        not all([pairwise_match(r, possible_match, pc)
-                                 for pc in pairwise_criteria]):
-                    neighbor_abs_stds.pop(neb_id)
-                    continue
-                # Get number of standard deviations in each grow field
-                for gf in grow_fields:
-                    neighbor_abs_stds[neb_id].append(
-                        abs_stds(r[gf], possible_match[gf],
-                                 std=self.object_stats.loc['std', gf]))
-
-            # Find neighbor with least total std away from feature considering
-            # all merge fields
-            best_match = None
-            best_match_id = None
-            if len(neighbor_abs_stds.keys()) != 0:
-                best_match_id = min(neighbor_abs_stds.keys(),
-                                    key=lambda k: sum(neighbor_abs_stds[k]))
-                best_match = self.objects.loc[best_match_id, :] # Can potentially remove this, just check if best_match_id below
-                logger.debug('Match found: {}'.format(best_match_id))
-
-            if best_match is not None:
-                logger.debug('Aggregating stats of current object and best match...')
-                # Update value fields of best match row with approriate
-                # aggregate e.g.: weighted mean
-                for vf, agg_type in self.value_fields.items():
-                    if agg_type == 'mean':
-                        self.objects.at[best_match_id, vf] = (
-                            weighted_mean(values=[r[vf], best_match[vf]],
-                                          weights=[r[self.pseudo_area_fld],
-                                                   best_match[self.pseudo_area_fld]]))
-                    elif agg_type == 'majority':
-                        # Get the value assoc with object that has most area
-                        self.objects.at[best_match_id, vf] = (
-                            max([(r[vf], r[self.pseudo_area_fld]),
-                                 (best_match[vf], best_match[self.pseudo_area_fld])],
-                                key=operator.itemgetter(1))[0])
-                    elif agg_type == 'minority':
-                        # Get the value assoc. with object that has least area
-                        self.objects.at[best_match_id, vf] = (
-                            min([(r[vf], r[self.pseudo_area_fld]),
-                                 (best_match[vf], best_match[self.pseudo_area_fld])],
-                                key=operator.itemgetter(1))[0])
-                    elif agg_type == 'minimum':
-                        self.objects.at[best_match_id, vf] = min(
-                            r[vf], best_match[vf])
-                    elif agg_type == 'maximum':
-                        self.objects.at[best_match_id, vf] = max(
-                            r[vf], best_match[vf])
-                    elif agg_type == 'sum':
-                        self.objects.at[best_match_id, vf] = sum(
-                            r[vf] + best_match[vf])
-                    elif agg_type == 'bool_and':
-                        self.objects.at[best_match_id, vf] = \
-                            (r[vf] and best_match[vf])
-                    elif agg_type == 'bool_or':
-                        self.objects.at[best_match_id, vf] = \
-                            (r[vf] or best_match[vf])
-                    else:
-                        logger.error('Unknown agg_type: {} for '
-                                     'value field: {}'.format(agg_type, vf))
-
-                # Update area field (add areas) TODO: make pseudo_area field
-                self.objects.at[best_match_id, self.pseudo_area_fld] = (
-                        r[self.pseudo_area_fld] + best_match[self.pseudo_area_fld])
-
-                # Calculate neighbors for best match if not already
-                if isinstance(best_match[self.nebs_fld], float) or \
-                        best_match[self.nebs_fld].size == 0 or \
-                        any([np.isnan(n) for n in best_match[self.nebs_fld]]):
-                    self.get_neighbors(self.objects[self.objects.index
-                                       .isin([best_match_id])])
-
-                # Replace current object with best match in all neighbor fields
-                # and merge_paths
-                self.replace_neighbor(i, best_match_id, update_merges=True)
-
-                # Update neighbor value fields that had current object as
-                # neighbor
-                for vf, nvf in self.nv_fields:
-                    self.replace_neighbor_value(nvf, i, best_match_id,
-                                                self.objects.at[best_match_id,
-                                                                vf])
-                # Update merge_path
-                # Get all of the feature to be merged's merge_path ids and add
-                # them to best match objects merge_path
-                # RAF
-                self.objects.at[best_match_id, self.mp_fld] = \
-                    np.concatenate([self.objects.at[best_match_id, self.mp_fld],
-                                    r[self.mp_fld]]).astype('i')
-                # Store ID to merge in new (best_match) object's merge_path
-                # field
-                # self.objects.at[best_match_id, self.mp_fld].append(i)
-                self.objects.at[best_match_id, self.mp_fld] = \
-                    np.concatenate([self.objects.at[best_match_id, self.mp_fld],
-                                    [i]])
-
-                # Mark as merge_seed
-                self.objects.at[best_match_id, self.m_seed_fld] = True
-
-            # Mark original feature as no longer mergeable, it was either
-            # "merged" or there was no possible match
-            self.objects.at[i, self.mp_fld] = []
-            self.objects.at[i, self.m_fld] = False
-            self.objects.at[i, self.mc_fld] = False
-
-            # TODO: potentially check if any merge_paths exist, only merge() if yes
-            # logger.debug('Merge paths:\n'
-            #              '{}'.format(self.objects[self.objects[self.mp_fld]
-            #                          .apply(lambda x: len(x) > 0)][self.mp_fld]))
-            # self.merge()
-
-            # Recalculate merge candidates, using new (merged) values # TODO: Just test the newly created feature
-            self.find_merge_candidates(merge_candidate_rules)
-
-            # Resort by area so smallest possible merge object is checked next # TODO: Check if necessary to resort
-            logger.debug('Sorting by area, smallest first...')
-            self.objects = self.objects.sort_values(by=self.pseudo_area_fld)
-
-            logger.debug('Updating mergeable IDs...')
-            self.update_mergeable_ids(max_iter=max_iter)
+        # Sort by area, smallest first
+        self.objects = self.objects.sort_values(by=self.pseudo_area_fld)
 
     def merge(self):
-        # merge features that have a merge path
+        """Merge features that have a merge path. All merge pairs are
+        resolved into groups and dissolved at once, each merged object
+        keeping the (already aggregated) values of the object that has the
+        merge path."""
         logger.debug('Performing calculated merges...')
         logger.debug('Objects before merge: {:,}'.format(self.num_objs))
-        for i, r in self.objects[
-                self.objects[self.mp_fld].map(lambda d: len(d)) > 0].iterrows():
-            logger.debug('Merging: {} into {}'.format(r[self.mp_fld], i))
-            # Create gdf of current row and the features to merge with it.
-            # Important that the current row is first, as it contains the
-            # correct aggregated values and the dissolve function defaults
-            # to keeping the first rows values
-            to_merge = pd.concat([gpd.GeoDataFrame([r], crs=self.objects.crs),
-                                  self.objects[self.objects.index
-                                 .isin(r[self.mp_fld])]])
-            to_merge['temp'] = 1
-            merged = to_merge[['geometry', 'temp']].dissolve(by='temp')
-            merged.index = [i]
-
-            # Add columns from current row back in (should be aggregated
-            # already
-            merged = pd.merge(merged,
-                              gpd.GeoDataFrame([r]).drop(columns='geometry'),
-                              left_index=True,
-                              right_index=True)
-
-            # Zero out merge_path
-            merged[self.mp_fld] = [[]]
-
-            # Add to merge count
-            merged[self.m_ct_fld] = merged[self.m_ct_fld] + \
-                                    len(r[self.mp_fld])
-
-            # Drop both original objects
-            self.objects.drop(np.concatenate([r[self.mp_fld], [i]]),
-                                             inplace=True)
-            # Add merged object back in
-            # self.objects = pd.concat([self.objects, merged])
-            self.objects = self.objects.append(merged)
-
-            # Replace merge field vlaues
-            for m in r[self.mp_fld]:
-                self.replace_neighbor(m, i, update_merges=True)
+        mp_len = self.objects[self.mp_fld].map(lambda d: len(d))
+        heads = self.objects[mp_len > 0]
+        if heads.empty:
+            logger.debug('No merge paths found.')
+            return
+
+        # Pairs of (object with merge path, object merged into it)
+        head_ids = np.repeat(heads.index.to_numpy(), mp_len[mp_len > 0])
+        merged_ids = np.concatenate([np.asarray(mp)
+                                     for mp in heads[self.mp_fld]])
+        groups = merge_groups(head_ids, merged_ids)
+
+        to_merge = self.objects[self.objects.index.isin(groups.index)]
+        to_merge_groups = groups.reindex(to_merge.index).to_numpy()
+
+        # The object with the longest merge path in each group holds the
+        # aggregated values
+        group_heads = (pd.DataFrame({'group': to_merge_groups,
+                                     'mp_len': mp_len.reindex(to_merge.index)},
+                                    index=to_merge.index)
+                       .sort_values(by='mp_len', ascending=False)
+                       .groupby('group').head(1))
+        group_heads = pd.Series(group_heads.index, index=group_heads['group'])
+
+        # Single dissolve of all groups
+        geom_fld = self.objects.geometry.name
+        dissolved = dissolve_groups(to_merge[[geom_fld]], to_merge_groups)
+
+        merged = self.objects.loc[group_heads.values]
+        merged[geom_fld] = dissolved.loc[group_heads.index, geom_fld].values
+        # Add to merge count
+        merged[self.m_ct_fld] = merged[self.m_ct_fld] + \
+                                mp_len.reindex(merged.index)
+        # Zero out merge_path
+        merged[self.mp_fld] = [[] for i in range(len(merged))]
+
+        # Drop original objects and add merged objects back in
+        self.objects = pd.concat([
+            self.objects[~self.objects.index.isin(to_merge.index)],
+            merged])
+        logger.debug('Objects after merge: {:,}'.format(self.num_objs))
+
+        # Replace merged IDs with the ID they were merged into in all
+        # neighbor fields
+        replace = {m: group_heads[g] for m, g in groups.items()
+                   if m != group_heads[g]}
+        self.replace_neighbors(replace)
+
+        # Geometries have changed, neighbor graph must be rebuilt
+        self._neighbor_graph = None
 
     # def determine_adj_thresh(self, neb_values_fld, value_thresh, value_op, out_field, subset=None):
     #     """Determines if each row is has neighbor that meets the value
@@ -891,26 +696,16 @@ class ImageObjects:
                     out_field=None,
                     compute_neighbors=True):
         logger.debug('Finding adjacent features with values...')
-
-        # # Create neighbor-value field(s) if necessary
-        in_field_nv = self._nv_field_name(in_field)
-        if in_field_nv not in self.fields:
-            self.compute_neighbor_values(in_field,
-                                         compute_neighbors=compute_neighbors)
-
+        # Adjacency is evaluated for all objects at once against the
+        # neighbor graph, so compute_neighbors is no longer required.
+        # True if any neighbor has value that meets op(value, threshold)
+        meets = op(self.objects[in_field], threshold)
+        adj_series = (self.neighbor_graph.any_neighbor(meets)
+                      .reindex(self.objects.index))
         if src_field:
-            adj_series = (
-                # src object threshold
-                (src_op(self.objects[src_field], src_thresh)) &
-                # True if any neighbor has value that meets op(nv, threshold)
-                (self.objects[in_field_nv].apply(
-                    lambda nv: any([op(v, threshold) for k, v in nv.items()])
-                    if pd.notnull(nv) else nv))
-                )
-        else:
-            adj_series = (self.objects[in_field_nv].apply(
-                lambda nv: any([op(v, threshold) for k, v in nv.items()])
-                if pd.notnull(nv) else nv))
+            # src object threshold
+            adj_series = (src_op(self.objects[src_field], src_thresh) &
+                          adj_series)
 
         if out_field:
             self.objects[out_field] = adj_series
@@ -938,6 +733,32 @@ class ImageObjects:
                   overwrite=overwrite,
                   **kwargs)
 
+    def evaluate_rules(self, rules):
+        """
+        Evaluate rules for all objects at once, storing the results of
+        rules with an out_field.
+
+        Parameters
+        ----------
+        rules : list or RulePlan
+            List of rule dictionaries (see create_rule), or rules already
+            compiled with rule_engine.compile_rules.
+
+        Returns
+        -------
+        pd.DataFrame : boolean, one column per rule, in order
+        """
+        plan = compile_rules(rules)
+        graph = self.neighbor_graph if plan.needs_graph else None
+        results = pd.DataFrame(plan.evaluate(self.objects, graph),
+                               index=self.objects.index)
+        for i, out_field in plan.out_fields():
+            self.objects[out_field] = results[i]
+            if out_field not in self.rule_fields:
+                self.rule_fields.append(out_field)
+
+        return results
+
     def apply_single_rule(self, rule_type, in_field, op, threshold,
                           out_field=None, **kwargs):
         """
@@ -963,36 +784,9 @@ class ImageObjects:
                 to subset the objects that the adjacency rule is
                 computed for.
         """
-        # Ensure rule type is supported
-        type_threshold = 'threshold'
-        type_adjacent = 'adjacent',
-        type_adj_or = 'adjacent_or_is'
-        accepted_rule_types = [type_threshold, type_adjacent, type_adj_or]
-        if rule_type not in accepted_rule_types:
-            logger.error('Rule type: "{}" not recognized. Must be one of: '
-                         '{}'.format(rule_type, accepted_rule_types))
-            raise Exception
-
-        if rule_type == type_threshold:
-            results = op(self.objects[in_field], threshold)
-
-        elif rule_type == type_adjacent:
-            results = self.adjacent_to(in_field=in_field,
-                                       op=op,
-                                       threshold=threshold,
-                                       **kwargs)
-        elif rule_type == type_adj_or:
-            adj_results = self.adjacent_to(in_field=in_field,
-                                           op=op,
-                                           threshold=threshold,
-                                           **kwargs)
-            is_results = op(self.objects[in_field], threshold)
-            results = adj_results | is_results
-
-        if out_field:
-            self.objects[out_field] = results
-            # TODO: Add out_field to self.contraint_fields
-            self.rule_fields.append(out_field)
+        rule = dict(kwargs, rule_type=rule_type, in_field=in_field, op=op,
+                    threshold=threshold, out_field=out_field)
+        results = self.evaluate_rules([rule])[0]
 
         return results
 
@@ -1009,16 +803,9 @@ class ImageObjects:
         ---------
         pd.series : Boolean series indicating if all rules met
         """
-        # Get and store boolean Series for each rule
-        all_results = []
-        for r in rules:
-            sr = self.apply_single_rule(**r)
-            all_results.append(sr)
-
-        # Get single series indicating if True across all result rows
-        # FIXME: row of NaNs being returned as True
-        results = pd.DataFrame(all_results).transpose().apply(
-            lambda row: all([v for v in row]), axis=1)
+        # All rules are evaluated at once, storing the result of any rules
+        # with an out_field
+        results = self.evaluate_rules(rules).all(axis=1)
 
         if out_field:
             self.objects[out_field] = results
@@ -1034,8 +821,6 @@ class ImageObjects:
         be placed in the 'class' field of objects. If overwrite_class is
         False, any existing values in the 'class' field will be maintained
         and only objects with a Null class will be classified."""
-        # TODO: optimize so that only unclassified objects have the other
-        #  rules applied, as adjacency rules can take a while
         # Create class field if it doesn't exist
         if class_fld is None:
             class_fld = self.class_fld
@@ -1043,21 +828,11 @@ class ImageObjects:
         if class_fld not in self.fields:
             self.objects[class_fld] = None
 
-        # Get boolean series for each rule
-        all_results = []
-        if threshold_rules:
-            thresholds_results = self.apply_rules(threshold_rules)
-            all_results.append(thresholds_results)
-        if adj_rules:
-            if threshold_rules:
-                self.get_neighbors(subset=self.objects.loc[thresholds_results])
-            for r in adj_rules:
-                self.compute_neighbor_values(r[self._rule_fld_name])
-            adj_results = self.apply_rules(adj_rules)
-            all_results.append(adj_results)
-
-        update_rows = pd.DataFrame(all_results).transpose().apply(
-            lambda row: all([v for v in row]), axis=1)
+        # Threshold and adjacency rules are evaluated together, adjacency
+        # against the neighbor graph
+        rules = (threshold_rules if threshold_rules else []) + \
+                (adj_rules if adj_rules else [])
+        update_rows = self.evaluate_rules(rules).all(axis=1)
 
         # Add class name to rows that meet criteria
         if overwrite_class:
@@ -20,8 +20,10 @@ from rasterstats import zonal_stats
 from skimage.feature import greycomatrix, greycoprops
 
 from misc_utils.logging_utils import create_logger
+from misc_utils.profiler import profile_stage
 from misc_utils.gdal_tools import auto_detect_ogr_driver
 from misc_utils.gpd_utils import read_vec, write_gdf
+from obia_utils.zonal_engine import zonal_stats_multi, ENGINE_STATS
 
 
 logger = create_logger(__name__, 'sh', 'INFO')
@@ -129,6 +131,7 @@ def compute_stats(gdf, raster, name=None,
     return gdf
 
 
+@profile_stage()
 def calc_zonal_stats(shp, rasters,
                      names=None,
                      stats=['min', 'max', 'mean', 'count', 'median'],
@@ -180,6 +183,7 @@ def calc_zonal_stats(shp, rasters,
 
     # Determine rasters input type
     # TODO: Fix logic here, what if a bad path is passed?
+    bands = None
     if len(rasters) == 1:
         if os.path.exists(rasters[0]):
             logger.info('Reading raster file...')
@@ -213,30 +217,45 @@ def calc_zonal_stats(shp, rasters,
             logger.error('Raster does not exist: {}'.format(r))
             logger.error('FileNotFoundError')
 
-    # Iterate rasters and compute stats for each
+    if bands is None:
+        bands = [None for i in range(len(rasters))]
+
+    # Stats that can be accumulated block by block are computed for all
+    # rasters and bands together, reading each raster once. Any others are
+    # computed with rasterstats, one raster and band at a time.
+    engine_requests = []
+    other_requests = []
     for r, n, s, bs in zip(rasters, names, stats, bands):
         if bs is None:
-            # Split custom stat functions from built-in options
-            accepted_stats = ['min', 'max', 'median', 'sum', 'std', 'mean',
-                              'unique', 'range', 'majority']
-            stats_acc = [k for k in s if k in accepted_stats
-                         or k.startswith('percentile_')]
-            # Assume any key not in accepted_stats is a name:custom_fxn
-            custom_stats = [k for k in stats if k not in accepted_stats]
-            custom_stats_dict = {}
-            # for cs in custom_stats:
-            #     custom_stats[cs] = custom_stat_fxn(cs)
-
-            seg = compute_stats(gdf=seg, raster=r, name=n,
-                                stats=stats_acc)
+            band_names = [(1, n)]
         else:
-            # Compute stats for each band
-            for b in bs:
-                stats_dict = {x: '{}b{}_{}'.format(n, b, x) for x in s}
-                seg = compute_stats(gdf=seg, raster=r,
-                                    stats=stats_dict,
-                                    renamer=stats_dict,
-                                    band=b)
+            band_names = [(b, '{}b{}'.format(n, b)) for b in bs]
+        for b, bn in band_names:
+            columns = {x: '{}_{}'.format(bn, x) for x in s}
+            engine_stats = [x for x in s if x in ENGINE_STATS]
+            rs_stats = [x for x in s if x not in ENGINE_STATS]
+            if engine_stats:
+                engine_requests.append({'path': r,
+                                        'band': b,
+                                        'stats': engine_stats,
+                                        'columns': columns})
+            if rs_stats:
+                other_requests.append((r, b if bs is not None else None,
+                                       {x: columns[x] for x in rs_stats}))
+
+    if engine_requests:
+        seg = seg.join(zonal_stats_multi(seg, engine_requests), how='left')
+
+    for r, b, stats_dict in other_requests:
+        # Split custom stat functions from built-in options
+        accepted_stats = ['min', 'max', 'median', 'sum', 'std', 'mean',
+                          'unique', 'range', 'majority']
+        stats_acc = [k for k in stats_dict if k in accepted_stats
+                     or k.startswith('percentile_')]
+        seg = compute_stats(gdf=seg, raster=r,
+                            stats=stats_acc,
+                            renamer=stats_dict,
+                            band=b)
 
     # Area recording
     if area:
@@ -1,30 +1,61 @@
 import argparse
-import copy
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import os
 from pathlib import PurePath
 
+import fiona
+import numpy as np
 from osgeo import gdal
 import pandas as pd
 import geopandas as gpd
 
+from misc_utils.gdal_tools import detect_ogr_driver, sample_raster
 from misc_utils.gpd_utils import read_vec, write_gdf
 from misc_utils.RasterWrapper import Raster
 from misc_utils.logging_utils import create_logger
+from misc_utils.profiler import profile_stage
+from obia_utils.zonal_engine import zonal_stats_multi
 
 logger = create_logger(__name__, 'sh', 'INFO')
 
 gdal.UseExceptions()
 gdal.SetConfigOption('CHECK_DISK_FREE_SPACE', 'FALSE')
 
+# Objects read and cleaned at once by each worker
+CHUNK_SIZE = 50000
+# Methods of removing objects in NoData areas
+MASK_POINT = 'point'
+MASK_OVERLAP = 'overlap'
 
-def load_objs(objects):
+
+def count_objs(objects):
+    """Number of objects in a vector file, without reading them."""
+    objects = str(objects)
+    driver, layer = detect_ogr_driver(objects, name_only=True)
+    if layer is not None:
+        objects = str(PurePath(objects).parent)
+    with fiona.open(objects, layer=layer) as src:
+        count = len(src)
+
+    return count
+
+
+def load_objs(objects, rows=None):
+    """
+    Read objects, or only the slice of rows of them. Segmentations are
+    polygonized in raster scan order, so consecutive rows are spatially
+    close.
+    """
     if isinstance(objects, PurePath):
         objects = str(objects)
-    # Load objects
-    # TODO: Read in chunks, parallelize, recombine and write
-    logger.info('Reading in objects...')
-    # objs = gpd.read_file(objects)
-    objs = read_vec(objects)
+    if rows is None:
+        logger.info('Reading in objects...')
+        objs = read_vec(objects)
+    else:
+        logger.debug('Reading objects {:,} to {:,}...'.format(rows.start,
+                                                              rows.stop))
+        objs = read_vec(objects, rows=rows)
     logger.info('Objects found: {:,}'.format(len(objs)))
 
     return objs
@@ -38,26 +69,67 @@ def remove_small_objects(objects, min_size):
     return objects
 
 
-def mask_objs(objs, mask_on, out_mask_img=None, out_mask_vec=None):
-    if out_mask_img is None:
-        out_mask_img = r'/vsimem/temp_mask.tif'
-    if out_mask_vec is None:
-        out_mask_vec = r'/vsimem/temp_mask.shp'
-
-    # Write mask vector (and raster if desired)
-    logger.info('Creating mask from raster: {}'.format(mask_on))
-    Raster(mask_on).WriteMaskVector(out_vec=out_mask_vec, out_mask_img=out_mask_img)
-    # mask = gpd.read_file(out_mask_vec)
-    mask = read_vec(out_mask_vec)
-    not_mask = mask[mask.iloc[:, 0] != '1']
-
-    # Select only objects in valid areas of mask
-    logger.info('Removing objects in masked areas...')
-    # TODO: use centroids for faster cleanup - Begin
-    # objs_centroids = copy.deepcopy(objs).set_geometry(objs.geometry.centroid)
-    # use centroids for faster cleanup - End
-
-    keep_objs = gpd.overlay(objs, not_mask)
+def write_mask(mask_on, out_mask_img=None, out_mask_vec=None):
+    """Write the NoData mask of mask_on as a raster and/or polygons, for
+    inspection. Masking objects does not use these."""
+    if out_mask_vec:
+        Raster(mask_on).WriteMaskVector(out_vec=out_mask_vec,
+                                        out_mask_img=out_mask_img)
+    elif out_mask_img:
+        Raster(mask_on).WriteMask(out_path=out_mask_img)
+
+
+def mask_objs(objs, mask_on, method=MASK_POINT, min_valid=0.5,
+              out_mask_img=None, out_mask_vec=None):
+    """
+    Remove objects in NoData areas of the raster mask_on.
+
+    Parameters
+    ----------
+    objs : gpd.GeoDataFrame
+        Objects, in the CRS of mask_on.
+    mask_on : str
+        Path to raster, objects over its NoData pixels are removed.
+    method : str
+        'point' to keep objects whose representative point (a point
+        guaranteed to be within the object) is on valid data, or 'overlap'
+        to keep objects with at least min_valid of their area on valid
+        data, from a rasterization of the objects onto the grid of mask_on.
+    min_valid : float
+        Fraction of area that must be valid data, for method 'overlap'.
+    out_mask_img, out_mask_vec : str
+        Optional paths to write the mask raster and polygons to.
+
+    Returns
+    -------
+    gpd.GeoDataFrame : objects kept
+    """
+    if out_mask_img or out_mask_vec:
+        write_mask(mask_on, out_mask_img=out_mask_img,
+                   out_mask_vec=out_mask_vec)
+    if len(objs) == 0:
+        return objs
+
+    logger.info('Removing objects in NoData areas of: {}'.format(mask_on))
+    if method == MASK_POINT:
+        pts = objs.geometry.representative_point()
+        _, keep = sample_raster(mask_on, pts.x.values, pts.y.values)
+    elif method == MASK_OVERLAP:
+        ds = gdal.Open(str(mask_on))
+        gt = ds.GetGeoTransform()
+        ds = None
+        valid = zonal_stats_multi(objs, [{'path': mask_on, 'band': 1,
+                                          'stats': ['count'],
+                                          'columns': {'count': 'valid'}}])
+        valid_area = valid['valid'].values * abs(gt[1] * gt[5])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            keep = valid_area / objs.geometry.area.values >= min_valid
+    else:
+        logger.error('Unsupported mask method: {}, must be one of: '
+                     '{}'.format(method, [MASK_POINT, MASK_OVERLAP]))
+        raise ValueError(method)
+
+    keep_objs = objs[keep]
     logger.info('Objects kept: {:,}'.format(len(keep_objs)))
 
     return keep_objs
@@ -69,35 +141,79 @@ def remove_null_objects(objects, fields=['all']):
         fields = list(objects)
     logger.info('Fields considered: {}'.format(fields))
 
-    keep_objs = objects[objects.apply(lambda x: all([pd.notna(x[f])
-                                                     for f in fields]), axis=1)]
-    # keep_objs = keep_objs[keep_objs[fields].notnull()]
+    keep_objs = objects[objects[fields].notna().all(axis=1)]
 
     logger.info('Objects kept: {:,}'.format(len(keep_objs)))
 
     return keep_objs
 
 
+def clean_objs(objs, min_size=None, mask_on=None, mask_method=MASK_POINT,
+               min_valid=0.5, drop_na=None):
+    """Apply each cleanup step requested to objs."""
+    if min_size:
+        objs = remove_small_objects(objects=objs, min_size=min_size)
+    if mask_on:
+        objs = mask_objs(objs=objs, mask_on=mask_on, method=mask_method,
+                         min_valid=min_valid)
+    if drop_na:
+        objs = remove_null_objects(objs, fields=drop_na)
+
+    return objs
+
+
+def _clean_chunk(input_objects, rows, kwargs):
+    """Read and clean one chunk of objects, in a worker process."""
+    return clean_objs(load_objs(input_objects, rows=rows), **kwargs)
+
+
+@profile_stage()
 def cleanup_objects(input_objects,
                     out_objects=None,
                     min_size=None,
                     mask_on=None,
+                    mask_method=MASK_POINT,
+                    min_valid=0.5,
                     out_mask_img=None,
                     out_mask_vec=None,
                     drop_na=None,
+                    chunk_size=CHUNK_SIZE,
+                    max_workers=None,
                     overwrite=False):
-
-    keep_objs = load_objs(input_objects)
-
-    if min_size:
-        keep_objs = remove_small_objects(objects=keep_objs,
-                                         min_size=min_size)
-    if mask_on:
-        keep_objs = mask_objs(objs=keep_objs, mask_on=mask_on,
-                              out_mask_img=out_mask_img,
-                              out_mask_vec=out_mask_vec)
-    if drop_na:
-        keep_objs = remove_null_objects(keep_objs, fields=drop_na)
+    """
+    Remove small objects, objects in NoData areas of a raster and objects
+    with null values. Input objects are read and cleaned in chunks of
+    chunk_size consecutive objects, in parallel in max_workers processes
+    (default the number of CPUs), see mask_objs for masking methods.
+    """
+    if mask_on and (out_mask_img or out_mask_vec):
+        write_mask(mask_on, out_mask_img=out_mask_img,
+                   out_mask_vec=out_mask_vec)
+    kwargs = {'min_size': min_size, 'mask_on': mask_on,
+              'mask_method': mask_method, 'min_valid': min_valid,
+              'drop_na': drop_na}
+
+    if isinstance(input_objects, gpd.GeoDataFrame):
+        keep_objs = clean_objs(input_objects, **kwargs)
+    else:
+        num_objs = count_objs(input_objects)
+        chunks = [slice(start, min(start + chunk_size, num_objs))
+                  for start in range(0, num_objs, chunk_size)]
+        if len(chunks) <= 1:
+            keep_objs = clean_objs(load_objs(input_objects), **kwargs)
+        else:
+            logger.info('Cleaning {:,} objects in {:,} chunks...'.format(
+                num_objs, len(chunks)))
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                # map returns chunks in order, keeping the input order
+                cleaned = list(executor.map(_clean_chunk,
+                                            repeat(str(input_objects)),
+                                            chunks, repeat(kwargs)))
+            keep_objs = gpd.GeoDataFrame(pd.concat(cleaned,
+                                                   ignore_index=True),
+                                         crs=cleaned[0].crs)
+        logger.info('Objects kept: {:,} of {:,}'.format(len(keep_objs),
+                                                        num_objs))
 
     if out_objects:
         logger.info('Writing kept objects ({:,}) to: {}'.format(len(keep_objs),
@@ -124,6 +240,21 @@ if __name__ == '__main__':
                         help='The minimum size object to keep, in units of CRS')
     parser.add_argument('-o', '--out_objects', type=os.path.abspath,
                         help='Path to write cleaned objects to.')
+    parser.add_argument('-mm', '--mask_method', choices=[MASK_POINT,
+                                                         MASK_OVERLAP],
+                        default=MASK_POINT,
+                        help='Remove objects whose representative point is on '
+                             'NoData (point), or with less than min_valid of '
+                             'their area on valid data (overlap).')
+    parser.add_argument('--min_valid', type=float, default=0.5,
+                        help='Fraction of area that must be valid data, for '
+                             'mask_method overlap.')
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE,
+                        help='Number of objects cleaned at once by each '
+                             'worker.')
+    parser.add_argument('--max_workers', type=int,
+                        help='Number of worker processes, default number of '
+                             'CPUs.')
     parser.add_argument('--out_mask_img', type=os.path.abspath,
                         help='Path to write intermediate mask raster derived '
                              'from raster.')
@@ -162,7 +293,11 @@ if __name__ == '__main__':
                     out_objects=out_objects,
                     min_size=min_size,
                     mask_on=mask_on,
+                    mask_method=args.mask_method,
+                    min_valid=args.min_valid,
                     drop_na=drop_na,
                     out_mask_vec=out_mask_vec,
                     out_mask_img=out_mask_img,
+                    chunk_size=args.chunk_size,
+                    max_workers=args.max_workers,
                     overwrite=overwrite)
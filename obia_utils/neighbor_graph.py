@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Neighbor (adjacency) graph of image-objects, shared by ImageObjects,
+neighbors and obia_utils. The graph is built once from a bulk spatial index
+query over the object geometries and stored as a sparse adjacency matrix,
+so neighbor lists, neighbor values and adjacency tests are lookups rather
+than a touches() scan of every object for every object.
+"""
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from misc_utils.logging_utils import create_logger
+from misc_utils.gpd_utils import sindex_pairs
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+
+def touching(gdf, geometry):
+    """
+    Get the index values of the features in gdf that touch geometry, using
+    the (cached) spatial index of gdf to limit the candidates tested.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        Features to search.
+    geometry : shapely.geometry
+        Geometry to find touching features of.
+
+    Returns
+    -------
+    list : index values of gdf
+    """
+    candidates = gdf.iloc[list(gdf.sindex.intersection(geometry.bounds))]
+    return candidates[candidates.geometry.touches(geometry)].index.tolist()
+
+
+class NeighborGraph:
+    """
+    Sparse, symmetric adjacency graph of a set of geometries.
+
+    Parameters
+    ----------
+    geometries : gpd.GeoDataFrame or gpd.GeoSeries
+        Geometries to compute adjacency between.
+    labels : list-like
+        Labels to identify each geometry by, defaults to the index of
+        geometries.
+    predicate : str
+        Spatial predicate defining adjacency. Default = 'touches'.
+    """
+    def __init__(self, geometries, labels=None, predicate='touches'):
+        if labels is None:
+            labels = geometries.index
+        self.labels = pd.Index(labels)
+        self.predicate = predicate
+        if not self.labels.is_unique:
+            logger.warning('Non-unique labels used for neighbor graph.')
+
+        n = len(self.labels)
+        logger.debug('Building neighbor graph for {:,} '
+                     'objects...'.format(n))
+        left, right = sindex_pairs(geometries, predicate=predicate)
+        # Objects are not neighbors of themselves
+        keep = left != right
+        left, right = left[keep], right[keep]
+        # int32, so products with the matrix count up to any number of
+        # neighbors without overflowing
+        adj = sparse.coo_matrix((np.ones(len(left), dtype=np.int32),
+                                 (left, right)),
+                                shape=(n, n)).tocsr()
+        # Ensure symmetric and binary
+        adj = adj + adj.T
+        adj.data[:] = 1
+        adj.sum_duplicates()
+        self.matrix = adj
+        logger.debug('Neighbor pairs found: {:,}'.format(self.matrix.nnz // 2))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def positions(self, labels):
+        """Integer positions in the graph of labels."""
+        pos = self.labels.get_indexer(labels)
+        if (pos == -1).any():
+            missing = np.asarray(labels)[pos == -1]
+            logger.error('Labels not in neighbor graph: '
+                         '{}'.format(missing[:10]))
+            raise KeyError(missing[:10])
+        return pos
+
+    def neighbor_positions(self, position):
+        """Integer positions of the neighbors of the object at position."""
+        start, end = self.matrix.indptr[position], \
+                     self.matrix.indptr[position + 1]
+        return self.matrix.indices[start:end]
+
+    def neighbors(self, label):
+        """Labels of the neighbors of label, as an array."""
+        pos = self.positions([label])[0]
+        return self.labels[self.neighbor_positions(pos)].to_numpy()
+
+    def neighbor_lists(self, labels=None):
+        """
+        Series of arrays of neighbor labels, indexed by labels.
+
+        Parameters
+        ----------
+        labels : list-like
+            Labels to get neighbors of, default is all objects.
+        """
+        if labels is None:
+            labels = self.labels
+        label_values = self.labels.to_numpy()
+        nebs = [label_values[self.neighbor_positions(p)]
+                for p in self.positions(labels)]
+        return pd.Series(nebs, index=pd.Index(labels, name=self.labels.name),
+                         dtype='object')
+
+    def neighbor_values(self, values, labels=None, dropna=False):
+        """
+        Series of dicts of {neighbor_label: value}, indexed by labels.
+
+        Parameters
+        ----------
+        values : pd.Series
+            Values to look up, indexed by the graph labels.
+        labels : list-like
+            Labels to get neighbor values for, default is all objects.
+        dropna : bool
+            True to drop neighbors with NaN values.
+        """
+        if labels is None:
+            labels = self.labels
+        label_values = self.labels.to_numpy()
+        vals = values.reindex(self.labels).to_numpy()
+        nvs = []
+        for p in self.positions(labels):
+            nps = self.neighbor_positions(p)
+            nv = dict(zip(label_values[nps], vals[nps]))
+            if dropna:
+                nv = {k: v for k, v in nv.items() if not pd.isnull(v)}
+            nvs.append(nv)
+        return pd.Series(nvs, index=pd.Index(labels, name=self.labels.name),
+                         dtype='object')
+
+    def any_neighbor(self, mask):
+        """
+        Determine for every object whether any of its neighbors are True in
+        mask, with a single sparse matrix product.
+
+        Parameters
+        ----------
+        mask : pd.Series
+            Boolean series indexed by graph labels. Missing or null values
+            are considered False.
+
+        Returns
+        -------
+        pd.Series : boolean, indexed by graph labels
+        """
+        m = mask.reindex(self.labels).fillna(False).to_numpy().astype(np.int32)
+        hits = self.matrix.dot(m) > 0
+        return pd.Series(hits, index=self.labels)
+
+    def edges(self):
+        """
+        DataFrame of each pair of neighbors, once per pair, as integer
+        positions ('src', 'dst').
+        """
+        upper = sparse.triu(self.matrix, k=1).tocoo()
+        return pd.DataFrame({'src': upper.row, 'dst': upper.col})
@@ -14,6 +14,8 @@ from pandas.api.types import is_numeric_dtype
 import geopandas as gpd
 
 from misc_utils.logging_utils import create_logger
+from misc_utils.gpd_utils import merge_groups
+from obia_utils.neighbor_graph import touching
 
 pd.options.mode.chained_assignment = None
 
@@ -118,8 +120,9 @@ def find_neighbors(row, gdf):
     if not gdf.index.is_unique:
         logger.warning("""Index of GeoDataFrame to compute neighbors on
                           is not unique.""")
-    # Get the indicies of features in gdf that touch the row's geometry
-    neighbors = gdf[gdf.geometry.touches(row.geometry)].index.tolist()
+    # Get the indicies of features in gdf that touch the row's geometry,
+    # only testing those found in the spatial index of gdf
+    neighbors = touching(gdf, row.geometry)
     # Check if current feature was included as one of it's own neighbors
     # if row.name in neighbors:
         # neighbors = neighbors.remove(row.index)
@@ -272,7 +275,7 @@ def merge(gdf, to_merge, col_of_int):
     dis_feats.index.name = index_name
     dis_feats.reset_index(inplace=True)
 
-    dis_feats['dis'] = dis_feats[index_name].apply(lambda x: to_merge[x])
+    dis_feats['dis'] = dis_feats[index_name].map(to_merge)
 
     # dis_feats.set_index(index_name, inplace=True)
 
@@ -355,10 +358,11 @@ def merge_closest_val(gdf, vc, vt, nvc, subset_params, iter_btw_merge=100):
     skip_ids = []
 
     while fts_to_merge:
-        # Dict to store ID: dissolve_value
-        to_merge = {}
-        # Dissolve value counter, increased everytime a match is found
-        dissolve_ctr = 0
+        # Pairs of (ID, matched ID) to merge, resolved into dissolve values
+        # when merging so that chained matches dissolve together
+        merge_pairs = []
+        # IDs already paired
+        paired = set()
 
         # Create subset of features that meet subset parameters [(column, compare, thresh),...]
         subset = subset_df(gdf, params=subset_params, skip_ids=skip_ids)
@@ -391,27 +395,27 @@ def merge_closest_val(gdf, vc, vt, nvc, subset_params, iter_btw_merge=100):
             match = closest_neighbor(row, vc,
                                      nvc=nvc,
                                      vt=vt,
-                                     ignore_ids=to_merge.keys())
+                                     ignore_ids=paired)
             if match:
-                # Add index of current row and its match with same dissolve value
-                to_merge[row.name] = dissolve_ctr
-                to_merge[match] = dissolve_ctr
-                dissolve_ctr += 1
+                # Add index of current row and its match as a pair to merge
+                merge_pairs.append((row.name, match))
+                paired.update([row.name, match])
             else:
                 # If no match found exclude ID from further checks
                 skip_ids.append(row.name)
 
-            # If number of features before merge, merge, exit loop, start loop over with new gdf
-            if len(to_merge) >= iter_btw_merge:
-                logger.debug('Merging features: {:,}...'.format(len(to_merge)))
-                gdf = merge(gdf, to_merge, col_of_int=vc)
-
+            # If number of features before merge, exit loop and merge,
+            # start loop over with new gdf
+            if len(paired) >= iter_btw_merge:
                 # start geodataframe iteration over with merged geodataframe
                 break
 
-        # End of the loop over subset is reached before the iter_btw_merge threshold
-        logger.debug('End of subset, merging features: {:,}'.format(len(to_merge)))
-        gdf = merge(gdf, to_merge, col_of_int=vc)
+        # Merge all pairs found with a single dissolve
+        logger.debug('Merging features: {:,}'.format(len(paired)))
+        if merge_pairs:
+            to_merge = merge_groups([p[0] for p in merge_pairs],
+                                    [p[1] for p in merge_pairs]).to_dict()
+            gdf = merge(gdf, to_merge, col_of_int=vc)
 
     # Add back in any features that had NaN in the vc.
     if isinstance(nan_feats, gpd.GeoDataFrame):
@@ -16,6 +16,7 @@ import geopandas as gpd
 
 from misc_utils.logging_utils import create_logger #LOGGING_CONFIG
 from misc_utils.RasterWrapper import Raster
+from obia_utils.neighbor_graph import NeighborGraph
 # from obia_utils.calc_zonal_stats import calc_zonal_stats
 # from calc_zonal_stats import calc_zonal_stats
 
@@ -61,29 +62,16 @@ def get_neighbors(gdf, subset=None, unique_id=None, neighbor_field='neighbors'):
         GeoDataFrame with added column containing list of unique IDs of neighbors.
 
     """
-    # TODO: Turn this into an apply function that takes the row and
-    #       returns the neighbors
     # If no subset is provided, use the whole dataframe
     if subset is None:
         subset = gdf
 
-    # List to store neighbors
-    ns = []
-    # List to store unique_ids
-    labels = []
-    # Iterate over rows, for each row, get unique_ids of all features it touches
-    print('Getting neighbors for {} features...'.format(len(subset)))
-    for index, row in tqdm(subset.iterrows(), total=len(subset)):
-        neighbors = gdf[gdf.geometry.touches(row['geometry'])][unique_id].tolist()
-        # If the feature is considering itself a neighbor remove it from the list
-        # TODO: clean this logic up (or just the comment)
-        #       when does a feature find itself as a neighbor?
-        if row[unique_id] in neighbors:
-            neighbors = neighbors.remove(row[unique_id])
-
-        # Save the neighbors that have been found and their IDs
-        ns.append(neighbors)
-        labels.append(row[unique_id])
+    # Build the neighbor graph of gdf once, labelled by unique_id, and look
+    # up the neighbors of each feature in subset
+    logger.info('Getting neighbors for {} features...'.format(len(subset)))
+    graph = NeighborGraph(gdf, labels=gdf[unique_id])
+    labels = subset[unique_id].tolist()
+    ns = [list(n) for n in graph.neighbor_lists(labels)]
 
     if not any(ns):
         logger.warning('No neighbors found.')
@@ -13,6 +13,7 @@ import subprocess
 from subprocess import PIPE
 
 from misc_utils.logging_utils import create_logger, create_logfile_path
+from misc_utils.profiler import profile_stage
 from misc_utils.gdal_tools import gdal_polygonize
 
 
@@ -63,6 +64,7 @@ def create_outname(img=None, out_edge=None, out_dir=None, out_fmt=None,
     return out_edge
 
 
+@profile_stage()
 def otb_edge_extraction(img: str, out_edge: str = None, out_dir: str = None,
                         out_fmt: str = None,
                         edge_filter: str = GRADIENT,
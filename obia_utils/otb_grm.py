@@ -6,17 +6,20 @@ Created on Fri Mar  6 14:22:54 2020
 """
 import argparse
 import datetime
+from functools import partial
 import os
 from pathlib import Path
 import platform
 import subprocess
 from subprocess import PIPE
 
+from osgeo import gdal
+
 from misc_utils.logging_utils import create_logger, create_logfile_path
+from misc_utils.profiler import profile_stage
 from misc_utils.gdal_tools import gdal_polygonize, detect_ogr_driver
-from misc_utils.gpd_utils import write_gdf
-from misc_utils.rio_utils import rio_polygonize
-from .cleanup_objects import remove_small_objects
+from misc_utils.polygonize import polygonize_blocks
+from .otb_grm_tiled import tiled_grm, TILE_OVERLAP, SEAM_AGREEMENT
 # from misc_utils.RasterWrapper import Raster
 
 
@@ -31,8 +34,9 @@ elif platform.system() == 'Linux':
 
 
 # Function definition
-def run_subprocess(command):
-    proc = subprocess.Popen(command, stdout=PIPE, stderr=PIPE, shell=True)
+def run_subprocess(command, env=None):
+    proc = subprocess.Popen(command, stdout=PIPE, stderr=PIPE, shell=True,
+                            env=env)
     for line in iter(proc.stdout.readline, b''):  # replace '' with b'' for Python 3
         logger.info(line.decode())
     output, error = proc.communicate()
@@ -61,6 +65,43 @@ def create_outname(img=None, out_seg=None, out_dir=None,
     return out_seg
 
 
+def grm_cmd(img, out_img, criterion='bs', threshold=None, niter=0,
+            spectral=0.5, spatial=0.5, init_otb_env=True):
+    """Build the GenericRegionMerging command."""
+    cmd = """otbcli_GenericRegionMerging
+             -in {}
+             -out {}
+             -criterion {}
+             -threshold {}
+             -niter {}
+             -cw {}
+             -sw {}""".format(img, out_img,
+                              criterion,
+                              threshold,
+                              niter,
+                              spectral,
+                              spatial)
+
+    # Remove whitespace, newlines
+    cmd = cmd.replace('\n', '')
+    cmd = ' '.join(cmd.split())
+    # Add environment init before calling segmentation
+    if init_otb_env:
+        cmd = '{} && {}'.format(otb_init, cmd)
+
+    return cmd
+
+
+def _exceeds(img, tile_size):
+    """True if img is larger than tile_size in either dimension."""
+    ds = gdal.Open(str(img))
+    exceeds = ds.RasterXSize > tile_size or ds.RasterYSize > tile_size
+    ds = None
+
+    return exceeds
+
+
+@profile_stage()
 def otb_grm(img,
             threshold,
             out_seg=None,
@@ -72,7 +113,11 @@ def otb_grm(img,
             spectral=0.5,
             spatial=0.5,
             init_otb_env=True,
-            drop_smaller=None):
+            drop_smaller=None,
+            tile_size=None,
+            tile_overlap=TILE_OVERLAP,
+            max_workers=None,
+            seam_agreement=SEAM_AGREEMENT):
     """
     Run the Orfeo Toolbox GenericRegionMerging command via the command line.
     Requires that OTB environment is activated
@@ -101,6 +146,17 @@ def otb_grm(img,
         Call OTB environment activating .bat script before running.
     drop_smaller: float
         If not None, drop resulting segments smaller than this size.
+    tile_size : int
+        If not None and the image is larger than this in either dimension,
+        segment in tiles of this size (pixels), in parallel, stitching the
+        tiles back together. See otb_grm_tiled.
+    tile_overlap : int
+        Pixels by which tiles overlap their neighbours on each side.
+    max_workers : int
+        Tiles segmented at once, default the number of CPUs.
+    seam_agreement : float
+        Fraction of the seam between objects in neighbouring tiles where
+        both tiles agree the objects are one, for them to be merged.
 
     Returns
     -------
@@ -127,6 +183,8 @@ def otb_grm(img,
         else:
             out_img = Path(out_seg).parent / \
                       '{}.tif'.format(Path(out_seg).stem)
+    else:
+        out_img = out_seg
 
     out_img_parent = Path(out_img).parent
     # out_seg_parent = Path(out_seg).parent
@@ -149,31 +207,20 @@ def otb_grm(img,
                                               criterion, threshold,
                                               niter, spectral, spatial))
     # Build the command
-    cmd = """otbcli_GenericRegionMerging
-             -in {}
-             -out {}
-             -criterion {}
-             -threshold {}
-             -niter {}
-             -cw {}
-             -sw {}""".format(img, out_img,
-                              criterion,
-                              threshold,
-                              niter,
-                              spectral,
-                              spatial)
-
-    # Remove whitespace, newlines
-    cmd = cmd.replace('\n', '')
-    cmd = ' '.join(cmd.split())
-    # Add environment init before calling segmentation
-    if init_otb_env:
-        cmd = '{} && {}'.format(otb_init, cmd)
-    # Run command
-    logger.debug(cmd)
+    build_cmd = partial(grm_cmd, criterion=criterion, threshold=threshold,
+                        niter=niter, spectral=spectral, spatial=spatial,
+                        init_otb_env=init_otb_env)
     # If run too quickly, check OTB env is active
     run_time_start = datetime.datetime.now()
-    run_subprocess(cmd)
+    if tile_size and _exceeds(img, tile_size):
+        tiled_grm(img, out_img, build_cmd, run_subprocess,
+                  tile_size=tile_size, overlap=tile_overlap,
+                  max_workers=max_workers, agreement=seam_agreement)
+    else:
+        cmd = build_cmd(img, out_img)
+        # Run command
+        logger.debug(cmd)
+        run_subprocess(cmd)
     run_time_finish = datetime.datetime.now()
     run_time = run_time_finish - run_time_start
     too_fast = datetime.timedelta(seconds=10)
@@ -188,12 +235,9 @@ def otb_grm(img,
         logger.info('Vectorizing...')
         # vec_seg = out_seg.replace('tif', 'shp')
         # gdal_polygonize(img=out_img, out_vec=out_seg, fieldname='label')
-        objects = rio_polygonize(img=out_img)
-
-        if drop_smaller is not None:
-            objects = remove_small_objects(objects=objects, min_size=drop_smaller)
-
-        write_gdf(objects, out_seg)
+        # Objects smaller than drop_smaller are dropped as they are created
+        polygonize_blocks(out_img, out_vec=out_seg, fieldname='raster_val',
+                          min_area=drop_smaller)
         logger.info('Segmentation created at: {}'.format(out_seg))
 
         logger.debug('Removing raster segmentation...')
@@ -257,6 +301,19 @@ if __name__ == "__main__":
     parser.add_argument('--drop_smaller', type=float,
                         help='Drop objects smaller than this size before writing '
                              'to file.')
+    parser.add_argument('-ts', '--tile_size', type=int,
+                        help='Segment images larger than this (pixels) in '
+                             'tiles of this size, in parallel.')
+    parser.add_argument('--tile_overlap', type=int, default=TILE_OVERLAP,
+                        help='Pixels by which tiles overlap.')
+    parser.add_argument('--max_workers', type=int,
+                        help='Tiles to segment at once, default the number '
+                             'of CPUs.')
+    parser.add_argument('--seam_agreement', type=float,
+                        default=SEAM_AGREEMENT,
+                        help='Fraction of the seam between objects in '
+                             'neighbouring tiles that both tiles must agree '
+                             'on to merge them.')
     parser.add_argument('-l', '--log_file',
                         type=os.path.abspath,
                         default='otb_grm.log',
@@ -279,6 +336,10 @@ if __name__ == "__main__":
     spectral = args.spectral
     spatial = args.spatial
     drop_smaller = args.drop_smaller
+    tile_size = args.tile_size
+    tile_overlap = args.tile_overlap
+    max_workers = args.max_workers
+    seam_agreement = args.seam_agreement
 
     # Set up logger
     handler_level = 'INFO'
@@ -305,4 +366,8 @@ if __name__ == "__main__":
             spectral=spectral,
             spatial=spatial,
             out_dir=out_dir,
-            drop_smaller=drop_smaller)
+            drop_smaller=drop_smaller,
+            tile_size=tile_size,
+            tile_overlap=tile_overlap,
+            max_workers=max_workers,
+            seam_agreement=seam_agreement)
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Tiled Generic Region Merging. GenericRegionMerging runs in a single
+process over the whole image, so large images are split into tiles that
+overlap by a margin and each tile is segmented by its own OTB process,
+several at once. The core (non-overlapping part) of each tile's labels is
+kept, with labels offset to be unique across tiles, and objects cut by a
+seam between tiles are merged when both neighbouring tiles' segmentations
+of the margin across the seam agree that the pixels either side of the
+seam belong to the same object.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
+import shutil
+import tempfile
+
+import numpy as np
+from osgeo import gdal
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from misc_utils.gdal_tools import pad_window
+from misc_utils.logging_utils import create_logger
+
+gdal.UseExceptions()
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+TILE_SIZE = 4096
+TILE_OVERLAP = 128
+# Fraction of the seam between two objects that both tiles must agree is
+# within a single object for the objects to be merged
+SEAM_AGREEMENT = 0.5
+
+
+class Tile:
+    """A core window of the image and the padded window segmented for it."""
+    def __init__(self, row, col, core, padded):
+        self.row = row
+        self.col = col
+        self.core = core
+        self.padded = padded
+        self.seg = None
+        # Labels of this tile are offset + tile label + 1 in the output
+        self.offset = None
+        self.num_labels = None
+
+    @property
+    def name(self):
+        return 'tile_r{}_c{}'.format(self.row, self.col)
+
+    def core_in_padded(self):
+        """(xoff, yoff, xsize, ysize) of the core within the padded tile."""
+        return (self.core[0] - self.padded[0], self.core[1] - self.padded[1],
+                self.core[2], self.core[3])
+
+
+def tile_grid(x_sz, y_sz, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    """
+    Tiles of an x_sz by y_sz image, with cores of tile_size pixels covering
+    the image, each padded by overlap pixels on every side (within the
+    image).
+
+    Returns
+    -------
+    dict : {(row, col): Tile}
+    """
+    tiles = {}
+    for row, yoff in enumerate(range(0, y_sz, tile_size)):
+        for col, xoff in enumerate(range(0, x_sz, tile_size)):
+            core = (xoff, yoff, min(tile_size, x_sz - xoff),
+                    min(tile_size, y_sz - yoff))
+            padded, _inner = pad_window(core, overlap, x_sz, y_sz)
+            tiles[(row, col)] = Tile(row, col, core, padded)
+
+    return tiles
+
+
+def _read(path, xoff, yoff, xsize, ysize):
+    ds = gdal.Open(str(path))
+    arr = ds.GetRasterBand(1).ReadAsArray(int(xoff), int(yoff),
+                                          int(xsize), int(ysize))
+    ds = None
+
+    return arr.astype(np.int64)
+
+
+def _max_label(path):
+    ds = gdal.Open(str(path))
+    _mn, mx = ds.GetRasterBand(1).ComputeRasterMinMax(False)
+    ds = None
+
+    return int(mx)
+
+
+def segment_tile(img, tile, tile_dir, grm_cmd, run_cmd, env=None):
+    """
+    Segment the padded window of tile from img, with the command built by
+    grm_cmd(in_img, out_img) and run by run_cmd(cmd, env=env).
+    """
+    tile_img = str(Path(tile_dir) / '{}.vrt'.format(tile.name))
+    tile.seg = str(Path(tile_dir) / '{}_seg.tif'.format(tile.name))
+    # VRT of the window, rather than a copy of the pixels
+    gdal.Translate(tile_img, str(img), format='VRT',
+                   srcWin=list(tile.padded))
+    logger.debug('Segmenting {}: {}'.format(tile.name, tile.padded))
+    run_cmd(grm_cmd(tile_img, tile.seg), env=env)
+    if not os.path.exists(tile.seg):
+        raise RuntimeError('Segmentation of {} failed, no output: '
+                           '{}'.format(tile.name, tile.seg))
+    tile.num_labels = _max_label(tile.seg) + 1
+
+    return tile
+
+
+def seam_merges(a, b, vertical, agreement=SEAM_AGREEMENT):
+    """
+    Pairs of output labels to merge across the seam between tile a and the
+    tile b to its right (vertical seam) or below it.
+
+    Returns
+    -------
+    np.array : (n, 2) output labels to merge
+    """
+    if vertical:
+        s = a.core[0] + a.core[2]
+        rows = (a.core[1], a.core[3])
+        # Columns either side of the seam, in each tile
+        a_strip = _read(a.seg, s - 1 - a.padded[0], rows[0] - a.padded[1],
+                        2, rows[1])
+        b_strip = _read(b.seg, s - 1 - b.padded[0], rows[0] - b.padded[1],
+                        2, rows[1])
+    else:
+        s = a.core[1] + a.core[3]
+        cols = (a.core[0], a.core[2])
+        a_strip = _read(a.seg, cols[0] - a.padded[0], s - 1 - a.padded[1],
+                        cols[1], 2).T
+        b_strip = _read(b.seg, cols[0] - b.padded[0], s - 1 - b.padded[1],
+                        cols[1], 2).T
+    # Labels of the pixels kept either side of the seam
+    left = a.offset + a_strip[:, 0] + 1
+    right = b.offset + b_strip[:, 1] + 1
+    # Both tiles place the pixels either side of the seam in one object
+    agree = (a_strip[:, 0] == a_strip[:, 1]) & (b_strip[:, 0] == b_strip[:, 1])
+
+    # Count contacts of each pair of labels along the seam, and those
+    # where the tiles agree
+    m = right.max() + 1
+    keys = left * m + right
+    pairs, contacts = np.unique(keys, return_counts=True)
+    agree_pairs, agree_contacts = np.unique(keys[agree], return_counts=True)
+    merge = agree_pairs[agree_contacts /
+                        contacts[np.searchsorted(pairs, agree_pairs)]
+                        >= agreement]
+
+    return np.stack([merge // m, merge % m], axis=1)
+
+
+def tile_lut(tiles, agreement=SEAM_AGREEMENT):
+    """
+    Set the label offset of each tile and determine the output label of
+    every tile label, with objects cut by seams sharing a label.
+
+    Returns
+    -------
+    np.array : lut, the output label of label l of tile t is
+    lut[t.offset + l + 1]. Labels only found in the margins of tiles have
+    output labels that are not used.
+    """
+    total = 1
+    for key in sorted(tiles):
+        tiles[key].offset = total - 1
+        total += tiles[key].num_labels
+
+    merges = []
+    for (row, col), a in tiles.items():
+        right = tiles.get((row, col + 1))
+        below = tiles.get((row + 1, col))
+        if right is not None:
+            merges.append(seam_merges(a, right, vertical=True,
+                                      agreement=agreement))
+        if below is not None:
+            merges.append(seam_merges(a, below, vertical=False,
+                                      agreement=agreement))
+    merges = np.concatenate(merges) if merges else np.empty((0, 2),
+                                                            dtype=np.int64)
+    logger.info('Objects merged across tile seams: {:,}'.format(len(merges)))
+
+    # Output label of each tile label, merged objects share a label
+    graph = coo_matrix((np.ones(len(merges)), (merges[:, 0], merges[:, 1])),
+                       shape=(total, total))
+    _num_components, lut = connected_components(graph, directed=False)
+    # Label 0 is not used by any tile, so is its own component (0) and
+    # objects are labelled from 1
+
+    return lut.astype(np.int32)
+
+
+def stitch_tiles(tiles, img, out_img, agreement=SEAM_AGREEMENT):
+    """
+    Write the cores of the segmented tiles to out_img, with labels unique
+    across tiles and objects cut by seams merged.
+
+    Returns
+    -------
+    int : number of objects
+    """
+    lut = tile_lut(tiles, agreement=agreement)
+
+    src = gdal.Open(str(img))
+    driver = gdal.GetDriverByName('GTiff')
+    dst = driver.Create(str(out_img), src.RasterXSize, src.RasterYSize, 1,
+                        gdal.GDT_Int32,
+                        options=['TILED=YES', 'COMPRESS=LZW', 'BIGTIFF=IF_SAFER'])
+    dst.SetGeoTransform(src.GetGeoTransform())
+    dst.SetProjection(src.GetProjection())
+    src = None
+    band = dst.GetRasterBand(1)
+    written = []
+    for t in tiles.values():
+        labels = lut[t.offset + _read(t.seg, *t.core_in_padded()) + 1]
+        band.WriteArray(labels, int(t.core[0]), int(t.core[1]))
+        written.append(np.unique(labels))
+    band = None
+    dst = None
+
+    return len(np.unique(np.concatenate(written)))
+
+
+def tiled_grm(img, out_img, grm_cmd, run_cmd, tile_size=TILE_SIZE,
+              overlap=TILE_OVERLAP, max_workers=None,
+              agreement=SEAM_AGREEMENT, keep_tiles=False):
+    """
+    Segment img in overlapping tiles, in parallel, and stitch the tiles into
+    a single label raster.
+
+    Parameters
+    ----------
+    img : str
+        Path to image to segment.
+    out_img : str
+        Path to write labels to.
+    grm_cmd : function
+        grm_cmd(in_img, out_img) returning the GenericRegionMerging command.
+    run_cmd : function
+        run_cmd(cmd, env=env) running a command.
+    tile_size : int
+        Size of tile cores, in pixels.
+    overlap : int
+        Pixels each tile is padded by on each side, giving GRM context at
+        the edges of the core, and used to decide merges across seams.
+    max_workers : int
+        Tiles segmented at once, default the number of CPUs.
+    agreement : float
+        Fraction of the seam between two objects where both tiles agree the
+        pixels are one object, for the objects to be merged.
+    keep_tiles : bool
+        True to keep the tile segmentations.
+
+    Returns
+    -------
+    str : out_img
+    """
+    if overlap < 1:
+        raise ValueError('Tile overlap must be at least 1 pixel.')
+    ds = gdal.Open(str(img))
+    x_sz, y_sz = ds.RasterXSize, ds.RasterYSize
+    ds = None
+    tiles = tile_grid(x_sz, y_sz, tile_size=tile_size, overlap=overlap)
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    max_workers = min(max_workers, len(tiles))
+    # Share the CPUs between the OTB processes
+    env = dict(os.environ)
+    env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(
+        max(1, (os.cpu_count() or 1) // max_workers))
+
+    tile_dir = tempfile.mkdtemp(prefix='grm_tiles_',
+                                dir=str(Path(out_img).parent))
+    logger.info('Segmenting {}x{} image in {:,} tiles, {} at '
+                'once...'.format(x_sz, y_sz, len(tiles), max_workers))
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Tiles are segmented by OTB processes, threads only wait on them
+            list(executor.map(lambda t: segment_tile(img, t, tile_dir,
+                                                     grm_cmd, run_cmd,
+                                                     env=env),
+                              tiles.values()))
+        num_objs = stitch_tiles(tiles, img, out_img, agreement=agreement)
+    finally:
+        if not keep_tiles:
+            shutil.rmtree(tile_dir, ignore_errors=True)
+    logger.info('Objects in stitched segmentation: {:,}'.format(num_objs))
+
+    return out_img
@@ -16,6 +16,7 @@ import sys
 from tqdm import tqdm
 
 from misc_utils.logging_utils import LOGGING_CONFIG, create_logger
+from misc_utils.profiler import profile_stage
 # from misc_utils.RasterWrapper import Raster
 
 
@@ -77,6 +78,7 @@ def run_subprocess(command, debug_filters=None, return_lines=None):
     return message_values
 
 
+@profile_stage()
 def otb_lsms(img, mode='vector',
              spatialr=5, ranger=15, minsize=50,
              tilesize_x=500, tilesize_y=500,
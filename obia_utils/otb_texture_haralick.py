@@ -17,6 +17,7 @@ from subprocess import PIPE
 # from osgeo import gdal
 
 from misc_utils.logging_utils import create_logger, create_logfile_path
+from misc_utils.profiler import profile_stage
 from misc_utils.gdal_tools import get_raster_stats
 
 
@@ -34,6 +35,7 @@ def run_subprocess(command):
     logger.debug('Err: {}'.format(error.decode()))
 
 
+@profile_stage()
 def otb_texture_haralick(img,
                          channel=1,
                          texture='simple',
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental region merging for ImageObjects.pseudo_merging. Merge
+candidates are held in a heap ordered by the merge criterion (smallest
+area first), and after each merge only the merged pair and its neighbors
+are updated, rather than re-sorting, re-classifying and re-describing every
+object after every merge.
+"""
+import heapq
+import operator
+
+import numpy as np
+import pandas as pd
+
+from misc_utils.logging_utils import create_logger
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+# Rule types that can be evaluated per object during merging
+THRESHOLD = 'threshold'
+ADJACENT = 'adjacent'
+ADJ_OR_IS = 'adjacent_or_is'
+
+
+def weighted_mean(values, weights):
+    weight_proportions = [i / sum(weights) for i in weights]
+    wm = sum([v * w for v, w in zip(values, weight_proportions)])
+
+    return wm
+
+
+def weighted_majority(values, weights):
+    weighted_values = [(v, w) for v, w in zip(values, weights)]
+    wmaj = max(weighted_values, key=operator.itemgetter(1))
+    return wmaj
+
+
+# Pairwise functions
+def within_range(a, b, range):
+    return operator.le(abs(a - b), range)
+
+
+def pairwise_match(row, possible_match, pairwise_criteria : list):
+    """Tests each set of pairwise critieria against the current row
+    and a possible match.
+    Parameters
+    ---------
+    row : pd.Series or dict
+        Must contain all fields in pairwise criteria
+    possible_match : pd.Series or dict
+        Must contain all fields in pairwise critieria
+    pairwise_criteria : list
+        List of dicts:
+        Dict of critiria, supported types:
+            'within': {'field': "field_name", 'range': "within range"}
+            'threshold: {'field': "field_name, 'op', operator comparison fxn,
+                         'threshold': value to use in fxn}
+    Returns
+    -------
+    bool : True is all criteria are met
+    """
+    # If no pairwise criteria provided, mark as True
+    if pairwise_criteria is None:
+        return True
+
+    criteria_met = []
+    for criteria_type, params in pairwise_criteria.items():
+        if criteria_type == 'within':
+            met = within_range(row[params['field']],
+                               possible_match[params['field']],
+                               params['range'])
+            criteria_met.append(met)
+        elif criteria_type == 'threshold':
+            if params['threshold'] == 'self':
+                threshold = row[params['field']]
+            else:
+                threshold = params['threshold']
+            met = params['op'](possible_match[params['field']],
+                               threshold)
+            criteria_met.append(met)
+
+    return all(criteria_met)
+
+
+def z_score(value, mean, std):
+    return (value - mean) / std
+
+
+def abs_stds(value1, value2, std):
+    return abs((value1 - value2) / std)
+
+
+def aggregate_values(agg_type, value, area, other_value, other_area):
+    """
+    Aggregate the values of two objects being merged.
+
+    Parameters
+    ----------
+    agg_type : str
+        One of 'mean' (area weighted), 'majority' (value of larger object),
+        'minority' (value of smaller object), 'min'/'minimum',
+        'max'/'maximum', 'sum', 'bool_and', 'bool_or'
+    value, other_value : object
+        Values of the two objects.
+    area, other_area : float
+        Areas of the two objects.
+
+    Returns
+    -------
+    object : aggregated value
+    """
+    if agg_type == 'mean':
+        agg = weighted_mean(values=[value, other_value],
+                            weights=[area, other_area])
+    elif agg_type == 'majority':
+        agg = max([(value, area), (other_value, other_area)],
+                  key=operator.itemgetter(1))[0]
+    elif agg_type == 'minority':
+        agg = min([(value, area), (other_value, other_area)],
+                  key=operator.itemgetter(1))[0]
+    elif agg_type in ('min', 'minimum'):
+        agg = min(value, other_value)
+    elif agg_type in ('max', 'maximum'):
+        agg = max(value, other_value)
+    elif agg_type == 'sum':
+        agg = value + other_value
+    elif agg_type == 'bool_and':
+        agg = value and other_value
+    elif agg_type == 'bool_or':
+        agg = value or other_value
+    else:
+        logger.error('Unknown agg_type: {}'.format(agg_type))
+        raise ValueError(agg_type)
+
+    return agg
+
+
+def _meets(op, value, threshold):
+    if pd.isnull(value):
+        return False
+    return bool(op(value, threshold))
+
+
+class RunningStd:
+    """Sample standard deviation (ddof=1, NaNs skipped, as in
+    pd.DataFrame.describe()) of a set of values that are updated one at
+    a time."""
+    def __init__(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        self.n = len(values)
+        self.total = values.sum()
+        self.total_sq = (values ** 2).sum()
+
+    def update(self, old, new):
+        if not pd.isnull(old):
+            self.n -= 1
+            self.total -= old
+            self.total_sq -= old ** 2
+        if not pd.isnull(new):
+            self.n += 1
+            self.total += new
+            self.total_sq += new ** 2
+
+    @property
+    def std(self):
+        if self.n < 2:
+            return np.NaN
+        var = (self.total_sq - self.total ** 2 / self.n) / (self.n - 1)
+        return np.sqrt(max(var, 0))
+
+
+class RegionMerger:
+    """
+    Priority-queue driven pseudo-merging of objects. Objects are popped
+    smallest area first and merged into the neighbor with the closest values
+    in the grow fields (in standard deviations), given that the neighbor is a
+    merge candidate and meets the pairwise criteria. After a merge, only the
+    merged pair's aggregates, areas and neighbor sets are updated, and only
+    the merged object and its neighbors are re-tested against the merge
+    candidate rules.
+
+    Parameters
+    ----------
+    records : dict
+        {object_id: {field: value}} for all fields used in merging.
+    neighbors : dict
+        {object_id: set of neighbor object_ids}
+    areas : dict
+        {object_id: area}
+    value_fields : dict
+        {field: agg_type} of fields to aggregate when merging.
+    grow_fields : list
+        Fields to choose the best neighbor to merge with on.
+    merge_candidates : dict
+        {object_id: bool} initial merge candidates.
+    seeds : dict
+        {object_id: bool} initial merge seeds.
+    merge_candidate_rules : list
+        Rules (see create_rule) used to re-test merged objects.
+    pairwise_criteria : list
+        List of pairwise criteria dicts, see pairwise_match.
+    merge_counts : dict
+        {object_id: merges already performed}
+    max_iter : int
+        Maximum merges into any single object, None for no limit.
+    """
+    def __init__(self, records, neighbors, areas, value_fields, grow_fields,
+                 merge_candidates, seeds,
+                 merge_candidate_rules=None,
+                 pairwise_criteria=None,
+                 merge_counts=None,
+                 max_iter=None):
+        self.records = records
+        self.neighbors = neighbors
+        self.areas = areas
+        self.value_fields = value_fields if value_fields else {}
+        self.grow_fields = list(grow_fields) if grow_fields else []
+        self.candidates = merge_candidates
+        self.seeds = seeds
+        self.rules = merge_candidate_rules if merge_candidate_rules else []
+        self.adj_rules = any([r['rule_type'] in (ADJACENT, ADJ_OR_IS)
+                              for r in self.rules])
+        self.pairwise_criteria = pairwise_criteria
+        self.merge_counts = merge_counts if merge_counts else {}
+        self.max_iter = max_iter
+
+        self.mergeable = {i: True for i in self.records}
+        self.merge_paths = {i: [] for i in self.records}
+        self.stds = {gf: RunningStd([r[gf] for r in self.records.values()])
+                     for gf in self.grow_fields}
+        # Heap of (area, order, version, object_id), entries with an old
+        # version are stale and skipped when popped
+        self._order = {i: n for n, i in enumerate(self.records)}
+        self._version = {i: 0 for i in self.records}
+        self._heap = []
+        self.num_merges = 0
+
+    def _can_grow(self, i):
+        if not (self.mergeable[i] and self.candidates[i] and self.seeds[i]):
+            return False
+        if self.max_iter is not None:
+            return (self.merge_counts.get(i, 0) + len(self.merge_paths[i])
+                    < self.max_iter)
+        return True
+
+    def _push(self, i):
+        self._version[i] += 1
+        heapq.heappush(self._heap, (self.areas[i], self._order[i],
+                                    self._version[i], i))
+
+    def _meets_rule(self, i, rule):
+        rule_type = rule['rule_type']
+        op = rule['op']
+        in_field = rule['in_field']
+        threshold = rule['threshold']
+        is_result = _meets(op, self.records[i][in_field], threshold)
+        if rule_type == THRESHOLD:
+            return is_result
+        if rule.get('src_field'):
+            if not _meets(rule['src_op'], self.records[i][rule['src_field']],
+                          rule['src_thresh']):
+                return False
+        adj_result = any([_meets(op, self.records[n][in_field], threshold)
+                          for n in self.neighbors[i]])
+        if rule_type == ADJ_OR_IS:
+            return adj_result or is_result
+        return adj_result
+
+    def _update_candidate(self, i):
+        """Re-test object against the merge candidate rules. Objects that
+        are already candidates remain candidates."""
+        if not self.rules or self.candidates[i] or not self.mergeable[i]:
+            return
+        if all([self._meets_rule(i, r) for r in self.rules]):
+            self.candidates[i] = True
+            if self._can_grow(i):
+                self._push(i)
+
+    def _best_match(self, i):
+        row = self.records[i]
+        best_match_id = None
+        best_score = None
+        for neb_id in self.neighbors[i]:
+            # Skip if marked unmergeable or not a merge_candidate
+            if not self.mergeable[neb_id] or not self.candidates[neb_id]:
+                continue
+            possible_match = self.records[neb_id]
+            if self.pairwise_criteria is not None and \
+                    not all([pairwise_match(row, possible_match, pc)
+                             for pc in self.pairwise_criteria]):
+                continue
+            # Total number of standard deviations away in all grow fields
+            score = sum([abs_stds(row[gf], possible_match[gf],
+                                  std=self.stds[gf].std)
+                         for gf in self.grow_fields])
+            if best_score is None or score < best_score:
+                best_match_id, best_score = neb_id, score
+
+        return best_match_id
+
+    def _merge(self, i, j):
+        """Merge object i into object j."""
+        row = self.records[i]
+        best_match = self.records[j]
+        for vf, agg_type in self.value_fields.items():
+            new = aggregate_values(agg_type,
+                                   row[vf], self.areas[i],
+                                   best_match[vf], self.areas[j])
+            if vf in self.stds:
+                self.stds[vf].update(best_match[vf], new)
+            best_match[vf] = new
+        self.areas[j] = self.areas[i] + self.areas[j]
+
+        # Contract i into j in the neighbor sets
+        for n in self.neighbors[i]:
+            self.neighbors[n].discard(i)
+            if n != j:
+                self.neighbors[n].add(j)
+        self.neighbors[j] |= self.neighbors[i]
+        self.neighbors[j] -= {i, j}
+        self.neighbors[i] = set()
+
+        # Merge path of j gets i and everything already merged into i
+        self.merge_paths[j].extend(self.merge_paths[i])
+        self.merge_paths[j].append(i)
+        self.merge_paths[i] = []
+        self.seeds[j] = True
+        self.num_merges += 1
+
+    def run(self):
+        for i in self.records:
+            if self._can_grow(i):
+                self._push(i)
+        logger.info('Mergeable IDs: {:,}'.format(len(self._heap)))
+
+        while self._heap:
+            area, order, version, i = heapq.heappop(self._heap)
+            if version != self._version[i] or not self._can_grow(i):
+                continue
+            j = self._best_match(i)
+            if j is not None:
+                logger.debug('Merging {} into {}'.format(i, j))
+                self._merge(i, j)
+                # Re-test only the merged object and, for adjacency rules,
+                # its neighbors, whose neighbor values have changed
+                self._update_candidate(j)
+                if self.adj_rules:
+                    for n in self.neighbors[j]:
+                        self._update_candidate(n)
+                if self._can_grow(j):
+                    self._push(j)
+            # Mark original feature as no longer mergeable, it was either
+            # "merged" or there was no possible match
+            self.mergeable[i] = False
+            self.candidates[i] = False
+
+        logger.info('Merges determined: {:,}'.format(self.num_merges))
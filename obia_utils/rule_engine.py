@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled evaluation of classification rules (see ImageObjects.create_rule).
+A list of rules is compiled once into a RulePlan, in which each distinct
+comparison (field, operator, threshold) appears once, whichever rules use
+it. Evaluating the plan computes each comparison as a single column
+operation, then every adjacency rule at once with one sparse product of
+the neighbor graph's adjacency matrix and the matrix of the adjacency
+rules' comparisons, so a whole rule set is evaluated in a few numpy
+passes rather than rule by rule and object by object.
+
+Null values never meet a comparison, and objects not in the neighbor graph
+have no neighbors.
+"""
+import numpy as np
+import pandas as pd
+
+from misc_utils.logging_utils import create_logger
+from obia_utils.region_merging import THRESHOLD, ADJACENT, ADJ_OR_IS
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+RULE_TYPES = [THRESHOLD, ADJACENT, ADJ_OR_IS]
+
+
+def compare(values, op, threshold):
+    """
+    Boolean array of op(values, threshold), False where values are null.
+
+    Parameters
+    ----------
+    values : pd.Series
+        Values to compare.
+    op : operator function
+        Comparison, one of operator.[lt, gt, le, ge, eq, ne].
+    threshold : float, int, str, bool
+        Value to compare to.
+
+    Returns
+    -------
+    np.array : boolean
+    """
+    valid = values.notnull().to_numpy()
+    with np.errstate(invalid='ignore'):
+        meets = op(values, threshold)
+    meets = pd.Series(meets, index=values.index).fillna(False)
+
+    return meets.to_numpy().astype(bool) & valid
+
+
+class RulePlan:
+    """
+    Rules compiled for vectorised evaluation.
+
+    Parameters
+    ----------
+    rules : list
+        Rule dicts, see ImageObjects.create_rule. Adjacency rules may also
+        have src_field, src_op and src_thresh, limiting the objects that
+        can meet the rule to those where src_op(src_field, src_thresh).
+    """
+    def __init__(self, rules):
+        self.rules = list(rules)
+        # Distinct comparisons, as (field, op, threshold), and the position
+        # of each in the list
+        self.comparisons = []
+        self._comparison_pos = {}
+        # Per rule: (rule_type, comparison, src comparison or None)
+        self.steps = []
+        for rule in self.rules:
+            rule_type = rule['rule_type']
+            if rule_type not in RULE_TYPES:
+                logger.error('Rule type: "{}" not recognized. Must be one '
+                             'of: {}'.format(rule_type, RULE_TYPES))
+                raise ValueError(rule_type)
+            comp = self._add_comparison(rule['in_field'], rule['op'],
+                                        rule['threshold'])
+            src = None
+            if rule_type != THRESHOLD and rule.get('src_field'):
+                src = self._add_comparison(rule['src_field'], rule['src_op'],
+                                           rule['src_thresh'])
+            self.steps.append((rule_type, comp, src))
+        # Comparisons tested against neighbors, columns of the matrix
+        # multiplied by the adjacency matrix
+        self.adjacent = sorted({comp for rule_type, comp, _src in self.steps
+                                if rule_type != THRESHOLD})
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __repr__(self):
+        return 'RulePlan({} rules, {} comparisons, {} adjacent)'.format(
+            len(self.rules), len(self.comparisons), len(self.adjacent))
+
+    def _add_comparison(self, field, op, threshold):
+        key = (field, op, threshold)
+        try:
+            return self._comparison_pos[key]
+        except TypeError:
+            # Unhashable threshold, not shared between rules
+            self.comparisons.append(key)
+            return len(self.comparisons) - 1
+        except KeyError:
+            self.comparisons.append(key)
+            self._comparison_pos[key] = len(self.comparisons) - 1
+            return self._comparison_pos[key]
+
+    @property
+    def fields(self):
+        """Fields the rules are evaluated on."""
+        return sorted({field for field, _op, _thresh in self.comparisons})
+
+    @property
+    def needs_graph(self):
+        return len(self.adjacent) > 0
+
+    def out_fields(self):
+        """Position of each rule and its out_field, for rules that have one."""
+        return [(i, r['out_field']) for i, r in enumerate(self.rules)
+                if r.get('out_field')]
+
+    def evaluate(self, objects, graph=None):
+        """
+        Evaluate every rule for every object.
+
+        Parameters
+        ----------
+        objects : pd.DataFrame
+            Objects, with all fields used by the rules.
+        graph : NeighborGraph
+            Adjacency graph of the objects, required if there are
+            adjacency rules.
+
+        Returns
+        -------
+        np.array : boolean, (number of objects, number of rules)
+        """
+        missing = [f for f in self.fields if f not in objects.columns]
+        if missing:
+            logger.error('Fields used in rules not found: {}'.format(missing))
+            raise KeyError(missing)
+        n = len(objects)
+        comps = np.zeros((n, len(self.comparisons)), dtype=bool)
+        for i, (field, op, threshold) in enumerate(self.comparisons):
+            comps[:, i] = compare(objects[field], op, threshold)
+
+        adjacent = {}
+        if self.needs_graph:
+            if graph is None:
+                raise ValueError('A neighbor graph is required to evaluate '
+                                 'adjacency rules.')
+            # Rows of the objects in the graph, and the reverse
+            pos = graph.labels.get_indexer(objects.index)
+            in_graph = pos != -1
+            meets = np.zeros((len(graph), len(self.adjacent)),
+                             dtype=np.int32)
+            meets[pos[in_graph]] = comps[in_graph][:, self.adjacent]
+            # Number of neighbors meeting each comparison, in int32 so
+            # objects with many neighbors do not overflow
+            counts = graph.matrix.astype(np.int32).dot(meets)
+            hits = np.zeros((n, len(self.adjacent)), dtype=bool)
+            hits[in_graph] = counts[pos[in_graph]] > 0
+            adjacent = {comp: hits[:, i] for i, comp in enumerate(self.adjacent)}
+
+        results = np.empty((n, len(self.steps)), dtype=bool)
+        for i, (rule_type, comp, src) in enumerate(self.steps):
+            if rule_type == THRESHOLD:
+                results[:, i] = comps[:, comp]
+                continue
+            result = adjacent[comp]
+            if src is not None:
+                result = result & comps[:, src]
+            if rule_type == ADJ_OR_IS:
+                result = result | comps[:, comp]
+            results[:, i] = result
+
+        return results
+
+
+def compile_rules(rules):
+    """Compile rules into a RulePlan, passing through compiled plans."""
+    if isinstance(rules, RulePlan):
+        return rules
+    plan = RulePlan(rules)
+    logger.debug('Compiled {}'.format(plan))
+
+    return plan
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Zonal statistics for many rasters and bands with a single read of each
+raster. Objects are rasterized once per raster grid into a label grid, and
+every raster sharing that grid is streamed block by block, accumulating the
+requested statistics for every object with label-indexed reductions
+(bincount), rather than re-rasterizing every polygon and re-reading the
+raster for every raster, band and statistic.
+"""
+from collections import OrderedDict
+from random import randint
+
+import numpy as np
+import pandas as pd
+from osgeo import gdal, ogr
+
+from misc_utils.logging_utils import create_logger
+from misc_utils.gdal_tools import block_windows, bounds2pixel_window, \
+    rasterize_window
+
+gdal.UseExceptions()
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+# Statistics that can be accumulated block by block
+ENGINE_STATS = ['count', 'sum', 'mean', 'min', 'max', 'std', 'range']
+
+LABEL_FLD = 'zs_label'
+
+
+class ZonalAccumulator:
+    """Running per-label count, sum, sum of squares, min and max."""
+    def __init__(self, num_labels):
+        # Label 0 is background
+        n = num_labels + 1
+        self.count = np.zeros(n, dtype=np.int64)
+        self.sum = np.zeros(n, dtype=np.float64)
+        self.sum_sq = np.zeros(n, dtype=np.float64)
+        self.min = np.full(n, np.inf)
+        self.max = np.full(n, -np.inf)
+
+    def add(self, labels, values):
+        """Add values (1D) with corresponding labels (1D) to the totals."""
+        n = len(self.count)
+        values = values.astype(np.float64)
+        self.count += np.bincount(labels, minlength=n)
+        self.sum += np.bincount(labels, weights=values, minlength=n)
+        self.sum_sq += np.bincount(labels, weights=values ** 2, minlength=n)
+        np.minimum.at(self.min, labels, values)
+        np.maximum.at(self.max, labels, values)
+
+    def stat(self, stat):
+        """Final values of stat, for labels 1..n, NaN where no pixels."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            count = self.count[1:]
+            empty = count == 0
+            if stat == 'count':
+                return count
+            elif stat == 'sum':
+                result = self.sum[1:].copy()
+            elif stat == 'mean':
+                result = self.sum[1:] / count
+            elif stat == 'std':
+                mean = self.sum[1:] / count
+                var = self.sum_sq[1:] / count - mean ** 2
+                result = np.sqrt(np.clip(var, 0, None))
+            elif stat == 'min':
+                result = self.min[1:].copy()
+            elif stat == 'max':
+                result = self.max[1:].copy()
+            elif stat == 'range':
+                result = self.max[1:] - self.min[1:]
+            else:
+                logger.error('Unsupported stat: {}'.format(stat))
+                raise ValueError(stat)
+        result[empty] = np.NaN
+
+        return result
+
+
+def _grid_key(ds):
+    return (tuple(ds.GetGeoTransform()), ds.RasterXSize, ds.RasterYSize,
+            ds.GetProjection())
+
+
+def _objects_layer(gdf):
+    """Write the objects with integer labels (position + 1) to an in
+    memory vector layer to rasterize from."""
+    ri = randint(0, 10000)
+    temp_objs = r'/vsimem/zonal_objs{}.shp'.format(ri)
+    objs = gdf[[gdf.geometry.name]].reset_index(drop=True)
+    objs[LABEL_FLD] = np.arange(1, len(objs) + 1, dtype=np.int32)
+    objs.to_file(temp_objs)
+
+    return temp_objs
+
+
+def zonal_stats_multi(gdf, requests, block_size=1024, all_touched=False):
+    """
+    Compute zonal statistics for the objects in gdf over multiple rasters
+    and bands, reading each raster only once.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        Polygons to compute statistics for, in the same CRS as the rasters.
+    requests : list
+        List of dicts, one per raster band:
+            {'path': raster path, 'band': band number,
+             'stats': list of stats (see ENGINE_STATS),
+             'columns': {stat: output column name}}
+    block_size : int
+        Approximate size in pixels of the blocks read at once.
+    all_touched : bool
+        True to include all pixels touched by a polygon, rather than those
+        whose centers are within it (the rasterstats default).
+
+    Returns
+    -------
+    pd.DataFrame : statistics columns, indexed by gdf index
+    """
+    unsupported = [s for r in requests for s in r['stats']
+                   if s not in ENGINE_STATS]
+    if unsupported:
+        logger.error('Unsupported stats: {}'.format(set(unsupported)))
+        raise ValueError(unsupported)
+
+    num_objs = len(gdf)
+    results = OrderedDict()
+
+    # Group requests by raster grid, so label grids are shared and each
+    # raster is opened once
+    grids = OrderedDict()
+    for r in requests:
+        ds = gdal.Open(str(r['path']))
+        grids.setdefault(_grid_key(ds), []).append(r)
+        ds = None
+
+    temp_objs = _objects_layer(gdf)
+    vect_ds = ogr.Open(temp_objs)
+    vect_lyr = vect_ds.GetLayer()
+
+    for (gt, x_sz, y_sz, prj), grid_requests in grids.items():
+        paths = list(OrderedDict.fromkeys([str(r['path'])
+                                           for r in grid_requests]))
+        logger.info('Computing zonal statistics for {} raster(s) on grid: '
+                    '{}x{}'.format(len(paths), x_sz, y_sz))
+        datasets = {p: gdal.Open(p) for p in paths}
+        accumulators = [ZonalAccumulator(num_objs) for r in grid_requests]
+
+        ref_band = datasets[paths[0]].GetRasterBand(1)
+        pixel_window = bounds2pixel_window(gdf.total_bounds, gt)
+        for xoff, yoff, xsize, ysize in block_windows(ref_band,
+                                                      target_size=block_size,
+                                                      pixel_window=pixel_window):
+            labels = rasterize_window(vect_lyr, gt, prj,
+                                      xoff, yoff, xsize, ysize,
+                                      attribute=LABEL_FLD,
+                                      all_touched=all_touched)
+            in_objs = labels > 0
+            if not in_objs.any():
+                continue
+            block_labels = labels[in_objs]
+            for r, acc in zip(grid_requests, accumulators):
+                band = datasets[str(r['path'])].GetRasterBand(r['band'])
+                arr = band.ReadAsArray(xoff, yoff, xsize, ysize)[in_objs]
+                valid = ~np.isnan(arr) if np.issubdtype(arr.dtype,
+                                                        np.floating) \
+                    else np.ones(arr.shape, dtype=bool)
+                nodata = band.GetNoDataValue()
+                if nodata is not None:
+                    valid &= arr != nodata
+                acc.add(block_labels[valid], arr[valid])
+
+        for r, acc in zip(grid_requests, accumulators):
+            for s in r['stats']:
+                results[r['columns'][s]] = acc.stat(s)
+        datasets = None
+
+    vect_lyr = None
+    vect_ds = None
+    ogr.GetDriverByName('ESRI Shapefile').DeleteDataSource(temp_objs)
+
+    return pd.DataFrame(results, index=gdf.index)
@@ -108,7 +108,7 @@ def rank_dem_pair(density, ovlp_perc, date_diff, doy_diff):
     
     score = ((density_score * 2) + ovlp_perc_score + date_diff_score + doy_score)*2
     
-    return round(score, 2)
+    return np.round(score, 2)
 
 
 def data_selection(aoi_p, out_dir=None,
@@ -160,10 +160,9 @@ def data_selection(aoi_p, out_dir=None,
     #                                                    x[dem_name]), axis=1)
     dems[mtp] = dems.apply(lambda x: get_matchtag_path(x[dem_path]), axis=1)
 
-    #%% Clip matchtags
-    logger.info('Clipping {:,} matchtags to AOI...'.format(len(dems)))
-    dems[mtp_clipped] = clip_rasters(aoi_p, list(dems[mtp]), in_mem=True,
-                                     skip_srs_check=True)
+    # Matchtags are read only within the AOI when computing density, so
+    # are not clipped first
+    dems[mtp_clipped] = dems[mtp]
 
     #%% Rank DEMs - Density
     logger.info('Ranking DEM pairs...')
@@ -182,10 +181,11 @@ def data_selection(aoi_p, out_dir=None,
     # Matchtag density
     logger.debug('Computing matchtag density...')
 
+    aoi_geom = aoi.geometry.unary_union
     combo_densities = []
     for i, row in tqdm(dem_ovlp.iterrows(), total=len(dem_ovlp)):
-        cd = combined_density(row[mtp_clipped1], row[mtp_clipped2], row['inters_geom'],
-                              # clip=True,
+        cd = combined_density(row[mtp_clipped1], row[mtp_clipped2],
+                              row['inters_geom'].intersection(aoi_geom),
                               in_mem_epsg=dem_ovlp.crs.to_epsg())
         combo_densities.append(cd)
     dem_ovlp[combo_dens] = combo_densities
@@ -205,9 +205,10 @@ def data_selection(aoi_p, out_dir=None,
     dem_rankings = copy.deepcopy(dem_ovlp)
     dem_ovlp = None
 
-    dem_rankings[rank] = dem_rankings.apply(
-        lambda x: rank_dem_pair(x[combo_dens], x[ovlp_perc],
-                                x[date_diff], x[doy_diff]), axis=1)
+    dem_rankings[rank] = rank_dem_pair(dem_rankings[combo_dens].values,
+                                       dem_rankings[ovlp_perc].values,
+                                       dem_rankings[date_diff].values,
+                                       dem_rankings[doy_diff].values)
 
     #%% Rank DEMS - Sensor
     #%% Select DEMs
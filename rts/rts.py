@@ -1,5 +1,6 @@
 import argparse
 from datetime import datetime, timedelta
+from functools import partial
 import json
 import numpy as np
 import os
@@ -17,8 +18,10 @@ from archive_analysis.archive_analysis_utils import grid_aoi
 from misc_utils.logging_utils import create_logger, create_logfile_path
 from misc_utils.gpd_utils import read_vec, write_gdf
 from misc_utils.gdal_tools import rasterize_shp2raster_extent
+from misc_utils.pipeline import Pipeline
+from misc_utils.profiler import stage, set_telemetry_path, TELEMETRY_NAME
 from misc_utils.raster_clip import clip_rasters
-from misc_utils.rio_utils import fill_internal_nodata
+from misc_utils.nodata_fill import fill_voids
 from dem_utils.dem_derivatives import gdal_dem_derivative
 from dem_utils.dem_utils import difference_dems
 from dem_utils.wbt_med import wbt_med
@@ -48,6 +51,8 @@ logger = create_logger(__name__, 'sh', 'INFO')
 # External py scripts
 PANSH_PY = r'C:\code\imagery_utils\pgc_pansharpen.py'
 NDVI_PY = r'C:\code\imagery_utils\pgc_ndvi.py'
+# Ruleset used in classification
+CLASSIFY_PY = Path(__file__).parent / 'classify_rts.py'
 
 # Config keys
 seg = 'seg'
@@ -118,10 +123,13 @@ rts_class = 'rts_class'
 grow_seg = 'grow_seg'
 grow_clean = 'grow_clean'
 grow_zs = 'grow_zs'
+grow_class = 'grow_class'
 
 # Constants
 clip_sfx = '_clip'
 clean_sfx = '_cln'
+# Step cache, relative to project directory
+STEP_CACHE = 'rts_steps.json'
 
 
 def get_config(config_file, param=None):
@@ -157,7 +165,10 @@ def main(dem, dem_prev,
          aoi=None,
          image=None,
          pansh_img=None,
-         skip_steps=None,):
+         skip_steps=None,
+         force_steps=None,
+         max_workers=4,
+         dryrun=False):
     # Convert to path objects
     if image is not None:
         image = Path(image)
@@ -224,39 +235,56 @@ def main(dem, dem_prev,
             os.makedirs(d)
     out_vec_fmt = project_config[out_vec_fmt_k]
 
+    # %% Pipeline
+    # Each step is declared with the paths it reads and writes and the config
+    # parameters that affect it. Steps whose inputs and parameters are
+    # unchanged since they were last run are skipped, and steps that do not
+    # depend on each other are run concurrently.
+    if skip_steps is None:
+        skip_steps = []
+    pipeline = Pipeline(project_dir / STEP_CACHE, max_workers=max_workers)
+    # Resources used by each step are recorded in the project directory
+    set_telemetry_path(project_dir / TELEMETRY_NAME)
+
     # %% Imagery Preprocessing
-    logger.info('\n\n***PREPROCESSING***')
     # Pansharpen
     if pansh_img is None:
-        if pan not in skip_steps:
-            logger.info('Pansharpening: {}'.format(image.name))
-            pansh_cmd = '{} {} {} -p {} -d {} -t {} -c {} ' \
-                        '--skip-dem-overlap-check'.format(PANSH_PY,
-                                                          image,
-                                                          PANSH_DIR,
-                                                          EPSG,
-                                                          dem,
-                                                          BITDEPTH,
-                                                          STRETCH)
-            run_subprocess(pansh_cmd)
-
         # Determine output name
         pansh_img = PANSH_DIR / '{}_{}{}{}_pansh.tif'.format(image.stem,
                                                              bitdepth_lut[
                                                                  BITDEPTH],
                                                              STRETCH,
                                                              EPSG)
+        pansh_cmd = '{} {} {} -p {} -d {} -t {} -c {} ' \
+                    '--skip-dem-overlap-check'.format(PANSH_PY,
+                                                      image,
+                                                      PANSH_DIR,
+                                                      EPSG,
+                                                      dem,
+                                                      BITDEPTH,
+                                                      STRETCH)
+
+        def pansharpen():
+            logger.info('Pansharpening: {}'.format(image.name))
+            run_subprocess(pansh_cmd)
+
+        pipeline.add(pan, pansharpen,
+                     inputs=[image, dem], outputs=[pansh_img],
+                     params={'EPSG': EPSG, 'pansharpen': pansh_config})
     else:
         pansh_img = Path(pansh_img)
 
     # NDVI
-    if ndvi not in skip_steps:
-        logger.info('Creating NDVI from: {}'.format(pansh_img.name))
-        ndvi_cmd = '{} {}'.format(NDVI_PY, pansh_img, NDVI_DIR)
-        run_subprocess(ndvi_cmd)
     # Determine NDVI name
     ndvi_img = NDVI_DIR / '{}_ndvi.tif'.format(pansh_img.stem)
     # ndvi_img = NDVI_DIR / '{}_ndvi.tif'.format(image.stem)
+    ndvi_cmd = '{} {}'.format(NDVI_PY, pansh_img, NDVI_DIR)
+
+    def create_ndvi():
+        logger.info('Creating NDVI from: {}'.format(pansh_img.name))
+        run_subprocess(ndvi_cmd)
+
+    pipeline.add(ndvi, create_ndvi, inputs=[pansh_img], outputs=[ndvi_img])
 
     # %% Clip to AOI
     # Organize inputs
@@ -265,213 +293,187 @@ def main(dem, dem_prev,
               dem_k: dem,
               dem_prev_k: dem_prev, }
 
+    def clip_input(k, r, out_path):
+        logger.debug('Clipping input {} to AOI: {}'.format(k, aoi.name))
+        clip_rasters(str(aoi), str(r), out_path=str(out_path),
+                     out_suffix='', skip_srs_check=True)
+
     if aoi:
         logger.info('Clipping inputs to AOI: {}'.format(aoi))
-        for k, r in tqdm(inputs.items()):
-            # out_path = r.parent / '{}{}{}'.format(r.stem, clip_sfx,
-            #                                       r.suffix)
+        for k, r in inputs.items():
             out_path = project_dir / k / '{}{}{}'.format(r.stem,
                                                          clip_sfx,
                                                          r.suffix)
-            if clip_step not in skip_steps:
-                logger.debug(
-                    'Clipping input {} to AOI: {}'.format(k, aoi.name))
-                clip_rasters(str(aoi), str(r), out_path=str(out_path),
-                             out_suffix='', skip_srs_check=True)
+            pipeline.add('clip_{}'.format(k),
+                         partial(clip_input, k, r, out_path),
+                         inputs=[aoi, r], outputs=[out_path],
+                         group=clip_step)
             inputs[k] = out_path
     if fill_nodata:
-        logger.info('Filling internal NoData gaps in sources...')
-        for k, r in tqdm(inputs.items()):
+        for k, r in inputs.items():
             # Only fill image no data
             if k in [img_k, ndvi_k]:
-                filled = inputs[k].parent / '{}_filled{}'.format(inputs[k].stem,
-                                                                 inputs[k].suffix)
-                if fill_step not in skip_steps:
-                    fill_internal_nodata(inputs[k], filled, str(aoi))
+                filled = r.parent / '{}_filled{}'.format(r.stem, r.suffix)
+                pipeline.add('fill_{}'.format(k),
+                             partial(fill_voids, r, filled,
+                                     aoi=str(aoi) if aoi else None),
+                             inputs=[r, aoi], outputs=[filled],
+                             group=fill_step)
                 inputs[k] = filled
 
     # %% EdgeExtraction
     edge_config[img_k] = inputs[img_k]
     edge_config[out_dir] = IMG_DIR
     edge = otb_ee.create_outname(**edge_config)
-    if edge_extraction not in skip_steps:
+
+    def edge_extract():
         logger.info('Creating EdgeExtraction')
         otb_ee.otb_edge_extraction(**edge_config)
+
+    pipeline.add(edge_extraction, edge_extract,
+                 inputs=[inputs[img_k]], outputs=[edge],
+                 params=edge_config)
     inputs[edge_k] = edge
 
     # %% DEM Derivatives
-    if dem_deriv not in skip_steps:
-        # DEM Diff
+    # Each derivative is independent, so they are run concurrently
+    in_dem = Path(inputs[dem_k])
+    diff = DEM_DERIV_DIR / 'dem_diff.tif'
+    slope = DEM_DERIV_DIR / '{}_slope{}'.format(dem.stem, dem.suffix)
+    ruggedness = DEM_DERIV_DIR / '{}_rugged{}'.format(dem.stem, dem.suffix)
+    # Get whitebox output names without running
+    med = wbt_med(in_dem, out_dir=DEM_DERIV_DIR, dryrun=True, **med_config)
+    curvature = wbt_curvature(in_dem, out_dir=DEM_DERIV_DIR, dryrun=True,
+                              **curv_config)
+    sar = wbt_sar(in_dem, out_dir=DEM_DERIV_DIR, dryrun=True)
+    # Divide the CPUs between the WhiteboxTools steps, which may run at
+    # the same time
+    wbt_threads = max(1, (os.cpu_count() or 1) // min(3, max_workers))
+
+    def dem_diff():
         logger.info('Creating DEM Difference...')
         logger.info('DEM1: {}'.format(inputs[dem_k]))
         logger.info('DEM2: {}'.format(inputs[dem_prev_k]))
-        diff = DEM_DERIV_DIR / 'dem_diff.tif'
         difference_dems(str(inputs[dem_k]), str(inputs[dem_prev_k]),
                         out_dem=str(diff))
 
-        # Slope
-        logger.info('Creating slope...')
-        slope = DEM_DERIV_DIR / '{}_slope{}'.format(dem.stem, dem.suffix)
-        gdal_dem_derivative(str(inputs[dem_k]), str(slope), 'slope')
-        # Ruggedness
-        logger.info('Creating ruggedness index...')
-        ruggedness = DEM_DERIV_DIR / '{}_rugged{}'.format(dem.stem, dem.suffix)
-        gdal_dem_derivative(str(inputs[dem_k]), str(ruggedness), 'TRI')
-
-        # MED
-        logger.info('Creating Maximum Elevation Deviation...')
-        med = wbt_med(str(inputs[dem_k]), out_dir=str(DEM_DERIV_DIR),
-                      **med_config)
-
-        # Curvature
-        logger.info('Creating profile curvature...')
-        curvature = wbt_curvature(str(inputs[dem_k]),
-                                  out_dir=str(DEM_DERIV_DIR),
-                                  **curv_config)
-
-        # Surface Area Ratio
-        logger.info('Creating Surface Area Ratio...')
-        sar = wbt_sar(str(inputs[dem_k]), out_dir=str(DEM_DERIV_DIR))
-
-        inputs[med_k] = med
-        inputs[curv_k] = curvature
-        inputs[slope_k] = slope
-        inputs[rugged_k] = ruggedness
-        inputs[diff_k] = diff
-        inputs[sar_k] = sar
-
-    # %% SEGMENTATION PREPROCESSING - Segment, calculate zonal statistics
-    # %%
-    # HEADWALL
-    logger.info('\n\n***HEADWALL***')
-    # Segmentation
-    hw_config[seg][params][img_k] = inputs[img_k]
-    # hw_config[seg][params][out_dir] = HW_DIR
-    hw_seg_out = hw_config[seg][params][out_seg] = str(HW_SEG_GPKG / 'headwall_seg')
-    if hw_config[seg][alg] == grm:
-        logger.info('Segmenting subobjects (headwalls)...')
-        if hw_seg not in skip_steps:
-            hw_objects = otb_grm.otb_grm(drop_smaller=0.5,
-                                         **hw_config[seg][params])
-        else:
-            hw_objects = otb_grm.create_outname(**hw_config[seg][params],
-                                                name_only=True)
-            logger.debug('Using provided headwall segmentation: '
-                         '{}'.format(Path(hw_config[seg][params][out_seg]).relative_to(project_dir)))
-
-    # %% Cleanup
-    # Create path to write cleaned objects to
-    # hw_objects = Path(hw_objects)
-    # cleaned_objects_out = str(hw_objects.parent / '{}{}{}'.format(
-    #     hw_objects.stem, clean_sfx, hw_objects.suffix))
-    cleaned_objects_out = hw_seg_out + '_cleaned'
-
-    if hw_clean not in skip_steps:
-        if hw_config[cleanup][cleanup]:
-            logger.info('Cleaning up subobjects...')
-            cleanup_params = hw_config[cleanup][params]
-            cleanup_params[mask_on] = str(inputs[dem_k])
-            # hw_objects = Path(hw_objects)
-            hw_objects = cleanup_objects(input_objects=hw_seg_out,
-                                         out_objects=cleaned_objects_out,
-                                         **cleanup_params)
-    else:
-        logger.debug('Using provided cleaned headwall objects'
-                     '{}: '.format(Path(cleaned_objects_out).relative_to(project_dir)))
-        # hw_objects = cleaned_objects_out
-
-    # %% Zonal Stats
-    logger.info('Calculating zonal statistics on headwall objects...')
-    # hw_objects_path = Path(hw_objects)
-    # hw_zs_out_path = '{}_zs{}'.format(
-    #     hw_objects_path.parent / hw_objects_path.stem, hw_objects_path.suffix)
-    hw_zs_out = cleaned_objects_out + '_zs'
-
-    if hw_zs not in skip_steps:
-        # Calculate zonal stats
+    pipeline.add(diff_k, dem_diff,
+                 inputs=[inputs[dem_k], inputs[dem_prev_k]], outputs=[diff],
+                 group=dem_deriv)
+    pipeline.add(slope_k,
+                 partial(gdal_dem_derivative, str(in_dem), str(slope),
+                         'slope'),
+                 inputs=[in_dem], outputs=[slope], group=dem_deriv)
+    pipeline.add(rugged_k,
+                 partial(gdal_dem_derivative, str(in_dem), str(ruggedness),
+                         'TRI'),
+                 inputs=[in_dem], outputs=[ruggedness], group=dem_deriv)
+    pipeline.add(med_k,
+                 partial(wbt_med, in_dem, out_dir=DEM_DERIV_DIR,
+                         threads=wbt_threads, **med_config),
+                 inputs=[in_dem], outputs=[med], params=med_config,
+                 group=dem_deriv)
+    pipeline.add(curv_k,
+                 partial(wbt_curvature, in_dem, out_dir=DEM_DERIV_DIR,
+                         threads=wbt_threads, **curv_config),
+                 inputs=[in_dem], outputs=[curvature], params=curv_config,
+                 group=dem_deriv)
+    pipeline.add(sar_k,
+                 partial(wbt_sar, in_dem, out_dir=DEM_DERIV_DIR,
+                         threads=wbt_threads),
+                 inputs=[in_dem], outputs=[sar], group=dem_deriv)
+
+    inputs[med_k] = med
+    inputs[curv_k] = curvature
+    inputs[slope_k] = slope
+    inputs[rugged_k] = ruggedness
+    inputs[diff_k] = diff
+    inputs[sar_k] = sar
+
+    # %% SEGMENTATION PREPROCESSING - Segment, cleanup, calculate zonal
+    # statistics, for each of headwall, RTS and grow objects
+    def zs_rasters(obj_config):
         zonal_stats_inputs = {k: {'path': v,
-                                  'stats': hw_config[zonal_stats][zs_stats]}
+                                  'stats': obj_config[zonal_stats][zs_stats]}
                               for k, v in inputs.items()
-                              if k in hw_config[zonal_stats][zs_rasters]}
-        if bands_k in hw_config[zonal_stats].keys():
-            zonal_stats_inputs[img_k][bands_k] = hw_config[zonal_stats][bands_k]
-        hw_objects = calc_zonal_stats(shp=cleaned_objects_out,
-                                      rasters=zonal_stats_inputs,
-                                      out_path=hw_zs_out)
-    else:
-        logger.debug('Using provided headwall objects with zonal stats: '
-                     '{}'.format(Path(hw_zs_out).relative_to(project_dir)))
-        # hw_objects = hw_zs_out
+                              if k in obj_config[zonal_stats][zs_rasters]}
+        return zonal_stats_inputs
+
+    def add_objects_steps(name, obj_config, seg_out, seg_step, clean_step,
+                          zs_step=None, zs_bands=False):
+        """Add segmentation, cleanup and zonal statistics steps, returning
+        the path to the objects with zonal statistics."""
+        obj_config[seg][params][img_k] = inputs[img_k]
+        obj_config[seg][params][out_seg] = seg_out
+        if obj_config[seg][alg] == grm:
+            def segment():
+                logger.info('Segmenting {} objects...'.format(name))
+                otb_grm.otb_grm(drop_smaller=0.5, **obj_config[seg][params])
+
+            pipeline.add(seg_step, segment,
+                         inputs=[inputs[img_k]], outputs=[seg_out],
+                         params=obj_config[seg])
+
+        # Cleanup
+        cleaned_objects_out = seg_out + '_cleaned'
+        if obj_config[cleanup][cleanup]:
+            cleanup_params = obj_config[cleanup][params]
+            cleanup_params[mask_on] = str(inputs[dem_k])
+
+            def clean():
+                logger.info('Cleaning up {} objects...'.format(name))
+                cleanup_objects(input_objects=seg_out,
+                                out_objects=cleaned_objects_out,
+                                **cleanup_params)
+
+            pipeline.add(clean_step, clean,
+                         inputs=[seg_out, inputs[dem_k]],
+                         outputs=[cleaned_objects_out],
+                         params=obj_config[cleanup])
+
+        if zs_step is None:
+            return cleaned_objects_out
 
-    # %%
+        # Zonal Stats
+        zs_out = cleaned_objects_out + '_zs'
+        zonal_stats_inputs = zs_rasters(obj_config)
+        if zs_bands and bands_k in obj_config[zonal_stats].keys():
+            zonal_stats_inputs[img_k][bands_k] = obj_config[zonal_stats][bands_k]
+
+        def zs():
+            logger.info('Calculating zonal statistics on {} '
+                        'objects...'.format(name))
+            calc_zonal_stats(shp=cleaned_objects_out,
+                             rasters=zonal_stats_inputs,
+                             out_path=zs_out)
+
+        pipeline.add(zs_step, zs,
+                     inputs=[cleaned_objects_out] +
+                            [v['path'] for v in zonal_stats_inputs.values()],
+                     outputs=[zs_out],
+                     params=obj_config[zonal_stats])
+
+        return zs_out
+
+    # HEADWALL
+    hw_zs_out = add_objects_steps('headwall', hw_config,
+                                  seg_out=str(HW_SEG_GPKG / 'headwall_seg'),
+                                  seg_step=hw_seg, clean_step=hw_clean,
+                                  zs_step=hw_zs, zs_bands=True)
     # RTS
-    logger.info('\n\n***RTS***')
-    # Naming
-    rts_config[seg][params][img_k] = inputs[img_k]
-    # rts_config[seg][params][out_dir] = RTS_DIR
-    rts_seg_out = rts_config[seg][params][out_seg] = str(RTS_SEG_GPKG / 'rts_seg')
-
-    # Segmentation
-    if rts_config[seg][alg] == grm:
-        logger.info('Segmenting superobjects (RTS)...')
-        if rts_seg not in skip_steps:
-            rts_objects = otb_grm.otb_grm(drop_smaller=0.5,
-                                          **rts_config[seg][params])
-        else:
-            # rts_objects = otb_grm.create_outname(**rts_config[seg][params],
-            #                              name_only=True)
-            logger.debug('Using provided RTS seg: '
-                         '{}'.format(Path(rts_config[seg][params][out_seg]).relative_to(project_dir)))
-        # rts_objects = Path(rts_objects)
-
-    # %% Cleanup
-    # cleaned_objects_out = str(rts_objects.parent / '{}_cln{}'.format(
-    #     rts_objects.stem, rts_objects.suffix))
-    cleaned_objects_out = rts_seg_out + '_cleaned'
-
-    if rts_clean not in skip_steps:
-        if rts_config[cleanup][cleanup]:
-            logger.info('Cleaning up objects...')
-            cleanup_params = rts_config[cleanup][params]
-            cleanup_params[mask_on] = str(inputs[dem_k])
-            # rts_objects = Path(rts_objects)
-            rts_objects = cleanup_objects(input_objects=rts_seg_out,
-                                          out_objects=cleaned_objects_out,
-                                          **cleanup_params)
-    else:
-        logger.debug('Using provided cleaned RTS objects: '
-                     '{}'.format(Path(cleaned_objects_out).relative_to(project_dir)))
-        # rts_objects = cleaned_objects_out
-
-    # %% Zonal Stats
-    logger.info('Calculating zonal statistics on super objects...')
-    # rts_objects_path = Path(rts_objects)
-    # rts_zs_out_path = '{}_zs{}'.format(rts_objects_path.parent /
-    #                                    rts_objects_path.stem,
-    #                                    rts_objects_path.suffix)
-    rts_zs_out = cleaned_objects_out + '_zs'
-
-    if rts_zs not in skip_steps:
-        # Calculate zonal_stats
-        zonal_stats_inputs = {k: {'path': v,
-                                  'stats': rts_config[zonal_stats][zs_stats]}
-                              for k, v in inputs.items()
-                              if k in rts_config[zonal_stats][zs_rasters]}
-        rts_objects = calc_zonal_stats(shp=cleaned_objects_out,
-                                       rasters=zonal_stats_inputs,
-                                       out_path=rts_zs_out)
-    else:
-        logger.debug('Using provided RTS zonal stats objects: '
-                     '{}'.format(Path(rts_zs_out).relative_to(project_dir)))
-        # rts_objects = rts_zs_out_path
+    rts_zs_out = add_objects_steps('RTS', rts_config,
+                                   seg_out=str(RTS_SEG_GPKG / 'rts_seg'),
+                                   seg_step=rts_seg, clean_step=rts_clean,
+                                   zs_step=rts_zs)
 
     # %% CLASSIFICATION
+    hw_class_out = None
+    hw_class_out_centroid = None
+    rts_predis_out = None
+    rts_class_out = None
     if hw_config[classification_k][hw_class_out_k]:
-        # hw_class_out = CLASS_DIR / '{}{}'.format(hw_class_out_k, out_vec_fmt)
         hw_class_out = CLASS_GPKG / 'headwalls'
     if hw_config[classification_k][hw_class_out_cent_k]:
-        # hw_class_out_centroid = CLASS_DIR / '{}_cent{}'.format(hw_class_out_k,
-        #                                                        out_vec_fmt)
         hw_class_out_centroid = CLASS_GPKG / 'headwall_centers'
 
     # Pass path to classified headwall objects if using previously classified
@@ -481,121 +483,102 @@ def main(dem, dem_prev,
         hw_candidates_in = None
 
     if rts_config[classification_k][rts_predis_out_k]:
-        # rts_predis_out = CLASS_DIR / '{}{}'.format(rts_predis_out_k, out_vec_fmt)
         rts_predis_out = CLASS_GPKG / 'rts_predissolve'
     if rts_config[classification_k][rts_class_out_k]:
-        # rts_class_out = CLASS_DIR / '{}{}'.format(rts_class_out_k, out_vec_fmt)
         rts_class_out = CLASS_GPKG / 'rts_candidates'
 
-    if rts_class not in skip_steps:
+    def classify():
         logger.info('Classifying RTS...')
-        rts_objects = classify_rts(
-                        sub_objects_path=hw_zs_out,
-                        super_objects_path=rts_zs_out,
-                        headwall_candidates_out=hw_class_out,
-                        headwall_candidates_centroid_out=hw_class_out_centroid,
-                        rts_predis_out=rts_predis_out,
-                        rts_candidates_out=rts_class_out,
-                        aoi_path=None,
-                        headwall_candidates_in=hw_candidates_in,
-                        aoi=aoi)
-    else:
-        logger.debug('Using provided classified RTS objects: '
-                     '{}'.format(Path(rts_class_out).relative_to(project_dir)))
-        rts_objects = rts_class_out
+        classify_rts(sub_objects_path=hw_zs_out,
+                     super_objects_path=rts_zs_out,
+                     headwall_candidates_out=hw_class_out,
+                     headwall_candidates_centroid_out=hw_class_out_centroid,
+                     rts_predis_out=rts_predis_out,
+                     rts_candidates_out=rts_class_out,
+                     aoi_path=None,
+                     headwall_candidates_in=hw_candidates_in,
+                     aoi=aoi)
+
+    # The ruleset is defined in classify_rts, so changes to it rerun
+    # classification
+    class_inputs = [hw_zs_out, rts_zs_out, CLASSIFY_PY]
+    if hw_candidates_in is not None:
+        class_inputs.append(hw_candidates_in)
+    pipeline.add(rts_class, classify,
+                 inputs=class_inputs,
+                 outputs=[o for o in [hw_class_out, hw_class_out_centroid,
+                                      rts_predis_out, rts_class_out]
+                          if o is not None and o != hw_candidates_in],
+                 params={'headwall': hw_config[classification_k],
+                         'rts': rts_config[classification_k],
+                         'aoi': aoi})
 
     #%% GROW OBJECTS
-    logger.info('\n\n***GROWING***')
-    logger.info('Creating grow subobjects..')
-    # Segment AOI into simple grow
-    grow_config[seg][params][img_k] = inputs[img_k]
-    # grow_config[seg][params][out_dir] = GROW_DIR
-    grow_seg_out = grow_config[seg][params][out_seg] = str(GROW_SEG_GPKG / 'grow')
-
-    if grow_seg not in skip_steps:
-        grow = otb_grm.otb_grm(drop_smaller=0.5,
-                               **grow_config[seg][params])
-    else:
-        grow = otb_grm.create_outname(**grow_config[seg][params], name_only=True)
-        logger.debug('Using provided grow objects: '
-                     '{}'.format(Path(grow).relative_to(project_dir)))
-
-    # Cleanup
-    # grow = Path(grow)
-    # cleaned_grow = str(grow.parent / '{}_cln{}'.format(grow.stem, grow.suffix))
-    cleaned_grow_out = grow_config[seg][params][out_seg] + '_cleaned'
-
-    if grow_clean not in skip_steps:
-        if grow_config[cleanup][cleanup]:
-            logger.info('Cleaning up objects...')
-            cleanup_params = grow_config[cleanup][params]
-            cleanup_params[mask_on] = str(inputs[dem_k])
-            cleaned_grow = cleanup_objects(input_objects=grow_seg_out,
-                                           out_objects=cleaned_grow_out,
-                                           **cleanup_params)
-
+    cleaned_grow_out = add_objects_steps('grow', grow_config,
+                                         seg_out=str(GROW_SEG_GPKG / 'grow'),
+                                         seg_step=grow_seg,
+                                         clean_step=grow_clean)
     grow_zs_out = cleaned_grow_out + '_zs'
-    if grow_zs not in skip_steps:
+    merged_out = GROW_SEG_GPKG / 'merged'
+    grow_zs_inputs = zs_rasters(grow_config)
+
+    def grow_zs_step():
         logger.info('Merging RTS candidates into grow objects...')
         # Load small objects
         logger.debug(cleaned_grow_out)
-        # so = gpd.read_file(cleaned_grow_out)
         so = read_vec(cleaned_grow_out)
 
         # Burn rts in, including class name
-        logger.debug(rts_objects)
-        # r = gpd.read_file(rts_objects)
-        r = read_vec(rts_objects)
+        logger.debug(rts_class_out)
+        r = read_vec(rts_class_out)
         r = r[r[class_fld] == rts_candidate][[class_fld, r.geometry.name]]
 
         # Erase subobjects under RTS candidates
         diff = gpd.overlay(so, r, how='difference')
         # Merge RTS candidates back in
         merged = pd.concat([diff, r])
-        # merged_out = SEG_DIR / GROW_DIR / 'merged.shp'
-        merged_out = GROW_SEG_GPKG / 'merged'
         write_gdf(merged, merged_out)
 
         # Zonal Stats
-        zonal_stats_inputs = {k: {'path': v,
-                                  'stats': grow_config[zonal_stats][zs_stats]}
-                              for k, v in inputs.items()
-                              if k in grow_config[zonal_stats][zs_rasters]}
-
         logger.info('Calculating zonal statistics on grow objects...')
         logger.debug('Computing zonal statistics on: '
-                     '{}'.format(zonal_stats_inputs.keys()))
-        grow = calc_zonal_stats(shp=merged_out,
-                                rasters=zonal_stats_inputs,
-                                out_path=str(grow_zs_out))
+                     '{}'.format(grow_zs_inputs.keys()))
+        calc_zonal_stats(shp=merged_out,
+                         rasters=grow_zs_inputs,
+                         out_path=str(grow_zs_out))
+
+    pipeline.add(grow_zs, grow_zs_step,
+                 inputs=[cleaned_grow_out, rts_class_out] +
+                        [v['path'] for v in grow_zs_inputs.values()],
+                 outputs=[merged_out, grow_zs_out],
+                 params=grow_config[zonal_stats])
 
     # Do growing
-    logger.info('Growing RTS objects into subobjects...')
-
-    # Grow from rts
-    # grow_objects = ImageObjects(grow_zs_out_path,
-    #                             value_fields=zonal_stats_inputs)
-    # # TODO: Remove after converting to use gpkg. This is just because of the
-    # #  shapefile field size limit
-    # grow_objects.objects.rename(columns={'ruggedness': 'ruggedness_mean'},
-    #                             inplace=True)
-    #
-    # rts_objects = ImageObjects(rts_objects)
-    # grown = grow_rts_candidates(rts_objects, grow_objects)
+    grow_candidates_out = CLASS_GPKG / 'grow_candidates'
+    rts_classified = CLASS_GPKG / 'RTS'
 
-    grown, grow_candidates = grow_rts_simple(grow_zs_out)
+    def grow_step():
+        logger.info('Growing RTS objects into subobjects...')
+        grown, grow_candidates = grow_rts_simple(grow_zs_out)
 
-    grow_candidates_out = CLASS_GPKG / 'grow_candidates'
-    # logger.info('Writing grow objects to file: {}'.format(CLASS_DIR / 'grow_candidates.shp'))
-    logger.info('Writing grow objects to file: {}'.format(grow_candidates_out))
-    write_gdf(grow_candidates.objects, grow_candidates_out)
+        logger.info('Writing grow objects to file: '
+                    '{}'.format(grow_candidates_out))
+        write_gdf(grow_candidates.objects, grow_candidates_out)
 
-    # n = datetime.now().strftime('%Y%b%d_%H%M%S').lower()
+        logger.info('Writing classfied RTS features: '
+                    '{}'.format(rts_classified))
+        write_gdf(grown, rts_classified)
 
-    # rts_classified = CLASS_DIR / 'RTS.shp'
-    rts_classified = CLASS_GPKG / 'RTS'
-    logger.info('Writing classfied RTS features: {}'.format(rts_classified))
-    write_gdf(grown, rts_classified)
+    pipeline.add(grow_class, grow_step,
+                 inputs=[grow_zs_out, CLASSIFY_PY],
+                 outputs=[grow_candidates_out, rts_classified])
+
+    # %% Run
+    with stage('rts', dem=dem.name, dryrun=dryrun):
+        status = pipeline.run(skip=skip_steps, force=force_steps,
+                              dryrun=dryrun)
+    logger.info('Steps run: {}'.format(
+        ', '.join([s for s, st in status.items() if st == 'ran'])))
 
     logger.info('Done')
 
@@ -606,7 +589,8 @@ if __name__ == '__main__':
                            edge_extraction, clip_step,
                            hw_seg, hw_clean, hw_zs, hw_class,
                            rts_seg, rts_clean, rts_zs, rts_class,
-                           grow_seg, grow_clean, grow_zs]
+                           grow_seg, grow_clean, grow_zs, grow_class,
+                           diff_k, slope_k, rugged_k, med_k, curv_k, sar_k]
 
     parser = argparse.ArgumentParser()
 
@@ -632,7 +616,19 @@ if __name__ == '__main__':
     parser.add_argument('--skip_steps', nargs='+',
                         choices=ARGDEF_SKIP_CHOICES,
                         help='Skip these steps, paths to intermediate layers '
-                             'must exist as computed by previous steps.')
+                             'must exist as computed by previous steps. Steps '
+                             'whose inputs and parameters have not changed '
+                             'since they were last run are skipped '
+                             'automatically.')
+    parser.add_argument('--force_steps', nargs='+',
+                        choices=ARGDEF_SKIP_CHOICES,
+                        help='Run these steps even if their inputs and '
+                             'parameters have not changed.')
+    parser.add_argument('--max_workers', type=int, default=4,
+                        help='Maximum number of independent steps to run '
+                             'concurrently.')
+    parser.add_argument('--dryrun', action='store_true',
+                        help='Print the order steps will be run in.')
     parser.add_argument('--logdir', type=os.path.abspath)
 
     # prj_dir = r'E:\disbr007\umn\accuracy_assessment'
@@ -747,6 +743,9 @@ if __name__ == '__main__':
     config = args.config
     pansh_img = args.pansharpened_img
     skip_steps = args.skip_steps
+    force_steps = args.force_steps
+    max_workers = args.max_workers
+    dryrun = args.dryrun
     logdir = args.logdir
 
     if logdir:
@@ -786,7 +785,10 @@ if __name__ == '__main__':
          aoi=aoi,
          config=config,
          pansh_img=pansh_img,
-         skip_steps=skip_steps)
+         skip_steps=skip_steps,
+         force_steps=force_steps,
+         max_workers=max_workers,
+         dryrun=dryrun)
     end = datetime.now()
 
     runtime = end - start
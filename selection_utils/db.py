@@ -1,3 +1,4 @@
+import io
 import json
 import re
 import os
@@ -5,15 +6,17 @@ from pathlib import Path
 import sys
 import time
 
-from sqlalchemy import create_engine
 from tqdm import tqdm
 import psycopg2
 from psycopg2 import sql
 import pandas as pd
 import geopandas as gpd
 import shapely
+from shapely import wkb
 
 from misc_utils.logging_utils import create_logger
+from selection_utils.db_session import db_url, get_engine, list_tables, \
+    read_sql, read_sql_chunks, CHUNKSIZE
 
 # Supress pandas SettingWithCopyWarning
 pd.set_option('mode.chained_assignment', None)
@@ -266,10 +269,10 @@ class Postgres(object):
         self.db_config = self.db_params["db_config"]
         self.tables_config = self.db_params["tables"]
 
-        self.host = db_config['host']
-        self.database = db_config['database']
-        self.user = db_config['user']
-        self.password = db_config['password']
+        self.host = self.db_config['host']
+        self.database = self.db_config['database']
+        self.user = self.db_config['user']
+        self.password = self.db_config['password']
         self._connection = None
         self._cursor = None
 
@@ -319,8 +322,11 @@ class Postgres(object):
 
         return self._cursor
 
-    def list_db_tables(self):
-        """List all tables in the database."""
+    def list_db_tables(self, refresh=False):
+        """List all tables in the database. The listing is cached for the
+        process, use refresh=True to list again."""
+        if not refresh:
+            return list_tables(self.get_engine())
         logger.debug('Listing tables...')
         tables_sql = sql.SQL("""SELECT table_schema as schema_name,
                                        table_name as view_name
@@ -353,6 +359,8 @@ class Postgres(object):
 
         tables = [x[1] for x in tables]
         tables = sorted(tables)
+        # Update cached listing
+        list_tables(self.get_engine(), refresh=True)
 
         return tables
 
@@ -419,75 +427,106 @@ class Postgres(object):
         return values
 
     def get_engine(self):
-        """Create sqlalchemy.engine object."""
-        engine = create_engine('postgresql+psycopg2://'
-                               '{}:{}@{}/{}'.format(self.user, self.password,
-                                                    self.host, self.database))
+        """Get the sqlalchemy.engine object for this database, shared by
+        all Postgres objects in the process, with a pool of connections."""
+        engine = get_engine(db_url(host=self.host, database=self.database,
+                                   user=self.user, password=self.password))
 
         return engine
 
+    def _sql_str(self, sql_str):
+        if isinstance(sql_str, (sql.Composed, sql.Composable)):
+            sql_str = sql_str.as_string(self.connection)
+
+        return sql_str
+
     def sql2gdf(self, sql_str, geom_col='geometry', crs=4326,):
         """Get a GeoDataFrame from a passed SQL query"""
-        gdf = gpd.GeoDataFrame.from_postgis(sql=sql_str,
-                                            con=self.get_engine().connect(),
-                                            geom_col=geom_col, crs=crs)
+        gdf = read_sql(self._sql_str(sql_str), self.get_engine(),
+                       geom_col=geom_col, crs=crs)
         return gdf
 
     def sql2df(self, sql_str, columns=None):
         """Get a DataFrame from a passed SQL query"""
-        if isinstance(sql_str, sql.Composed):
-            sql_str = sql_str.as_string(self.cursor)
         if isinstance(columns, str):
             columns = [columns]
 
-        df = pd.read_sql(sql=sql_str, con=self.get_engine().connect(),
-                         columns=columns)
+        df = read_sql(self._sql_str(sql_str), self.get_engine(),
+                      columns=columns)
 
         return df
 
-    def insert_new_records(self, records, table, dryrun=False):
+    def sql2gdf_chunks(self, sql_str, geom_col='geometry', crs=4326,
+                       chunksize=CHUNKSIZE):
+        """Stream GeoDataFrames of chunksize rows from a passed SQL query,
+        using a server-side cursor."""
+        return read_sql_chunks(self._sql_str(sql_str), self.get_engine(),
+                               chunksize=chunksize, geom_col=geom_col,
+                               crs=crs)
+
+    def sql2df_chunks(self, sql_str, chunksize=CHUNKSIZE):
+        """Stream DataFrames of chunksize rows from a passed SQL query,
+        using a server-side cursor."""
+        return read_sql_chunks(self._sql_str(sql_str), self.get_engine(),
+                               chunksize=chunksize)
+
+    def _copy_records(self, records, staging, geom_cols, srid,
+                      chunksize=CHUNKSIZE):
+        """Stream records into the staging table with COPY, in chunks of
+        chunksize rows, with geometries as hex EWKB."""
+        columns = sql.SQL(', ').join([sql.Identifier(c)
+                                      for c in records.columns])
+        copy_sql = sql.SQL("COPY {staging} ({columns}) FROM STDIN "
+                           "WITH (FORMAT csv, NULL '\\N')").format(
+            staging=staging, columns=columns).as_string(self.connection)
+        for start in tqdm(range(0, len(records), chunksize),
+                          desc='Copying records'):
+            chunk = pd.DataFrame(records.iloc[start:start + chunksize])
+            for gc in geom_cols:
+                chunk[gc] = [wkb.dumps(g, hex=True, srid=srid)
+                             if g is not None else None
+                             for g in chunk[gc]]
+            buffer = io.StringIO()
+            chunk.to_csv(buffer, index=False, header=False, na_rep='\\N')
+            buffer.seek(0)
+            self.cursor.copy_expert(copy_sql, buffer)
+
+    def insert_new_records(self, records, table, dryrun=False,
+                           chunksize=CHUNKSIZE):
         """
-        Add records to table, converting data types as necessary for INSERT.
-        Optionally using a unique_id (or combination of columns) to skip
-        duplicates.
+        Add records to table, skipping any that duplicate a unique_id (or
+        combination of columns) in the table or in records. Records are
+        streamed with COPY into a temporary staging table and inserted into
+        table with a single INSERT, all in one transaction, so either all new
+        records are added or none are.
         records : pd.DataFrame / gpd.GeoDataFrame
             DataFrame containing rows to be inserted to table
         table : str
             Name of table to be inserted into
+        dryrun : bool
+            True to load the staging table and report the number of new
+            records, then roll back without changing table.
+        chunksize : int
+            Number of records sent per COPY.
         """
         # TODO: Create overwrite scenes option that removes any scenes in the
         #  input from the DB before writing them
 
-        def _row_columns_unique(row, unique_on, values):
-            """Determines if row has combination of columns in unique_on that
-            are in values.
-            Parameters
-            ----------
-            row : pd.Series
-                Table row to be inserted
-            unique_on : list / tuple
-                Column names that when combined indicate a unique row
-            values : list / tuple
-                Values to check row against
-            Returns
-            -------
-            bool
-            """
-            if isinstance(unique_on, str):
-                unique_on = [unique_on]
-            row_values = [row[c] for c in unique_on]
-            if len(row_values) > 1:
-                row_values = tuple(row_values)
-            else:
-                row_values = row_values[0]
-
-            return row_values in values
-
         # Check that records is not empty
         if len(records) == 0:
             logger.warning('No records to be added.')
             return
 
+        # Check records can be loaded before starting a transaction
+        geom_cols = get_geometry_cols(records)
+        srid = None
+        if geom_cols:
+            if getattr(records, 'crs', None) is None:
+                logger.error('Records with geometry must have a CRS to '
+                             'insert into {}.{}'.format(self.database, table))
+                raise ValueError('Records have no CRS.')
+            srid = records.crs.to_epsg()
+
         # Check if table exists, get table starting count, unique constraint
         logger.info('Inserting records into {}...'.format(table))
         if table in self.list_db_tables():
@@ -498,119 +537,73 @@ class Postgres(object):
             logger.warning('Table "{}" not found in database "{}", '
                            'exiting.'.format(table, self.database))
             sys.exit()
-
-        # Get unique IDs to remove duplicates if provided
-        if table in self.list_db_tables() and unique_on is not None:
-            # Remove duplicate values from rows to insert based on unique_on
-            # columns
-            existing_ids = self.get_values(table=table, columns=unique_on,
-                                           distinct=True)
-            logger.debug('Removing any existing IDs from search results...')
-            logger.debug('Existing unique IDs in table "{}": '
-                         '{:,}'.format(table, len(existing_ids)))
-
-            # Remove dups
-            starting_count = len(records)
-            records = records[~records.apply(lambda x: _row_columns_unique(
-                x, unique_on, existing_ids), axis=1)]
-            if len(records) != starting_count:
-                logger.info('Duplicates removed: {}'.format(starting_count -
-                                                            len(records)))
-        logger.info('IDs to add: {:,}'.format(len(records)))
-        if len(records) == 0:
-            logger.info('No new records, skipping indexing.')
-            return
-
-        geom_cols = get_geometry_cols(records)
-        if geom_cols:
-            # Get epsg code
-            srid = records.crs.to_epsg()
-        else:
-            geom_cols = []
-
-        # Insert new records
-        if len(records) != 0:
-            logger.info('Writing new records to {}.{}: '
-                        '{:,}'.format(self.database, table, len(records)))
-
-            for i, row in tqdm(records.iterrows(),
-                               desc='Adding new records to: {}'.format(table),
-                               total=len(records)):
-                if dryrun:
-                    if i == 0:
-                        logger.info('-dryrun-')
-                    continue
-
-                # Format the INSERT query
-                columns = [sql.Identifier(c) for c in row.index if c not in
-                           geom_cols]
-                if geom_cols:
-                    for gc in geom_cols:
-                        columns.append(sql.Identifier(gc))
-                # Create INSERT statement, parenthesis left open intentionally
-                # to accommodate adding geometry statements, e.g.:
-                # "ST_GeomFromText(..)"
-                # paranthesis, closed in else block if no geometry columns
-                insert_statement = sql.SQL(
-                    "INSERT INTO {table} ({columns}) VALUES ({values}").format(
-                    table=sql.Identifier(table),
-                    columns=sql.SQL(', ').join(columns),
-                    values=sql.SQL(', ').join([sql.Placeholder(f)
-                                               for f in row.index
-                                               if f not in geom_cols]),
-                )
-                if geom_cols:
-                    geom_statements = [sql.SQL(', ')]
-                    for i, gc in enumerate(geom_cols):
-                        if i != len(geom_cols) - 1:
-                            geom_statements.append(
-                                sql.SQL(
-                                    " ST_GeomFromText({gc}, {srid}),").format(
-                                    gc=sql.Placeholder(gc),
-                                    srid=sql.Literal(srid)))
-                        else:
-                            geom_statements.append(
-                                sql.SQL(
-                                    " ST_GeomFromText({gc}, {srid}))").format(
-                                    gc=sql.Placeholder(gc),
-                                    srid=sql.Literal(srid)))
-                    geom_statement = sql.Composed(geom_statements)
-                    insert_statement = insert_statement + geom_statement
-                else:
-                    # Close paranthesis that was left open for geometries
-                    insert_statement = sql.SQL("{statement})").format(
-                        statement=insert_statement)
-
-                values = {f: row[f] if f not in geom_cols
-                          else row[f].wkt for f in row.index}
-
-                # Make the INSERT
-                with self.cursor as cursor:
-                    try:
-                        cursor.execute(self.cursor.mogrify(insert_statement,
-                                                           values))
-                        self.connection.commit()
-                    except Exception as e:
-                        if e == psycopg2.errors.UniqueViolation:
-                            logger.warning('Skipping due to unique violation '
-                                           'for scene: '
-                                           '{}'.format(row[unique_on]))
-                            logger.warning(e)
-                            self.connection.rollback()
-                        elif e == psycopg2.errors.IntegrityError:
-                            logger.warning('Skipping due to integrity error '
-                                           'for scene: '
-                                           '{}'.format(row[unique_on]))
-                            logger.warning(e)
-                            self.connection.rollback()
-                        else:
-                            logger.debug('Error on statement: {}'.format(
-                                f"{str(self.cursor.mogrify(insert_statement, values))}"))
-                            logger.error(e)
-                            self.connection.rollback()
+        if isinstance(unique_on, str):
+            unique_on = [unique_on]
+
+        table_id = sql.Identifier(table)
+        staging = sql.Identifier('{}_staging'.format(table))
+        columns = sql.SQL(', ').join([sql.Identifier(c)
+                                      for c in records.columns])
+        staging_columns = sql.SQL(', ').join([sql.Identifier('s', c)
+                                              for c in records.columns])
+        if unique_on is None:
+            select = sql.SQL("SELECT {columns} FROM {staging} s").format(
+                columns=staging_columns, staging=staging)
         else:
-            logger.info('No new records to be written.')
-            
+            # Drop duplicates within records and those already in table
+            select = sql.SQL(
+                "SELECT DISTINCT ON ({unique_cols}) {columns} "
+                "FROM {staging} s WHERE NOT EXISTS ("
+                "SELECT 1 FROM {table} t WHERE {match})").format(
+                unique_cols=sql.SQL(', ').join([sql.Identifier('s', c)
+                                                for c in unique_on]),
+                columns=staging_columns,
+                staging=staging,
+                table=table_id,
+                match=sql.SQL(' AND ').join([
+                    sql.SQL("t.{c} = s.{c}").format(c=sql.Identifier(c))
+                    for c in unique_on]))
+        insert_sql = sql.SQL(
+            "INSERT INTO {table} ({columns}) {select} "
+            "ON CONFLICT DO NOTHING").format(table=table_id, columns=columns,
+                                             select=select)
+
+        logger.info('Loading {:,} records into staging table for '
+                    '{}.{}'.format(len(records), self.database, table))
+        try:
+            # Staging table with the column types of table but none of its
+            # constraints, dropped at the end of the transaction
+            self.cursor.execute(sql.SQL(
+                "CREATE TEMP TABLE {staging} ON COMMIT DROP AS "
+                "SELECT {columns} FROM {table} WITH NO DATA").format(
+                staging=staging, columns=columns, table=table_id))
+            self._copy_records(records, staging, geom_cols=geom_cols,
+                               srid=srid, chunksize=chunksize)
+            logger.debug('Insert sql: {}'.format(
+                insert_sql.as_string(self.connection)))
+            self.cursor.execute(insert_sql)
+            inserted = self.cursor.rowcount
+            if len(records) != inserted:
+                logger.info('Duplicates skipped: '
+                            '{:,}'.format(len(records) - inserted))
+            if dryrun:
+                logger.info('-dryrun-')
+                logger.info('New records that would be written to {}.{}: '
+                            '{:,}'.format(self.database, table, inserted))
+                self.connection.rollback()
+                return
+            self.connection.commit()
+        except Exception as e:
+            # Any error, including preparing records for COPY, leaves the
+            # transaction (and staging table) open on the shared connection
+            logger.error('Error inserting records into {}.{}, no records '
+                         'were written.'.format(self.database, table))
+            logger.error(e)
+            self.connection.rollback()
+            raise e
+
+        logger.info('New records written to {}.{}: '
+                    '{:,}'.format(self.database, table, inserted))
         logger.info('New count for {}.{}: '
                     '{:,}'.format(self.database, table,
                                   self.get_table_count(table)))
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide database session layer. SQLAlchemy engines (and their
+connection pools) are created once per database URL and process and
+reused, table listings are cached per database, and large results can be
+streamed in chunks through server-side cursors rather than paged with
+LIMIT/OFFSET. Works with Postgres/PostGIS and with SQLite (e.g. for tests).
+"""
+import os
+import threading
+
+import geopandas as gpd
+import pandas as pd
+from shapely import wkb
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine.url import URL
+
+from misc_utils.logging_utils import create_logger
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+POSTGRES_DRIVER = 'postgresql+psycopg2'
+# Default pool settings, change with configure_pool()
+POOL_DEFAULTS = {'pool_size': 5,
+                 'max_overflow': 10,
+                 'pool_recycle': 3600,
+                 'pool_pre_ping': True}
+CHUNKSIZE = 50_000
+
+_pool_config = dict(POOL_DEFAULTS)
+_engines = {}
+_tables = {}
+_lock = threading.Lock()
+
+
+def db_url(host, database, user=None, password=None,
+           drivername=POSTGRES_DRIVER, port=None):
+    """Create a database URL from connection parameters."""
+    return str(URL(drivername, username=user, password=password, host=host,
+                   port=port, database=database))
+
+
+def configure_pool(**kwargs):
+    """
+    Set the pool arguments (create_engine keyword arguments, e.g. pool_size,
+    max_overflow, poolclass) used for engines created after this call. Call
+    with no arguments to restore the defaults.
+    """
+    with _lock:
+        _pool_config.clear()
+        _pool_config.update(POOL_DEFAULTS if not kwargs else kwargs)
+
+
+def get_engine(url, **kwargs):
+    """
+    Get the engine for url, creating it on first use in this process.
+    Engines are not shared with forked processes, as pooled connections
+    cannot be shared between processes.
+
+    Parameters
+    ----------
+    url : str
+        Database URL, see db_url.
+    kwargs : dict
+        Additional create_engine arguments, overriding the pool
+        configuration. Only used when the engine is created.
+
+    Returns
+    -------
+    sqlalchemy.engine.Engine
+    """
+    key = (str(url), os.getpid())
+    with _lock:
+        engine = _engines.get(key)
+        if engine is None:
+            if str(url).startswith('postgresql'):
+                engine_kwargs = dict(_pool_config)
+            else:
+                # SQLite etc. use their dialect's default pool
+                engine_kwargs = {}
+            engine_kwargs.update(kwargs)
+            engine = create_engine(url, **engine_kwargs)
+            _engines[key] = engine
+            logger.debug('Created engine for: {}'.format(engine.url))
+
+    return engine
+
+
+def dispose_engines():
+    """Close all pooled connections of the engines in this process."""
+    with _lock:
+        for (url, pid), engine in list(_engines.items()):
+            if pid == os.getpid():
+                engine.dispose()
+            del _engines[(url, pid)]
+        _tables.clear()
+
+
+def list_tables(engine, refresh=False):
+    """
+    Sorted list of the tables, views and (Postgres) materialized views in
+    the database. Listings are cached per database, use refresh=True after
+    creating or dropping tables.
+    """
+    key = str(engine.url)
+    with _lock:
+        tables = _tables.get(key)
+    if tables is None or refresh:
+        logger.debug('Listing tables: {}'.format(engine.url.database))
+        insp = inspect(engine)
+        schemas = [s for s in insp.get_schema_names()
+                   if s not in ('information_schema', 'pg_catalog')]
+        if not schemas:
+            schemas = [None]
+        tables = []
+        for schema in schemas:
+            tables.extend(insp.get_table_names(schema=schema))
+            tables.extend(insp.get_view_names(schema=schema))
+        if engine.dialect.name == 'postgresql':
+            with engine.connect() as con:
+                tables.extend([r[0] for r in con.execute(
+                    text("SELECT matviewname FROM pg_matviews"))])
+        tables = sorted(set(tables))
+        with _lock:
+            _tables[key] = tables
+
+    return tables
+
+
+def _load_geom(geom):
+    if geom is None:
+        return None
+    if isinstance(geom, memoryview):
+        geom = bytes(geom)
+    return wkb.loads(geom, hex=isinstance(geom, str))
+
+
+def df2gdf(df, geom_col='geom', crs=None):
+    """
+    Convert a DataFrame with a WKB (bytes or hex string, as returned by
+    PostGIS or ST_AsBinary/encode) geometry column to a GeoDataFrame.
+    """
+    df[geom_col] = [_load_geom(g) for g in df[geom_col]]
+    gdf = gpd.GeoDataFrame(df, geometry=geom_col, crs=crs)
+
+    return gdf
+
+
+def read_sql_chunks(sql, engine, chunksize=CHUNKSIZE, geom_col=None,
+                    crs=None, params=None):
+    """
+    Stream the results of sql in chunks. On Postgres a server-side cursor
+    is used, so only one chunk is held in memory at a time, and the query
+    is run once, rather than once per chunk as when paging with
+    LIMIT/OFFSET.
+
+    Parameters
+    ----------
+    sql : str
+        Query to run.
+    engine : sqlalchemy.engine.Engine
+        Engine to run the query with, see get_engine.
+    chunksize : int
+        Number of rows per chunk.
+    geom_col : str
+        Name of WKB geometry column to convert to a GeoDataFrame, if None a
+        DataFrame is returned.
+    crs : object
+        CRS of geometry column.
+    params : dict
+        Query parameters.
+
+    Yields
+    -------
+    pd.DataFrame or gpd.GeoDataFrame
+    """
+    if not isinstance(sql, str):
+        sql = str(sql)
+    with engine.connect() as con:
+        con = con.execution_options(stream_results=True)
+        for chunk in pd.read_sql(sql, con=con, params=params,
+                                 chunksize=chunksize):
+            if geom_col is not None:
+                chunk = df2gdf(chunk, geom_col=geom_col, crs=crs)
+            yield chunk
+
+
+def read_sql(sql, engine, geom_col=None, crs=None, params=None, **kwargs):
+    """Read all results of sql into a DataFrame, or GeoDataFrame if
+    geom_col is provided, using a pooled connection. kwargs are passed to
+    pd.read_sql."""
+    if not isinstance(sql, str):
+        sql = str(sql)
+    with engine.connect() as con:
+        df = pd.read_sql(sql, con=con, params=params, **kwargs)
+    if geom_col is not None:
+        df = df2gdf(df, geom_col=geom_col, crs=crs)
+
+    return df
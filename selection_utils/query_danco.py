@@ -6,10 +6,6 @@ Created on Thu Jan 17 12:43:09 2019
 """
 # TODO:
 # -Refactor this so that danco tables are Class, that can then be counted, listed, queried, etc.
-# -add chunksize support: 
-#    sql = "SELECT * FROM My_Table"
-#    for chunk in pd.read_sql_query(sql , engine, chunksize=5):
-#        print(chunk)
 
 
 import os
@@ -17,9 +13,9 @@ import os
 import geopandas as gpd
 import pandas as pd
 import psycopg2
-from sqlalchemy import create_engine, pool
-
 from misc_utils.logging_utils import create_logger
+from selection_utils.db_session import db_url, get_engine, list_tables, \
+    read_sql, read_sql_chunks, CHUNKSIZE
 
 
 logger = create_logger(__name__, 'sh', 'INFO')
@@ -68,45 +64,37 @@ def list_danco_footprint(instance='danco.pgc.umn.edu'):
            logger.debug("PostgreSQL connection closed.")
 
 
-def list_danco_db(db, instance='danco.pgc.umn.edu'):
+def danco_engine(db, instance='danco.pgc.umn.edu', creds=[creds[0], creds[1]]):
+    """
+    Get the (pooled) engine for a danco database. The engine is created on
+    the first call and reused by all following queries in the process.
+    """
+    return get_engine(db_url(host=instance, database=db,
+                             user=creds[0], password=creds[1]))
+
+
+def list_danco_db(db, instance='danco.pgc.umn.edu', refresh=False):
     '''
     queries the danco footprint database, returns all layer names in list
+    The listing is cached for the process, use refresh=True to list again.
     '''
     global logger
     logger.debug('Listing danco.{} tables...'.format(db))
-    connection = None
     try:
-        connection = psycopg2.connect(user=creds[0],
-                                      password=creds[1],
-                                      host=instance,
-                                      database=db)
-        cursor = connection.cursor()
-        cursor.execute("""SELECT table_name FROM information_schema.tables""")
-        tables = cursor.fetchall()    
-        tables = [x[0] for x in tables]
-        tables = sorted(tables)
-        
-        return tables
-    
-    
+        tables = list_tables(danco_engine(db=db, instance=instance),
+                             refresh=refresh)
     except (Exception, psycopg2.Error) as error :
         logger.error("Error while connecting to PostgreSQL\n", error)
         raise error
-    
-    finally:
-#        return tables
-        # Close database connection.
-        if connection:
-            connection.close()
-            connection = None
-            logger.debug("PostgreSQL connection closed.")
+
+    return tables
 
 
 def query_footprint(layer, instance='danco.pgc.umn.edu', db='footprint', creds=[creds[0], creds[1]], 
                     table=False, sql=False,
                     where=None, columns=None, orderby=None, orderby_asc=False, 
                     limit=None, offset=None, noh=False, catid_field='catalogid',
-                    dryrun=False):
+                    chunksize=None, dryrun=False):
     '''
     queries the danco footprint database, for the specified layer and optional where clause
     returns a dataframe of match
@@ -124,56 +112,57 @@ def query_footprint(layer, instance='danco.pgc.umn.edu', db='footprint', creds=[
     offset: number of records to offset from beginning of table
     noh: Return only records not in pgc_imagery_catalogids
     catid_field: Field in layer to compare to pgc_imagery_catalogids, default: catalogid
+    chunksize: if provided, return a generator of dataframes of chunksize records,
+               streamed from a server-side cursor, rather than a single dataframe
     dryrun: print SQL statement without running.
     '''
     global logger
     logger.debug('Querying danco.{}.{}'.format(db, layer))
-    connection = None
     try:
         db_tables = list_danco_db(db=db, instance=instance)
-        
+
         if layer not in db_tables:
             logger.warning('{} not found in {}'.format(layer, db))
 
-        engine = create_engine('postgresql+psycopg2://{}:{}@{}/{}'.format(creds[0], creds[1], instance, db),
-                               poolclass=pool.NullPool)
+        engine = danco_engine(db=db, instance=instance, creds=creds)
 
-#        engine = create_engine('postgresql+psycopg2://{}:{}@{}/{}'.format(creds[0], creds[1], instance, db))
-        connection = engine.connect()
+        if not sql:
+            sql = generate_sql(layer=layer, columns=columns, where=where, orderby=orderby,
+                               orderby_asc=orderby_asc, limit=limit, offset=offset, noh=noh,
+                               catid_field=catid_field, table=table)
 
-        if connection:
-            if not sql:
-                sql = generate_sql(layer=layer, columns=columns, where=where, orderby=orderby,
-                                   orderby_asc=orderby_asc, limit=limit, offset=offset, noh=noh,
-                                   catid_field=catid_field, table=table)
-                
-            if not dryrun:
-                # Create pandas df for tables, geopandas df for feature classes
-                logger.debug('SQL statement: {}'.format(sql))
-                if table == True:
-                    df = pd.read_sql_query(sql, con=engine)
-                else:
-                	# TODO: Fix hard coded epsg
-                    logger.debug('SQL: {}'.format(sql))
-                    # print(sql)
-                    df = gpd.GeoDataFrame.from_postgis(sql, connection, geom_col='geom', crs='epsg:4326')
-                
-                return df
+        if not dryrun:
+            # Create pandas df for tables, geopandas df for feature classes
+            logger.debug('SQL statement: {}'.format(sql))
+            if table == True:
+                geom_col = None
             else:
-                logger.info('SQL: {}'.format(sql))
+                # TODO: Fix hard coded epsg
+                geom_col = 'geom'
+            if chunksize:
+                return read_sql_chunks(sql, engine, chunksize=chunksize,
+                                       geom_col=geom_col, crs='epsg:4326')
+            df = read_sql(sql, engine, geom_col=geom_col, crs='epsg:4326')
+
+            return df
+        else:
+            logger.info('SQL: {}'.format(sql))
 
     except psycopg2.Error as error:
         logger.debug("Error while connecting to PostgreSQL", error)
         logger.debug("SQL: {}".format(sql))
         raise error
 
-    finally:
-        # Close database connection.
-        if connection:
-            connection.close()
-            connection = None
-            logger.debug("PostgreSQL connection closed.")
-    
+
+def query_footprint_chunks(layer, chunksize=CHUNKSIZE, **kwargs):
+    """
+    Generator of dataframes of chunksize records from layer, streamed
+    from a single query with a server-side cursor, rather than paging
+    through the layer with LIMIT/OFFSET queries. kwargs are passed to
+    query_footprint.
+    """
+    return query_footprint(layer, chunksize=chunksize, **kwargs)
+
 
 def table_sample(layer, db='footprint', n=5, table=False, sql=False, where=None, 
                  columns=None, orderby_asc=False, offset=None, dryrun=False):
@@ -188,47 +177,32 @@ def count_table(layer, db='footprint', distinct=False, distinct_col=None,
                 instance='danco.pgc.umn.edu', cred=[creds[0], creds[1]], 
                 noh=False, where=None, table=True):
     logger.debug('Querying danco.{}.{}'.format(db, layer))
-    connection = None
     try:
-        db_tables = list_danco_db(db)
+        db_tables = list_danco_db(db, instance=instance)
         
         if layer not in db_tables:
             logger.error('{} not found in {}'.format(layer, db))
 
+        # cols_str = '*' # select all columns
+        sql = generate_sql(layer=layer, where=where, noh=noh, table=True)
+        sql = sql.replace('SELECT *', 'SELECT COUNT(*)')
 
-        connection = psycopg2.connect(user=creds[0],
-                                      password=creds[1],
-                                      host=instance,
-                                      database=db)
-        cursor = connection.cursor()
+        logger.debug('SQL: {}'.format(sql))
+        with danco_engine(db=db, instance=instance, creds=cred).connect() as connection:
+            # No parameters, so '%' in where clauses is passed as is
+            result = connection.execution_options(no_parameters=True) \
+                               .execute(sql).fetchall()
+        count = [x[0] for x in result][0]
+
+        logger.debug('Query will result in {:,} records.'.format(count))
+
+        return count
 
-        if connection:
-            # cols_str = '*' # select all columns
-            sql = generate_sql(layer=layer, where=where, noh=noh, table=True)
-            sql = sql.replace('SELECT *', 'SELECT COUNT(*)')
-                
-            logger.debug('SQL: {}'.format(sql))
-            cursor.execute(sql)
-            result = cursor.fetchall()
-            count = [x[0] for x in result][0]
-            
-            logger.debug('Query will result in {:,} records.'.format(count))
-            
-            return count
-        
-            
     except (Exception, psycopg2.Error) as error :
         logger.debug("Error while connecting to PostgreSQL", error)
         raise error
 
-    finally:
-        # Close database connection.
-        if connection:
-            connection.close()
-            connection = None
-            logger.debug("PostgreSQL connection closed.")
-    
-    
+
 def footprint_fields(layer, db='footprint', table=False):
     '''
     DEPREC. -- Use layer_fields
@@ -7,10 +7,11 @@ Module to select from Danco footprint layer based on AOI or list of IDs
 """
 
 import geopandas as gpd
+import pandas as pd
 import sys, os, logging, argparse, tqdm
 
 from misc_utils.logging_utils import create_logger
-from misc_utils.id_parse_utils import read_ids, remove_mfp, mfp_ids
+from misc_utils.id_parse_utils import read_ids, remove_mfp, isin_mfp
 from selection_utils.query_danco import query_footprint, layer_fields
 
 
@@ -232,7 +233,7 @@ def remove_mfp_selection(selection):
     # Assume dataframe
     else:
         catid_fields = [f for f in list(selection) if 'catalogid' in f]
-        selection = selection[selection[catid_fields[0]].isin(remove_mfp(list(selection[catid_fields[0]])))]
+        selection = selection[~isin_mfp(selection[catid_fields[0]])]
 
     return selection
 
@@ -241,16 +242,16 @@ def keep_mfp_selection(selection, stereo=True):
     """Keep only IDs in master footprint from given selection"""
     logger.debug('Keeping only IDs in the master footprint.')
     logger.debug('IDs before keeping only MFP: {}'.format(len(selection)))
-    oh_ids = set(mfp_ids())
     if type(selection) in (list, set):
-        selection = set(selection).intersection(oh_ids)
+        selection = pd.Series(list(set(selection)), dtype=object)
+        selection = set(selection[isin_mfp(selection)])
     else:
         catid_field = [f for f in list(selection) if 'catalogid' in f][0]
-        selection = selection[selection[catid_field].isin(oh_ids)]
+        selection = selection[isin_mfp(selection[catid_field])]
         if stereo:
             logger.debug('Keeping where stereopair also in MFP.')
             stp_field = [f for f in list(selection) if 'stereopair' in f][0]
-            selection = selection[selection[stp_field].isin(oh_ids)]
+            selection = selection[isin_mfp(selection[stp_field])]
 
 
     logger.debug('IDs after keeping only MFP: {}'.format(len(selection)))
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic data for the benchmark suite: DEMs, multispectral rasters,
+segmentation polygons and footprint tables, generated once per session at
+the size set by the BENCH_SIZE environment variable (small, medium or
+large, default small).
+
+Run with pytest-benchmark, saving results to compare later runs against:
+    BENCH_SIZE=medium pytest tests/benchmarks --benchmark-autosave
+    BENCH_SIZE=medium pytest tests/benchmarks --benchmark-compare
+"""
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from shapely.geometry import box
+
+# Polar stereographic north, meters
+EPSG = 3413
+ORIGIN = (-100000.0, -500000.0)
+RES = 2.0
+SEED = 1
+
+SIZES = {
+    # raster: pixels per side, objects: segmentation polygons per side,
+    # footprints: imagery footprints, dems: DEM footprints,
+    # records: rows inserted to the database
+    'small': {'raster': 512, 'objects': 20, 'footprints': 1000,
+              'dems': 200, 'records': 10000},
+    'medium': {'raster': 2048, 'objects': 60, 'footprints': 10000,
+               'dems': 1000, 'records': 100000},
+    'large': {'raster': 8192, 'objects': 150, 'footprints': 100000,
+              'dems': 5000, 'records': 1000000},
+}
+
+
+@pytest.fixture(scope='session')
+def size():
+    name = os.environ.get('BENCH_SIZE', 'small')
+    if name not in SIZES:
+        raise ValueError('BENCH_SIZE must be one of: {}'.format(list(SIZES)))
+    return SIZES[name]
+
+
+def raster_bounds(n):
+    """(minx, miny, maxx, maxy) of an n x n pixel raster."""
+    minx, maxy = ORIGIN
+    return minx, maxy - n * RES, minx + n * RES, maxy
+
+
+def write_raster(path, arr, nodata=None):
+    """Write a (bands, rows, cols) array to a tiled GeoTiff."""
+    gdal = pytest.importorskip('osgeo.gdal')
+    osr = pytest.importorskip('osgeo.osr')
+    dtype = gdal.GDT_Float32 if arr.dtype == np.float32 else gdal.GDT_UInt16
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(str(path), arr.shape[2], arr.shape[1], arr.shape[0],
+                       dtype, options=['TILED=YES', 'COMPRESS=LZW'])
+    ds.SetGeoTransform((ORIGIN[0], RES, 0, ORIGIN[1], 0, -RES))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    ds.SetProjection(srs.ExportToWkt())
+    for i, a in enumerate(arr):
+        band = ds.GetRasterBand(i + 1)
+        if nodata is not None:
+            band.SetNoDataValue(nodata)
+        band.WriteArray(a)
+    ds = None
+
+    return str(path)
+
+
+def synthetic_dem(path, n, nodata=-9999.0, seed=SEED):
+    """Smooth terrain with noise and a NoData corner, n x n pixels."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:n, 0:n] / n
+    dem = (200 * np.sin(3 * x) * np.cos(2 * y) + 50 * np.sin(17 * x * y) +
+           rng.normal(0, 0.5, (n, n))).astype(np.float32)
+    dem[:n // 10, :n // 10] = nodata
+
+    return write_raster(path, dem[np.newaxis], nodata=nodata)
+
+
+def synthetic_multispectral(path, n, bands=4, seed=SEED):
+    """Random reflectance-like values, bands x n x n pixels."""
+    rng = np.random.default_rng(seed)
+    arr = rng.integers(0, 2048, (bands, n, n)).astype(np.uint16)
+
+    return write_raster(path, arr, nodata=0)
+
+
+def synthetic_labels(path, n, n_side, seed=SEED):
+    """
+    Label raster of irregular objects, about n_side x n_side of them on an
+    n x n pixel grid, like a segmentation: a grid of labels with ragged
+    boundaries.
+    """
+    rng = np.random.default_rng(seed)
+    cell = max(1, n // n_side)
+    y, x = np.mgrid[0:n, 0:n]
+    jitter = rng.integers(0, max(1, cell // 2), (2, n, n))
+    labels = ((y + jitter[0]) // cell) * (n_side + 1) + (x + jitter[1]) // cell
+    labels = labels.astype(np.uint16)
+
+    return write_raster(path, labels[np.newaxis])
+
+
+def segmentation_polygons(n_side, bounds, seed=SEED):
+    """
+    Grid of n_side x n_side adjacent square objects covering bounds, with
+    the value fields used by the RTS classification.
+    """
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    xs = np.linspace(minx, maxx, n_side + 1)
+    ys = np.linspace(miny, maxy, n_side + 1)
+    geoms = [box(xs[i], ys[j], xs[i + 1], ys[j + 1])
+             for i in range(n_side) for j in range(n_side)]
+    n = len(geoms)
+    objects = gpd.GeoDataFrame({'label': np.arange(n),
+                                'slope_mean': rng.uniform(0, 30, n),
+                                'ndvi_mean': rng.uniform(-0.2, 0.6, n),
+                                'delev_mean': rng.normal(0, 1, n)},
+                               geometry=geoms, crs='epsg:{}'.format(EPSG))
+
+    return objects
+
+
+def footprints(n, bounds, max_size=20000, seed=SEED):
+    """Random rectangular footprints within bounds, with acquisition
+    dates."""
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    x0 = rng.uniform(minx, maxx, n)
+    y0 = rng.uniform(miny, maxy, n)
+    w = rng.uniform(max_size / 10, max_size, n)
+    h = rng.uniform(max_size / 10, max_size, n)
+    geoms = [box(*b) for b in zip(x0, y0, x0 + w, y0 + h)]
+    start = datetime.datetime(2010, 1, 1)
+    dates = [start + datetime.timedelta(days=int(d))
+             for d in rng.integers(0, 3650, n)]
+    fps = gpd.GeoDataFrame({'catalogid': ['{:016X}'.format(i)
+                                          for i in range(n)],
+                            'acq_time': pd.to_datetime(dates)},
+                           geometry=geoms, crs='epsg:{}'.format(EPSG))
+
+    return fps
+
+
+@pytest.fixture(scope='session')
+def crs():
+    """CRS of all synthetic data."""
+    return 'epsg:{}'.format(EPSG)
+
+
+@pytest.fixture(scope='session')
+def bounds(size):
+    """(minx, miny, maxx, maxy) of the synthetic rasters."""
+    return raster_bounds(size['raster'])
+
+
+@pytest.fixture(scope='session')
+def bench_dir(tmp_path_factory):
+    return tmp_path_factory.mktemp('bench')
+
+
+@pytest.fixture(scope='session')
+def dem(bench_dir, size):
+    return synthetic_dem(bench_dir / 'dem.tif', size['raster'])
+
+
+@pytest.fixture(scope='session')
+def multispectral(bench_dir, size):
+    return synthetic_multispectral(bench_dir / 'ms.tif', size['raster'])
+
+
+@pytest.fixture(scope='session')
+def labels(bench_dir, size):
+    return synthetic_labels(bench_dir / 'labels.tif', size['raster'],
+                            size['objects'])
+
+
+@pytest.fixture(scope='session')
+def objects(size, bounds):
+    return segmentation_polygons(size['objects'], bounds)
+
+
+@pytest.fixture(scope='session')
+def objects_path(bench_dir, objects):
+    path = bench_dir / 'objects.shp'
+    objects.to_file(str(path))
+    return str(path)
+
+
+@pytest.fixture(scope='session')
+def imagery_footprints(size):
+    return footprints(size['footprints'], (0, 0, 1000000, 1000000))
+
+
+@pytest.fixture(scope='session')
+def dem_footprints(size):
+    dems = footprints(size['dems'], (0, 0, 200000, 200000))
+    dems = dems.rename(columns={'catalogid': 'PAIRNAME'})
+    return dems
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the DEM hot paths: TPI, clipping rasters to an AOI and
+overlaps between DEM footprints.
+"""
+import geopandas as gpd
+import pytest
+from shapely.geometry import box
+
+pytest.importorskip('pytest_benchmark')
+
+from dem_utils.TPI import calc_TPI
+from dem_utils.dem_utils import dems2dems_ovlp
+from misc_utils.raster_clip import clip_rasters
+
+
+@pytest.mark.parametrize('win_size', [3, 21])
+def test_calc_TPI(benchmark, dem, bench_dir, win_size):
+    out = str(bench_dir / 'dem_TPI{}.tif'.format(win_size))
+
+    result = benchmark.pedantic(calc_TPI, args=(win_size, dem, out),
+                                rounds=3)
+
+    assert result == out
+
+
+def test_clip_rasters(benchmark, dem, multispectral, bench_dir, bounds, crs):
+    # AOI covering the center quarter of the rasters
+    minx, miny, maxx, maxy = bounds
+    dx, dy = (maxx - minx) / 4, (maxy - miny) / 4
+    aoi = gpd.GeoDataFrame(geometry=[box(minx + dx, miny + dy,
+                                         maxx - dx, maxy - dy)],
+                           crs=crs)
+    aoi_path = str(bench_dir / 'clip_aoi.shp')
+    aoi.to_file(aoi_path)
+    out_dir = bench_dir / 'clipped'
+    out_dir.mkdir(exist_ok=True)
+
+    result = benchmark.pedantic(clip_rasters,
+                                args=(aoi_path, [dem, multispectral]),
+                                kwargs={'out_dir': str(out_dir),
+                                        'overwrite': True},
+                                rounds=3)
+
+    assert len(result) == 2
+
+
+def test_dems2dems_ovlp(benchmark, dem_footprints):
+    pairs = benchmark(dems2dems_ovlp, dem_footprints)
+
+    assert len(pairs) > 0
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of footprint processing: counting footprints over a grid and
+inserting new footprint records into the database. The database benchmark
+runs against the Postgres database at TEST_DB_URL and is skipped if it is
+not set, as insert_new_records relies on Postgres COPY.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from archive_analysis.archive_analysis_utils import get_count
+from archive_analysis.grid_count import grid_cells
+
+# Grid cell size, in units of the footprints (meters)
+CELL_SIZE = 10000
+TABLE = 'bench_footprints'
+
+
+def test_get_count(benchmark, imagery_footprints, crs):
+    minx, miny, maxx, maxy = imagery_footprints.total_bounds
+    cells = grid_cells(np.arange(minx, maxx + CELL_SIZE, CELL_SIZE),
+                       np.arange(miny, maxy + CELL_SIZE, CELL_SIZE),
+                       crs=crs)
+
+    counts = benchmark(get_count, cells, imagery_footprints,
+                       date_col='acq_time')
+
+    assert len(counts) == len(cells)
+
+
+@pytest.fixture
+def postgres(monkeypatch):
+    url = os.environ.get('TEST_DB_URL')
+    if not url or not url.startswith('postgres'):
+        pytest.skip('TEST_DB_URL not set to a Postgres database')
+    pytest.importorskip('psycopg2')
+    from sqlalchemy.engine.url import make_url
+    from selection_utils import db
+
+    url = make_url(url)
+    config = {'db_config': {'host': url.host,
+                            'database': url.database,
+                            'user': url.username,
+                            'password': url.password},
+              'tables': {TABLE: {db.k_unique_id: 'catalogid'}}}
+    monkeypatch.setattr(db, 'get_config', lambda param: config)
+
+    with db.Postgres(url.host, url.database) as pg:
+        pg.cursor.execute('DROP TABLE IF EXISTS {}'.format(TABLE))
+        pg.cursor.execute('CREATE TABLE {} (catalogid text PRIMARY KEY, '
+                          'acq_time timestamp, value integer)'.format(TABLE))
+        pg.connection.commit()
+        pg.list_db_tables(refresh=True)
+        yield pg
+        pg.cursor.execute('DROP TABLE IF EXISTS {}'.format(TABLE))
+        pg.connection.commit()
+
+
+def test_insert_new_records(benchmark, postgres, size):
+    n = size['records']
+    records = pd.DataFrame({'catalogid': ['{:016X}'.format(i)
+                                          for i in range(n)],
+                            'acq_time': pd.date_range('2010-01-01',
+                                                      periods=n, freq='h'),
+                            'value': np.arange(n)})
+    # Duplicates within the records are skipped on insert
+    records = pd.concat([records, records.iloc[:n // 10]])
+
+    def empty_table():
+        postgres.cursor.execute('TRUNCATE {}'.format(TABLE))
+        postgres.connection.commit()
+
+    benchmark.pedantic(postgres.insert_new_records, args=(records, TABLE),
+                       setup=empty_table, rounds=3)
+
+    assert postgres.get_table_count(TABLE) == n
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the OBIA hot paths: polygonizing segmentations, neighbor
+lookup, rule classification, pseudo-merging and zonal statistics of
+segmentation polygons.
+"""
+import operator
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from obia_utils.ImageObjects import ImageObjects, create_rule
+from obia_utils.calc_zonal_stats import calc_zonal_stats
+from misc_utils.polygonize import polygonize_blocks
+
+VALUE_FIELDS = [('slope_mean', 'mean'),
+                ('ndvi_mean', 'mean'),
+                ('delev_mean', 'mean')]
+
+
+def image_objects(objects):
+    return ImageObjects(objects, value_fields=list(VALUE_FIELDS))
+
+
+@pytest.mark.parametrize('max_workers', [0, None])
+def test_polygonize_blocks(benchmark, labels, bench_dir, max_workers):
+    out_vec = str(bench_dir / 'labels_{}.gpkg'.format(max_workers))
+
+    result = benchmark.pedantic(polygonize_blocks, args=(labels,),
+                                kwargs={'out_vec': out_vec,
+                                        'block_size': 256,
+                                        'max_workers': max_workers},
+                                rounds=3)
+
+    assert result == out_vec
+
+
+def test_get_neighbors(benchmark, objects):
+    # A new ImageObjects each round, so the neighbor graph build is timed
+    result = benchmark.pedantic(
+        ImageObjects.get_neighbors,
+        setup=lambda: ((image_objects(objects),), {}),
+        rounds=5)
+
+    assert len(result) == len(objects)
+
+
+def test_classify_objects(benchmark, objects):
+    threshold_rules = [create_rule('threshold', 'slope_mean', operator.gt, 5),
+                       create_rule('threshold', 'ndvi_mean', operator.lt,
+                                   0.3, out_field=True)]
+    adj_rules = [create_rule('adjacent_or_is', 'delev_mean', operator.lt, -1,
+                             out_field=True),
+                 create_rule('adjacent', 'slope_mean', operator.gt, 20)]
+
+    def classify_objects(io):
+        io.classify_objects('candidate', threshold_rules=threshold_rules,
+                            adj_rules=adj_rules)
+        return io
+
+    io = benchmark.pedantic(classify_objects,
+                            setup=lambda: ((image_objects(objects),), {}),
+                            rounds=5)
+
+    assert (io.objects[io.class_fld] == 'candidate').any()
+
+
+def test_pseudo_merging(benchmark, objects):
+    mc_rules = [create_rule('threshold', 'slope_mean', operator.gt, 5),
+                create_rule('threshold', 'delev_mean', operator.lt, 0.5)]
+    pairwise = [{'threshold': {'field': 'ndvi_mean',
+                               'op': operator.lt,
+                               'threshold': 'self'}}]
+
+    def pseudo_merging(io):
+        io.pseudo_merging(merge_candidate_rules=mc_rules,
+                          pairwise_criteria=pairwise,
+                          grow_fields=['slope_mean', 'delev_mean'],
+                          max_iter=100)
+        return io
+
+    io = benchmark.pedantic(pseudo_merging,
+                            setup=lambda: ((image_objects(objects),), {}),
+                            rounds=3)
+
+    assert io.objects[io.mp_fld].map(len).sum() > 0
+
+
+def test_calc_zonal_stats(benchmark, objects_path, dem, multispectral,
+                          bench_dir):
+    rasters = {'dem': {'path': dem,
+                       'stats': ['min', 'max', 'mean', 'count', 'median']},
+               'ms': {'path': multispectral,
+                      'stats': ['mean'],
+                      'bands': [1, 2, 3, 4]}}
+    out_path = str(bench_dir / 'objects_stats.shp')
+
+    result = benchmark.pedantic(calc_zonal_stats,
+                                args=(objects_path, rasters),
+                                kwargs={'out_path': out_path},
+                                rounds=3)
+
+    assert result == out_path
@@ -0,0 +1,62 @@
+"""
+Tests for selection_utils.db_session. Runs against SQLite by default, set
+TEST_DB_URL to a Postgres/PostGIS database URL to run against Postgres.
+"""
+import os
+
+import pandas as pd
+import pytest
+from shapely.geometry import Point
+from sqlalchemy import text
+
+from selection_utils import db_session
+
+
+@pytest.fixture
+def engine(tmp_path):
+    url = os.environ.get('TEST_DB_URL',
+                         'sqlite:///{}'.format(tmp_path / 'test.db'))
+    engine = db_session.get_engine(url)
+    records = pd.DataFrame({'catalogid': ['id{}'.format(i)
+                                          for i in range(25)],
+                            'value': range(25),
+                            'geom': [Point(i, i).wkb_hex
+                                     for i in range(25)]})
+    records.to_sql('footprints', engine, index=False, if_exists='replace')
+    db_session.list_tables(engine, refresh=True)
+    yield engine
+    with engine.connect() as con:
+        con.execute(text('DROP TABLE IF EXISTS footprints'))
+    db_session.dispose_engines()
+
+
+def test_engine_cached(engine):
+    assert db_session.get_engine(str(engine.url)) is engine
+
+
+def test_list_tables_cached(engine):
+    assert 'footprints' in db_session.list_tables(engine)
+    pd.DataFrame({'a': [1]}).to_sql('new_table', engine, index=False)
+    # Cached listing until refreshed
+    assert 'new_table' not in db_session.list_tables(engine)
+    assert 'new_table' in db_session.list_tables(engine, refresh=True)
+    with engine.connect() as con:
+        con.execute(text('DROP TABLE new_table'))
+
+
+def test_read_sql_chunks(engine):
+    chunks = list(db_session.read_sql_chunks(
+        'SELECT * FROM footprints ORDER BY value', engine, chunksize=10,
+        geom_col='geom', crs='epsg:4326'))
+    assert [len(c) for c in chunks] == [10, 10, 5]
+    gdf = pd.concat(chunks)
+    assert list(gdf['value']) == list(range(25))
+    assert gdf.geometry.iloc[3].equals(Point(3, 3))
+    assert chunks[0].crs is not None
+
+
+def test_read_sql(engine):
+    df = db_session.read_sql('SELECT catalogid, value FROM footprints '
+                             'WHERE value < 5', engine)
+    assert len(df) == 5
+    assert list(df.columns) == ['catalogid', 'value']
@@ -0,0 +1,32 @@
+"""
+Tests for dem_utils.dem_compare.DiffStats.
+"""
+import numpy as np
+
+from dem_utils.dem_compare import DiffStats
+
+
+def test_diff_stats():
+    rng = np.random.default_rng(0)
+    diffs = rng.normal(0.5, 2, 10000)
+    stats = DiffStats()
+    for block in np.array_split(diffs, 7):
+        stats.update(block)
+
+    assert stats.count == diffs.size
+    assert np.isclose(stats.mean, diffs.mean())
+    assert np.isclose(stats.median, np.median(diffs), atol=stats.bin_width)
+    counts, edges = stats.histogram(bins=20)
+    assert counts.sum() == diffs.size
+    assert len(edges) == 21
+
+
+def test_diff_stats_empty():
+    stats = DiffStats()
+    stats.update(np.array([]))
+    counts, edges = stats.histogram(bins=5)
+
+    assert stats.count == 0
+    assert counts.sum() == 0
+    assert len(counts) == 5
+    assert np.isfinite(edges).all()
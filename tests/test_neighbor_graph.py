@@ -0,0 +1,46 @@
+"""
+Tests for obia_utils.neighbor_graph.
+"""
+import geopandas as gpd
+import pandas as pd
+import pytest
+from shapely.geometry import box
+
+from obia_utils.neighbor_graph import NeighborGraph
+
+
+def hub_objects(n):
+    """A long object (label 0) with n small objects along its top edge."""
+    geoms = [box(0, 0, n, 1)] + [box(i, 1, i + 1, 2) for i in range(n)]
+    return gpd.GeoDataFrame({'value': [0] + [1] * n}, geometry=geoms)
+
+
+def test_neighbors():
+    graph = NeighborGraph(hub_objects(3))
+
+    assert sorted(graph.neighbors(0)) == [1, 2, 3]
+    assert sorted(graph.neighbors(2)) == [0, 1, 3]
+    assert len(graph.edges()) == 5
+
+
+@pytest.mark.parametrize('n', [127, 128, 256, 300])
+def test_any_neighbor_many_neighbors(n):
+    objects = hub_objects(n)
+    graph = NeighborGraph(objects)
+    hits = graph.any_neighbor(objects['value'] == 1)
+
+    assert graph.matrix[0].sum() == n
+    assert hits[0]
+    # Small objects only neighbor the hub (value 0) and each other
+    assert hits[1:].all()
+    assert not graph.any_neighbor(objects['value'] == 0)[0]
+
+
+def test_any_neighbor_missing():
+    objects = hub_objects(3)
+    graph = NeighborGraph(objects)
+    # Missing and null values are not True
+    mask = pd.Series([True, None], index=[1, 2])
+    hits = graph.any_neighbor(mask)
+
+    assert list(hits) == [True, False, True, False]
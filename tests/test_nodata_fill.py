@@ -0,0 +1,143 @@
+"""
+Tests for misc_utils.nodata_fill: filled values must not depend on the
+tiling, void-free tiles are copied through and AOIs limit filling.
+"""
+import numpy as np
+import pytest
+
+from misc_utils.gdal_tools import pad_window
+from misc_utils.nodata_fill import fill_array, fill_voids, IDW, KDTREE
+
+NODATA = -9999.0
+HALO = 12
+
+
+def synthetic(n=96, seed=0):
+    """Smooth surface with voids of a range of sizes."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:n, 0:n] / n
+    arr = (100 * np.sin(3 * x) * np.cos(2 * y)).astype(np.float32)
+    arr[40:49, 40:49] = NODATA
+    arr[5:7, 70:90] = NODATA
+    arr[rng.random((n, n)) < 0.02] = NODATA
+    # Void-free corner
+    arr[64:, :32] = 1.0
+
+    return arr
+
+
+def fill_windows(arr, window_size, k):
+    """Fill arr window by window, as fill_voids does."""
+    invalid = arr == NODATA
+    out = arr.astype(np.float64)
+    n = arr.shape[0]
+    for yoff in range(0, n, window_size):
+        for xoff in range(0, n, window_size):
+            window = (xoff, yoff, min(window_size, n - xoff),
+                      min(window_size, n - yoff))
+            (px, py, pw, ph), inner = pad_window(window, HALO, n, n)
+            padded = arr[py:py + ph, px:px + pw]
+            pad_invalid = invalid[py:py + ph, px:px + pw]
+            core = np.zeros(padded.shape, dtype=bool)
+            core[inner] = True
+            filled_arr, _filled = fill_array(padded, pad_invalid & core,
+                                             ~pad_invalid, method=KDTREE,
+                                             max_distance=HALO, k=k)
+            xs, ys, w, h = window
+            out[ys:ys + h, xs:xs + w] = filled_arr[inner]
+
+    return out
+
+
+@pytest.mark.parametrize('k', [1, 2, 12])
+def test_kdtree_tiling(k):
+    # Grid distances are often tied, so sources tied with the kth nearest
+    # must all be used for the result not to depend on the window
+    arr = synthetic()
+    invalid = arr == NODATA
+    full, filled = fill_array(arr, invalid, ~invalid, method=KDTREE,
+                              max_distance=HALO, k=k)
+
+    assert filled.sum() == invalid.sum()
+    for window_size in [16, 40]:
+        np.testing.assert_array_equal(fill_windows(arr, window_size, k), full)
+
+
+def test_kdtree_unfilled():
+    arr = np.full((30, 30), NODATA)
+    arr[0, 0] = 5
+    invalid = arr == NODATA
+    out, filled = fill_array(arr, invalid, ~invalid, method=KDTREE,
+                             max_distance=10, k=3)
+
+    # Only pixels within max_distance of the valid pixel are filled
+    assert filled[5, 5]
+    assert not filled[20, 20]
+    assert out[5, 5] == 5
+    assert out[20, 20] == NODATA
+
+
+@pytest.fixture
+def raster(tmp_path):
+    gdal = pytest.importorskip('osgeo.gdal')
+    arr = synthetic()
+    path = str(tmp_path / 'voids.tif')
+    ds = gdal.GetDriverByName('GTiff').Create(
+        path, arr.shape[1], arr.shape[0], 1, gdal.GDT_Float32,
+        options=['TILED=YES', 'BLOCKXSIZE=16', 'BLOCKYSIZE=16'])
+    ds.SetGeoTransform((0, 1, 0, arr.shape[0], 0, -1))
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(NODATA)
+    band.WriteArray(arr)
+    ds = None
+
+    return path, arr
+
+
+def read(path):
+    from osgeo import gdal
+    ds = gdal.Open(path)
+    arr = ds.GetRasterBand(1).ReadAsArray()
+    ds = None
+    return arr
+
+
+@pytest.mark.parametrize('method', [IDW, KDTREE])
+def test_fill_voids_tiling(raster, tmp_path, method):
+    path, arr = raster
+    outs = []
+    for tile_size in [16, 48]:
+        out_path = str(tmp_path / 'filled_{}_{}.tif'.format(method,
+                                                            tile_size))
+        fill_voids(path, out_path, method=method, halo=HALO,
+                   tile_size=tile_size, max_workers=2)
+        outs.append(read(out_path))
+
+    np.testing.assert_array_equal(outs[0], outs[1])
+    assert (outs[0] != NODATA).all()
+    # Valid pixels, including the void-free tiles, are copied through
+    valid = arr != NODATA
+    np.testing.assert_array_equal(outs[0][valid], arr[valid])
+
+
+def test_fill_voids_aoi(raster, tmp_path):
+    gpd = pytest.importorskip('geopandas')
+    from shapely.geometry import box
+    path, arr = raster
+    n = arr.shape[0]
+    # Left half of the raster, in map coordinates (y up)
+    aoi = gpd.GeoDataFrame(geometry=[box(0, 0, n // 2, n)])
+    aoi_path = str(tmp_path / 'aoi.geojson')
+    aoi.to_file(aoi_path, driver='GeoJSON')
+    out_path = str(tmp_path / 'filled_aoi.tif')
+
+    fill_voids(path, out_path, aoi=aoi_path, method=KDTREE, halo=HALO,
+               tile_size=16, max_workers=2)
+    out = read(out_path)
+
+    # Voids filled within the AOI, everything outside it is NoData
+    assert (out[:, :n // 2] != NODATA).all()
+    assert (out[:, n // 2:] == NODATA).all()
+    valid = arr[:, :n // 2] != NODATA
+    np.testing.assert_array_equal(out[:, :n // 2][valid],
+                                  arr[:, :n // 2][valid])
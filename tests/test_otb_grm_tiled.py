@@ -0,0 +1,138 @@
+"""
+Tests for stitching tiled segmentations in obia_utils.otb_grm_tiled, with
+tile segmentations held as arrays rather than written by OTB.
+"""
+import numpy as np
+import pytest
+
+from obia_utils import otb_grm_tiled
+from obia_utils.otb_grm_tiled import tile_grid, tile_lut
+
+TILE_SIZE = 16
+OVERLAP = 4
+
+
+@pytest.fixture
+def segs(monkeypatch):
+    """Tile segmentations, {tile name: labels of padded window}, read in
+    place of the tile rasters."""
+    segs = {}
+
+    def read(path, xoff, yoff, xsize, ysize):
+        return segs[path][yoff:yoff + ysize, xoff:xoff + xsize].astype(
+            np.int64)
+
+    monkeypatch.setattr(otb_grm_tiled, '_read', read)
+
+    return segs
+
+
+def set_seg(segs, tile, seg):
+    tile.seg = tile.name
+    tile.num_labels = int(seg.max()) + 1
+    segs[tile.name] = seg
+
+
+def segment_tiles(segs, full, tile_size=TILE_SIZE, overlap=OVERLAP):
+    """Tiles of full, each segmented as its padded window of full, with
+    labels renumbered from 0 as a tile segmentation would be."""
+    tiles = tile_grid(full.shape[1], full.shape[0], tile_size=tile_size,
+                      overlap=overlap)
+    for t in tiles.values():
+        x, y, w, h = t.padded
+        _values, seg = np.unique(full[y:y + h, x:x + w], return_inverse=True)
+        set_seg(segs, t, seg.reshape(h, w))
+
+    return tiles
+
+
+def stitch(segs, tiles, shape, agreement=otb_grm_tiled.SEAM_AGREEMENT):
+    lut = tile_lut(tiles, agreement=agreement)
+    out = np.zeros(shape, dtype=np.int64)
+    for t in tiles.values():
+        cx, cy, cw, ch = t.core_in_padded()
+        labels = segs[t.seg][cy:cy + ch, cx:cx + cw]
+        x, y, w, h = t.core
+        out[y:y + h, x:x + w] = lut[t.offset + labels + 1]
+
+    return out, len(np.unique(out))
+
+
+def same_partition(a, b):
+    """True if label arrays a and b divide the pixels into the same
+    objects."""
+    pairs = np.unique(np.stack([a.ravel(), b.ravel()]), axis=1)
+    return (pairs.shape[1] == len(np.unique(a)) == len(np.unique(b)))
+
+
+def blocks(shape, xs, ys):
+    """Rectangular objects, split at columns xs and rows ys."""
+    col = np.searchsorted(xs, np.arange(shape[1]), side='right')
+    row = np.searchsorted(ys, np.arange(shape[0]), side='right')
+    return row[:, np.newaxis] * (len(xs) + 1) + col[np.newaxis, :]
+
+
+def test_matches_single_pass(segs):
+    # Objects crossing both vertical and horizontal seams, and objects
+    # split exactly at seams
+    full = blocks((40, 44), xs=[5, 16, 22, 37], ys=[10, 32])
+    full[20:26, 2:40] = full.max() + 1
+    tiles = segment_tiles(segs, full)
+    assert len(tiles) == 9
+
+    out, num_objs = stitch(segs, tiles, full.shape)
+
+    assert same_partition(out, full)
+    assert num_objs == len(np.unique(full))
+    assert out.min() == 1
+
+
+def test_merge_across_seams(segs):
+    # One object covering four tiles
+    full = np.zeros((32, 32), dtype=np.int64)
+    tiles = segment_tiles(segs, full)
+
+    out, num_objs = stitch(segs, tiles, full.shape)
+
+    assert num_objs == 1
+    assert (out == 1).all()
+
+
+def test_labels_unique(segs):
+    # Every tile has its own label 0, objects end at the seams
+    full = blocks((32, 32), xs=[TILE_SIZE], ys=[TILE_SIZE])
+    tiles = segment_tiles(segs, full)
+    assert all(segs[t.seg].min() == 0 for t in tiles.values())
+
+    out, num_objs = stitch(segs, tiles, full.shape)
+
+    assert num_objs == 4
+    assert len({out[0, 0], out[0, -1], out[-1, 0], out[-1, -1]}) == 4
+    assert same_partition(out, full)
+
+
+def test_disagreeing_seam(segs):
+    # Tile a has one object across the seam, tile b splits its margin from
+    # its core at the seam on some rows
+    full = np.zeros((TILE_SIZE, 2 * TILE_SIZE), dtype=np.int64)
+    tiles = segment_tiles(segs, full)
+    a, b = tiles[(0, 0)], tiles[(0, 1)]
+    seg_b = np.zeros_like(segs[b.seg])
+    # Columns of b's padded window left of the seam
+    margin = TILE_SIZE - b.padded[0]
+    seg_b[:, :margin] = 1
+
+    # Disagree along the whole seam
+    set_seg(segs, b, seg_b.copy())
+    out, num_objs = stitch(segs, tiles, full.shape)
+    assert num_objs == 2
+    assert len(np.unique(out[:, :TILE_SIZE])) == 1
+    assert (out[:, :TILE_SIZE] != out[:, TILE_SIZE:]).all()
+
+    # Disagree along a quarter of the seam
+    seg_b[TILE_SIZE // 4:] = 0
+    set_seg(segs, b, seg_b)
+    _out, num_objs = stitch(segs, tiles, full.shape, agreement=0.5)
+    assert num_objs == 1
+    _out, num_objs = stitch(segs, tiles, full.shape, agreement=0.9)
+    assert num_objs == 2
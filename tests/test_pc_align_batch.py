@@ -0,0 +1,138 @@
+"""
+Tests for dem_utils.pc_align_batch, using fake pc_align and point2dem
+executables that write the files the real tools would.
+"""
+import os
+import stat
+import sys
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('osgeo')
+
+from dem_utils import pc_align_batch
+
+FAKE_PC_ALIGN = """#!{python}
+import sys
+args = sys.argv[1:]
+prefix = args[args.index('-o') + 1]
+with open(prefix + '.calls', 'a') as calls:
+    calls.write(' '.join(args) + '\\n')
+if 'bad' in args[-1]:
+    sys.exit(1)
+with open(prefix + '-log-pc_align-001.txt', 'w') as log:
+    log.write('[ asp INFO ] : Input: error percentile of smallest errors '
+              '(meters): 16%: 0.5, 50%: 1.5, 84%: 4.2\\n')
+    log.write('[ asp INFO ] : Output: error percentile of smallest errors '
+              '(meters): 16%: 0.1, 50%: 0.3, 84%: 0.9\\n')
+    log.write('[ asp INFO ] : Translation vector (North-East-Down, meters): '
+              'Vector3(1.25,-2.5,0.75)\\n')
+    log.write('[ asp INFO ] : Translation vector magnitude (meters): '
+              '2.894\\n')
+with open(prefix + '-trans_source.tif', 'w') as ts:
+    ts.write('points')
+"""
+
+FAKE_POINT2DEM = """#!{python}
+import sys
+args = sys.argv[1:]
+prefix = args[args.index('-o') + 1]
+with open(prefix + '-DEM.tif', 'w') as dem:
+    dem.write('dem')
+"""
+
+
+def _executable(path, content):
+    path.write_text(content.format(python=sys.executable))
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+
+    return str(path)
+
+
+@pytest.fixture
+def batch(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    monkeypatch.setattr(pc_align_batch, 'PC_ALIGN',
+                        _executable(bin_dir / 'pc_align', FAKE_PC_ALIGN))
+    monkeypatch.setattr(pc_align_batch, 'POINT2DEM',
+                        _executable(bin_dir / 'point2dem', FAKE_POINT2DEM))
+    monkeypatch.setattr(pc_align_batch, 'dem_res_nodata',
+                        lambda dem: (2.0, -9999.0))
+
+    dem_dir = tmp_path / 'dems'
+    dem_dir.mkdir()
+    dems = {}
+    for name in ['ref', 'src1', 'src2', 'bad']:
+        dems[name] = dem_dir / '{}.tif'.format(name)
+        dems[name].write_text(name)
+    manifest = tmp_path / 'manifest.csv'
+    pd.DataFrame({'reference': [str(dems['ref'])] * 3,
+                  'source': [str(dems[s]) for s in ['src1', 'src2', 'bad']],
+                  'name': ['src1', 'src2', 'bad']}).to_csv(manifest,
+                                                           index=False)
+
+    return manifest, tmp_path / 'out', dems
+
+
+def _calls(out_dir, name):
+    calls = out_dir / '{}.calls'.format(name)
+    if not calls.exists():
+        return 0
+    return len(calls.read_text().splitlines())
+
+
+def test_parse_pc_align_log(tmp_path):
+    log = tmp_path / 'log.txt'
+    log.write_text('Translation vector (North-East-Down, meters): '
+                   'Vector3(1e-2,-3,4.5)\n'
+                   'Translation vector magnitude (meters): 5.4\n')
+    results = pc_align_batch.parse_pc_align_log(log)
+    assert results == {'trans_north': 0.01, 'trans_east': -3.0,
+                       'trans_down': 4.5, 'trans_magnitude': 5.4}
+
+
+def test_align_batch(batch):
+    manifest, out_dir, dems = batch
+    results = pc_align_batch.align_batch(manifest, str(out_dir), jobs=2,
+                                         threads=3)
+    results = results.set_index('name')
+
+    assert list(results['status']) == ['ran', 'ran', 'failed']
+    assert results.loc['src1', 'trans_north'] == 1.25
+    assert results.loc['src1', 'output_err_50'] == 0.3
+    assert os.path.exists(results.loc['src2', 'out_dem'])
+    assert '--threads 3' in (out_dir / 'src1.calls').read_text()
+    table = pd.read_csv(out_dir / pc_align_batch.RESULTS_NAME)
+    assert len(table) == 3
+
+
+def test_align_batch_skips_current(batch):
+    manifest, out_dir, dems = batch
+    pc_align_batch.align_batch(manifest, str(out_dir))
+
+    # Second run only retries the failed pair
+    results = pc_align_batch.align_batch(manifest, str(out_dir))
+    assert list(results['status']) == ['cached', 'cached', 'failed']
+    assert results['trans_east'].iloc[0] == -2.5
+    assert _calls(out_dir, 'src1') == 1
+    assert _calls(out_dir, 'bad') == 2
+
+    # Changed parameters or inputs realign
+    results = pc_align_batch.align_batch(manifest, str(out_dir),
+                                         max_diff=20)
+    assert list(results['status']) == ['ran', 'ran', 'failed']
+    dems['src1'].write_text('changed')
+    results = pc_align_batch.align_batch(manifest, str(out_dir),
+                                         max_diff=20)
+    assert list(results['status']) == ['ran', 'cached', 'failed']
+    assert _calls(out_dir, 'src1') == 3
+
+
+def test_align_batch_dryrun(batch):
+    manifest, out_dir, dems = batch
+    results = pc_align_batch.align_batch(manifest, str(out_dir), dryrun=True)
+
+    assert list(results['status']) == ['pending'] * 3
+    assert not out_dir.exists()
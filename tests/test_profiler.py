@@ -0,0 +1,61 @@
+"""
+Tests for misc_utils.profiler stage records.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from misc_utils.pipeline import Pipeline
+from misc_utils.profiler import stage, in_current_stage, current_stage, \
+    read_telemetry
+
+
+def test_nested_stages(tmp_path):
+    path = str(tmp_path / 'telemetry.jsonl')
+    with stage('outer', path=path, n=3):
+        assert current_stage() == 'outer'
+        with stage('inner', path=path):
+            pass
+    assert current_stage() is None
+
+    records = read_telemetry(path).set_index('stage')
+    assert records.loc['inner', 'parent'] == 'outer'
+    assert records.loc['outer', 'parent'] is None
+    assert records.loc['outer', 'n'] == 3
+
+
+def test_stages_in_threads(tmp_path):
+    path = str(tmp_path / 'telemetry.jsonl')
+
+    def work(i):
+        with stage('work_{}'.format(i), path=path):
+            pass
+
+    with stage('outer', path=path):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(in_current_stage(work), range(2)))
+            # Without wrapping, the worker threads have no open stage
+            executor.submit(work, 2).result()
+
+    records = read_telemetry(path).set_index('stage')
+    assert records.loc['work_0', 'parent'] == 'outer'
+    assert records.loc['work_1', 'parent'] == 'outer'
+    assert records.loc['work_2', 'parent'] is None
+
+
+def test_pipeline_stages(tmp_path, monkeypatch):
+    path = str(tmp_path / 'telemetry.jsonl')
+    monkeypatch.setenv('TELEMETRY_PATH', path)
+
+    def step():
+        with stage('tool'):
+            pass
+
+    pipeline = Pipeline(tmp_path / 'cache.json', max_workers=2)
+    pipeline.add('a', step)
+    pipeline.add('b', step)
+    with stage('run'):
+        pipeline.run()
+
+    records = read_telemetry(path)
+    assert set(records[records['stage'].isin(['a', 'b'])]['parent']) == \
+        {'run'}
+    assert set(records[records['stage'] == 'tool']['parent']) == {'a', 'b'}
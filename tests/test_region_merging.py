@@ -0,0 +1,150 @@
+"""
+Tests for obia_utils.region_merging, checking RegionMerger against a brute
+force merge of a label array that recomputes every object's values,
+neighbors and candidacy from the pixels after every merge.
+"""
+import operator
+
+import numpy as np
+import pytest
+
+from obia_utils.region_merging import RegionMerger
+
+N_SIDE = 24
+WITHIN = 0.25
+ADJ_THRESHOLD = 0.6
+VALUE_FIELDS = {'mean': 'mean', 'max': 'max'}
+GROW_FIELDS = ['mean', 'max']
+
+
+def stats(image, labels, i):
+    values = image[labels == i]
+    return {'mean': values.mean(), 'max': values.max()}
+
+
+def neighbors(labels):
+    """{label: set of 4-connected neighbor labels}"""
+    nebs = {int(i): set() for i in np.unique(labels)}
+    for a, b in [(labels[:, :-1], labels[:, 1:]),
+                 (labels[:-1], labels[1:])]:
+        edge = a != b
+        for x, y in zip(a[edge], b[edge]):
+            nebs[int(x)].add(int(y))
+            nebs[int(y)].add(int(x))
+
+    return nebs
+
+
+def meets_rule(values, nebs, i):
+    """Merge candidate rule: any neighbor has a high mean."""
+    return any([values[n]['mean'] > ADJ_THRESHOLD for n in nebs[i]])
+
+
+def synthetic(seed):
+    """Rectangular objects of varied sizes, labelled 0 to n - 1 in row major
+    order, a random image, the merge candidates and random seeds."""
+    rng = np.random.default_rng(seed)
+    xs = np.sort(rng.choice(np.arange(1, N_SIDE), 7, replace=False))
+    ys = np.sort(rng.choice(np.arange(1, N_SIDE), 7, replace=False))
+    col = np.searchsorted(xs, np.arange(N_SIDE), side='right')
+    row = np.searchsorted(ys, np.arange(N_SIDE), side='right')
+    labels = row[:, np.newaxis] * (len(xs) + 1) + col[np.newaxis, :]
+    image = rng.random((N_SIDE, N_SIDE))
+    ids = [int(i) for i in np.unique(labels)]
+    values = {i: stats(image, labels, i) for i in ids}
+    nebs = neighbors(labels)
+    candidates = {i: meets_rule(values, nebs, i) for i in ids}
+    seeds = {i: bool(s) for i, s in zip(ids, rng.random(len(ids)) < 0.7)}
+
+    return labels, image, candidates, seeds
+
+
+def brute_force_merge(labels, image, candidates, seeds, max_iter):
+    """Merge the smallest growable object into its closest mergeable
+    neighbor, one merge at a time, recomputing everything from the
+    pixels."""
+    labels = labels.copy()
+    ids = [int(i) for i in np.unique(labels)]
+    # Objects merged away keep their last values, as their rows do in
+    # ImageObjects
+    values = {i: stats(image, labels, i) for i in ids}
+    candidates = dict(candidates)
+    seeds = dict(seeds)
+    mergeable = {i: True for i in ids}
+    absorbed = {i: 0 for i in ids}
+
+    def can_grow(i):
+        return (mergeable[i] and candidates[i] and seeds[i] and
+                absorbed[i] < max_iter)
+
+    while True:
+        growable = [i for i in ids if can_grow(i)]
+        if not growable:
+            break
+        i = min(growable, key=lambda g: ((labels == g).sum(), ids.index(g)))
+        nebs = neighbors(labels)
+        stds = {gf: np.std([values[k][gf] for k in ids], ddof=1)
+                for gf in GROW_FIELDS}
+        matches = [n for n in nebs[i] if mergeable[n] and candidates[n] and
+                   abs(values[i]['mean'] - values[n]['mean']) <= WITHIN]
+        if matches:
+            j = min(matches, key=lambda n: sum(
+                [abs(values[i][gf] - values[n][gf]) / stds[gf]
+                 for gf in GROW_FIELDS]))
+            labels[labels == i] = j
+            values[j] = stats(image, labels, j)
+            absorbed[j] += absorbed[i] + 1
+            seeds[j] = True
+            nebs = neighbors(labels)
+            for k in nebs:
+                if mergeable[k] and meets_rule(values, nebs, k):
+                    candidates[k] = True
+        mergeable[i] = False
+        candidates[i] = False
+
+    return labels, values
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('max_iter', [2, 100])
+def test_matches_brute_force(seed, max_iter):
+    labels, image, candidates, seeds = synthetic(seed)
+    ids = [int(i) for i in np.unique(labels)]
+    merger = RegionMerger(
+        records={i: stats(image, labels, i) for i in ids},
+        neighbors=neighbors(labels),
+        areas={i: int((labels == i).sum()) for i in ids},
+        value_fields=VALUE_FIELDS,
+        grow_fields=GROW_FIELDS,
+        merge_candidates=dict(candidates),
+        seeds=dict(seeds),
+        merge_candidate_rules=[{'rule_type': 'adjacent', 'in_field': 'mean',
+                                'op': operator.gt,
+                                'threshold': ADJ_THRESHOLD}],
+        pairwise_criteria=[{'within': {'field': 'mean', 'range': WITHIN}}],
+        max_iter=max_iter)
+    merger.run()
+
+    expected, values = brute_force_merge(labels, image, candidates, seeds,
+                                         max_iter)
+    assert merger.num_merges > 0
+    assert merger.num_merges == len(ids) - len(np.unique(expected))
+
+    # Merge paths give the merged labels
+    merged = labels.copy()
+    for j, path in merger.merge_paths.items():
+        for i in path:
+            merged[labels == i] = j
+    np.testing.assert_array_equal(merged, expected)
+
+    # Aggregated values and areas of remaining objects match the pixels
+    for j in np.unique(expected):
+        j = int(j)
+        assert merger.areas[j] == (expected == j).sum()
+        for vf in VALUE_FIELDS:
+            assert merger.records[j][vf] == pytest.approx(values[j][vf])
+
+    # Neighbor sets are contracted, objects merged away have none
+    expected_nebs = neighbors(expected)
+    for i in ids:
+        assert merger.neighbors[i] == expected_nebs.get(i, set())
@@ -0,0 +1,135 @@
+"""
+Tests for obia_utils.rule_engine, checking compiled rule evaluation against
+evaluating each rule for each object in turn.
+"""
+import operator
+
+import numpy as np
+import geopandas as gpd
+import pytest
+from shapely.geometry import box
+
+from obia_utils.neighbor_graph import NeighborGraph
+from obia_utils.rule_engine import compile_rules, RulePlan
+
+N_SIDE = 12
+
+
+@pytest.fixture
+def objects():
+    rng = np.random.default_rng(0)
+    geoms = [box(i, j, i + 1, j + 1)
+             for i in range(N_SIDE) for j in range(N_SIDE)]
+    n = len(geoms)
+    slope = rng.uniform(0, 30, n)
+    slope[rng.choice(n, 10, replace=False)] = np.nan
+    objects = gpd.GeoDataFrame({'slope': slope,
+                                'ndvi': rng.uniform(-0.2, 0.6, n),
+                                'flag': rng.choice([True, False, None], n)},
+                               geometry=geoms)
+    objects.index = objects.index * 10
+
+    return objects
+
+
+def _meets(op, value, threshold):
+    if value is None or value != value:
+        return False
+    return bool(op(value, threshold))
+
+
+def _reference(objects, graph, rule):
+    """Evaluate rule for each object in turn."""
+    results = []
+    for label, row in objects.iterrows():
+        is_result = _meets(rule['op'], row[rule['in_field']],
+                           rule['threshold'])
+        if rule['rule_type'] == 'threshold':
+            results.append(is_result)
+            continue
+        adj_result = any(_meets(rule['op'],
+                                objects.at[n, rule['in_field']],
+                                rule['threshold'])
+                         for n in graph.neighbors(label))
+        if rule.get('src_field'):
+            adj_result = adj_result and _meets(rule['src_op'],
+                                               row[rule['src_field']],
+                                               rule['src_thresh'])
+        if rule['rule_type'] == 'adjacent_or_is':
+            adj_result = adj_result or is_result
+        results.append(adj_result)
+
+    return np.array(results)
+
+
+RULES = [{'rule_type': 'threshold', 'in_field': 'slope',
+          'op': operator.gt, 'threshold': 10},
+         {'rule_type': 'threshold', 'in_field': 'slope',
+          'op': operator.ne, 'threshold': 10},
+         {'rule_type': 'threshold', 'in_field': 'flag',
+          'op': operator.eq, 'threshold': True},
+         {'rule_type': 'adjacent', 'in_field': 'slope',
+          'op': operator.gt, 'threshold': 25},
+         {'rule_type': 'adjacent_or_is', 'in_field': 'ndvi',
+          'op': operator.lt, 'threshold': -0.15},
+         {'rule_type': 'adjacent', 'in_field': 'ndvi',
+          'op': operator.gt, 'threshold': 0.5,
+          'src_field': 'slope', 'src_op': operator.lt, 'src_thresh': 15}]
+
+
+def test_evaluate(objects):
+    graph = NeighborGraph(objects)
+    plan = compile_rules(RULES)
+    results = plan.evaluate(objects, graph)
+
+    assert results.shape == (len(objects), len(RULES))
+    for i, rule in enumerate(RULES):
+        np.testing.assert_array_equal(results[:, i],
+                                      _reference(objects, graph, rule))
+
+
+def test_shared_comparisons():
+    rules = [dict(RULES[0]), dict(RULES[0], rule_type='adjacent'),
+             dict(RULES[0], rule_type='adjacent_or_is')]
+    plan = compile_rules(rules)
+
+    assert len(plan.comparisons) == 1
+    assert plan.adjacent == [0]
+    assert compile_rules(plan) is plan
+
+
+def test_graph_order(objects):
+    # Graph built with objects in a different order
+    graph = NeighborGraph(objects.iloc[::-1])
+    results = compile_rules(RULES).evaluate(objects, graph)
+
+    for i, rule in enumerate(RULES):
+        np.testing.assert_array_equal(results[:, i],
+                                      _reference(objects, graph, rule))
+
+
+def test_errors(objects):
+    with pytest.raises(ValueError):
+        RulePlan([dict(RULES[0], rule_type='nearby')])
+    with pytest.raises(KeyError):
+        compile_rules([dict(RULES[0], in_field='missing')]).evaluate(objects)
+    with pytest.raises(ValueError):
+        compile_rules(RULES).evaluate(objects)
+
+
+@pytest.mark.parametrize('n', [128, 256, 300])
+def test_hub_object(n):
+    # A long object with n small objects along its top edge, all of which
+    # meet the comparison
+    geoms = [box(0, 0, n, 1)] + [box(i, 1, i + 1, 2) for i in range(n)]
+    objects = gpd.GeoDataFrame({'slope': [0.0] + [20.0] * n},
+                               geometry=geoms)
+    graph = NeighborGraph(objects)
+    rules = [{'rule_type': 'adjacent', 'in_field': 'slope',
+              'op': operator.gt, 'threshold': 10},
+             {'rule_type': 'adjacent_or_is', 'in_field': 'slope',
+              'op': operator.lt, 'threshold': 10}]
+    results = compile_rules(rules).evaluate(objects, graph)
+
+    assert results[0, 0]
+    assert results[:, 1].all()
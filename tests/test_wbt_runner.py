@@ -0,0 +1,141 @@
+"""
+Tests for dem_utils.wbt_runner, using a fake whitebox_tools executable
+that writes the outputs the real tools would.
+"""
+import stat
+import sys
+
+import pytest
+
+from dem_utils import wbt_runner
+from dem_utils.wbt_runner import Derivative, run_derivatives
+
+FAKE_WBT = """#!{python}
+import os
+import sys
+args = dict(a.lstrip('-').split('=', 1) for a in sys.argv[1:] if '=' in a)
+with open(os.path.join({calls_dir!r}, 'calls.txt'), 'a') as calls:
+    calls.write(' '.join(sys.argv[1:]) + '\\n')
+if args['r'] == 'Failing':
+    print('Error: tool failed')
+    sys.exit(1)
+for out in ['output', 'out_mag', 'out_scale']:
+    if out in args:
+        with open(args[out], 'w') as dst:
+            dst.write(args['r'])
+"""
+
+
+@pytest.fixture
+def wbt(tmp_path, monkeypatch):
+    exe = tmp_path / 'whitebox_tools'
+    exe.write_text(FAKE_WBT.format(python=sys.executable,
+                                   calls_dir=str(tmp_path)))
+    exe.chmod(exe.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setattr(wbt_runner, 'WBT', str(exe))
+    dem = tmp_path / 'dem.tif'
+    dem.write_text('dem')
+
+    return dem, tmp_path / 'out', tmp_path / 'calls.txt'
+
+
+def _derivatives(out_dir, step=5):
+    return [Derivative('sar', 'SurfaceAreaRatio',
+                       {'output': out_dir / 'sar.tif'}),
+            Derivative('curv', 'ProfileCurvature',
+                       {'output': out_dir / 'curv.tif'}),
+            Derivative('med', 'MaxElevationDeviation',
+                       {'out_mag': out_dir / 'med_mag.tif',
+                        'out_scale': out_dir / 'med_scl.tif',
+                        'min_scale': 1, 'max_scale': 50, 'step': step})]
+
+
+def _calls(calls, tool=None):
+    if not calls.exists():
+        return []
+    return [c for c in calls.read_text().splitlines()
+            if tool is None or '-r={} '.format(tool) in c]
+
+
+def test_run_derivatives(wbt):
+    dem, out_dir, calls = wbt
+    report = run_derivatives(dem, _derivatives(out_dir), threads=6)
+
+    assert list(report['status']) == ['ran', 'ran', 'ran']
+    assert list(report['threads']) == [2, 2, 2]
+    assert (out_dir / 'med_mag.tif').read_text() == 'MaxElevationDeviation'
+    assert (out_dir / 'med_scl.tif').exists()
+    med_call = _calls(calls, 'MaxElevationDeviation')[0]
+    assert '--dem={}'.format(dem) in med_call
+    assert '--step=5' in med_call
+    assert '--max_procs=2' in med_call
+
+
+def test_run_derivatives_cached(wbt):
+    dem, out_dir, calls = wbt
+    run_derivatives(dem, _derivatives(out_dir), threads=3)
+
+    # Same DEM and parameters, nothing is run
+    report = run_derivatives(dem, _derivatives(out_dir), threads=3)
+    assert list(report['status']) == ['cached', 'cached', 'cached']
+    assert len(_calls(calls)) == 3
+
+    # Changed parameters rerun only that tool, with all the threads
+    report = run_derivatives(dem, _derivatives(out_dir, step=10), threads=3)
+    assert list(report['status']) == ['cached', 'cached', 'ran']
+    assert '--max_procs=3' in _calls(calls, 'MaxElevationDeviation')[-1]
+
+    # Changed DEM reruns everything
+    dem.write_text('new dem')
+    report = run_derivatives(dem, _derivatives(out_dir, step=10), threads=3)
+    assert list(report['status']) == ['ran', 'ran', 'ran']
+    assert len(_calls(calls)) == 7
+
+    # Removed outputs are recreated
+    (out_dir / 'sar.tif').unlink()
+    report = run_derivatives(dem, _derivatives(out_dir, step=10), threads=3)
+    assert list(report['status']) == ['ran', 'cached', 'cached']
+
+
+def test_run_derivatives_failure(wbt):
+    dem, out_dir, calls = wbt
+    derivatives = _derivatives(out_dir) + [
+        Derivative('bad', 'Failing', {'output': out_dir / 'bad.tif'})]
+    report = run_derivatives(dem, derivatives, threads=4).set_index('name')
+
+    assert report.loc['bad', 'status'] == 'failed'
+    assert 'Failing' in report.loc['bad', 'error']
+    assert report.loc['sar', 'status'] == 'ran'
+
+    # Failed tools are retried, others are not
+    report = run_derivatives(dem, derivatives, threads=4).set_index('name')
+    assert report.loc['sar', 'status'] == 'cached'
+    assert len(_calls(calls, 'Failing')) == 2
+
+
+def test_run_derivatives_dryrun(wbt):
+    dem, out_dir, calls = wbt
+    report = run_derivatives(dem, _derivatives(out_dir), dryrun=True)
+
+    assert list(report['status']) == ['pending'] * 3
+    assert not calls.exists()
+    assert not out_dir.exists()
+
+
+def test_run_derivatives_invalid(wbt):
+    dem, out_dir, calls = wbt
+    with pytest.raises(ValueError):
+        run_derivatives(dem, [])
+    with pytest.raises(ValueError):
+        run_derivatives(dem, [Derivative('sar', 'SurfaceAreaRatio',
+                                         {'zfactor': 1})])
+
+
+def test_wbt_sar(wbt):
+    from dem_utils.wbt_sar import wbt_sar
+    dem, out_dir, calls = wbt
+    out_dir.mkdir()
+    out_sar = wbt_sar(dem, out_dir=out_dir, threads=2)
+
+    assert out_sar.read_text() == 'SurfaceAreaRatio'
+    assert '--max_procs=2' in _calls(calls)[0]
@@ -0,0 +1,73 @@
+"""
+Tests for obia_utils.zonal_engine, checking statistics accumulated block by
+block against statistics computed for each object directly with numpy.
+"""
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+
+from obia_utils.zonal_engine import ZonalAccumulator, ENGINE_STATS
+
+NUM_LABELS = 6
+
+REFERENCE = {'count': len,
+             'sum': np.sum,
+             'mean': np.mean,
+             'min': np.min,
+             'max': np.max,
+             'std': np.std,
+             'range': np.ptp}
+
+
+@pytest.fixture
+def raster():
+    """Random labels (0 is background, the last label has no pixels) and
+    values, with some invalid (NaN) values."""
+    rng = np.random.default_rng(0)
+    labels = rng.integers(0, NUM_LABELS, (50, 70))
+    values = rng.normal(100, 20, labels.shape).astype(np.float32)
+    values[rng.random(labels.shape) < 0.1] = np.nan
+
+    return labels, values
+
+
+def accumulate(labels, values, block_size):
+    acc = ZonalAccumulator(NUM_LABELS)
+    for y in range(0, labels.shape[0], block_size):
+        for x in range(0, labels.shape[1], block_size):
+            block_labels = labels[y:y + block_size, x:x + block_size]
+            block_values = values[y:y + block_size, x:x + block_size]
+            keep = (block_labels > 0) & ~np.isnan(block_values)
+            acc.add(block_labels[keep], block_values[keep])
+
+    return acc
+
+
+@pytest.mark.parametrize('block_size', [7, 16, 100])
+def test_matches_numpy(raster, block_size):
+    labels, values = raster
+    acc = accumulate(labels, values, block_size)
+
+    for stat in ENGINE_STATS:
+        result = acc.stat(stat)
+        assert len(result) == NUM_LABELS
+        for label in range(1, NUM_LABELS + 1):
+            label_values = values[(labels == label) & ~np.isnan(values)]
+            label_values = label_values.astype(np.float64)
+            if len(label_values) == 0:
+                if stat == 'count':
+                    assert result[label - 1] == 0
+                else:
+                    assert np.isnan(result[label - 1])
+                continue
+            assert result[label - 1] == pytest.approx(
+                REFERENCE[stat](label_values), rel=1e-9)
+
+
+def test_unsupported_stat(raster):
+    labels, values = raster
+    acc = accumulate(labels, values, 16)
+
+    with pytest.raises(ValueError):
+        acc.stat('median')
@@ -1,12 +1,11 @@
 import argparse
 import os
 from pathlib import Path
-import shutil
 
 import geopandas as gpd
-from tqdm import tqdm
 
 from misc_utils.logging_utils import create_logger
+from misc_utils.transfer import transfer_files, COPY, LINK, JOURNAL_NAME
 
 logger = create_logger(__name__, 'sh', 'INFO')
 
@@ -25,22 +24,18 @@ tm_copy = 'copy'
 tm_link = 'link'
 
 
-def move_scene_files(generator_obj, dst_par_dir, opf_values, tm=tm_copy, dryrun=False):
-    for f in generator_obj:
-        dst_dir = dst_par_dir
-        for ov in opf_values:
-            dst_dir = dst_dir / ov
-        logger.debug('Copying {} -> {}'.format(f, dst_dir))
-        if not dryrun:
-            if not dst_dir.exists():
-                os.makedirs(dst_dir)
-            if tm == tm_copy:
-                shutil.copy2(f, dst_dir)
-            elif tm == tm_link:
-                os.link(f, dst_dir)
+def scene_file_pairs(generator_obj, dst_par_dir, opf_values):
+    """(source, destination) for each scene file, in subdirectories of
+    dst_par_dir named by opf_values."""
+    dst_dir = Path(dst_par_dir)
+    for ov in opf_values:
+        dst_dir = dst_dir / str(ov)
 
+    return [(f, dst_dir / f.name) for f in generator_obj]
 
-def move_scenes(footprint_p, src_par_dir, dst_par_dir, opfs, tm):
+
+def move_scenes(footprint_p, src_par_dir, dst_par_dir, opfs, tm=tm_copy,
+                dryrun=False):
     # Read footprint
     logger.info('Reading footprint of scenes to move.')
     footprint = gpd.read_file(footprint_p)
@@ -48,19 +43,21 @@ def move_scenes(footprint_p, src_par_dir, dst_par_dir, opfs, tm):
 
     # Find scene files - puts a list of scene files into each row
     logger.info('Finding associated scene files...')
+    src_par_dir = Path(src_par_dir)
     footprint[f_scene_files] = footprint[f_sid].apply(lambda x: src_par_dir.rglob('{}*'.format(x)))
 
     # Move scene files
     logger.info('Moving scene files...')
-    pbar = tqdm(footprint.iterrows(), total=len(footprint))
-    for i, row in pbar:
-        pbar.set_description("Moving scene files for: {}".format(row[f_sid]))
-        move_scene_files(row[f_scene_files],
-                         dst_par_dir=dst_par_dir,
-                         opf_values=[row[opf] for opf in opfs],
-                         tm=tm,
-                         dryrun=True)
-
+    pairs = []
+    for i, row in footprint.iterrows():
+        pairs.extend(scene_file_pairs(row[f_scene_files],
+                                      dst_par_dir=dst_par_dir,
+                                      opf_values=[row[opf] for opf in opfs]))
+    journal = None if dryrun else os.path.join(dst_par_dir, JOURNAL_NAME)
+    results = transfer_files(pairs, method=LINK if tm == tm_link else COPY,
+                             journal=journal, dryrun=dryrun)
+
+    return results
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -1,14 +1,12 @@
 import argparse
-import time
 import glob
 import os
 import re
-import shutil
 
 import geopandas as gpd
-from tqdm import tqdm
 
 from misc_utils.logging_utils import create_logger
+from misc_utils.transfer import transfer_files, COPY, SYMLINK, JOURNAL_NAME
 
 logger = create_logger(__name__, 'sh', 'DEBUG')
 
@@ -59,24 +57,11 @@ def move_scenes_by_fps(src_dir, dst_par_dir, imagery_base_dir,
         fp_moves = [(src, os.path.join(dst_dir, os.path.basename(src))) for src in fp_srcs]
         all_moves.extend(fp_moves)
 
-    # Perform moves
-    pbar = tqdm(total=len(all_moves), desc='Copying files')
-    for (s, d) in all_moves:
-        if os.path.exists(d):
-            pbar.write('Destination exists, skipping: {}'.format(s))
-            continue
-        if not os.path.exists(os.path.dirname(d)):
-            os.makedirs(os.path.dirname(d))
-        if link:
-            pbar.write('Linking: {} -> {}'.format(s, d))
-            # time.sleep(0.1)
-            os.symlink(s, d)
-        else:
-            pbar.write('Copying: {} -> {}'.format(s, d))
-            # time.sleep(0.1)
-            shutil.copy(s, d)
-        pbar.update(1)
+    # Perform moves, skipping destinations that are up to date
+    results = transfer_files(all_moves, method=SYMLINK if link else COPY,
+                             journal=os.path.join(dst_par_dir, JOURNAL_NAME))
 
+    return results
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -11,10 +11,14 @@ import logging
 from pathlib import Path
 import warnings
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 from shapely.geometry import box
 
+from archive_analysis.grid_count import footprint_counts
+from misc_utils.gpd_utils import sindex_pairs
+
 # To ignore pandas warning about joining with multi-indexes
 warnings.simplefilter(action='ignore', category=UserWarning)
 
@@ -33,10 +37,8 @@ def get_count(geocells, fps, centroid=False, count_field='count',
               date_col=None):
     '''
     Gets the count of features in fps that intersect with each feature
-    in geocells. This method is essentially a many to many spatial join,
-    so if two footprints overlaps a grid cell, there will be two of that
-    grid cell in the resulting dataframe. These repeated cells are then
-    counted and saved to the returned dataframe
+    in geocells. Footprints are matched to geocells with a bulk spatial
+    index query, see archive_analysis.grid_count.footprint_counts.
 
     Parameters
     ----------
@@ -64,39 +66,16 @@ def get_count(geocells, fps, centroid=False, count_field='count',
         logger.info('Converting crs of grid to match footprint...')
         geocells = geocells.to_crs(fps.crs)
 
-    logger.info('Performing spatial join...')
-    # Get a column from fps to use to test if sjoin found matches
-    fp_col = fps.columns[0]
-    if centroid:
-        sj = gpd.sjoin(geocells, fps.set_geometry(fps.centroid), how='left',
-                       op='intersects')
-    else:
-        sj = gpd.sjoin(geocells, fps, how='left', op='intersects')
-    sj.index.name = count_field
-    sj.reset_index(inplace=True)
-
-    # Remove no matches, group the rest, counting the index, and get minimum
-    # and maximum dates if requested
     logger.info('Getting count...')
-    agg = {count_field: 'count'}
+    gb = footprint_counts(geocells, fps, date_col=date_col,
+                          centroid=centroid, count_field=count_field)
     if date_col:
-        agg[date_col] = ['min', 'max']
-
-    gb = sj[~sj[fp_col].isna()].groupby(count_field).agg(agg)
+        gb.columns = [count_field, (date_col, 'min'), (date_col, 'max')]
 
     ## Join geocells to dataframe with counts
     out = pd.merge(geocells, gb, left_index=True, right_index=True,
                    how='outer')
 
-    if date_col:
-        # If date aggregation was done, count column will be tuple:
-        # (count_field: 'count') due to multi-index in gb, so rename back to
-        # just count_field
-        out.rename(columns={(count_field, 'count'): count_field}, inplace=True)
-
-    # Replace NaN with 0
-    out[count_field] = out[count_field].fillna(0)
-
     out = gpd.GeoDataFrame(out, geometry=out.geometry, crs=geocells.crs)
 
     return out
@@ -167,8 +146,8 @@ def calculate_density(grid_path, footprint_path, out_path=None,
     if check_overlap:
         # Reduce to only footprints that overlap grid cells.
         logger.info('Removing any non-overlapping footprints...')
-        footprint = footprint[footprint.index.isin(
-            gpd.overlay(footprint, grid).index)]
+        _, overlapping = sindex_pairs(grid, footprint, predicate='intersects')
+        footprint = footprint.iloc[np.unique(overlapping)]
         logger.info('Remaining footprints: {:,}'.format(len(footprint)))
 
     logger.info('Calculating density...')